@@ -15,5 +15,6 @@ setup(name="vlab-superna-api",
       package_files={'vlab_superna_api' : ['app.ini']},
       description="superna",
       install_requires=['flask', 'ldap3', 'pyjwt', 'uwsgi', 'vlab-api-common',
-                        'ujson', 'cryptography', 'vlab-inf-common', 'celery']
+                        'ujson', 'cryptography', 'vlab-inf-common', 'celery'],
+      extras_require={'redis': ['redis']},
       )
@@ -0,0 +1,225 @@
+# -*- coding: UTF-8 -*-
+"""
+Measures the worker's show, create and delete against the vCenter simulator.
+
+For each task type this reports the p50/p99/mean latency of a call, the
+round trips to vCenter per call, and the calls per second. Long polls
+(``WaitForUpdatesEx``) are reported separately from the round trips.
+
+Run it with::
+
+  python -m tests.benchmark --users 50 --vms 20 --latency 0.005
+
+Only the (in-process) simulator is used, so there's no network involved. Create
+uses the "template" deploy mode; importing an OVA needs a real ESXi host to
+upload the disks to.
+"""
+import ssl
+import sys
+import math
+import time
+import logging
+import argparse
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import ujson
+
+from vlab_superna_api.lib import const
+from vlab_superna_api.lib.ttl_cache import SharedTTLCache
+from vlab_superna_api.lib.worker import admission, folders, networks, session_pool, templates, vmware, waiter, warm_pool
+from tests.vcsim import VCenterSim, IMAGE, IMAGE_INFO
+
+OPERATIONS = ('show', 'create', 'delete')
+IP_CONFIG = {'static-ip': '10.7.7.7', 'netmask': '255.255.255.0', 'default-gateway': '10.7.7.1', 'dns': ['10.7.7.2']}
+LOGGER = logging.getLogger('vcsim-benchmark')
+
+
+class _Catalog(object):
+    """Stands in for ``image_catalog.CATALOG``, so no OVA files are needed"""
+    def get(self, version):
+        return dict(IMAGE_INFO) if version == IMAGE else None
+
+    def images(self):
+        return {IMAGE: dict(IMAGE_INFO)}
+
+    def versions(self):
+        return [IMAGE]
+
+
+@contextlib.contextmanager
+def simulated(sim):
+    """Point the worker at the simulator, with fresh (empty) per-process caches
+
+    :Returns: None
+
+    :param sim: The simulated vCenter
+    :type sim: tests.vcsim.VCenterSim
+    """
+    settings = const._replace(VLAB_SUPERNA_BOOT_SETTLE=0,
+                              VLAB_SUPERNA_DEPLOY_MODE='template',
+                              VLAB_SUPERNA_WARM_POOL_SIZE=0,
+                              VLAB_SUPERNA_WARM_POOL_SIZES='')
+    the_waiter = waiter.Waiter(factory=sim.login)
+    with contextlib.ExitStack() as stack:
+        slots = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.enter_context(patch.object(admission, 'ADMISSION', admission.Admission(url='file://{}'.format(slots))))
+        stack.enter_context(patch.object(session_pool, 'SESSIONS', session_pool.SessionPool(factory=sim.login)))
+        stack.enter_context(patch.object(waiter, 'WAITER', the_waiter))
+        stack.enter_context(patch.object(folders, 'USER_FOLDERS', folders.UserFolders()))
+        stack.enter_context(patch.object(networks, 'INDEX', networks.NetworkIndex()))
+        stack.enter_context(patch.object(vmware, 'SHOW_CACHE', SharedTTLCache(max_size=1, ttl=0, prefix='superna-show-')))
+        stack.enter_context(patch.object(vmware.image_catalog, 'CATALOG', _Catalog()))
+        stack.enter_context(patch.dict(templates._REGISTRY, clear=True))
+        stack.enter_context(patch.object(ssl, 'get_server_certificate', return_value=sim.certificate))
+        for module in (vmware, templates, waiter, warm_pool):
+            stack.enter_context(patch.object(module, 'const', settings))
+        try:
+            yield
+        finally:
+            the_waiter.close()
+
+
+def _call(operation, sim, index):
+    """Run one show, create or delete
+
+    :Returns: None
+
+    :param operation: Which task type to run; one of OPERATIONS
+    :type operation: String
+
+    :param sim: The simulated vCenter
+    :type sim: tests.vcsim.VCenterSim
+
+    :param index: Which call this is; picks the user and the name of the VM
+    :type index: Integer
+    """
+    username = sim.users[index % len(sim.users)]
+    machine_name = 'bench{}'.format(index)
+    if operation == 'show':
+        vmware.show_superna(username)
+    elif operation == 'create':
+        vmware.create_superna(username, machine_name, IMAGE, '{}_network0'.format(username), IP_CONFIG, LOGGER)
+    else:
+        vmware.delete_superna(username, machine_name, LOGGER)
+
+
+def percentile(values, pct):
+    """The nearest-rank percentile of some values
+
+    :Returns: Float
+
+    :param values: The values
+    :type values: List
+
+    :param pct: Which percentile, from 0 to 100
+    :type pct: Integer
+    """
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100.0 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def measure(operation, sim, calls, concurrency=1):
+    """Time ``calls`` runs of a task type, and count the round trips they made
+
+    :Returns: Dictionary
+
+    :param operation: Which task type to run; one of OPERATIONS
+    :type operation: String
+
+    :param sim: The simulated vCenter
+    :type sim: tests.vcsim.VCenterSim
+
+    :param calls: How many times to run it
+    :type calls: Integer
+
+    :param concurrency: How many to run at the same time
+    :type concurrency: Integer
+    """
+    def timed(index):
+        started = time.perf_counter()
+        _call(operation, sim, index)
+        return time.perf_counter() - started
+
+    trips = sim.round_trips()
+    waits = sim.calls['WaitForUpdatesEx']
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, range(calls)))
+    elapsed = time.perf_counter() - started
+    return {'calls': calls,
+            'concurrency': concurrency,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'mean': sum(latencies) / calls,
+            'throughput': calls / elapsed,
+            'round_trips': (sim.round_trips() - trips) / calls,
+            'waits': (sim.calls['WaitForUpdatesEx'] - waits) / calls}
+
+
+def run(sim, calls=20, concurrency=1):
+    """Benchmark every task type against a simulator. Each create makes a new VM
+    for a delete to destroy, so the inventory is the same size afterwards.
+
+    :Returns: Dictionary
+
+    :param sim: The simulated vCenter
+    :type sim: tests.vcsim.VCenterSim
+
+    :param calls: How many times to run each task type
+    :type calls: Integer
+
+    :param concurrency: How many calls to run at the same time
+    :type concurrency: Integer
+    """
+    with simulated(sim):
+        # Logging in, and filling the per-process caches, happens once per worker
+        _call('show', sim, 0)
+        return {x: measure(x, sim, calls, concurrency) for x in OPERATIONS}
+
+
+def report(results):
+    """Make a table out of the output of ``run``
+
+    :Returns: String
+    """
+    lines = ['{:<8}{:>8}{:>12}{:>12}{:>12}{:>10}{:>13}{:>8}'.format('task', 'calls', 'p50 ms', 'p99 ms',
+                                                                   'mean ms', 'calls/s', 'round trips', 'waits')]
+    for operation, stats in results.items():
+        lines.append('{:<8}{:>8}{:>12.2f}{:>12.2f}{:>12.2f}{:>10.1f}{:>13.1f}{:>8.1f}'.format(
+            operation, stats['calls'], stats['p50'] * 1000, stats['p99'] * 1000, stats['mean'] * 1000,
+            stats['throughput'], stats['round_trips'], stats['waits']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """The command line interface of the benchmark
+
+    :Returns: Integer
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10, help='How many users are in the inventory')
+    parser.add_argument('--vms', type=int, default=5, help='How many Superna VMs each user has')
+    parser.add_argument('--networks', type=int, default=2, help='How many port groups each user has')
+    parser.add_argument('--latency', type=float, default=0.002, help='Seconds per round trip to vCenter')
+    parser.add_argument('--task-duration', type=float, default=0.0, help='Seconds every vCenter task takes')
+    parser.add_argument('--boot-time', type=float, default=0.0, help='Seconds after power on until a VM has an IP')
+    parser.add_argument('--calls', type=int, default=20, help='How many times to run each task type')
+    parser.add_argument('--concurrency', type=int, default=1, help='How many calls to run at the same time')
+    parser.add_argument('--json', action='store_true', help='Output JSON instead of a table')
+    args = parser.parse_args(argv)
+    sim = VCenterSim(users=args.users, vms_per_user=args.vms, networks_per_user=max(args.networks, 1),
+                     latency=args.latency, task_duration=args.task_duration, boot_time=args.boot_time)
+    results = run(sim, calls=args.calls, concurrency=args.concurrency)
+    if args.json:
+        print(ujson.dumps(results, indent=2))
+    else:
+        print(report(results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the admission.py module
+"""
+import time
+import tempfile
+import unittest
+import threading
+from unittest.mock import patch, MagicMock
+
+from vlab_superna_api.lib.worker import admission
+
+
+class TestFileStore(unittest.TestCase):
+    """A set of test cases for the ``FileStore`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.store = admission.FileStore(self.tmpdir.name)
+
+    def test_first_come_first_served(self):
+        """FileStore - a ticket's place in line is the order it joined"""
+        self.store.join('host/esxi1', 'a', 100)
+        self.store.join('host/esxi1', 'b', 100)
+
+        self.assertEqual(self.store.poll('host/esxi1', 'b', 101, 60), 1)
+        self.assertEqual(self.store.poll('host/esxi1', 'a', 101, 60), 0)
+
+    def test_leave(self):
+        """FileStore - leaving moves everyone behind up in line"""
+        self.store.join('host/esxi1', 'a', 100)
+        self.store.join('host/esxi1', 'b', 100)
+        self.store.leave('host/esxi1', 'a')
+
+        self.assertEqual(self.store.poll('host/esxi1', 'b', 101, 60), 0)
+
+    def test_expired(self):
+        """FileStore - tickets nobody refreshed are forgotten"""
+        self.store.join('host/esxi1', 'a', 100)
+        self.store.join('host/esxi1', 'b', 150)
+
+        self.assertEqual(self.store.poll('host/esxi1', 'b', 200, 60), 0)
+        self.assertEqual(self.store.poll('host/esxi1', 'a', 200, 60), None)
+
+    def test_length(self):
+        """FileStore - ``length`` counts the tickets of a resource"""
+        self.store.join('host/esxi1', 'a', 100)
+        self.store.join('host/esxi1', 'b', 100)
+        self.store.join('host/esxi2', 'c', 100)
+
+        self.assertEqual(self.store.length('host/esxi1', 101, 60), 2)
+
+
+class TestMakeStore(unittest.TestCase):
+    """A set of test cases for the ``make_store`` function"""
+    def test_file(self):
+        """``make_store`` returns a FileStore for a file:// URL"""
+        output = admission.make_store('file:///tmp/slots')
+
+        self.assertTrue(isinstance(output, admission.FileStore))
+        self.assertEqual(output.directory, '/tmp/slots')
+
+    def test_redis(self):
+        """``make_store`` returns a RedisStore for a redis:// URL"""
+        output = admission.make_store('redis://localhost:6379/0')
+
+        self.assertTrue(isinstance(output, admission.RedisStore))
+
+    def test_unsupported(self):
+        """``make_store`` raises ValueError for an unsupported URL"""
+        with self.assertRaises(ValueError):
+            admission.make_store('ftp://localhost/slots')
+
+
+class TestAdmission(unittest.TestCase):
+    """A set of test cases for the ``Admission`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.admission = admission.Admission(url='file://{}'.format(self.tmpdir.name), interval=0.01)
+        self.logger = MagicMock()
+
+    def test_slots(self):
+        """Admission - a slot is free to take when nobody else holds it"""
+        with self.admission.slots([('datastore', 'ds1', 1), ('host', 'esxi1', 1)], self.logger):
+            held = self.admission.store.length('datastore/ds1', time.time(), 60)
+
+        self.assertEqual(held, 1)
+        self.assertEqual(self.admission.store.length('datastore/ds1', time.time(), 60), 0)
+        self.assertEqual(self.admission.stats()['admitted'], 1)
+
+    def test_no_limit(self):
+        """Admission - a limit of zero takes no slot"""
+        with self.admission.slots([('datastore', 'ds1', 0)], self.logger):
+            held = self.admission.store.length('datastore/ds1', time.time(), 60)
+
+        self.assertEqual(held, 0)
+
+    def test_waits(self):
+        """Admission - an import waits for a slot, and reports its place in line"""
+        report_progress = MagicMock()
+        taken = threading.Event()
+        release = threading.Event()
+
+        def holder():
+            with self.admission.slots([('host', 'esxi1', 1)], self.logger):
+                taken.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=holder)
+        thread.start()
+        taken.wait(5)
+        threading.Timer(0.1, release.set).start()
+        with self.admission.slots([('host', 'esxi1', 1)], self.logger, report_progress=report_progress):
+            pass
+        thread.join()
+
+        report_progress.assert_called_with(admission.progress.QUEUED, resource='host/esxi1', position=1)
+        self.assertEqual(self.admission.stats()['waited'], 1)
+
+    def test_timeout(self):
+        """Admission - raises ValueError if no slot is free in time, and gets out of line"""
+        self.admission.store.join('host/esxi1', 'someone-else', time.time())
+        settings = admission.const._replace(VLAB_SUPERNA_ADMISSION_TIMEOUT=0)
+
+        with patch.object(admission, 'const', settings):
+            with self.assertRaises(ValueError):
+                with self.admission.slots([('host', 'esxi1', 1)], self.logger):
+                    pass
+
+        self.assertEqual(self.admission.store.length('host/esxi1', time.time(), 60), 1)
+        self.assertEqual(self.admission.stats()['timeouts'], 1)
+
+    def test_least_busy(self):
+        """Admission - ``least_busy`` picks the resource with the fewest tickets"""
+        self.admission.store.join('host/esxi1', 'a', time.time())
+
+        self.assertEqual(self.admission.least_busy('host', ['esxi1', 'esxi2']), 'esxi2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in aio.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock, AsyncMock
+
+from vlab_superna_api.lib.worker import aio
+
+
+class TestEventLoop(unittest.TestCase):
+    """A set of test cases for the ``_EventLoop`` object"""
+
+    def test_run(self):
+        """``run`` returns the output of the coroutine"""
+        async def work():
+            return 'worked'
+
+        output = aio.run(work())
+
+        self.assertEqual(output, 'worked')
+
+    def test_run_error(self):
+        """``run`` raises the exception of the coroutine"""
+        async def work():
+            raise ValueError('testing')
+
+        with self.assertRaises(ValueError):
+            aio.run(work())
+
+    def test_call(self):
+        """``call`` runs the blocking function, and returns its output"""
+        func = MagicMock()
+        func.return_value = 'worked'
+
+        output = aio.run(aio.call(func, 'a', b='b'))
+
+        self.assertEqual(output, 'worked')
+        func.assert_called_with('a', b='b')
+
+    def test_semaphore(self):
+        """``semaphore`` returns the same semaphore for the same vCenter"""
+        async def get_semaphores():
+            return aio.LOOP.semaphore('vcenter1'), aio.LOOP.semaphore('vcenter1'), aio.LOOP.semaphore('vcenter2')
+
+        sem1, sem2, sem3 = aio.run(get_semaphores())
+
+        self.assertTrue(sem1 is sem2)
+        self.assertFalse(sem1 is sem3)
+
+    @patch.object(aio, 'vcenter_session')
+    def test_call_with_session(self, fake_vcenter_session):
+        """``call_with_session`` passes a pooled session to the function"""
+        func = MagicMock()
+
+        aio.run(aio.call_with_session(func, 'a'))
+
+        func.assert_called_with(fake_vcenter_session.return_value.__enter__.return_value, 'a')
+
+
+class TestCreate(unittest.TestCase):
+    """A set of test cases for ``aio.create_superna``"""
+
+    @patch.object(aio, 'const', aio.const._replace(VLAB_SUPERNA_BOOT_SETTLE=0))
+    @patch.object(aio.virtual_machine, 'get_info')
+    @patch.object(aio.virtual_machine, 'set_meta')
+    @patch.object(aio.vmware, 'add_unique_params')
+    @patch.object(aio, 'wait_task', new_callable=AsyncMock)
+    @patch.object(aio.waiter, 'WAITER')
+    @patch.object(aio, '_deploy')
+    @patch.object(aio, 'vcenter_session')
+    @patch.object(aio.image_catalog, 'CATALOG')
+    def test_create_superna(self, fake_CATALOG, fake_vcenter_session, fake_deploy, fake_WAITER, fake_wait_task,
+                            fake_add_unique_params, fake_set_meta, fake_get_info):
+        """``create_superna`` returns the info about the new VM"""
+        fake_CATALOG.get.return_value = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['someLAN']}
+        fake_WAITER.watch_async = AsyncMock()
+        fake_get_info.return_value = {'worked': True}
+
+        output = aio.run(aio.create_superna('bob', 'mySuperna', '1.0.0', 'someLAN', {}, MagicMock()))
+        expected = {'mySuperna': {'worked': True}}
+
+        self.assertEqual(output, expected)
+        # once for VMware Tools, once for the IP
+        self.assertEqual(fake_WAITER.watch_async.call_count, 2)
+
+    @patch.object(aio.image_catalog, 'CATALOG')
+    def test_create_superna_bad_image(self, fake_CATALOG):
+        """``create_superna`` raises ValueError if the image does not exist"""
+        fake_CATALOG.get.return_value = None
+
+        with self.assertRaises(ValueError):
+            aio.run(aio.create_superna('bob', 'mySuperna', '1.0.0', 'someLAN', {}, MagicMock()))
+
+    @patch.object(aio.networks, 'lookup')
+    def test_deploy_no_network(self, fake_lookup):
+        """``_deploy`` raises ValueError if the network does not exist"""
+        vcenter = MagicMock()
+        fake_lookup.side_effect = ValueError('testing')
+
+        with self.assertRaises(ValueError):
+            aio._deploy(vcenter, 'bob', 'mySuperna', '1.0.0', {}, 'someLAN', MagicMock())
+
+
+if __name__ == '__main__':
+    unittest.main()
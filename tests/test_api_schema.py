@@ -22,6 +22,26 @@ class TestSupernaViewSchema(unittest.TestCase):
         self.assertTrue(schema_valid)
 
 
+    def test_batch_schema(self):
+        """The schema defined for POST on ./batch is valid"""
+        try:
+            Draft4Validator.check_schema(superna.SupernaView.BATCH_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_batch_delete_schema(self):
+        """The schema defined for DELETE on ./batch is valid"""
+        try:
+            Draft4Validator.check_schema(superna.SupernaView.BATCH_DELETE_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
     def test_get_schema(self):
         """The schema defined for GET on is valid"""
         try:
@@ -52,6 +72,16 @@ class TestSupernaViewSchema(unittest.TestCase):
 
         self.assertTrue(schema_valid)
 
+    def test_tasks_schema(self):
+        """The schema defined for POST on ./task is valid"""
+        try:
+            Draft4Validator.check_schema(superna.SupernaView.TASKS_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the benchmark harness, and the vCenter simulator it runs
+against. These double as a regression gate on the round trips each task type
+makes to vCenter.
+"""
+import unittest
+
+from pyVmomi import vim
+
+from tests import benchmark
+from tests.vcsim import VCenterSim
+
+
+class TestVCenterSim(unittest.TestCase):
+    """A set of test cases for the ``VCenterSim`` object"""
+    def test_inventory(self):
+        """VCenterSim - makes a folder, with VMs, for every user"""
+        sim = VCenterSim(users=2, vms_per_user=3)
+        vcenter = sim.login()
+        folder = vcenter.get_vm_folder('vlab/user1')
+        names = sorted(x.name for x in folder.childEntity)
+
+        self.assertEqual(names, ['superna0', 'superna1', 'superna2'])
+
+    def test_counts_round_trips(self):
+        """VCenterSim - every method call and property read is a round trip"""
+        sim = VCenterSim(users=1, vms_per_user=1)
+        vcenter = sim.login()
+        before = sim.round_trips()
+        vcenter.content.rootFolder.name
+
+        self.assertEqual(sim.round_trips() - before, 2)
+
+    def test_not_found(self):
+        """VCenterSim - reading a property of a destroyed object raises ManagedObjectNotFound"""
+        sim = VCenterSim(users=1, vms_per_user=1)
+        vcenter = sim.login()
+        the_vm = vcenter.get_vm_folder('vlab/user0').childEntity[0]
+        the_vm.PowerOff()
+        the_vm.Destroy()
+
+        with self.assertRaises(vim.ManagedObjectNotFound):
+            the_vm.name
+
+    def test_not_implemented(self):
+        """VCenterSim - calling a method it does not simulate raises NotImplementedError"""
+        sim = VCenterSim(users=1, vms_per_user=1)
+        vcenter = sim.login()
+
+        with self.assertRaises(NotImplementedError):
+            vcenter.content.rootFolder.Rename_Task('foo')
+
+
+class TestBenchmark(unittest.TestCase):
+    """A set of test cases for the benchmark harness"""
+    @classmethod
+    def setUpClass(cls):
+        """Runs once, before any test case"""
+        cls.small = benchmark.run(VCenterSim(users=3, vms_per_user=5), calls=3)
+        cls.big = benchmark.run(VCenterSim(users=3, vms_per_user=50), calls=3)
+
+    def test_reports(self):
+        """benchmark - ``run`` reports on every task type"""
+        self.assertEqual(set(self.small.keys()), set(benchmark.OPERATIONS))
+
+    def test_show_round_trips(self):
+        """benchmark - show costs one round trip per VM (the console clone ticket), plus a constant"""
+        extra = self.big['show']['round_trips'] - self.small['show']['round_trips']
+
+        self.assertEqual(extra, 45)
+
+    def test_delete_round_trips(self):
+        """benchmark - delete costs the same round trips, no matter how many VMs the user has"""
+        self.assertEqual(self.big['delete']['round_trips'], self.small['delete']['round_trips'])
+
+    def test_create(self):
+        """benchmark - create makes a new VM, which delete destroys"""
+        sim = VCenterSim(users=1, vms_per_user=1)
+        with benchmark.simulated(sim):
+            benchmark.vmware.create_superna('user0', 'bench0', benchmark.IMAGE, 'user0_network0',
+                                            benchmark.IP_CONFIG, benchmark.LOGGER)
+            shown = benchmark.vmware.show_superna('user0')
+            benchmark.vmware.delete_superna('user0', 'bench0', benchmark.LOGGER)
+            after = benchmark.vmware.show_superna('user0')
+
+        self.assertEqual(shown['bench0']['state'], 'poweredOn')
+        self.assertTrue(shown['bench0']['ips'])
+        self.assertNotIn('bench0', after)
+
+    def test_percentile(self):
+        """benchmark - ``percentile`` uses the nearest rank"""
+        values = list(range(1, 101))
+
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+
+
+if __name__ == '__main__':
+    unittest.main()
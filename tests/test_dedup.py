@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in dedup.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from celery.backends.base import BaseKeyValueStoreBackend
+
+from vlab_superna_api.lib import dedup
+
+
+class TestDeduplicator(unittest.TestCase):
+    """A set of test cases for the ``Deduplicator`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.celery_app = MagicMock()
+        self.celery_app.send_task.side_effect = lambda *args, **kwargs: MagicMock(id='task-{}'.format(self.celery_app.send_task.call_count))
+        self.dedup = dedup.Deduplicator(max_size=10, ttl=60)
+
+    def test_send_task(self):
+        """``Deduplicator`` sends the task, and returns its id"""
+        output = self.dedup.send_task(self.celery_app, 'superna.show', ['bob', 'myId'], 'bob', 'myId')
+
+        self.assertEqual(output, 'task-1')
+        self.assertEqual(self.celery_app.send_task.call_args[0], ('superna.show', ['bob', 'myId']))
+
+    def test_same_txn_id(self):
+        """``Deduplicator`` returns the first task for a request with the same X-REQUEST-ID"""
+        first = self.dedup.send_task(self.celery_app, 'superna.show', ['bob', 'myId'], 'bob', 'myId')
+        second = self.dedup.send_task(self.celery_app, 'superna.show', ['bob', 'myId'], 'bob', 'myId')
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.dedup.stats()['duplicates'], 1)
+
+    def test_no_txn_id(self):
+        """``Deduplicator`` does not dedup requests that have no X-REQUEST-ID"""
+        first = self.dedup.send_task(self.celery_app, 'superna.show', ['bob', 'noId'], 'bob', 'noId')
+        second = self.dedup.send_task(self.celery_app, 'superna.show', ['bob', 'noId'], 'bob', 'noId')
+
+        self.assertNotEqual(first, second)
+
+    def test_other_user(self):
+        """``Deduplicator`` never returns the task of another user"""
+        first = self.dedup.send_task(self.celery_app, 'superna.show', ['bob', 'myId'], 'bob', 'myId')
+        second = self.dedup.send_task(self.celery_app, 'superna.show', ['alice', 'myId'], 'alice', 'myId')
+
+        self.assertNotEqual(first, second)
+
+    @patch.object(dedup.results, 'get_many')
+    def test_machine_in_flight(self, fake_get_many):
+        """``Deduplicator`` returns the running task for the same machine, even with a new X-REQUEST-ID"""
+        self.celery_app.backend = MagicMock(spec=BaseKeyValueStoreBackend)
+        fake_get_many.return_value = {'task-1': {'status': 'PROGRESS', 'result': None}}
+        first = self.dedup.send_task(self.celery_app, 'superna.create', [], 'bob', 'id1', machine_name='box')
+        second = self.dedup.send_task(self.celery_app, 'superna.create', [], 'bob', 'id2', machine_name='box')
+
+        self.assertEqual(first, second)
+
+    @patch.object(dedup.results, 'get_many')
+    def test_machine_done(self, fake_get_many):
+        """``Deduplicator`` sends a new task for a machine once the last one is done"""
+        self.celery_app.backend = MagicMock(spec=BaseKeyValueStoreBackend)
+        fake_get_many.return_value = {'task-1': {'status': 'FAILURE', 'result': None}}
+        first = self.dedup.send_task(self.celery_app, 'superna.create', [], 'bob', 'id1', machine_name='box')
+        second = self.dedup.send_task(self.celery_app, 'superna.create', [], 'bob', 'id2', machine_name='box')
+
+        self.assertNotEqual(first, second)
+
+    def test_machine_rpc(self):
+        """``Deduplicator`` only uses the X-REQUEST-ID with the rpc:// backend, since it can't tell if a task is done"""
+        first = self.dedup.send_task(self.celery_app, 'superna.create', [], 'bob', 'id1', machine_name='box')
+        second = self.dedup.send_task(self.celery_app, 'superna.create', [], 'bob', 'id2', machine_name='box')
+
+        self.assertNotEqual(first, second)
+        self.assertFalse(self.celery_app.AsyncResult.called)
+
+    @patch.object(dedup.results, 'get_many')
+    def test_machine_replaced(self, fake_get_many):
+        """``Deduplicator`` sends a new task for a machine after another kind of task was sent for it"""
+        self.celery_app.backend = MagicMock(spec=BaseKeyValueStoreBackend)
+        fake_get_many.side_effect = lambda app, ids: {x: {'status': 'PROGRESS', 'result': None} for x in ids}
+        first = self.dedup.send_task(self.celery_app, 'superna.create', [], 'bob', 'id1', machine_name='box')
+        self.dedup.send_task(self.celery_app, 'superna.delete', [], 'bob', 'id2', machine_name='box')
+        third = self.dedup.send_task(self.celery_app, 'superna.create', [], 'bob', 'id3', machine_name='box')
+
+        self.assertNotEqual(first, third)
+
+    def test_other_task(self):
+        """``Deduplicator`` does not confuse a delete with a create of the same machine"""
+        first = self.dedup.send_task(self.celery_app, 'superna.create', [], 'bob', 'id1', machine_name='box')
+        second = self.dedup.send_task(self.celery_app, 'superna.delete', [], 'bob', 'id1', machine_name='box')
+
+        self.assertNotEqual(first, second)
+
+
+if __name__ == '__main__':
+    unittest.main()
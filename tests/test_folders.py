@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in folders.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock, PropertyMock
+
+from vlab_superna_api.lib.worker import folders
+
+
+class TestUserFolders(unittest.TestCase):
+    """A set of test cases for the ``UserFolders`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.vcenter = MagicMock()
+        self.vcenter.get_vm_folder.return_value = folders.vim.Folder('group-v1')
+        self.found = {folders.vim.Folder('group-v2'): {'name': 'bob'},
+                      folders.vim.Folder('group-v3'): {'name': 'alice'}}
+
+    @patch.object(folders.UserFolders, '_valid')
+    @patch.object(folders.inventory, 'retrieve')
+    def test_get(self, fake_retrieve, fake_valid):
+        """``UserFolders`` - ``get`` returns the folder of the user"""
+        fake_retrieve.return_value = self.found
+        fake_valid.return_value = True
+        user_folders = folders.UserFolders()
+
+        output = user_folders.get(self.vcenter, 'alice')
+
+        self.assertEqual(output, folders.vim.Folder('group-v3'))
+
+    @patch.object(folders.UserFolders, '_valid')
+    @patch.object(folders.inventory, 'retrieve')
+    def test_get_cached(self, fake_retrieve, fake_valid):
+        """``UserFolders`` only finds every folder once"""
+        fake_retrieve.return_value = self.found
+        fake_valid.return_value = True
+        user_folders = folders.UserFolders()
+
+        user_folders.get(self.vcenter, 'alice')
+        user_folders.get(self.vcenter, 'bob')
+
+        self.assertEqual(fake_retrieve.call_count, 1)
+        self.assertEqual(user_folders.stats()['hits'], 1)
+
+    @patch.object(folders.UserFolders, '_valid')
+    @patch.object(folders.inventory, 'retrieve')
+    def test_get_stale(self, fake_retrieve, fake_valid):
+        """``UserFolders`` finds every folder again if the cached folder is no longer valid"""
+        fake_retrieve.side_effect = [self.found, {folders.vim.Folder('group-v4'): {'name': 'alice'}}]
+        fake_valid.return_value = False
+        user_folders = folders.UserFolders()
+
+        user_folders.get(self.vcenter, 'alice')
+        output = user_folders.get(self.vcenter, 'alice')
+
+        self.assertEqual(output, folders.vim.Folder('group-v4'))
+        self.assertEqual(user_folders.stats()['stale'], 1)
+
+    @patch.object(folders.inventory, 'retrieve')
+    def test_get_missing(self, fake_retrieve):
+        """``UserFolders`` raises ValueError if the user has no folder"""
+        fake_retrieve.return_value = self.found
+        user_folders = folders.UserFolders()
+
+        with self.assertRaises(ValueError):
+            user_folders.get(self.vcenter, 'eve')
+
+    @patch.object(folders.inventory, 'retrieve')
+    def test_get_missing_cached(self, fake_retrieve):
+        """``UserFolders`` doesn't find every folder again for a user it just couldn't find"""
+        fake_retrieve.return_value = self.found
+        user_folders = folders.UserFolders(miss_ttl=60)
+
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                user_folders.get(self.vcenter, 'eve')
+
+        self.assertEqual(fake_retrieve.call_count, 1)
+        self.assertEqual(user_folders.stats()['missing'], 1)
+
+    @patch.object(folders.inventory, 'retrieve')
+    def test_get_missing_expires(self, fake_retrieve):
+        """``UserFolders`` looks for a missing folder again once the miss expires"""
+        fake_retrieve.side_effect = [self.found, {folders.vim.Folder('group-v4'): {'name': 'eve'}}]
+        user_folders = folders.UserFolders(miss_ttl=0)
+
+        with self.assertRaises(ValueError):
+            user_folders.get(self.vcenter, 'eve')
+        output = user_folders.get(self.vcenter, 'eve')
+
+        self.assertEqual(output, folders.vim.Folder('group-v4'))
+
+    def test_valid(self):
+        """``UserFolders`` - ``_valid`` is False if the folder was renamed"""
+        folder = MagicMock()
+        folder.name = 'notBob'
+
+        self.assertFalse(folders.UserFolders()._valid(folder, 'bob'))
+
+    def test_valid_deleted(self):
+        """``UserFolders`` - ``_valid`` is False if the folder was deleted"""
+        folder = MagicMock()
+        type(folder).name = PropertyMock(side_effect=folders.vmodl.fault.ManagedObjectNotFound())
+
+        self.assertFalse(folders.UserFolders()._valid(folder, 'bob'))
+
+
+if __name__ == '__main__':
+    unittest.main()
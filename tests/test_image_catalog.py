@@ -0,0 +1,297 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in image_catalog.py
+"""
+import os
+import io
+import time
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_superna_api.lib import image_catalog
+
+OVF = """<?xml version="1.0" encoding="UTF-8"?>
+<Envelope xmlns="http://schemas.dmtf.org/ovf/envelope/1" xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1">
+  <NetworkSection>
+    <Info>The list of logical networks</Info>
+    <Network ovf:name="VM Network">
+      <Description>The VM Network network</Description>
+    </Network>
+  </NetworkSection>
+  <VirtualSystem ovf:id="eyeglass">
+    <ProductSection>
+      <Property ovf:key="eth0.ipv4.ip" ovf:type="string"/>
+      <Property ovf:key="hostname" ovf:type="string"/>
+    </ProductSection>
+  </VirtualSystem>
+</Envelope>
+"""
+
+
+def make_ova(location, ovf=OVF, disk=b'0' * 1024):
+    """Create a tiny, but valid, OVA file"""
+    with tarfile.open(location, 'w') as tar:
+        for name, data in (('eyeglass.ovf', ovf.encode()), ('eyeglass-disk1.vmdk', disk)):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    # backdate the file, so it's not ignored as a partial upload
+    os.utime(location, (time.time() - 3600, time.time() - 3600))
+
+
+class TestImageCatalog(unittest.TestCase):
+    """A set of test cases for the ImageCatalog object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.images_dir = tempfile.mkdtemp()
+        make_ova(os.path.join(self.images_dir, 'Superna_Eyeglass-2.5.6.ova'))
+        self.catalog = image_catalog.ImageCatalog(images_dir=self.images_dir, recheck=0, settle=60,
+                                                  index=image_catalog.ManifestIndex(location=''))
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.images_dir)
+
+    def test_versions(self):
+        """``ImageCatalog`` - ``versions`` returns the available versions of Superna"""
+        output = self.catalog.versions()
+        expected = ['2.5.6']
+
+        self.assertEqual(output, expected)
+
+    def test_metadata(self):
+        """``ImageCatalog`` - ``get`` returns details about the OVA"""
+        output = self.catalog.get('2.5.6')
+
+        self.assertEqual(output['networks'], ['VM Network'])
+        self.assertEqual(output['properties'], ['eth0.ipv4.ip', 'hostname'])
+        self.assertEqual(output['file'], 'Superna_Eyeglass-2.5.6.ova')
+        self.assertTrue(output['size'] > 0)
+
+    def test_get_unknown(self):
+        """``ImageCatalog`` - ``get`` returns None for unknown versions"""
+        output = self.catalog.get('9.9.9')
+
+        self.assertTrue(output is None)
+
+    def test_ignores_other_files(self):
+        """``ImageCatalog`` ignores files that are not OVAs"""
+        with open(os.path.join(self.images_dir, 'README.txt'), 'w') as the_file:
+            the_file.write('hello')
+        make_ova(os.path.join(self.images_dir, '.Superna_Eyeglass-2.5.7.ova.aBc123'))
+
+        output = self.catalog.versions()
+        expected = ['2.5.6']
+
+        self.assertEqual(output, expected)
+
+    def test_ignores_hidden_files(self):
+        """``ImageCatalog`` ignores hidden files, like partial uploads from rsync"""
+        make_ova(os.path.join(self.images_dir, '.Superna_Eyeglass-2.5.7.ova'))
+
+        output = self.catalog.versions()
+        expected = ['2.5.6']
+
+        self.assertEqual(output, expected)
+
+    def test_ignores_recent_files(self):
+        """``ImageCatalog`` ignores OVAs that are still being uploaded"""
+        new_ova = os.path.join(self.images_dir, 'Superna_Eyeglass-2.5.7.ova')
+        make_ova(new_ova)
+        os.utime(new_ova, None)
+
+        output = self.catalog.versions()
+        expected = ['2.5.6']
+
+        self.assertEqual(output, expected)
+
+    def test_ignores_broken_files(self):
+        """``ImageCatalog`` ignores OVAs that cannot be parsed"""
+        broken_ova = os.path.join(self.images_dir, 'Superna_Eyeglass-2.5.7.ova')
+        with open(broken_ova, 'wb') as the_file:
+            the_file.write(b'not a tar file')
+        os.utime(broken_ova, (time.time() - 3600, time.time() - 3600))
+
+        output = self.catalog.versions()
+        expected = ['2.5.6']
+
+        self.assertEqual(output, expected)
+
+    def test_cached(self):
+        """``ImageCatalog`` does not re-read the directory if it has not changed"""
+        self.catalog.versions()
+        with patch.object(image_catalog.os, 'listdir') as fake_listdir:
+            self.catalog.versions()
+
+        self.assertFalse(fake_listdir.called)
+
+    def test_recheck(self):
+        """``ImageCatalog`` does not stat the directory if it was recently checked"""
+        catalog = image_catalog.ImageCatalog(images_dir=self.images_dir, recheck=300, settle=60)
+        catalog.versions()
+        with patch.object(image_catalog.os, 'stat') as fake_stat:
+            catalog.versions()
+
+        self.assertFalse(fake_stat.called)
+
+    def test_refresh_on_change(self):
+        """``ImageCatalog`` picks up new OVAs"""
+        self.catalog.versions()
+        make_ova(os.path.join(self.images_dir, 'Superna_Eyeglass-2.5.7.ova'))
+        # Some file systems only track mtime to the second
+        os.utime(self.images_dir, (time.time() + 5, time.time() + 5))
+
+        output = self.catalog.versions()
+        expected = ['2.5.6', '2.5.7']
+
+        self.assertEqual(output, expected)
+
+    def test_parse_once(self):
+        """``ImageCatalog`` only parses an OVA once"""
+        self.catalog.versions()
+        make_ova(os.path.join(self.images_dir, 'Superna_Eyeglass-2.5.7.ova'))
+        os.utime(self.images_dir, (time.time() + 5, time.time() + 5))
+        self.catalog.versions()
+
+        self.assertEqual(self.catalog.stats()['parsed'], 2)
+
+    def test_warm(self):
+        """``ImageCatalog`` - ``warm`` builds the catalog in the background"""
+        self.catalog.warm()
+        for _ in range(100):
+            if self.catalog.loaded:
+                break
+            time.sleep(0.01)
+
+        self.assertTrue(self.catalog.loaded)
+
+    def test_warm_error(self):
+        """``ImageCatalog`` - ``warm`` ignores a missing images directory"""
+        catalog = image_catalog.ImageCatalog(images_dir='/not/a/real/dir', recheck=0, settle=60)
+        catalog._warm()
+
+        self.assertFalse(catalog.loaded)
+
+    def test_loaded(self):
+        """``ImageCatalog`` - ``loaded`` is False until the directory has been read"""
+        self.assertFalse(self.catalog.loaded)
+        self.catalog.versions()
+        self.assertTrue(self.catalog.loaded)
+
+
+class TestManifestIndex(unittest.TestCase):
+    """A set of test cases for the ManifestIndex object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.the_dir = tempfile.mkdtemp()
+        self.ova = os.path.join(self.the_dir, 'Superna_Eyeglass-2.5.6.ova')
+        self.location = os.path.join(self.the_dir, 'index.json')
+        make_ova(self.ova, disk=b'1' * 2048)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.the_dir)
+
+    def test_get(self):
+        """``ManifestIndex`` - ``get`` returns the OVF, networks, vApp properties and disks"""
+        output = image_catalog.ManifestIndex(self.location).get(self.ova)
+
+        self.assertEqual(output['networks'], ['VM Network'])
+        self.assertEqual(output['properties'], ['eth0.ipv4.ip', 'hostname'])
+        self.assertEqual(output['ovf'], OVF)
+        self.assertEqual(list(output['disks'].keys()), ['eyeglass-disk1.vmdk'])
+
+    def test_disk_offsets(self):
+        """``ManifestIndex`` - the disk offsets point at the disk data within the OVA"""
+        output = image_catalog.ManifestIndex(self.location).get(self.ova)
+        offset, size = output['disks']['eyeglass-disk1.vmdk']
+
+        with open(self.ova, 'rb') as the_file:
+            the_file.seek(offset)
+            data = the_file.read(size)
+
+        self.assertEqual(data, b'1' * 2048)
+
+    def test_persisted(self):
+        """``ManifestIndex`` does not re-read an OVA that another instance already indexed"""
+        image_catalog.ManifestIndex(self.location).get(self.ova)
+        index = image_catalog.ManifestIndex(self.location)
+        with patch.object(image_catalog, 'scan_ova') as fake_scan_ova:
+            index.get(self.ova)
+
+        self.assertFalse(fake_scan_ova.called)
+        self.assertEqual(index.counters, {'hits': 1, 'scans': 0})
+
+    def test_changed(self):
+        """``ManifestIndex`` re-reads an OVA that has changed"""
+        index = image_catalog.ManifestIndex(self.location)
+        index.get(self.ova)
+        make_ova(self.ova, disk=b'2' * 4096)
+
+        output = index.get(self.ova)
+
+        self.assertEqual(output['disks']['eyeglass-disk1.vmdk'][1], 4096)
+        self.assertEqual(index.counters['scans'], 2)
+
+    def test_corrupt(self):
+        """``ManifestIndex`` ignores a corrupt index file"""
+        with open(self.location, 'w') as the_file:
+            the_file.write('{not json')
+
+        output = image_catalog.ManifestIndex(self.location).get(self.ova)
+
+        self.assertEqual(output['networks'], ['VM Network'])
+
+    def test_read_only(self):
+        """``ManifestIndex`` still works if the index cannot be saved"""
+        index = image_catalog.ManifestIndex('/not/a/real/dir/index.json')
+
+        output = index.get(self.ova)
+
+        self.assertEqual(output['networks'], ['VM Network'])
+
+    def test_prune(self):
+        """``ManifestIndex`` forgets about OVAs that were deleted"""
+        other_ova = os.path.join(self.the_dir, 'Superna_Eyeglass-2.5.7.ova')
+        make_ova(other_ova)
+        index = image_catalog.ManifestIndex(self.location)
+        index.get(other_ova)
+        os.remove(other_ova)
+        index.get(self.ova)
+
+        with open(self.location) as the_file:
+            saved = image_catalog.ujson.load(the_file)
+
+        self.assertEqual(list(saved.keys()), [self.ova])
+
+
+class TestParseOvf(unittest.TestCase):
+    """A set of test cases for the ``parse_ovf`` function"""
+
+    def test_parse_ovf(self):
+        """``parse_ovf`` returns the networks and vApp properties of an OVF"""
+        output = image_catalog.parse_ovf(OVF)
+        expected = {'networks': ['VM Network'], 'properties': ['eth0.ipv4.ip', 'hostname']}
+
+        self.assertEqual(output, expected)
+
+    def test_scan_ova_missing(self):
+        """``scan_ova`` raises ValueError if the OVA has no OVF"""
+        the_dir = tempfile.mkdtemp()
+        try:
+            ova = os.path.join(the_dir, 'foo.ova')
+            with tarfile.open(ova, 'w') as tar:
+                info = tarfile.TarInfo('foo.vmdk')
+                info.size = 1
+                tar.addfile(info, io.BytesIO(b'0'))
+            with self.assertRaises(ValueError):
+                image_catalog.scan_ova(ova)
+        finally:
+            shutil.rmtree(the_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in inventory.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_superna_api.lib.worker import inventory
+
+
+def _make_object(obj, **props):
+    """Mimic the ObjectContent returned by the PropertyCollector"""
+    content = MagicMock()
+    content.obj = obj
+    content.propSet = []
+    for name, val in props.items():
+        prop = MagicMock()
+        prop.name = name.replace('__', '.')
+        prop.val = val
+        content.propSet.append(prop)
+    return content
+
+
+def _make_result(objects, token=None):
+    """Mimic the RetrieveResult returned by the PropertyCollector"""
+    result = MagicMock()
+    result.objects = objects
+    result.token = token
+    return result
+
+
+class TestRetrieve(unittest.TestCase):
+    """A set of test cases for the ``retrieve`` function"""
+
+    def test_retrieve(self):
+        """``retrieve`` returns a mapping of object to properties"""
+        vcenter = MagicMock()
+        vm = inventory.vim.VirtualMachine('vm-1')
+        collector = vcenter.content.propertyCollector
+        collector.RetrievePropertiesEx.return_value = _make_result([_make_object(vm, name='myVM')])
+
+        output = inventory.retrieve(vcenter, MagicMock())
+        expected = {vm: {'name': 'myVM'}}
+
+        self.assertEqual(output, expected)
+
+    def test_retrieve_paging(self):
+        """``retrieve`` follows the paging token"""
+        vcenter = MagicMock()
+        vm1 = inventory.vim.VirtualMachine('vm-1')
+        vm2 = inventory.vim.VirtualMachine('vm-2')
+        collector = vcenter.content.propertyCollector
+        collector.RetrievePropertiesEx.return_value = _make_result([_make_object(vm1, name='vm1')], token='1')
+        collector.ContinueRetrievePropertiesEx.return_value = _make_result([_make_object(vm2, name='vm2')])
+
+        output = inventory.retrieve(vcenter, MagicMock())
+        expected = {vm1: {'name': 'vm1'}, vm2: {'name': 'vm2'}}
+
+        self.assertEqual(output, expected)
+        collector.ContinueRetrievePropertiesEx.assert_called_with(token='1')
+
+    def test_retrieve_nothing(self):
+        """``retrieve`` handles vCenter returning no result"""
+        vcenter = MagicMock()
+        vcenter.content.propertyCollector.RetrievePropertiesEx.return_value = None
+
+        output = inventory.retrieve(vcenter, MagicMock())
+
+        self.assertEqual(output, {})
+
+
+class TestFolderVms(unittest.TestCase):
+    """A set of test cases for the ``folder_vms`` function"""
+
+    @patch.object(inventory, 'retrieve')
+    def test_folder_vms(self, fake_retrieve):
+        """``folder_vms`` resolves the network names of each VM"""
+        vm = inventory.vim.VirtualMachine('vm-1')
+        net = inventory.vim.Network('net-1')
+        fake_retrieve.return_value = {vm: {'name': 'myVM', 'network': [net]},
+                                      net: {'name': 'bob_frontend'}}
+
+        output = inventory.folder_vms(MagicMock(), inventory.vim.Folder('group-1'))
+        expected = {vm: {'name': 'myVM', 'network': ['bob_frontend']}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(inventory, 'retrieve')
+    def test_folder_vms_no_network(self, fake_retrieve):
+        """``folder_vms`` handles VMs without any networks"""
+        vm = inventory.vim.VirtualMachine('vm-1')
+        fake_retrieve.return_value = {vm: {'name': 'myVM'}}
+
+        output = inventory.folder_vms(MagicMock(), inventory.vim.Folder('group-1'))
+        expected = {vm: {'name': 'myVM', 'network': []}}
+
+        self.assertEqual(output, expected)
+
+
+class TestFindVm(unittest.TestCase):
+    """A set of test cases for the ``find_vm`` function"""
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_vm(self, fake_retrieve):
+        """``find_vm`` returns the VM, and the requested properties"""
+        vm = inventory.vim.VirtualMachine('vm-1')
+        vcenter = MagicMock()
+        vcenter.content.searchIndex.FindChild.return_value = vm
+        fake_retrieve.return_value = {vm: {'config.annotation': 'some notes'}}
+
+        output = inventory.find_vm(vcenter, MagicMock(), 'myVM', ['config.annotation'])
+        expected = (vm, {'config.annotation': 'some notes'})
+
+        self.assertEqual(output, expected)
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_vm_missing(self, fake_retrieve):
+        """``find_vm`` returns None if there's no such VM"""
+        vcenter = MagicMock()
+        vcenter.content.searchIndex.FindChild.return_value = None
+
+        output = inventory.find_vm(vcenter, MagicMock(), 'myVM', ['config.annotation'])
+
+        self.assertTrue(output is None)
+        self.assertFalse(fake_retrieve.called)
+
+    def test_find_vm_not_vm(self):
+        """``find_vm`` returns None if the child with that name is not a VM"""
+        vcenter = MagicMock()
+        vcenter.content.searchIndex.FindChild.return_value = inventory.vim.Folder('group-v1')
+
+        output = inventory.find_vm(vcenter, MagicMock(), 'myVM', ['config.annotation'])
+
+        self.assertTrue(output is None)
+
+
+class TestVmFolder(unittest.TestCase):
+    """A set of test cases for the ``vm_folder`` function"""
+
+    def test_vm_folder(self):
+        """``vm_folder`` returns the folder"""
+        vcenter = MagicMock()
+        vcenter.get_vm_folder.return_value = 'someFolder'
+
+        output = inventory.vm_folder(vcenter, 'some/path')
+
+        self.assertEqual(output, 'someFolder')
+        self.assertFalse(vcenter.create_vm_folder.called)
+
+    def test_vm_folder_creates(self):
+        """``vm_folder`` creates the folder if it does not exist"""
+        vcenter = MagicMock()
+        vcenter.get_vm_folder.side_effect = [FileNotFoundError('testing'), 'someFolder']
+
+        output = inventory.vm_folder(vcenter, 'some/path')
+
+        self.assertEqual(output, 'someFolder')
+        self.assertTrue(vcenter.create_vm_folder.called)
+
+
+class TestVmInfo(unittest.TestCase):
+    """A set of test cases for ``vm_info`` and ``parse_meta``"""
+
+    def test_parse_meta(self):
+        """``parse_meta`` returns the VM meta data"""
+        output = inventory.parse_meta('{"component": "Superna"}')
+        expected = {'component': 'Superna'}
+
+        self.assertEqual(output, expected)
+
+    def test_parse_meta_none(self):
+        """``parse_meta`` handles VMs without a config"""
+        output = inventory.parse_meta(None)
+
+        self.assertEqual(output['component'], 'Unknown')
+
+    def test_parse_meta_not_json(self):
+        """``parse_meta`` handles VMs with notes that are not meta data"""
+        output = inventory.parse_meta('some notes')
+
+        self.assertEqual(output['component'], 'Unknown')
+
+    def test_vm_info(self):
+        """``vm_info`` returns the same info as ``virtual_machine.get_info``"""
+        vm = inventory.vim.VirtualMachine('vm-1')
+        nic = MagicMock()
+        nic.ipAddress = ['10.1.1.2', 'fe80::1']
+        props = {'name': 'myVM',
+                 'runtime.powerState': 'poweredOn',
+                 'guest.net': [nic],
+                 'network': ['bob_frontend', 'sue_backend'],
+                 'config.annotation': '{"component": "Superna"}'}
+        console = MagicMock()
+        console.return_value = 'https://console'
+
+        output = inventory.vm_info(vm, props, 'bob', console)
+        expected = {'state': 'poweredOn',
+                    'console': 'https://console',
+                    'ips': ['10.1.1.2'],
+                    'networks': ['frontend'],
+                    'moid': 'vm-1',
+                    'meta': {'component': 'Superna'}}
+
+        self.assertEqual(output, expected)
+
+
+class TestConsoleUrls(unittest.TestCase):
+    """A set of test cases for the ``ConsoleUrls`` object"""
+
+    @patch.object(inventory, 'OpenSSL')
+    @patch.object(inventory.ssl, 'get_server_certificate')
+    def test_shared_lookup(self, fake_get_server_certificate, fake_OpenSSL):
+        """``ConsoleUrls`` only looks up the vCenter cert once"""
+        fake_OpenSSL.crypto.load_certificate.return_value.digest.return_value = b'aa:bb'
+        console = inventory.ConsoleUrls(MagicMock())
+
+        console(inventory.vim.VirtualMachine('vm-1'), 'vm1')
+        console(inventory.vim.VirtualMachine('vm-2'), 'vm2')
+
+        self.assertEqual(fake_get_server_certificate.call_count, 1)
+
+    @patch.object(inventory, 'OpenSSL')
+    @patch.object(inventory.ssl, 'get_server_certificate')
+    def test_url(self, fake_get_server_certificate, fake_OpenSSL):
+        """``ConsoleUrls`` returns a URL for the supplied VM"""
+        fake_OpenSSL.crypto.load_certificate.return_value.digest.return_value = b'aa:bb'
+        console = inventory.ConsoleUrls(MagicMock())
+
+        output = console(inventory.vim.VirtualMachine('vm-1'), 'vm1')
+
+        self.assertTrue(output.startswith('https://'))
+        self.assertTrue('vmId=vm-1&vmName=vm1' in output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the metrics.py module
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.request
+from unittest.mock import patch
+
+from vlab_superna_api.lib import metrics
+
+
+class TestHistogram(unittest.TestCase):
+    """A set of test cases for the ``Histogram`` object"""
+    def test_render(self):
+        """Histogram - renders cumulative buckets, the sum and the count"""
+        registry = metrics.Registry()
+        histogram = registry.histogram('foo_seconds', 'testing', ['phase'], buckets=(1, 5))
+        histogram.observe(0.5, phase='a')
+        histogram.observe(3, phase='a')
+        histogram.observe(10, phase='a')
+
+        output = metrics.render(registry.snapshot())
+        expected = '\n'.join(['# HELP foo_seconds testing',
+                              '# TYPE foo_seconds histogram',
+                              'foo_seconds_bucket{phase="a",le="1.0"} 1',
+                              'foo_seconds_bucket{phase="a",le="5.0"} 2',
+                              'foo_seconds_bucket{phase="a",le="+Inf"} 3',
+                              'foo_seconds_sum{phase="a"} 13.5',
+                              'foo_seconds_count{phase="a"} 3']) + '\n'
+
+        self.assertEqual(output, expected)
+
+
+class TestCounter(unittest.TestCase):
+    """A set of test cases for the ``Counter`` object"""
+    def test_render(self):
+        """Counter - renders one sample per set of labels"""
+        registry = metrics.Registry()
+        counter = registry.counter('foo_total', 'testing', ['task'])
+        counter.inc(task='a')
+        counter.inc(2, task='b')
+
+        output = metrics.render(registry.snapshot())
+
+        self.assertIn('foo_total{task="a"} 1\n', output)
+        self.assertIn('foo_total{task="b"} 2\n', output)
+
+    def test_escape(self):
+        """Counter - escapes quotes in label values"""
+        registry = metrics.Registry()
+        counter = registry.counter('foo_total', 'testing', ['task'])
+        counter.inc(task='say "hi"')
+
+        output = metrics.render(registry.snapshot())
+
+        self.assertIn(r'foo_total{task="say \"hi\""} 1', output)
+
+
+class TestPhases(unittest.TestCase):
+    """A set of test cases for ``task`` and ``phase``"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.registry = metrics.Registry()
+        for name, kind in (('TASK_SECONDS', 'histogram'), ('PHASE_SECONDS', 'histogram'), ('PHASE_ERRORS', 'counter')):
+            metric = getattr(self.registry, kind)(name, 'testing', getattr(metrics, name).labels)
+            patcher = patch.object(metrics, name, metric)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_labels(self):
+        """``phase`` is labeled with the task & image it runs within"""
+        with metrics.task('superna.create', '1.2.3'):
+            with metrics.phase('power_on'):
+                pass
+
+        output = metrics.render(self.registry.snapshot())
+
+        self.assertIn('PHASE_SECONDS_count{phase="power_on",task="superna.create",image="1.2.3"} 1', output)
+        self.assertIn('TASK_SECONDS_count{task="superna.create",image="1.2.3"} 1', output)
+
+    def test_errors(self):
+        """``phase`` counts the steps that raise"""
+        with self.assertRaises(RuntimeError):
+            with metrics.task('superna.delete'):
+                with metrics.phase('destroy'):
+                    raise RuntimeError('testing')
+
+        output = metrics.render(self.registry.snapshot())
+
+        self.assertIn('PHASE_ERRORS{phase="destroy",task="superna.delete",image=""} 1', output)
+
+    def test_no_task(self):
+        """``phase`` works outside of a task"""
+        with metrics.phase('login'):
+            pass
+
+        output = metrics.render(self.registry.snapshot())
+
+        self.assertIn('PHASE_SECONDS_count{phase="login",task="",image=""} 1', output)
+
+
+class TestWorkerExport(unittest.TestCase):
+    """A set of test cases for sharing metrics between worker processes"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_merge(self):
+        """``merge`` adds up the samples of every process"""
+        registry = metrics.Registry()
+        registry.counter('foo_total', 'testing', ['task']).inc(task='a')
+        registry.histogram('foo_seconds', 'testing', buckets=(1,)).observe(0.5)
+        snapshot = registry.snapshot()
+
+        output = metrics.render(metrics.merge([snapshot, snapshot]))
+
+        self.assertIn('foo_total{task="a"} 2\n', output)
+        self.assertIn('foo_seconds_bucket{le="1.0"} 2\n', output)
+        self.assertIn('foo_seconds_count 2\n', output)
+
+    @patch.object(metrics, '_alive', return_value=True)
+    def test_dump_collect(self, fake_alive):
+        """``collect`` reads the metrics saved by ``dump``"""
+        with patch.object(metrics.os, 'getpid', return_value=1):
+            metrics.dump(self.directory)
+        with patch.object(metrics.os, 'getpid', return_value=2):
+            metrics.dump(self.directory)
+
+        output = metrics.collect(self.directory)
+
+        self.assertIn('# TYPE vlab_superna_vcenter_seconds histogram', output)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['1.json', '2.json'])
+
+    def test_collect_dead(self):
+        """``collect`` folds the metrics of processes that are gone into one file, and keeps counting them"""
+        registry = metrics.Registry()
+        registry.counter('foo_total', 'testing').inc()
+        with patch.object(metrics, 'REGISTRY', registry):
+            for pid in (1, 2, 3):
+                with patch.object(metrics.os, 'getpid', return_value=pid):
+                    metrics.dump(self.directory)
+
+        with patch.object(metrics, '_alive', side_effect=lambda pid: pid in (3, 4)):
+            first = metrics.collect(self.directory)
+            # Celery starts a new process in place of 1 and 2
+            with patch.object(metrics, 'REGISTRY', registry):
+                with patch.object(metrics.os, 'getpid', return_value=4):
+                    metrics.dump(self.directory)
+            second = metrics.collect(self.directory)
+
+        self.assertIn('foo_total 3\n', first)
+        self.assertIn('foo_total 4\n', second)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['3.json', '4.json', 'retained.json'])
+
+    def test_alive(self):
+        """``_alive`` is True for a running process"""
+        self.assertTrue(metrics._alive(os.getpid()))
+
+    def test_reset(self):
+        """``reset`` removes the metrics of old processes"""
+        metrics.dump(self.directory)
+
+        metrics.reset(self.directory)
+
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_serve(self):
+        """``serve`` exports the saved metrics on /metrics"""
+        metrics.dump(self.directory)
+        server = metrics.serve(0, self.directory)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_port)
+        with urllib.request.urlopen(url) as resp:
+            body = resp.read().decode()
+
+        self.assertIn('# TYPE vlab_superna_task_seconds histogram', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
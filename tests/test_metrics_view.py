@@ -0,0 +1,40 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the metrics API end point
+"""
+import unittest
+
+from flask import Flask
+
+from vlab_superna_api.lib.views import metrics
+
+
+class TestMetricsView(unittest.TestCase):
+    """A set of test cases for the MetricsView object"""
+
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        app = Flask(__name__)
+        metrics.MetricsView.register(app)
+        app.config['TESTING'] = True
+        cls.app = app.test_client()
+
+    def test_metrics(self):
+        """A simple test to verify the /api/1/inf/superna/metrics end point works"""
+        resp = self.app.get('/api/1/inf/superna/metrics')
+
+        expected = 200
+
+        self.assertEqual(expected, resp.status_code)
+
+    def test_metrics_format(self):
+        """The /api/1/inf/superna/metrics end point uses the Prometheus text format"""
+        resp = self.app.get('/api/1/inf/superna/metrics')
+
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'# TYPE vlab_superna_http_request_seconds histogram', resp.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in networks.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock, PropertyMock
+
+from vlab_superna_api.lib.worker import networks
+
+# The real ``_valid``; setUp patches it, since the fake vCenter can't read names back
+VALID = networks.NetworkIndex._valid
+
+
+class TestNetworkIndex(unittest.TestCase):
+    """A set of test cases for the ``NetworkIndex`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.vcenter = MagicMock()
+        self.vcenter.content.viewManager.CreateContainerView.return_value = MagicMock(spec=networks.vim.view.ContainerView)
+        self.network_folder = networks.vim.Folder('group-n1')
+        self.found = {networks.vim.Network('network-1'): {'name': 'VM Network'},
+                      networks.vim.dvs.DistributedVirtualPortgroup('dvportgroup-1'): {'name': 'bob_frontend'},
+                      networks.vim.Datacenter('datacenter-1'): {'networkFolder': self.network_folder}}
+        self.vcenter.content.searchIndex.FindChild.return_value = None
+        patcher = patch.object(networks.NetworkIndex, '_valid', return_value=True)
+        self.fake_valid = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch.object(networks.inventory, 'retrieve')
+    def test_lookup(self, fake_retrieve):
+        """``NetworkIndex`` - ``lookup`` returns the network with the supplied name"""
+        fake_retrieve.return_value = self.found
+        index = networks.NetworkIndex(ttl=300)
+
+        output = index.lookup(self.vcenter, 'bob_frontend')
+
+        self.assertEqual(output, networks.vim.dvs.DistributedVirtualPortgroup('dvportgroup-1'))
+
+    @patch.object(networks.inventory, 'retrieve')
+    def test_lookup_cached(self, fake_retrieve):
+        """``NetworkIndex`` only queries vCenter once per TTL"""
+        fake_retrieve.return_value = self.found
+        index = networks.NetworkIndex(ttl=300)
+
+        index.lookup(self.vcenter, 'bob_frontend')
+        index.lookup(self.vcenter, 'VM Network')
+
+        self.assertEqual(fake_retrieve.call_count, 1)
+        self.assertEqual(index.stats()['hits'], 2)
+
+    @patch.object(networks.inventory, 'retrieve')
+    def test_lookup_expired(self, fake_retrieve):
+        """``NetworkIndex`` rebuilds the index once the TTL expires"""
+        fake_retrieve.return_value = self.found
+        index = networks.NetworkIndex(ttl=-1)
+
+        index.lookup(self.vcenter, 'bob_frontend')
+        index.lookup(self.vcenter, 'VM Network')
+
+        self.assertEqual(fake_retrieve.call_count, 2)
+
+    @patch.object(networks.inventory, 'retrieve')
+    def test_lookup_miss(self, fake_retrieve):
+        """``NetworkIndex`` looks in the network folders for networks not in the index"""
+        fake_retrieve.return_value = self.found
+        new_network = networks.vim.dvs.DistributedVirtualPortgroup('dvportgroup-2')
+        self.vcenter.content.searchIndex.FindChild.return_value = new_network
+        index = networks.NetworkIndex(ttl=300)
+
+        output = index.lookup(self.vcenter, 'alice_frontend')
+        index.lookup(self.vcenter, 'alice_frontend')
+
+        self.assertEqual(output, new_network)
+        self.assertEqual(self.vcenter.content.searchIndex.FindChild.call_count, 1)
+        self.assertEqual(self.vcenter.content.searchIndex.FindChild.call_args[1]['entity'], self.network_folder)
+
+    @patch.object(networks.inventory, 'retrieve')
+    def test_lookup_stale(self, fake_retrieve):
+        """``NetworkIndex`` looks in the network folders again when an indexed network was deleted"""
+        fake_retrieve.return_value = self.found
+        new_network = networks.vim.dvs.DistributedVirtualPortgroup('dvportgroup-2')
+        self.vcenter.content.searchIndex.FindChild.return_value = new_network
+        self.fake_valid.return_value = False
+        index = networks.NetworkIndex(ttl=300)
+
+        output = index.lookup(self.vcenter, 'bob_frontend')
+
+        self.assertEqual(output, new_network)
+        self.assertEqual(index.stats()['stale'], 1)
+
+    def test_valid(self):
+        """``NetworkIndex`` - ``_valid`` is False if the network was renamed"""
+        the_network = MagicMock()
+        the_network.name = 'alice_frontend'
+
+        self.assertFalse(VALID(networks.NetworkIndex(), the_network, 'bob_frontend'))
+
+    def test_valid_deleted(self):
+        """``NetworkIndex`` - ``_valid`` is False if the network was deleted"""
+        the_network = MagicMock()
+        type(the_network).name = PropertyMock(side_effect=networks.vmodl.fault.ManagedObjectNotFound())
+
+        self.assertFalse(VALID(networks.NetworkIndex(), the_network, 'bob_frontend'))
+
+    @patch.object(networks.inventory, 'retrieve')
+    def test_lookup_missing(self, fake_retrieve):
+        """``NetworkIndex`` raises ValueError if the network does not exist"""
+        fake_retrieve.return_value = self.found
+        index = networks.NetworkIndex(ttl=300)
+
+        with self.assertRaises(ValueError):
+            index.lookup(self.vcenter, 'alice_frontend')
+
+    @patch.object(networks.inventory, 'retrieve')
+    def test_destroys_view(self, fake_retrieve):
+        """``NetworkIndex`` cleans up the container view, even if the query fails"""
+        fake_retrieve.side_effect = RuntimeError('testing')
+        index = networks.NetworkIndex(ttl=300)
+
+        with self.assertRaises(RuntimeError):
+            index.lookup(self.vcenter, 'bob_frontend')
+        view = self.vcenter.content.viewManager.CreateContainerView.return_value
+        self.assertTrue(view.DestroyView.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in nfc.py
+"""
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest.mock import patch, MagicMock
+
+from vlab_superna_api.lib import image_catalog
+from vlab_superna_api.lib.worker import nfc
+
+DISKS = {'disk1.vmdk': b'a' * 5000, 'disk2.vmdk': b'b' * 7000}
+
+
+class FakeESXi(BaseHTTPRequestHandler):
+    """Mimics the NFC upload endpoint of ESXi"""
+    protocol_version = 'HTTP/1.1'
+    uploads = {}
+    failures = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.failures:
+            status = self.failures.pop(0)
+            if status is None:
+                # drop the connection mid-upload
+                self.close_connection = True
+                self.connection.close()
+                return
+            self.send_response(status)
+        else:
+            self.uploads[self.path] = body
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _make_lease(port):
+    """Mimic a vim.HttpNfcLease, with a URL for each disk"""
+    lease = MagicMock()
+    lease.info.deviceUrl = []
+    for key in DISKS:
+        device = MagicMock()
+        device.importKey = key
+        device.url = 'http://*:{}/nfc/{}'.format(port, key)
+        lease.info.deviceUrl.append(device)
+    return lease
+
+
+def _make_file_items():
+    """Mimic the vim.OvfManager.FileItem objects of an import spec"""
+    items = []
+    for key in DISKS:
+        item = MagicMock()
+        item.deviceId = key
+        item.path = key
+        items.append(item)
+    return items
+
+
+class TestNfc(unittest.TestCase):
+    """A set of test cases for nfc.py"""
+    @classmethod
+    def setUpClass(cls):
+        """Runs once, before any test case"""
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.ova_file = os.path.join(cls.tmpdir.name, 'Superna_Eyeglass-1.0.0.ova')
+        with tarfile.open(cls.ova_file, 'w') as tar:
+            for name, data in [('superna.ovf', b'<Envelope/>')] + list(DISKS.items()):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        cls.disks = image_catalog.scan_ova(cls.ova_file)['disks']
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeESXi)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Runs once, after every test case"""
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        """Runs before every test case"""
+        FakeESXi.uploads.clear()
+        FakeESXi.failures[:] = []
+        self.lease = _make_lease(self.server.server_address[1])
+
+    def test_upload(self):
+        """``upload`` sends every disk, then completes the lease"""
+        nfc.upload(self.lease, _make_file_items(), self.ova_file, self.disks, '127.0.0.1', MagicMock())
+
+        expected = {'/nfc/{}'.format(k): v for k, v in DISKS.items()}
+
+        self.assertEqual(FakeESXi.uploads, expected)
+        self.lease.HttpNfcLeaseProgress.assert_called_with(100)
+        self.assertTrue(self.lease.HttpNfcLeaseComplete.called)
+
+    @patch.object(nfc, 'const', nfc.const._replace(VLAB_SUPERNA_NFC_CONCURRENCY=1))
+    def test_upload_retry(self):
+        """``upload`` re-sends a disk when the connection breaks"""
+        FakeESXi.failures.append(None)
+
+        nfc.upload(self.lease, _make_file_items(), self.ova_file, self.disks, '127.0.0.1', MagicMock())
+
+        self.assertEqual(len(FakeESXi.uploads), 2)
+        self.assertTrue(self.lease.HttpNfcLeaseComplete.called)
+
+    @patch.object(nfc, 'const', nfc.const._replace(VLAB_SUPERNA_NFC_RETRIES=0))
+    def test_upload_rejected(self):
+        """``upload`` aborts the lease, and raises RuntimeError if ESXi rejects a disk"""
+        FakeESXi.failures.extend([500, 500])
+
+        with self.assertRaises(RuntimeError):
+            nfc.upload(self.lease, _make_file_items(), self.ova_file, self.disks, '127.0.0.1', MagicMock())
+        self.assertTrue(self.lease.HttpNfcLeaseAbort.called)
+        self.assertFalse(self.lease.HttpNfcLeaseComplete.called)
+
+    @patch.object(nfc, 'const', nfc.const._replace(VLAB_SUPERNA_NFC_RETRIES=0, VLAB_SUPERNA_NFC_CONCURRENCY=2))
+    @patch.object(nfc, '_send')
+    def test_upload_stops_others(self, fake_send):
+        """``upload`` tells the other disks to stop once one disk fails for good"""
+        stopped = []
+        sending = threading.Event()
+        def send(conn, url, ova_fh, ova_map, offset, size, report, stop):
+            if url.endswith('disk1.vmdk'):
+                # fail while the other disk is still being sent
+                sending.wait(5)
+                raise OSError('testing')
+            sending.set()
+            stopped.append(stop.wait(5))
+            raise nfc._Stopped()
+        fake_send.side_effect = send
+
+        with self.assertRaises(RuntimeError):
+            nfc.upload(self.lease, _make_file_items(), self.ova_file, self.disks, '127.0.0.1', MagicMock())
+
+        self.assertEqual(stopped, [True])
+        self.assertTrue(self.lease.HttpNfcLeaseAbort.called)
+
+    def test_send_stopped(self):
+        """``_send`` gives up between chunks once told to stop"""
+        conn = MagicMock()
+        stop = threading.Event()
+        stop.set()
+
+        with self.assertRaises(nfc._Stopped):
+            nfc._send(conn, 'https://esxi01/nfc/disk1.vmdk', None, b'a' * 10, 0, 10, MagicMock(), stop)
+        self.assertFalse(conn.sock.sendall.called)
+
+    def test_upload_skips_missing(self):
+        """``upload`` ignores the files of the import spec that are not in the OVA"""
+        items = _make_file_items()
+        extra = MagicMock()
+        extra.path = 'disk3.vmdk'
+        items.append(extra)
+
+        nfc.upload(self.lease, items, self.ova_file, self.disks, '127.0.0.1', MagicMock())
+
+        self.assertEqual(len(FakeESXi.uploads), 2)
+
+    def test_device_url(self):
+        """``device_url`` replaces the wildcard host"""
+        output = nfc.device_url(self.lease, _make_file_items()[0], 'esxi01')
+
+        self.assertTrue(output.startswith('http://esxi01:'))
+
+    def test_device_url_missing(self):
+        """``device_url`` raises RuntimeError if the lease has no URL for the disk"""
+        item = MagicMock()
+        item.deviceId = 'nope'
+
+        with self.assertRaises(RuntimeError):
+            nfc.device_url(self.lease, item, 'esxi01')
+
+    def test_progress(self):
+        """``_Progress`` never reports 100 percent on its own"""
+        progress = nfc._Progress(MagicMock(), total=10)
+        progress.add(10)
+
+        self.assertEqual(progress.percent(), 99)
+
+    def test_progress_reports(self):
+        """``_Progress`` tells the client how many bytes have been sent"""
+        fake_report_progress = MagicMock()
+        progress = nfc._Progress(MagicMock(), total=10, report_progress=fake_report_progress, interval=0.01)
+        fake_report_progress.side_effect = lambda *args, **kwargs: progress.stop()
+        progress.add(4)
+        progress.start()
+        progress._thread.join(5)
+
+        fake_report_progress.assert_called_with(nfc.progress.IMPORTING, bytes=4, total=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
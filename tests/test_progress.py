@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in progress.py
+"""
+import unittest
+import threading
+from unittest.mock import patch, MagicMock
+
+from celery import Celery
+
+from vlab_superna_api.lib.worker import progress
+
+
+class TestTaskProgress(unittest.TestCase):
+    """A set of test cases for the ``TaskProgress`` object"""
+    def test_update_state(self):
+        """``TaskProgress`` publishes the step as the PROGRESS state of the task"""
+        fake_task = MagicMock()
+        fake_task.request.id = 'asdf-asdf-asdf'
+        report_progress = progress.TaskProgress(fake_task, MagicMock())
+
+        report_progress(progress.IMPORTING, bytes=10, total=100)
+
+        the_kwargs = fake_task.update_state.call_args[1]
+
+        self.assertEqual(the_kwargs['state'], 'PROGRESS')
+        self.assertEqual(the_kwargs['meta']['step'], 'importing')
+        self.assertEqual(the_kwargs['meta']['bytes'], 10)
+
+    def test_other_thread(self):
+        """``TaskProgress`` publishes progress reported from another thread"""
+        app = Celery('testing', broker='memory://', backend='cache+memory://')
+
+        @app.task(bind=True)
+        def the_task(self):
+            pass
+
+        the_task.push_request(id='asdf-asdf-asdf')
+        self.addCleanup(the_task.pop_request)
+        report_progress = progress.TaskProgress(the_task, MagicMock())
+        with patch.object(the_task, 'update_state') as fake_update_state:
+            thread = threading.Thread(target=report_progress, args=(progress.IMPORTING,))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(fake_update_state.call_args[1]['task_id'], 'asdf-asdf-asdf')
+
+    def test_not_a_task(self):
+        """``TaskProgress`` does nothing when the task was called directly"""
+        fake_task = MagicMock()
+        fake_task.request.id = None
+        report_progress = progress.TaskProgress(fake_task, MagicMock())
+
+        report_progress(progress.POWERING_ON)
+
+        self.assertFalse(fake_task.update_state.called)
+
+    def test_update_state_error(self):
+        """``TaskProgress`` never raises, even if publishing fails"""
+        fake_task = MagicMock()
+        fake_task.request.id = 'asdf-asdf-asdf'
+        fake_task.update_state.side_effect = RuntimeError('testing')
+        fake_logger = MagicMock()
+        report_progress = progress.TaskProgress(fake_task, fake_logger)
+
+        report_progress(progress.POWERING_ON)
+
+        self.assertTrue(fake_logger.error.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
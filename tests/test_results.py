@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in results.py
+"""
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from celery import Celery
+
+from vlab_superna_api.lib import results
+
+
+class TestResults(unittest.TestCase):
+    """A set of test cases for results.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        backend = 'file://{}'.format(self.tmpdir.name)
+        with patch.object(results, 'const', results.const._replace(VLAB_SUPERNA_RESULT_BACKEND=backend,
+                                                                   VLAB_SUPERNA_RESULT_TTL=60)):
+            self.app = Celery('superna', backend=backend, broker='memory://')
+            results.configure(self.app)
+
+    def test_configure(self):
+        """``configure`` sets the TTL and serializer of results"""
+        self.assertEqual(self.app.conf.result_expires, 60)
+        self.assertEqual(self.app.conf.result_serializer, 'json')
+        self.assertFalse(self.app.conf.result_extended)
+
+    def test_get_many(self):
+        """``get_many`` returns the state of every task"""
+        self.app.backend.store_result('task-1', {'content': {}, 'error': None, 'params': {}}, 'SUCCESS')
+        self.app.backend.store_result('task-2', {'step': 'powering on'}, 'PROGRESS')
+
+        output = results.get_many(self.app, ['task-1', 'task-2', 'task-3'])
+        expected = {'task-1': {'status': 'SUCCESS', 'result': {'content': {}, 'error': None, 'params': {}}},
+                    'task-2': {'status': 'PROGRESS', 'result': {'step': 'powering on'}},
+                    'task-3': {'status': 'PENDING', 'result': None}}
+
+        self.assertEqual(output, expected)
+
+    def test_get_many_shared(self):
+        """``get_many`` returns results stored by a different Celery app (i.e. a worker)"""
+        worker = Celery('superna', backend=self.app.conf.result_backend, broker='memory://')
+        worker.backend.store_result('task-1', {'content': {}, 'error': None, 'params': {}}, 'SUCCESS')
+
+        output = results.get_many(self.app, ['task-1'])
+
+        self.assertEqual(output['task-1']['status'], 'SUCCESS')
+
+    def test_get_many_failure(self):
+        """``get_many`` returns the exception of a failed task"""
+        self.app.backend.mark_as_failure('task-1', RuntimeError('testing'))
+
+        output = results.get_many(self.app, ['task-1'])
+
+        self.assertTrue(isinstance(output['task-1']['result'], Exception))
+
+    def test_get_many_not_key_value(self):
+        """``get_many`` falls back to one lookup per task for backends like rpc://"""
+        fake_app = MagicMock()
+        fake_app.AsyncResult.return_value.state = 'PENDING'
+        fake_app.AsyncResult.return_value.info = None
+
+        output = results.get_many(fake_app, ['task-1', 'task-2', 'task-1'])
+
+        self.assertEqual(fake_app.AsyncResult.call_count, 2)
+        self.assertEqual(output['task-1'], {'status': 'PENDING', 'result': None})
+
+    @patch.object(results.time, 'sleep')
+    @patch.object(results, 'get_many')
+    def test_wait_many(self, fake_get_many, fake_sleep):
+        """``wait_many`` only looks up the tasks that are not done yet"""
+        fake_get_many.side_effect = [{'task-1': {'status': 'SUCCESS', 'result': {}},
+                                      'task-2': {'status': 'PROGRESS', 'result': {}}},
+                                     {'task-2': {'status': 'SUCCESS', 'result': {}}}]
+
+        output = results.wait_many(self.app, ['task-1', 'task-2'], timeout=10)
+
+        self.assertEqual(fake_get_many.call_args_list[1][0][1], ['task-2'])
+        self.assertEqual(output['task-2']['status'], 'SUCCESS')
+
+    @patch.object(results.time, 'sleep')
+    @patch.object(results, 'get_many')
+    def test_wait_many_timeout(self, fake_get_many, fake_sleep):
+        """``wait_many`` returns whatever it has once the timeout expires"""
+        fake_get_many.return_value = {'task-1': {'status': 'PENDING', 'result': None}}
+
+        output = results.wait_many(self.app, ['task-1'], timeout=0)
+
+        self.assertEqual(output['task-1']['status'], 'PENDING')
+        self.assertFalse(fake_sleep.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
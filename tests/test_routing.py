@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in routing.py
+"""
+import unittest
+from unittest.mock import patch
+
+from celery import Celery
+
+from vlab_superna_api.lib import routing
+from vlab_superna_api.lib.worker import tasks
+
+
+class TestRouting(unittest.TestCase):
+    """A set of test cases for routing.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.app = Celery('superna', broker='memory://')
+        routing.configure(self.app)
+
+    def test_configure(self):
+        """``configure`` routes reads to the fast queue, and changes to the slow queue"""
+        show = self.app.amqp.router.route({}, 'superna.show')['queue'].name
+        create = self.app.amqp.router.route({}, 'superna.create')['queue'].name
+
+        self.assertEqual(show, routing.FAST)
+        self.assertEqual(create, routing.SLOW)
+
+    def test_templates(self):
+        """``configure`` routes listing the templates to the fast queue, and rebuilding them to the slow queue"""
+        listing = self.app.amqp.router.route({}, 'superna.templates', args=['myId'])['queue'].name
+        rebuild = self.app.amqp.router.route({}, 'superna.templates', args=['myId'],
+                                             kwargs={'rebuild': True})['queue'].name
+        rebuild_positional = self.app.amqp.router.route({}, 'superna.templates', args=['myId', True])['queue'].name
+
+        self.assertEqual(listing, routing.FAST)
+        self.assertEqual(rebuild, routing.SLOW)
+        self.assertEqual(rebuild_positional, routing.SLOW)
+
+    def test_every_task_routed(self):
+        """Every task the worker defines has a queue in ``ROUTES``"""
+        defined = set(x for x in tasks.app.tasks if x.startswith('superna.'))
+
+        self.assertEqual(defined, set(routing.ROUTES.keys()))
+
+    def test_configure_worker(self):
+        """``configure_worker`` consumes only the queues of the mode, with their concurrency and prefetch"""
+        settings = routing.const._replace(VLAB_SUPERNA_FAST_CONCURRENCY=8, VLAB_SUPERNA_FAST_PREFETCH=4)
+        with patch.object(routing, 'const', settings):
+            routing.configure_worker(self.app, 'fast')
+
+        self.assertEqual([x.name for x in self.app.conf.task_queues], [routing.FAST])
+        self.assertEqual(self.app.conf.worker_concurrency, 8)
+        self.assertEqual(self.app.conf.worker_prefetch_multiplier, 4)
+
+    def test_configure_worker_all(self):
+        """``configure_worker`` in "all" mode consumes both queues, and reserves one task at a time"""
+        settings = routing.const._replace(VLAB_SUPERNA_FAST_CONCURRENCY=8, VLAB_SUPERNA_SLOW_CONCURRENCY=4)
+        with patch.object(routing, 'const', settings):
+            routing.configure_worker(self.app, 'all')
+
+        self.assertEqual([x.name for x in self.app.conf.task_queues], [routing.FAST, routing.SLOW])
+        self.assertEqual(self.app.conf.worker_concurrency, 12)
+        self.assertEqual(self.app.conf.worker_prefetch_multiplier, 1)
+
+    def test_configure_worker_async(self):
+        """``configure_worker`` runs a thread pool for the async execution mode"""
+        settings = routing.const._replace(VLAB_SUPERNA_EXECUTION_MODE='async', VLAB_SUPERNA_ASYNC_THREADS=50)
+        with patch.object(routing, 'const', settings):
+            routing.configure_worker(self.app, 'slow')
+
+        self.assertEqual(self.app.conf.worker_pool, 'threads')
+        self.assertEqual(self.app.conf.worker_concurrency, 50)
+
+    def test_configure_worker_sync(self):
+        """``configure_worker`` leaves the pool alone for the sync execution mode"""
+        routing.configure_worker(self.app, 'slow')
+
+        self.assertEqual(self.app.conf.worker_pool, 'prefork')
+
+    def test_configure_worker_bad_mode(self):
+        """``configure_worker`` raises ValueError for an unknown mode"""
+        with self.assertRaises(ValueError):
+            routing.configure_worker(self.app, 'medium')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in session_pool.py
+"""
+import unittest
+import threading
+from unittest.mock import patch, MagicMock, PropertyMock
+
+from vlab_superna_api.lib.worker import session_pool
+
+
+class TestSessionPool(unittest.TestCase):
+    """A set of test cases for the SessionPool object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.factory = MagicMock()
+        self.factory.side_effect = lambda: MagicMock()
+        self.pool = session_pool.SessionPool(max_size=2, keepalive=0, max_idle=60, factory=self.factory)
+
+    def test_session_reused(self):
+        """``SessionPool`` reuses a session that's been checked back in"""
+        with self.pool.session() as vcenter1:
+            pass
+        with self.pool.session() as vcenter2:
+            pass
+
+        self.assertTrue(vcenter1 is vcenter2)
+
+    def test_counters(self):
+        """``SessionPool`` counts hits and misses"""
+        with self.pool.session():
+            pass
+        with self.pool.session():
+            pass
+
+        stats = self.pool.stats()
+
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_concurrent_sessions(self):
+        """``SessionPool`` creates a new session when the idle ones are in use"""
+        with self.pool.session() as vcenter1:
+            with self.pool.session() as vcenter2:
+                pass
+
+        self.assertFalse(vcenter1 is vcenter2)
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_checkin_on_error(self):
+        """``SessionPool`` returns the session to the pool when the caller raises an error"""
+        with self.assertRaises(ValueError):
+            with self.pool.session():
+                raise ValueError('testing')
+
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_not_authenticated(self):
+        """``SessionPool`` discards sessions that are no longer authenticated"""
+        with self.assertRaises(session_pool.vim.fault.NotAuthenticated):
+            with self.pool.session():
+                raise session_pool.vim.fault.NotAuthenticated()
+
+        stats = self.pool.stats()
+
+        self.assertEqual(stats['idle'], 0)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['discarded'], 1)
+
+    def test_health_check(self):
+        """``SessionPool`` replaces a stale session that fails the health check"""
+        with self.pool.session() as vcenter1:
+            vcenter1.content.sessionManager.currentSession = None
+        self.pool._idle[0].last_used = 0
+        with self.pool.session() as vcenter2:
+            pass
+
+        self.assertFalse(vcenter1 is vcenter2)
+        self.assertTrue(vcenter1.close.called)
+
+    def test_health_check_ok(self):
+        """``SessionPool`` keeps a stale session that passes the health check"""
+        with self.pool.session() as vcenter1:
+            pass
+        self.pool._idle[0].last_used = 0
+        with self.pool.session() as vcenter2:
+            pass
+
+        self.assertTrue(vcenter1 is vcenter2)
+
+    def test_login_failure(self):
+        """``SessionPool`` frees the slot if logging into vCenter fails"""
+        self.factory.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            with self.pool.session():
+                pass
+
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+    def test_flush(self):
+        """``SessionPool`` - ``flush`` logs out of every idle session"""
+        with self.pool.session() as vcenter:
+            pass
+        self.pool.flush()
+
+        self.assertTrue(vcenter.close.called)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def test_ping_idle(self):
+        """``SessionPool`` - ``_ping_idle`` logs out of sessions idle longer than ``max_idle``"""
+        with self.pool.session() as vcenter:
+            pass
+        self.pool._idle[0].last_used -= 61
+        self.pool._ping_idle()
+
+        self.assertTrue(vcenter.close.called)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def test_ping_counts_toward_max(self):
+        """``SessionPool`` doesn't open more than ``max_size`` sessions while the idle ones are pinged"""
+        pool = session_pool.SessionPool(max_size=1, keepalive=0, max_idle=60, factory=self.factory)
+        with pool.session() as vcenter:
+            pass
+        pinging = threading.Event()
+        release = threading.Event()
+
+        def ping():
+            pinging.set()
+            release.wait(5)
+            return MagicMock()
+
+        type(vcenter.content.sessionManager).currentSession = PropertyMock(side_effect=ping)
+        pinger = threading.Thread(target=pool._ping_idle)
+        pinger.start()
+        pinging.wait(5)
+        checked_out = []
+        user = threading.Thread(target=lambda: checked_out.append(pool._checkout()))
+        user.start()
+        user.join(0.2)
+        opened_while_pinging = self.factory.call_count
+        release.set()
+        pinger.join()
+        user.join()
+
+        self.assertEqual(opened_while_pinging, 1)
+        self.assertTrue(checked_out[0].vcenter is vcenter)
+
+    @patch.object(session_pool.os, 'getpid')
+    def test_fork(self, fake_getpid):
+        """``SessionPool`` does not share sessions with a parent process"""
+        fake_getpid.return_value = 1
+        self.pool._reset()
+        with self.pool.session() as vcenter1:
+            pass
+        fake_getpid.return_value = 2
+        with self.pool.session() as vcenter2:
+            pass
+
+        self.assertFalse(vcenter1 is vcenter2)
+
+
+class TestReauthenticate(unittest.TestCase):
+    """A set of test cases for the ``reauthenticate`` decorator"""
+
+    def test_retry(self):
+        """``reauthenticate`` calls the function again if the session expired"""
+        func = MagicMock()
+        func.__name__ = 'func'
+        func.side_effect = [session_pool.vim.fault.NotAuthenticated(), 'worked']
+
+        output = session_pool.reauthenticate(func)()
+        expected = 'worked'
+
+        self.assertEqual(output, expected)
+
+    def test_retry_once(self):
+        """``reauthenticate`` only retries one time"""
+        func = MagicMock()
+        func.__name__ = 'func'
+        func.side_effect = session_pool.vim.fault.NotAuthenticated()
+
+        with self.assertRaises(session_pool.vim.fault.NotAuthenticated):
+            session_pool.reauthenticate(func)()
+
+
+if __name__ == '__main__':
+    unittest.main()
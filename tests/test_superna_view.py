@@ -33,6 +33,13 @@ class TestSupernaView(unittest.TestCase):
         cls.fake_task = MagicMock()
         cls.fake_task.id = 'asdf-asdf-asdf'
         app.celery_app.send_task.return_value = cls.fake_task
+        # Every test case gets an empty dedup store
+        cls.dedup_patcher = patch.object(superna.dedup, 'DEDUP', superna.dedup.Deduplicator())
+        cls.dedup_patcher.start()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.dedup_patcher.stop()
 
     def test_v1_deprecated(self):
         """SupernaView - GET on /api/1/inf/superna returns an HTTP 404"""
@@ -83,6 +90,17 @@ class TestSupernaView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_post_task_retry(self):
+        """SupernaView - A retried POST on /api/2/inf/superna returns the task-id of the first request"""
+        body = {'network': "someLAN", 'name': "mySupernaBox", 'image': "someVersion", 'ip-config' : {'static-ip': '1.2.3.4'}}
+        headers = {'X-Auth': self.token, 'X-REQUEST-ID': 'myId'}
+        first = self.app.post('/api/2/inf/superna', headers=headers, json=body)
+        self.app.application.celery_app.send_task.return_value = MagicMock(id='qwer-qwer-qwer')
+        second = self.app.post('/api/2/inf/superna', headers=headers, json=body)
+
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+        self.assertEqual(first.json['content']['task-id'], second.json['content']['task-id'])
+
     def test_post_task_link(self):
         """SupernaView - POST on /api/2/inf/superna sets the Link header"""
         resp = self.app.post('/api/2/inf/superna',
@@ -102,6 +120,73 @@ class TestSupernaView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_batch_task(self):
+        """SupernaView - POST on /api/2/inf/superna/batch returns a single task-id"""
+        resp = self.app.post('/api/2/inf/superna/batch',
+                             headers={'X-Auth': self.token},
+                             json={'network': "someLAN",
+                                   'image': "someVersion",
+                                   'machines': [{'name': 'superna1', 'ip-config': {'static-ip': '1.2.3.4'}},
+                                                {'name': 'superna2', 'ip-config': {'static-ip': '1.2.3.5'}}]})
+
+        task_id = resp.json['content']['task-id']
+        expected = 'asdf-asdf-asdf'
+
+        self.assertEqual(task_id, expected)
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+
+    def test_batch_defaults(self):
+        """SupernaView - POST on /api/2/inf/superna/batch fills in the IP config defaults"""
+        self.app.post('/api/2/inf/superna/batch',
+                      headers={'X-Auth': self.token},
+                      json={'network': "someLAN",
+                            'image': "someVersion",
+                            'machines': [{'name': 'superna1', 'ip-config': {'static-ip': '1.2.3.4'}}]})
+
+        machines = self.app.application.celery_app.send_task.call_args[0][1][1]
+
+        self.assertEqual(machines[0]['ip-config']['netmask'], '255.255.255.0')
+
+    def test_batch_duplicate_names(self):
+        """SupernaView - POST on /api/2/inf/superna/batch returns 400 if a name is used twice"""
+        resp = self.app.post('/api/2/inf/superna/batch',
+                             headers={'X-Auth': self.token},
+                             json={'network': "someLAN",
+                                   'image': "someVersion",
+                                   'machines': [{'name': 'superna1', 'ip-config': {'static-ip': '1.2.3.4'}},
+                                                {'name': 'superna1', 'ip-config': {'static-ip': '1.2.3.5'}}]})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_batch_delete(self):
+        """SupernaView - DELETE on /api/2/inf/superna/batch returns a task-id"""
+        resp = self.app.delete('/api/2/inf/superna/batch',
+                               headers={'X-Auth': self.token},
+                               json={'names': ['superna1', 'superna2']})
+
+        task_id = resp.json['content']['task-id']
+        expected = 'asdf-asdf-asdf'
+
+        self.assertEqual(task_id, expected)
+
+    def test_batch_delete_all(self):
+        """SupernaView - DELETE on /api/2/inf/superna/batch with "all" deletes every instance"""
+        self.app.delete('/api/2/inf/superna/batch',
+                        headers={'X-Auth': self.token},
+                        json={'all': True})
+
+        machine_names = self.app.application.celery_app.send_task.call_args[0][1][1]
+
+        self.assertTrue(machine_names is None)
+
+    def test_batch_delete_nothing(self):
+        """SupernaView - DELETE on /api/2/inf/superna/batch returns 400 without "names" or "all" """
+        resp = self.app.delete('/api/2/inf/superna/batch',
+                               headers={'X-Auth': self.token},
+                               json={})
+
+        self.assertEqual(resp.status_code, 400)
+
     def test_delete_task(self):
         """SupernaView - DELETE on /api/2/inf/superna returns a task-id"""
         resp = self.app.delete('/api/2/inf/superna',
@@ -144,6 +229,187 @@ class TestSupernaView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    @patch.object(superna, 'image_catalog')
+    @patch.object(superna, 'const', superna.const._replace(VLAB_SUPERNA_IMAGE_SYNC=True))
+    def test_image_sync(self, fake_image_catalog):
+        """SupernaView - GET on the ./image end point can answer without a task"""
+        fake_image_catalog.CATALOG.loaded = True
+        fake_image_catalog.CATALOG.versions.return_value = ['1.2.3']
+        resp = self.app.get('/api/2/inf/superna/image',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'image': ['1.2.3']})
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(superna, 'image_catalog')
+    @patch.object(superna, 'const', superna.const._replace(VLAB_SUPERNA_IMAGE_SYNC=True))
+    def test_image_sync_cache_headers(self, fake_image_catalog):
+        """SupernaView - GET on the ./image end point sets the ETag and Cache-Control headers"""
+        fake_image_catalog.CATALOG.loaded = True
+        fake_image_catalog.CATALOG.versions.return_value = ['1.2.3']
+        resp = self.app.get('/api/2/inf/superna/image',
+                            headers={'X-Auth': self.token})
+
+        self.assertTrue(resp.headers.get('ETag'))
+        self.assertEqual(resp.headers['Cache-Control'], 'private, max-age=300')
+
+    @patch.object(superna, 'image_catalog')
+    @patch.object(superna, 'const', superna.const._replace(VLAB_SUPERNA_IMAGE_SYNC=True))
+    def test_image_sync_not_modified(self, fake_image_catalog):
+        """SupernaView - GET on the ./image end point supports If-None-Match"""
+        fake_image_catalog.CATALOG.loaded = True
+        fake_image_catalog.CATALOG.versions.return_value = ['1.2.3']
+        etag = self.app.get('/api/2/inf/superna/image',
+                            headers={'X-Auth': self.token}).headers['ETag']
+        resp = self.app.get('/api/2/inf/superna/image',
+                            headers={'X-Auth': self.token, 'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 304)
+
+    @patch.object(superna, 'image_catalog')
+    @patch.object(superna, 'const', superna.const._replace(VLAB_SUPERNA_IMAGE_SYNC=True))
+    def test_image_sync_cold(self, fake_image_catalog):
+        """SupernaView - GET on the ./image end point falls back to a task when the catalog is not loaded"""
+        fake_image_catalog.CATALOG.loaded = False
+        resp = self.app.get('/api/2/inf/superna/image',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertTrue(fake_image_catalog.CATALOG.warm.called)
+
+    @patch.object(superna, 'image_catalog')
+    @patch.object(superna, 'const', superna.const._replace(VLAB_SUPERNA_IMAGE_SYNC=True))
+    def test_image_sync_error(self, fake_image_catalog):
+        """SupernaView - GET on the ./image end point falls back to a task if the catalog cannot be read"""
+        fake_image_catalog.CATALOG.loaded = True
+        fake_image_catalog.CATALOG.versions.side_effect = FileNotFoundError('testing')
+        resp = self.app.get('/api/2/inf/superna/image',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+
+    @patch.object(superna.results, 'wait_many')
+    def test_tasks(self, fake_wait_many):
+        """SupernaView - POST on the ./task end point returns the status of every task"""
+        fake_wait_many.return_value = {'task-1': {'status': 'SUCCESS',
+                                                 'result': {'content': {'mySuperna': {}}, 'error': None, 'params': {}}},
+                                      'task-2': {'status': 'PROGRESS', 'result': {'step': 'powering on'}},
+                                      'task-3': {'status': 'FAILURE', 'result': RuntimeError('testing')},
+                                      'task-4': {'status': 'PENDING', 'result': None}}
+        resp = self.app.post('/api/2/inf/superna/task',
+                             headers={'X-Auth': self.token},
+                             json={'task-ids': ['task-1', 'task-2', 'task-3', 'task-4']})
+
+        expected = {'task-1': {'status': 'SUCCESS', 'content': {'mySuperna': {}}, 'error': None, 'params': {}},
+                    'task-2': {'status': 'PROGRESS', 'progress': {'step': 'powering on'}},
+                    'task-3': {'status': 'FAILURE', 'error': 'testing'},
+                    'task-4': {'status': 'PENDING'}}
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], expected)
+
+    @patch.object(superna.results, 'wait_many')
+    def test_tasks_timeout(self, fake_wait_many):
+        """SupernaView - POST on the ./task end point waits for the supplied timeout"""
+        fake_wait_many.return_value = {}
+        self.app.post('/api/2/inf/superna/task',
+                      headers={'X-Auth': self.token},
+                      json={'task-ids': ['task-1'], 'timeout': 10})
+
+        self.assertEqual(fake_wait_many.call_args[1]['timeout'], 10)
+
+    def test_tasks_timeout_max(self):
+        """SupernaView - POST on the ./task end point caps how long a client can wait"""
+        resp = self.app.post('/api/2/inf/superna/task',
+                             headers={'X-Auth': self.token},
+                             json={'task-ids': ['task-1'], 'timeout': 100000})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_tasks_timeout_thread(self):
+        """SupernaView - POST on the ./task end point gives back its thread within 25 seconds"""
+        resp = self.app.post('/api/2/inf/superna/task',
+                             headers={'X-Auth': self.token},
+                             json={'task-ids': ['task-1'], 'timeout': 26})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_tasks_no_ids(self):
+        """SupernaView - POST on the ./task end point requires at least one task id"""
+        resp = self.app.post('/api/2/inf/superna/task',
+                             headers={'X-Auth': self.token},
+                             json={'task-ids': []})
+
+        self.assertEqual(resp.status_code, 400)
+
+    @patch.object(superna, 'const', superna.const._replace(VLAB_SUPERNA_EVENTS_POLL=0))
+    def test_events(self):
+        """SupernaView - GET on the ./task/<tid>/events end point streams the progress of the task"""
+        fake_result = MagicMock()
+        states = iter(['PENDING', 'PROGRESS', 'PROGRESS', 'SUCCESS'])
+        type(fake_result).state = property(lambda _: next(states))
+        fake_result.info = {'step': 'powering on'}
+        fake_result.result = {'content': {'mySuperna': {}}}
+        self.app.application.celery_app.AsyncResult.return_value = fake_result
+
+        resp = self.app.get('/api/2/inf/superna/task/asdf-asdf-asdf/events',
+                            headers={'X-Auth': self.token})
+        body = resp.get_data(as_text=True)
+        events = [x.split('\n')[0] for x in body.split('\n\n') if x]
+        expected = ['event: pending', 'event: progress', 'event: success']
+
+        self.assertEqual(events, expected)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/event-stream'))
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+    @patch.object(superna, 'const', superna.const._replace(VLAB_SUPERNA_EVENTS_POLL=0))
+    def test_events_failure(self):
+        """SupernaView - GET on the ./task/<tid>/events end point ends the stream when the task fails"""
+        fake_result = MagicMock()
+        fake_result.state = 'FAILURE'
+        fake_result.result = RuntimeError('testing')
+        self.app.application.celery_app.AsyncResult.return_value = fake_result
+
+        resp = self.app.get('/api/2/inf/superna/task/asdf-asdf-asdf/events',
+                            headers={'X-Auth': self.token})
+        body = resp.get_data(as_text=True)
+        expected = 'event: failure\ndata: {"error":"testing"}\n\n'
+
+        self.assertEqual(body, expected)
+
+    @patch.object(superna, 'const', superna.const._replace(VLAB_SUPERNA_EVENTS_POLL=0,
+                                                           VLAB_SUPERNA_EVENTS_TIMEOUT=-1))
+    def test_events_timeout(self):
+        """SupernaView - GET on the ./task/<tid>/events end point tells the client to reconnect after VLAB_SUPERNA_EVENTS_TIMEOUT"""
+        fake_result = MagicMock()
+        fake_result.state = 'PENDING'
+        self.app.application.celery_app.AsyncResult.return_value = fake_result
+
+        resp = self.app.get('/api/2/inf/superna/task/asdf-asdf-asdf/events',
+                            headers={'X-Auth': self.token})
+        body = resp.get_data(as_text=True)
+
+        self.assertTrue(body.endswith('event: reconnect\ndata: {}\nretry: 0\n\n'))
+
+    @patch.object(superna, 'const', superna.const._replace(VLAB_SUPERNA_EVENTS_POLL=0,
+                                                           VLAB_SUPERNA_EVENTS_TIMEOUT=-1))
+    def test_events_last_event_id(self):
+        """SupernaView - GET on the ./task/<tid>/events end point doesn't resend the event named by Last-Event-ID"""
+        fake_result = MagicMock()
+        fake_result.state = 'PENDING'
+        self.app.application.celery_app.AsyncResult.return_value = fake_result
+        first = self.app.get('/api/2/inf/superna/task/asdf-asdf-asdf/events',
+                             headers={'X-Auth': self.token}).get_data(as_text=True)
+        event_id = [x for x in first.split('\n') if x.startswith('id: ')][0][4:]
+
+        resp = self.app.get('/api/2/inf/superna/task/asdf-asdf-asdf/events',
+                            headers={'X-Auth': self.token, 'Last-Event-ID': event_id})
+        body = resp.get_data(as_text=True)
+
+        self.assertTrue(first.startswith('event: pending'))
+        self.assertTrue(body.startswith('event: reconnect'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -20,6 +20,19 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'aio')
+    @patch.object(tasks, 'vmware')
+    def test_show_async(self, fake_vmware, fake_aio):
+        """``show`` uses the event loop in the async execution mode"""
+        fake_aio.enabled.return_value = True
+        fake_aio.run.return_value = {'worked': True}
+
+        output = tasks.show(username='bob', txn_id='myId')
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_vmware.show_superna.called)
+
     @patch.object(tasks, 'vmware')
     def test_show_value_error(self, fake_vmware):
         """``show`` sets the error in the dictionary to the ValueError message"""
@@ -51,6 +64,22 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'vmware')
+    def test_create_reports_progress(self, fake_vmware):
+        """``create`` has ``create_superna`` publish its progress via the task state"""
+        fake_vmware.create_superna.return_value = {'worked': True}
+
+        tasks.create(username='bob',
+                     machine_name='supernaBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     ip_config={},
+                     txn_id='myId')
+
+        the_kwargs = fake_vmware.create_superna.call_args[1]
+
+        self.assertTrue(isinstance(the_kwargs['report_progress'], tasks.TaskProgress))
+
     @patch.object(tasks, 'vmware')
     def test_create_value_error(self, fake_vmware):
         """``create`` sets the error in the dictionary to the ValueError message"""
@@ -72,6 +101,41 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'vmware')
+    def test_create_batch(self, fake_vmware):
+        """``create_batch`` returns the result of every VM in the batch"""
+        fake_vmware.create_batch.return_value = {'created': {'superna1': {}}, 'failed': {}}
+
+        output = tasks.create_batch(username='bob',
+                                    machines=[{'name': 'superna1', 'ip-config': {}}],
+                                    image='0.0.1',
+                                    network='someLAN',
+                                    txn_id='myId')
+        expected = {'content' : {'created': {'superna1': {}}, 'failed': {}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_create_batch_partial(self, fake_vmware):
+        """``create_batch`` sets the error when some of the VMs failed"""
+        fake_vmware.create_batch.return_value = {'created': {'superna1': {}}, 'failed': {'superna2': 'testing'}}
+        machines = [{'name': 'superna1', 'ip-config': {}}, {'name': 'superna2', 'ip-config': {}}]
+
+        output = tasks.create_batch(username='bob', machines=machines, image='0.0.1', network='someLAN', txn_id='myId')
+        expected = 'Failed to create 1 of 2 instances'
+
+        self.assertEqual(output['error'], expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_create_batch_value_error(self, fake_vmware):
+        """``create_batch`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.create_batch.side_effect = [ValueError('testing')]
+
+        output = tasks.create_batch(username='bob', machines=[], image='0.0.1', network='someLAN', txn_id='myId')
+        expected = {'content' : {}, 'error': 'testing', 'params': {}}
+
+        self.assertEqual(output, expected)
+
     @patch.object(tasks, 'vmware')
     def test_delete_ok(self, fake_vmware):
         """``delete`` returns a dictionary when everything works as expected"""
@@ -92,6 +156,26 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'vmware')
+    def test_delete_batch(self, fake_vmware):
+        """``delete_batch`` returns which VMs were deleted"""
+        fake_vmware.delete_many.return_value = {'deleted': ['superna1'], 'failed': {}}
+
+        output = tasks.delete_batch(username='bob', machine_names=['superna1'], txn_id='myId')
+        expected = {'content' : {'deleted': ['superna1'], 'failed': {}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_delete_batch_partial(self, fake_vmware):
+        """``delete_batch`` sets the error when some VMs were not deleted"""
+        fake_vmware.delete_many.return_value = {'deleted': [], 'failed': {'superna1': 'testing'}}
+
+        output = tasks.delete_batch(username='bob', machine_names=['superna1'], txn_id='myId')
+        expected = 'Failed to delete 1 instances'
+
+        self.assertEqual(output['error'], expected)
+
     @patch.object(tasks, 'vmware')
     def test_image(self, fake_vmware):
         """``image`` returns a dictionary when everything works as expected"""
@@ -102,6 +186,133 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'warm_pool')
+    @patch.object(tasks, 'admission')
+    @patch.object(tasks, 'tracing')
+    @patch.object(tasks, 'folders')
+    @patch.object(tasks, 'networks')
+    @patch.object(tasks, 'waiter')
+    @patch.object(tasks, 'vmware')
+    @patch.object(tasks, 'image_catalog')
+    @patch.object(tasks, 'session_pool')
+    def test_stats(self, fake_session_pool, fake_image_catalog, fake_vmware, fake_waiter, fake_networks, fake_folders,
+                   fake_tracing, fake_admission, fake_warm_pool):
+        """``stats`` returns the performance counters of the worker"""
+        fake_session_pool.SESSIONS.stats.return_value = {'hits': 1}
+        fake_image_catalog.CATALOG.stats.return_value = {'refreshes': 1}
+        fake_vmware.SHOW_CACHE.stats.return_value = {'hit_rate': 0.5}
+        fake_waiter.WAITER.stats.return_value = {'waits': 2}
+        fake_networks.INDEX.stats.return_value = {'hits': 3}
+        fake_folders.USER_FOLDERS.stats.return_value = {'hits': 4}
+        fake_tracing.EXPORTER.stats.return_value = {'exported': 5}
+        fake_admission.ADMISSION.stats.return_value = {'admitted': 6}
+        fake_warm_pool.stats.return_value = {'2.5.6': {'ready': 1}}
+
+        output = tasks.stats(txn_id='myId')
+        expected = {'content' : {'sessions' : {'hits': 1},
+                                 'images': {'refreshes': 1},
+                                 'show_cache': {'hit_rate': 0.5},
+                                 'waiter': {'waits': 2},
+                                 'networks': {'hits': 3},
+                                 'folders': {'hits': 4},
+                                 'tracing': {'exported': 5},
+                                 'admission': {'admitted': 6},
+                                 'warm_pool': {'2.5.6': {'ready': 1}}},
+                    'error': None,
+                    'params' : {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'refill_pool')
+    @patch.object(tasks, 'warm_pool')
+    @patch.object(tasks, 'vmware')
+    def test_create_refills_pool(self, fake_vmware, fake_warm_pool, fake_refill_pool):
+        """``create`` queues a refill of the warm pool, when the pool is used"""
+        fake_vmware.create_superna.return_value = {'worked': True}
+        fake_warm_pool.target_size.return_value = 2
+
+        tasks.create(username='bob',
+                     machine_name='supernaBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     ip_config={},
+                     txn_id='myId')
+
+        fake_refill_pool.apply_async.assert_called_with(args=('myId',), kwargs={'version': '0.0.1'})
+
+    @patch.object(tasks, 'image_catalog')
+    @patch.object(tasks, 'warm_pool')
+    def test_refill_pool(self, fake_warm_pool, fake_image_catalog):
+        """``refill_pool`` refills the pool of every version by default"""
+        fake_image_catalog.CATALOG.versions.return_value = ['1.0.0', '1.1.0']
+        fake_warm_pool.refill.return_value = []
+
+        output = tasks.refill_pool(txn_id='myId')
+        expected = {'content' : {'staged' : {'1.0.0': [], '1.1.0': []}}, 'error': None, 'params' : {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'warm_pool')
+    def test_refill_pool_value_error(self, fake_warm_pool):
+        """``refill_pool`` sets the error in the dictionary to the ValueError message"""
+        fake_warm_pool.refill.side_effect = [ValueError('testing')]
+
+        output = tasks.refill_pool(txn_id='myId', version='1.0.0')
+        expected = {'content' : {}, 'error': 'testing', 'params' : {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_template_registry(self, fake_vmware):
+        """``template_registry`` returns a dictionary when everything works as expected"""
+        fake_vmware.sync_templates.return_value = {'1.2.3': {'current': True}}
+
+        output = tasks.template_registry(txn_id='myId')
+        expected = {'content' : {'templates' : {'1.2.3': {'current': True}}}, 'error': None, 'params' : {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_template_registry_value_error(self, fake_vmware):
+        """``template_registry`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.sync_templates.side_effect = [ValueError("testing")]
+
+        output = tasks.template_registry(txn_id='myId', rebuild=True)
+        expected = {'content' : {}, 'error': 'testing', 'params' : {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks.metrics, 'QUEUE_SECONDS')
+    @patch.object(tasks, 'tracing')
+    def test_trace(self, fake_tracing, fake_queue_seconds):
+        """``start_trace`` records the time in the broker, and traces the task as a child of the API request"""
+        task = MagicMock()
+        task.name = 'superna.show'
+        task.request.get.side_effect = {fake_tracing.TRACEPARENT: '00-aa-bb-01', fake_tracing.SENT_AT: 1}.get
+        the_span = MagicMock()
+        fake_tracing.start.side_effect = [MagicMock(), the_span]
+
+        tasks.start_trace(task_id='1234', task=task)
+        tasks.finish_trace(task_id='1234', state='SUCCESS', retval={'error': None})
+
+        queued = fake_tracing.start.call_args_list[0]
+        self.assertEqual(queued[0][:2], ('queue', '00-aa-bb-01'))
+        self.assertEqual(fake_tracing.start.call_args_list[1][0], ('superna.show', '00-aa-bb-01'))
+        self.assertTrue(fake_queue_seconds.observe.called)
+        self.assertTrue(the_span.finish.called)
+        self.assertEqual(tasks._SPANS, {})
+
+
+    @patch.object(tasks, 'aio')
+    def test_check_pool(self, fake_aio):
+        """``check_pool`` warns when the async execution mode runs on a prefork pool"""
+        fake_aio.enabled.return_value = True
+        worker = MagicMock()
+        worker.pool_cls = tasks.concurrency.get_implementation('prefork')
+
+        with self.assertLogs(tasks.__name__, level='WARNING'):
+            tasks.check_pool(sender=worker)
+
 
 if __name__ == '__main__':
     unittest.main()
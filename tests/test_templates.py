@@ -0,0 +1,299 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in templates.py
+"""
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_superna_api.lib.worker import templates
+
+
+def lookup_network(vcenter, name):
+    """Stands in for ``networks.lookup``, using the ``networks`` attribute of the (fake) vCenter"""
+    try:
+        return vcenter.networks[name]
+    except KeyError:
+        raise ValueError('No such network named {}'.format(name))
+
+
+def user_folder(vcenter, username):
+    """Stands in for ``folders.user_folder``, using the ``get_by_name`` method of the (fake) vCenter"""
+    return vcenter.get_by_name(name=username, vimtype=templates.vim.Folder)
+
+
+IMAGE_INFO = {'file': 'Superna_Eyeglass-2.5.6.ova',
+              'networks': ['VM Network'],
+              'properties': ['hostname'],
+              'size': 100,
+              'mtime': 1234}
+
+
+class TestTemplates(unittest.TestCase):
+    """A set of test cases for templates.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        templates._REGISTRY.clear()
+        self.logger = MagicMock()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        the_admission = templates.admission.Admission(url='file://{}'.format(tmpdir.name))
+        for patcher in (patch.object(templates.networks, 'lookup', lookup_network),
+                        patch.object(templates.folders, 'user_folder', user_folder),
+                        patch.object(templates.admission, 'ADMISSION', the_admission)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_template_name(self):
+        """``template_name`` includes the version of Superna"""
+        output = templates.template_name('2.5.6')
+        expected = 'SupernaTemplate-2.5.6'
+
+        self.assertEqual(output, expected)
+
+    @patch.object(templates.inventory, 'folder_vms')
+    def test_list_templates(self, fake_folder_vms):
+        """``list_templates`` only returns Superna templates"""
+        vm1 = templates.vim.VirtualMachine('vm-1')
+        vm2 = templates.vim.VirtualMachine('vm-2')
+        vm3 = templates.vim.VirtualMachine('vm-3')
+        fake_folder_vms.return_value = {vm1: {'name': 'SupernaTemplate-2.5.6',
+                                              'config.annotation': '{"component": "SupernaTemplate", "version": "2.5.6"}'},
+                                        vm2: {'name': 'foo', 'config.annotation': 'some notes'},
+                                        vm3: {'name': 'SupernaTemplate-2.5.6-retired-1234',
+                                              'config.annotation': '{"component": "SupernaTemplate", "version": "2.5.6"}'}}
+
+        output = templates.list_templates(MagicMock())
+        expected = {'2.5.6': {'vm': vm1, 'meta': {'component': 'SupernaTemplate', 'version': '2.5.6'}}}
+
+        self.assertEqual(output, expected)
+
+    def test_is_current(self):
+        """``is_current`` returns True when the template was made from the current OVA"""
+        meta = {'ova_mtime': 1234, 'ova_size': 100}
+
+        self.assertTrue(templates.is_current(meta, IMAGE_INFO))
+
+    def test_is_current_changed(self):
+        """``is_current`` returns False when the OVA changed"""
+        meta = {'ova_mtime': 1000, 'ova_size': 100}
+
+        self.assertFalse(templates.is_current(meta, IMAGE_INFO))
+
+    @patch.object(templates, 'build_template')
+    @patch.object(templates, 'list_templates')
+    def test_ensure_template_cached(self, fake_list_templates, fake_build_template):
+        """``ensure_template`` uses the registry, instead of looking up the template"""
+        templates._REGISTRY['2.5.6'] = {'moref': 'vm-1', 'meta': {'ova_mtime': 1234, 'ova_size': 100}}
+
+        output = templates.ensure_template(MagicMock(), '2.5.6', IMAGE_INFO, self.logger)
+
+        self.assertEqual(output._moId, 'vm-1')
+        self.assertFalse(fake_list_templates.called)
+        self.assertFalse(fake_build_template.called)
+
+    @patch.object(templates.inventory, 'folder_vms')
+    def test_ensure_template_other_session(self, fake_folder_vms):
+        """``ensure_template`` returns the template bound to the caller's session, not the one that found it"""
+        old_session = MagicMock()
+        new_session = MagicMock()
+        the_template = templates.vim.VirtualMachine('vm-1', stub=old_session._conn._stub)
+        annotation = '{"component": "SupernaTemplate", "version": "2.5.6", "ova_mtime": 1234, "ova_size": 100}'
+        fake_folder_vms.return_value = {the_template: {'name': 'SupernaTemplate-2.5.6', 'config.annotation': annotation}}
+        templates.list_templates(old_session)
+
+        output = templates.ensure_template(new_session, '2.5.6', IMAGE_INFO, self.logger)
+
+        self.assertEqual(output._moId, 'vm-1')
+        self.assertTrue(output._stub is new_session._conn._stub)
+        self.assertEqual(fake_folder_vms.call_count, 1)
+
+    @patch.object(templates, 'build_template')
+    @patch.object(templates, 'list_templates')
+    def test_ensure_template_builds(self, fake_list_templates, fake_build_template):
+        """``ensure_template`` builds the template if it does not exist"""
+        fake_list_templates.return_value = {}
+        fake_build_template.return_value = 'newTemplate'
+
+        output = templates.ensure_template(MagicMock(), '2.5.6', IMAGE_INFO, self.logger)
+
+        self.assertEqual(output, 'newTemplate')
+
+    @patch.object(templates, 'wait_task')
+    @patch.object(templates, 'build_template')
+    @patch.object(templates, 'list_templates')
+    def test_ensure_template_rebuilds(self, fake_list_templates, fake_build_template, fake_wait_task):
+        """``ensure_template`` retires and rebuilds the template when the OVA changed"""
+        fake_list_templates.side_effect = lambda _: templates._REGISTRY.update(
+            {'2.5.6': {'moref': 'vm-1', 'meta': {'ova_mtime': 1, 'ova_size': 1}}})
+        fake_build_template.return_value = 'newTemplate'
+
+        with patch.object(templates, '_bind') as fake_bind:
+            output = templates.ensure_template(MagicMock(), '2.5.6', IMAGE_INFO, self.logger)
+
+        new_name = fake_bind.return_value.Rename_Task.call_args[1]['newName']
+
+        self.assertEqual(output, 'newTemplate')
+        self.assertFalse(fake_bind.return_value.Destroy_Task.called)
+        self.assertTrue(new_name.startswith('SupernaTemplate-2.5.6-retired-'))
+
+    @patch.object(templates, 'wait_task')
+    @patch.object(templates.virtual_machine, 'set_meta')
+    @patch.object(templates, 'import_ova')
+    @patch.object(templates, 'template_folder')
+    def test_build_template(self, fake_template_folder, fake_import_ova, fake_set_meta, fake_wait_task):
+        """``build_template`` imports the OVA, snapshots it, and marks it as a template"""
+        vcenter = MagicMock()
+        vcenter.networks = {'VM Network': templates.vim.Network('net-1')}
+
+        output = templates.build_template(vcenter, '2.5.6', IMAGE_INFO, self.logger)
+
+        self.assertTrue(output.CreateSnapshot_Task.called)
+        self.assertTrue(output.MarkAsTemplate.called)
+        self.assertTrue(fake_import_ova.call_args[0][1].endswith(IMAGE_INFO['file']))
+        self.assertTrue('2.5.6' in templates._REGISTRY)
+
+    @patch.object(templates, 'wait_task')
+    @patch.object(templates.virtual_machine, 'set_meta')
+    @patch.object(templates, 'import_ova')
+    @patch.object(templates, 'template_folder')
+    def test_build_template_cleans_up(self, fake_template_folder, fake_import_ova, fake_set_meta, fake_wait_task):
+        """``build_template`` destroys the imported VM if it can't be made into a template"""
+        vcenter = MagicMock()
+        vcenter.networks = {'VM Network': templates.vim.Network('net-1')}
+        fake_set_meta.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            templates.build_template(vcenter, '2.5.6', IMAGE_INFO, self.logger)
+
+        self.assertTrue(fake_import_ova.return_value.Destroy_Task.called)
+        self.assertFalse('2.5.6' in templates._REGISTRY)
+
+    @patch.object(templates, 'wait_task')
+    @patch.object(templates, 'nfc')
+    @patch.object(templates, 'virtual_machine')
+    @patch.object(templates, 'image_catalog')
+    @patch.object(templates, 'pick_datastore')
+    def test_import_ova_cleans_up(self, fake_pick_datastore, fake_image_catalog, fake_virtual_machine, fake_nfc,
+                                  fake_wait_task):
+        """``import_ova`` destroys the half-made VM when the upload fails"""
+        vcenter = MagicMock()
+        vcenter.host_systems = {'esxi1': MagicMock()}
+        vcenter.host_systems['esxi1'].runtime.inMaintenanceMode = False
+        fake_pick_datastore.return_value.name = 'ds1'
+        fake_nfc.upload.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            templates.import_ova(vcenter, 'some.ova', [], MagicMock(), 'mySuperna', self.logger)
+        the_vm = fake_virtual_machine._get_lease.return_value.info.entity
+
+        self.assertTrue(the_vm.Destroy_Task.called)
+
+    @patch.object(templates, 'template_folder')
+    def test_build_template_no_network(self, fake_template_folder):
+        """``build_template`` raises ValueError if the template network does not exist"""
+        vcenter = MagicMock()
+        vcenter.networks = {}
+
+        with self.assertRaises(ValueError):
+            templates.build_template(vcenter, '2.5.6', IMAGE_INFO, self.logger)
+
+    @patch.object(templates, '_nic_spec')
+    @patch.object(templates, 'pick_datastore')
+    @patch.object(templates, 'wait_task')
+    def test_clone(self, fake_wait_task, fake_pick_datastore, fake_nic_spec):
+        """``clone`` returns the new VM"""
+        fake_wait_task.return_value = 'newVM'
+        fake_nic_spec.return_value = templates.vim.vm.device.VirtualDeviceSpec()
+        the_template = MagicMock()
+        vcenter = MagicMock()
+        vcenter.resource_pools = {templates.const.INF_VCENTER_RESORUCE_POOL: templates.vim.ResourcePool('pool-1')}
+        fake_pick_datastore.return_value = templates.vim.Datastore('ds-1')
+
+        output = templates.clone(vcenter, the_template, MagicMock(), 'mySuperna', MagicMock())
+
+        self.assertEqual(output, 'newVM')
+        spec = the_template.CloneVM_Task.call_args[1]['spec']
+        self.assertEqual(spec.location.diskMoveType, None)
+
+    @patch.object(templates, '_nic_spec')
+    @patch.object(templates, 'pick_datastore')
+    @patch.object(templates, 'wait_task')
+    def test_clone_linked(self, fake_wait_task, fake_pick_datastore, fake_nic_spec):
+        """``clone`` can make linked clones"""
+        fake_nic_spec.return_value = templates.vim.vm.device.VirtualDeviceSpec()
+        the_template = MagicMock()
+        the_template.snapshot.currentSnapshot = templates.vim.vm.Snapshot('snap-1')
+        vcenter = MagicMock()
+        vcenter.resource_pools = {templates.const.INF_VCENTER_RESORUCE_POOL: templates.vim.ResourcePool('pool-1')}
+
+        templates.clone(vcenter, the_template, MagicMock(), 'mySuperna', MagicMock(), linked=True)
+        spec = the_template.CloneVM_Task.call_args[1]['spec']
+
+        self.assertEqual(spec.location.diskMoveType, 'createNewChildDiskBacking')
+        self.assertFalse(fake_pick_datastore.called)
+
+    def test_clone_bad_name(self):
+        """``clone`` raises ValueError if the machine name is not a valid hostname"""
+        with self.assertRaises(ValueError):
+            templates.clone(MagicMock(), MagicMock(), MagicMock(), 'my_superna!', MagicMock())
+
+    def test_import_ova_bad_name(self):
+        """``import_ova`` raises ValueError if the machine name is invalid"""
+        with self.assertRaises(ValueError):
+            templates.import_ova(MagicMock(), 'some.ova', [], MagicMock(), 'bad_name!', self.logger)
+
+    @patch.object(templates, 'nfc')
+    @patch.object(templates, 'virtual_machine')
+    @patch.object(templates, 'image_catalog')
+    @patch.object(templates, 'pick_datastore')
+    @patch.object(templates, 'admission')
+    def test_import_ova_slots(self, fake_admission, fake_pick_datastore, fake_image_catalog, fake_virtual_machine,
+                              fake_nfc):
+        """``import_ova`` uploads on the least busy host, once it has a slot on the datastore and host"""
+        vcenter = MagicMock()
+        vcenter.host_systems = {'esxi1': MagicMock(), 'esxi2': MagicMock()}
+        vcenter.host_systems['esxi1'].runtime.inMaintenanceMode = False
+        vcenter.host_systems['esxi2'].runtime.inMaintenanceMode = False
+        fake_pick_datastore.return_value.name = 'ds1'
+        fake_admission.ADMISSION.least_busy.return_value = 'esxi2'
+
+        templates.import_ova(vcenter, 'some.ova', [], MagicMock(), 'mySuperna', self.logger)
+        resources = fake_admission.ADMISSION.slots.call_args[0][0]
+        lease_host = fake_virtual_machine._get_lease.call_args[0][3]
+
+        self.assertEqual([x[:2] for x in resources], [('datastore', 'ds1'), ('host', 'esxi2')])
+        self.assertTrue(lease_host is vcenter.host_systems['esxi2'])
+        self.assertTrue(fake_admission.ADMISSION.slots.return_value.__exit__.called)
+
+    def test_nic_spec_no_nic(self):
+        """``_nic_spec`` raises RuntimeError if the template has no NIC"""
+        the_template = MagicMock()
+        the_template.config.hardware.device = []
+
+        with self.assertRaises(RuntimeError):
+            templates._nic_spec(the_template, MagicMock())
+
+    @patch.object(templates, 'clone')
+    @patch.object(templates, 'ensure_template')
+    def test_deploy_missing_template(self, fake_ensure_template, fake_clone):
+        """``deploy`` rebuilds the template if it was deleted"""
+        fake_clone.side_effect = [templates.vmodl.fault.ManagedObjectNotFound(), 'newVM']
+
+        output = templates.deploy(MagicMock(), 'bob', 'mySuperna', '2.5.6', IMAGE_INFO, MagicMock(), self.logger)
+
+        self.assertEqual(output, 'newVM')
+        self.assertEqual(fake_ensure_template.call_count, 2)
+
+    def test_registry(self):
+        """``registry`` describes the known templates"""
+        templates._REGISTRY['2.5.6'] = {'vm': 'someTemplate', 'meta': {'version': '2.5.6'}}
+
+        output = templates.registry()
+        expected = {'2.5.6': {'name': 'SupernaTemplate-2.5.6', 'meta': {'version': '2.5.6'}}}
+
+        self.assertEqual(output, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the tracing.py module
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import ujson
+
+from vlab_superna_api.lib import const, tracing
+
+
+class _Collected(object):
+    """Stands in for ``tracing.EXPORTER``, and keeps every span it's given"""
+    def __init__(self):
+        self.spans = []
+
+    def export(self, the_span):
+        self.spans.append(the_span)
+
+
+class TestParse(unittest.TestCase):
+    """A set of test cases for the ``parse`` function"""
+    def test_parse(self):
+        """``parse`` returns the trace and span id of a traceparent header"""
+        output = tracing.parse('00-{}-{}-01'.format('a' * 32, 'b' * 16))
+
+        self.assertEqual(output, ('a' * 32, 'b' * 16))
+
+    def test_parse_invalid(self):
+        """``parse`` returns None for a header it cannot read"""
+        for header in (None, 'foo', '00-abc-def-01', '00-{}-{}-01'.format('z' * 32, 'b' * 16)):
+            self.assertEqual(tracing.parse(header), None)
+
+
+@patch.object(tracing, 'const', const._replace(VLAB_SUPERNA_TRACE_EXPORTER='file'))
+class TestSpans(unittest.TestCase):
+    """A set of test cases for making spans"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.exporter = _Collected()
+        patcher = patch.object(tracing, 'EXPORTER', self.exporter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_nested(self):
+        """``span`` makes the spans within it children of it"""
+        with tracing.span('parent') as parent:
+            with tracing.span('child') as child:
+                pass
+
+        self.assertEqual(child.parent_id, parent.span_id)
+        self.assertEqual(child.trace_id, parent.trace_id)
+        self.assertEqual(parent.parent_id, None)
+
+    def test_exported(self):
+        """``span`` exports the span when the ``with`` statement ends"""
+        with tracing.span('foo', bar=1):
+            pass
+
+        self.assertEqual(len(self.exporter.spans), 1)
+        self.assertEqual(self.exporter.spans[0].attributes, {'bar': 1})
+        self.assertTrue(self.exporter.spans[0].end >= self.exporter.spans[0].start)
+
+    def test_error(self):
+        """``span`` records the error that ended the span"""
+        with self.assertRaises(RuntimeError):
+            with tracing.span('foo'):
+                raise RuntimeError('doh')
+
+        self.assertEqual(self.exporter.spans[0].error, 'doh')
+
+    def test_traceparent(self):
+        """``start`` makes a child of the span in the traceparent header"""
+        the_span = tracing.start('foo', '00-{}-{}-01'.format('a' * 32, 'b' * 16))
+
+        self.assertEqual(the_span.trace_id, 'a' * 32)
+        self.assertEqual(the_span.parent_id, 'b' * 16)
+
+    def test_headers(self):
+        """``headers`` carries the current span, and the time sent"""
+        with tracing.span('foo') as the_span:
+            output = tracing.headers()
+
+        self.assertEqual(output[tracing.TRACEPARENT], the_span.traceparent)
+        self.assertTrue(output[tracing.SENT_AT] <= time.time())
+
+    def test_to_otlp(self):
+        """``to_otlp`` makes an OTLP/JSON export request"""
+        the_span = tracing.start('foo', '00-{}-{}-01'.format('a' * 32, 'b' * 16), start_time=1, count=2)
+        the_span.error = 'doh'
+        the_span.finish(end=2)
+
+        output = tracing.to_otlp([the_span.to_dict()], 'testing')
+        sent = output['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+        service = output['resourceSpans'][0]['resource']['attributes'][0]
+
+        self.assertEqual(service, {'key': 'service.name', 'value': {'stringValue': 'testing'}})
+        self.assertEqual(sent['parentSpanId'], 'b' * 16)
+        self.assertEqual(sent['startTimeUnixNano'], '1000000000')
+        self.assertEqual(sent['attributes'], [{'key': 'count', 'value': {'intValue': '2'}}])
+        self.assertEqual(sent['status'], {'code': 2, 'message': 'doh'})
+
+
+class TestDisabled(unittest.TestCase):
+    """A set of test cases for when tracing is off"""
+    def test_start(self):
+        """``start`` returns None when tracing is disabled"""
+        with patch.object(tracing, 'const', const._replace(VLAB_SUPERNA_TRACE_EXPORTER='')):
+            self.assertEqual(tracing.start('foo'), None)
+
+    def test_headers(self):
+        """``headers`` still sends the time the task was sent, for the queue latency metric"""
+        with patch.object(tracing, 'const', const._replace(VLAB_SUPERNA_TRACE_EXPORTER='')):
+            output = tracing.headers()
+
+        self.assertEqual(list(output.keys()), [tracing.SENT_AT])
+
+
+class TestExporter(unittest.TestCase):
+    """A set of test cases for the ``Exporter`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'traces.jsonl')
+        settings = const._replace(VLAB_SUPERNA_TRACE_EXPORTER='file', VLAB_SUPERNA_TRACE_FILE=self.path)
+        patcher = patch.object(tracing, 'const', settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.tmpdir)
+
+    def test_file(self):
+        """Exporter - appends one JSON object per span to a file"""
+        exporter = tracing.Exporter(service='testing')
+        with patch.object(tracing, 'EXPORTER', exporter):
+            with tracing.span('foo'):
+                pass
+        for _ in range(50):
+            if exporter.stats()['exported']:
+                break
+            time.sleep(0.01)
+        with open(self.path) as the_file:
+            written = [ujson.loads(x) for x in the_file]
+
+        self.assertEqual(exporter.stats()['exported'], 1)
+        self.assertEqual(written[0]['name'], 'foo')
+        self.assertEqual(written[0]['service'], 'testing')
+
+    def test_full(self):
+        """Exporter - drops spans instead of blocking, when too many are queued"""
+        exporter = tracing.Exporter(max_queued=1)
+        the_span = tracing.start('foo', start_time=1)
+        the_span.end = 2
+        with patch.object(exporter, '_run'):
+            for _ in range(3):
+                exporter.export(the_span)
+
+        self.assertEqual(exporter.stats()['dropped'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the TTLCache object
+"""
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from celery import Celery
+
+from vlab_superna_api.lib import ttl_cache
+
+
+class TestTTLCache(unittest.TestCase):
+    """A set of test cases for the TTLCache object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache = ttl_cache.TTLCache(max_size=2, ttl=10)
+
+    def test_get(self):
+        """``TTLCache`` returns cached values"""
+        self.cache.set('bob', {'some': 'data'})
+
+        output = self.cache.get('bob')
+        expected = {'some': 'data'}
+
+        self.assertEqual(output, expected)
+
+    def test_get_default(self):
+        """``TTLCache`` returns the default for unknown keys"""
+        output = self.cache.get('bob', 'nope')
+        expected = 'nope'
+
+        self.assertEqual(output, expected)
+
+    @patch.object(ttl_cache.time, 'time')
+    def test_expires(self, fake_time):
+        """``TTLCache`` does not return expired values"""
+        fake_time.return_value = 100
+        self.cache.set('bob', 'data')
+        fake_time.return_value = 111
+
+        output = self.cache.get('bob')
+
+        self.assertTrue(output is None)
+        self.assertEqual(self.cache.stats()['expired'], 1)
+
+    def test_lru(self):
+        """``TTLCache`` evicts the least recently used entry"""
+        self.cache.set('bob', 1)
+        self.cache.set('sue', 2)
+        self.cache.get('bob')
+        self.cache.set('alice', 3)
+
+        self.assertEqual(self.cache.get('bob'), 1)
+        self.assertTrue(self.cache.get('sue') is None)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_pop(self):
+        """``TTLCache`` - ``pop`` invalidates an entry"""
+        self.cache.set('bob', 1)
+        self.cache.pop('bob')
+        self.cache.pop('sue')
+
+        self.assertTrue(self.cache.get('bob') is None)
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+    def test_disabled(self):
+        """``TTLCache`` caches nothing when the TTL is zero"""
+        cache = ttl_cache.TTLCache(max_size=2, ttl=0)
+        cache.set('bob', 1)
+
+        self.assertEqual(len(cache), 0)
+
+    def test_hit_rate(self):
+        """``TTLCache`` reports the hit rate"""
+        self.cache.set('bob', 1)
+        self.cache.get('bob')
+        self.cache.get('sue')
+
+        output = self.cache.stats()['hit_rate']
+        expected = 0.5
+
+        self.assertEqual(output, expected)
+
+    def test_hit_rate_no_lookups(self):
+        """``TTLCache`` reports a hit rate of zero before any lookups"""
+        output = self.cache.stats()['hit_rate']
+        expected = 0.0
+
+        self.assertEqual(output, expected)
+
+
+class TestSharedTTLCache(unittest.TestCase):
+    """A set of test cases for the SharedTTLCache object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        app = Celery('testing', broker='memory://', backend='file://{}'.format(self.tmpdir.name))
+        self.cache = ttl_cache.SharedTTLCache(max_size=2, ttl=10, prefix='testing-')
+        self.other = ttl_cache.SharedTTLCache(max_size=2, ttl=10, prefix='testing-')
+        self.cache.share(lambda: app.backend)
+        self.other.share(lambda: app.backend)
+
+    def test_get(self):
+        """``SharedTTLCache`` returns cached values"""
+        self.cache.set('bob', {'some': 'data'})
+
+        output = self.cache.get('bob')
+        expected = {'some': 'data'}
+
+        self.assertEqual(output, expected)
+
+    def test_pop_shared(self):
+        """``SharedTTLCache`` - a ``pop`` in one cache invalidates the others"""
+        self.cache.set('bob', 'data')
+        self.other.pop('bob')
+
+        output = self.cache.get('bob')
+
+        self.assertTrue(output is None)
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+    def test_stale_generation(self):
+        """``SharedTTLCache`` doesn't reuse a value made before an invalidation"""
+        generation = self.cache.generation('bob')
+        self.other.pop('bob')
+        self.cache.set('bob', 'data', generation=generation)
+
+        output = self.cache.get('bob')
+
+        self.assertTrue(output is None)
+
+    def test_not_shared(self):
+        """``SharedTTLCache`` acts like a TTLCache when the backend can't share invalidations"""
+        self.cache.share(lambda: MagicMock())
+        self.cache.set('bob', 'data')
+        self.other.pop('bob')
+
+        output = self.cache.get('bob')
+        expected = 'data'
+
+        self.assertEqual(output, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
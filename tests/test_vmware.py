@@ -2,100 +2,258 @@
 """
 A suite of tests for the functions in vmware.py
 """
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 
+from celery import Celery
+
+from vlab_superna_api.lib.ttl_cache import SharedTTLCache
 from vlab_superna_api.lib.worker import vmware
 
 
+def lookup_network(vcenter, name):
+    """Stands in for ``networks.lookup``, using the ``networks`` attribute of the (fake) vCenter"""
+    try:
+        return vcenter.networks[name]
+    except KeyError:
+        raise ValueError('No such network named {}'.format(name))
+
+
+def user_folder(vcenter, username):
+    """Stands in for ``folders.user_folder``, using the ``get_by_name`` method of the (fake) vCenter"""
+    return vcenter.get_by_name(name=username, vimtype=vmware.vim.Folder)
+
+
 class TestVMware(unittest.TestCase):
     """A set of test cases for the vmware.py module"""
+    def setUp(self):
+        """Runs before every test case"""
+        vmware.SHOW_CACHE.clear()
+        for patcher in (patch.object(vmware.networks, 'lookup', lookup_network),
+                        patch.object(vmware.folders, 'user_folder', user_folder)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Keep the create tests from waiting on (fake) VMs to power on & get an IP
+        for name in ('power', 'wait_for_ip'):
+            patcher = patch.object(vmware.waiter, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_show_superna(self, fake_vCenter, fake_consume_task, fake_get_info):
+    @patch.object(vmware.inventory, 'ConsoleUrls')
+    @patch.object(vmware.inventory, 'folder_vms')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_superna(self, fake_vcenter_session, fake_folder_vms, fake_ConsoleUrls):
         """``superna`` returns a dictionary when everything works as expected"""
-        fake_vm = MagicMock()
-        fake_vm.name = 'Superna'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'Superna',
-                                               'created': 1234,
-                                               'version': '1.0',
-                                               'configured': False,
-                                               'generation': 1}}
+        fake_ConsoleUrls.return_value.return_value = 'https://some-console-url'
+        fake_folder_vms.return_value = {vmware.vim.VirtualMachine('vm-1'): {'name': 'Superna',
+                                                                            'runtime.powerState': 'poweredOn',
+                                                                            'config.annotation': '{"component": "Superna", "created": 1234, "version": "1.0", "configured": false, "generation": 1}',
+                                                                            'guest.net': [],
+                                                                            'network': ['alice_frontend']}}
 
         output = vmware.show_superna(username='alice')
-        expected = {'Superna': {'meta': {'component': 'Superna',
-                                                             'created': 1234,
-                                                             'version': '1.0',
-                                                             'configured': False,
-                                                             'generation': 1}}}
+        expected = {'Superna': {'state': 'poweredOn',
+                                'console': 'https://some-console-url',
+                                'ips': [],
+                                'networks': ['frontend'],
+                                'moid': 'vm-1',
+                                'meta': {'component': 'Superna',
+                                         'created': 1234,
+                                         'version': '1.0',
+                                         'configured': False,
+                                         'generation': 1}}}
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'power')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_superna(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    @patch.object(vmware.inventory, 'ConsoleUrls')
+    @patch.object(vmware.inventory, 'folder_vms')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_superna_filters(self, fake_vcenter_session, fake_folder_vms, fake_ConsoleUrls):
+        """``superna`` only returns Superna VMs"""
+        fake_folder_vms.return_value = {vmware.vim.VirtualMachine('vm-1'): {'name': 'win10',
+                                                                            'runtime.powerState': 'poweredOn',
+                                                                            'config.annotation': '{"component": "Windows"}',
+                                                                            'guest.net': [],
+                                                                            'network': []}}
+
+        output = vmware.show_superna(username='alice')
+        expected = {}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_ConsoleUrls.return_value.called)
+
+    @patch.object(vmware.inventory, 'ConsoleUrls')
+    @patch.object(vmware.inventory, 'folder_vms')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_superna_cached(self, fake_vcenter_session, fake_folder_vms, fake_ConsoleUrls):
+        """``superna`` caches the result for each user"""
+        fake_folder_vms.return_value = {}
+
+        vmware.show_superna(username='alice')
+        vmware.show_superna(username='alice')
+
+        self.assertEqual(fake_folder_vms.call_count, 1)
+
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware.waiter, 'power')
+    @patch.object(vmware, 'wait_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_superna_invalidates(self, fake_vcenter_session, fake_wait_task, fake_power, fake_find_vm):
+        """``delete_superna`` invalidates the cached output of ``show_superna``"""
+        fake_logger = MagicMock()
+        fake_find_vm.return_value = (MagicMock(), {'config.annotation': '{"component": "Superna"}'})
+        vmware.SHOW_CACHE.set('bob', {'SupernaBox': {}})
+
+        vmware.delete_superna(username='bob', machine_name='SupernaBox', logger=fake_logger)
+
+        self.assertTrue(vmware.SHOW_CACHE.get('bob') is None)
+
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware.waiter, 'power')
+    @patch.object(vmware, 'wait_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_superna(self, fake_vcenter_session, fake_wait_task, fake_power, fake_find_vm):
         """``delete_superna`` returns None when everything works as expected"""
         fake_logger = MagicMock()
         fake_vm = MagicMock()
-        fake_vm.name = 'SupernaBox'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'Superna',
-                                               'created': 1234,
-                                               'version': '1.0',
-                                               'configured': False,
-                                               'generation': 1}}
+        fake_find_vm.return_value = (fake_vm, {'config.annotation': '{"component": "Superna"}',
+                                               'runtime.powerState': 'poweredOn'})
 
         output = vmware.delete_superna(username='bob', machine_name='SupernaBox', logger=fake_logger)
         expected = None
 
         self.assertEqual(output, expected)
+        self.assertTrue(fake_power.called)
+        self.assertTrue(fake_vm.Destroy_Task.called)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'power')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_superna_value_error(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware.waiter, 'power')
+    @patch.object(vmware, 'wait_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_superna_powered_off(self, fake_vcenter_session, fake_wait_task, fake_power, fake_find_vm):
+        """``delete_superna`` does not power off a VM that's already off"""
+        fake_find_vm.return_value = (MagicMock(), {'config.annotation': '{"component": "Superna"}',
+                                                   'runtime.powerState': 'poweredOff'})
+
+        vmware.delete_superna(username='bob', machine_name='SupernaBox', logger=MagicMock())
+
+        self.assertFalse(fake_power.called)
+
+    @patch.object(vmware.metrics, 'phase')
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware.waiter, 'power')
+    @patch.object(vmware, 'wait_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_superna_phases(self, fake_vcenter_session, fake_wait_task, fake_power, fake_find_vm, fake_phase):
+        """``delete_superna`` times each step that talks to vCenter"""
+        fake_find_vm.return_value = (MagicMock(), {'config.annotation': '{"component": "Superna"}',
+                                                   'runtime.powerState': 'poweredOn'})
+
+        vmware.delete_superna(username='bob', machine_name='SupernaBox', logger=MagicMock())
+        phases = [x[0][0] for x in fake_phase.call_args_list]
+        expected = ['find_folder', 'find_vm', 'power_off', 'destroy']
+
+        self.assertEqual(phases, expected)
+
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware.waiter, 'power')
+    @patch.object(vmware, 'wait_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_superna_value_error(self, fake_vcenter_session, fake_wait_task, fake_power, fake_find_vm):
         """``delete_superna`` raises ValueError when unable to find requested vm for deletion"""
         fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'win10'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'Superna',
-                                               'created': 1234,
-                                               'version': '1.0',
-                                               'configured': False,
-                                               'generation': 1}}
+        fake_find_vm.return_value = None
 
         with self.assertRaises(ValueError):
             vmware.delete_superna(username='bob', machine_name='myOtherSupernaBox', logger=fake_logger)
 
-    @patch.object(vmware.virtual_machine, 'block_on_boot')
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware.waiter, 'power')
+    @patch.object(vmware, 'wait_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_superna_not_superna(self, fake_vcenter_session, fake_wait_task, fake_power, fake_find_vm):
+        """``delete_superna`` raises ValueError if the VM is not a Superna"""
+        fake_vm = MagicMock()
+        fake_find_vm.return_value = (fake_vm, {'config.annotation': '{"component": "OneFS"}'})
+
+        with self.assertRaises(ValueError):
+            vmware.delete_superna(username='bob', machine_name='SupernaBox', logger=MagicMock())
+        self.assertFalse(fake_vm.Destroy_Task.called)
+
+    @patch.object(vmware.waiter, 'wait_for_tasks')
+    @patch.object(vmware.inventory, 'folder_vms')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_many(self, fake_vcenter_session, fake_folder_vms, fake_wait_for_tasks):
+        """``delete_many`` powers off, then destroys, every requested VM"""
+        vm1, vm2, vm3 = MagicMock(), MagicMock(), MagicMock()
+        fake_folder_vms.return_value = {
+            vm1: {'name': 'superna1', 'runtime.powerState': 'poweredOn', 'config.annotation': '{"component": "Superna"}'},
+            vm2: {'name': 'superna2', 'runtime.powerState': 'poweredOff', 'config.annotation': '{"component": "Superna"}'},
+            vm3: {'name': 'win10', 'runtime.powerState': 'poweredOn', 'config.annotation': '{"component": "Windows"}'},
+        }
+        fake_wait_for_tasks.side_effect = lambda tasks: {x: None for x in tasks}
+
+        output = vmware.delete_many('bob', ['superna1', 'superna2', 'superna3'], MagicMock())
+        expected = {'deleted': ['superna1', 'superna2'], 'failed': {'superna3': 'No superna named superna3 found'}}
+
+        self.assertEqual(output, expected)
+        self.assertTrue(vm1.PowerOffVM_Task.called)
+        self.assertFalse(vm2.PowerOffVM_Task.called)
+        self.assertFalse(vm3.Destroy_Task.called)
+        # one wait for all power off tasks, and one for all destroy tasks
+        self.assertEqual(fake_wait_for_tasks.call_count, 2)
+
+    @patch.object(vmware.waiter, 'wait_for_tasks')
+    @patch.object(vmware.inventory, 'folder_vms')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_many_all(self, fake_vcenter_session, fake_folder_vms, fake_wait_for_tasks):
+        """``delete_many`` deletes every Superna when ``machine_names`` is None"""
+        vm1, vm2 = MagicMock(), MagicMock()
+        fake_folder_vms.return_value = {
+            vm1: {'name': 'superna1', 'runtime.powerState': 'poweredOff', 'config.annotation': '{"component": "Superna"}'},
+            vm2: {'name': 'superna2', 'runtime.powerState': 'poweredOff', 'config.annotation': '{"component": "Superna"}'},
+        }
+        fake_wait_for_tasks.side_effect = lambda tasks: {x: None for x in tasks}
+
+        output = vmware.delete_many('bob', None, MagicMock())
+        expected = {'deleted': ['superna1', 'superna2'], 'failed': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware.waiter, 'wait_for_tasks')
+    @patch.object(vmware.inventory, 'folder_vms')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_many_power_off_fails(self, fake_vcenter_session, fake_folder_vms, fake_wait_for_tasks):
+        """``delete_many`` does not destroy a VM that failed to power off"""
+        vm1 = MagicMock()
+        fake_folder_vms.return_value = {
+            vm1: {'name': 'superna1', 'runtime.powerState': 'poweredOn', 'config.annotation': '{"component": "Superna"}'},
+        }
+        fake_wait_for_tasks.side_effect = lambda tasks: {x: 'testing' for x in tasks}
+
+        output = vmware.delete_many('bob', ['superna1'], MagicMock())
+        expected = {'deleted': [], 'failed': {'superna1': 'testing'}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(vm1.Destroy_Task.called)
+
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware.waiter, 'wait_for_boot')
     @patch.object(vmware, 'add_unique_params')
     @patch.object(vmware.virtual_machine, 'set_meta')
-    @patch.object(vmware, 'Ova')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_superna(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova,
-                            fake_get_info, fake_Ova, fake_set_meta, fake_add_unique_params,
-                            fake_block_on_boot):
+    @patch.object(vmware.templates, 'import_ova')
+    @patch.object(vmware, 'wait_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_superna(self, fake_vcenter_session, fake_wait_task, fake_import_ova,
+                            fake_get_info, fake_set_meta, fake_add_unique_params,
+                            fake_wait_for_boot, fake_CATALOG):
         """``create_superna`` returns a dictionary upon success"""
         fake_logger = MagicMock()
-        fake_deploy_from_ova.return_value.name = 'mySuperna'
+        fake_CATALOG.get.return_value = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['someLAN']}
+        fake_import_ova.return_value.name = 'mySuperna'
         fake_get_info.return_value = {'worked': True}
-        fake_Ova.return_value.networks = ['someLAN']
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
         ip_config = {
             'static-ip' : "1.2.3.4",
             'default-gateway' : '1.2.3.1',
@@ -114,17 +272,88 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.inventory, 'ConsoleUrls')
+    @patch.object(vmware.inventory, 'folder_vms')
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware.waiter, 'wait_for_boot')
+    @patch.object(vmware, 'add_unique_params')
+    @patch.object(vmware.virtual_machine, 'set_meta')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_superna_invalid_network(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
+    @patch.object(vmware.templates, 'import_ova')
+    @patch.object(vmware, 'wait_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_then_show(self, fake_vcenter_session, fake_wait_task, fake_import_ova,
+                              fake_get_info, fake_set_meta, fake_add_unique_params,
+                              fake_wait_for_boot, fake_CATALOG, fake_folder_vms, fake_ConsoleUrls):
+        """``create_superna`` in one process invalidates the cached ``show_superna`` of another"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        app = Celery('testing', broker='memory://', backend='file://{}'.format(tmpdir.name))
+        fast_cache = SharedTTLCache(max_size=10, ttl=600, prefix='superna-show-')
+        slow_cache = SharedTTLCache(max_size=10, ttl=600, prefix='superna-show-')
+        fast_cache.share(lambda: app.backend)
+        slow_cache.share(lambda: app.backend)
+        fake_CATALOG.get.return_value = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['someLAN']}
+        fake_import_ova.return_value.name = 'mySuperna'
+        fake_get_info.return_value = {'worked': True}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_folder_vms.return_value = {}
+        ip_config = {'static-ip' : "1.2.3.4", 'default-gateway' : '1.2.3.1', 'netmask': '255.255.255.0',
+                     'dns' : ['1.2.3.2'], 'domain' : 'vlab.local'}
+
+        with patch.object(vmware, 'SHOW_CACHE', fast_cache):
+            vmware.show_superna(username='alice')
+        with patch.object(vmware, 'SHOW_CACHE', slow_cache):
+            vmware.create_superna(username='alice', machine_name='SupernaBox', image='1.0.0',
+                                  network='someLAN', ip_config=ip_config, logger=MagicMock())
+        with patch.object(vmware, 'SHOW_CACHE', fast_cache):
+            vmware.show_superna(username='alice')
+
+        self.assertEqual(fake_folder_vms.call_count, 2)
+
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware.waiter, 'wait_for_boot')
+    @patch.object(vmware, 'add_unique_params')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.templates, 'import_ova')
+    @patch.object(vmware, 'wait_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_superna_progress(self, fake_vcenter_session, fake_wait_task, fake_import_ova,
+                                     fake_get_info, fake_set_meta, fake_add_unique_params,
+                                     fake_wait_for_boot, fake_CATALOG):
+        """``create_superna`` reports each step of the create"""
+        fake_CATALOG.get.return_value = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['someLAN']}
+        fake_import_ova.return_value.name = 'mySuperna'
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_report_progress = MagicMock()
+
+        vmware.create_superna(username='alice',
+                              machine_name='SupernaBox',
+                              image='1.0.0',
+                              network='someLAN',
+                              ip_config={},
+                              logger=MagicMock(),
+                              report_progress=fake_report_progress)
+
+        steps = [x[0][0] for x in fake_report_progress.call_args_list]
+        expected = [vmware.progress.DEPLOYING, vmware.progress.CONFIGURING, vmware.progress.POWERING_ON,
+                    vmware.progress.WAITING_FOR_BOOT, vmware.progress.WAITING_FOR_IP]
+
+        self.assertEqual(steps, expected)
+        self.assertEqual(fake_import_ova.call_args[1]['report_progress'], fake_report_progress)
+
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.templates, 'import_ova')
+    @patch.object(vmware, 'wait_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_superna_invalid_network(self, fake_vcenter_session, fake_wait_task, fake_import_ova, fake_get_info, fake_CATALOG):
         """``create_superna`` raises ValueError if supplied with a non-existing network"""
         fake_logger = MagicMock()
+        fake_CATALOG.get.return_value = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['someLAN']}
         fake_get_info.return_value = {'worked': True}
-        fake_Ova.return_value.networks = ['someLAN']
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
         ip_config = {
             'static-ip' : "1.2.3.4",
             'default-gateway' : '1.2.3.1',
@@ -141,10 +370,199 @@ class TestVMware(unittest.TestCase):
                                   ip_config=ip_config,
                                   logger=fake_logger)
 
-    @patch.object(vmware.os, 'listdir')
-    def test_list_images(self, fake_listdir):
+    @patch.object(vmware, 'const', vmware.const._replace(VLAB_SUPERNA_DEPLOY_MODE='template'))
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware.waiter, 'wait_for_boot')
+    @patch.object(vmware, 'add_unique_params')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware.templates, 'import_ova')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.templates, 'deploy')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_superna_template(self, fake_vcenter_session, fake_deploy, fake_get_info, fake_import_ova,
+                                     fake_set_meta, fake_add_unique_params, fake_wait_for_boot, fake_CATALOG):
+        """``create_superna`` clones a template when VLAB_SUPERNA_DEPLOY_MODE is template"""
+        fake_logger = MagicMock()
+        fake_CATALOG.get.return_value = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['someLAN']}
+        fake_deploy.return_value.name = 'mySuperna'
+        fake_get_info.return_value = {'worked': True}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        ip_config = {
+            'static-ip' : "1.2.3.4",
+            'default-gateway' : '1.2.3.1',
+            'netmask': '255.255.255.0',
+            'dns' : ['1.2.3.2'],
+            'domain' : 'vlab.local'
+        }
+
+        output = vmware.create_superna(username='alice',
+                                       machine_name='SupernaBox',
+                                       image='1.0.0',
+                                       network='someLAN',
+                                       ip_config=ip_config,
+                                       logger=fake_logger)
+        expected = {'mySuperna': {'worked': True}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_import_ova.called)
+        self.assertTrue(fake_add_unique_params.called)
+
+    @patch.object(vmware.warm_pool, 'target_size')
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware.waiter, 'wait_for_boot')
+    @patch.object(vmware, 'add_unique_params')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware.templates, 'import_ova')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.warm_pool, 'claim')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_superna_warm_pool(self, fake_vcenter_session, fake_claim, fake_get_info, fake_import_ova,
+                                      fake_set_meta, fake_add_unique_params, fake_wait_for_boot, fake_CATALOG,
+                                      fake_target_size):
+        """``create_superna`` uses a VM from the warm pool when one is available"""
+        fake_target_size.return_value = 1
+        fake_CATALOG.get.return_value = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['someLAN']}
+        fake_claim.return_value.name = 'mySuperna'
+        fake_get_info.return_value = {'worked': True}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        ip_config = {
+            'static-ip' : "1.2.3.4",
+            'default-gateway' : '1.2.3.1',
+            'netmask': '255.255.255.0',
+            'dns' : ['1.2.3.2'],
+            'domain' : 'vlab.local'
+        }
+
+        output = vmware.create_superna(username='alice',
+                                       machine_name='SupernaBox',
+                                       image='1.0.0',
+                                       network='someLAN',
+                                       ip_config=ip_config,
+                                       logger=MagicMock())
+        expected = {'mySuperna': {'worked': True}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_import_ova.called)
+
+    @patch.object(vmware.warm_pool, 'target_size')
+    @patch.object(vmware.templates, 'import_ova')
+    @patch.object(vmware.warm_pool, 'claim')
+    def test_deploy_warm_pool_empty(self, fake_claim, fake_import_ova, fake_target_size):
+        """``_deploy`` falls back to the OVA when the warm pool is empty"""
+        fake_target_size.return_value = 1
+        fake_claim.return_value = None
+        fake_import_ova.return_value = 'newVM'
+        image_info = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['someLAN']}
+
+        output = vmware._deploy(MagicMock(), 'alice', 'SupernaBox', '1.0.0', image_info,
+                                vmware.vim.Network(moId='1'), MagicMock())
+
+        self.assertEqual(output, 'newVM')
+        self.assertTrue(fake_import_ova.call_args[0][1].endswith('Superna_Eyeglass-1.0.0.ova'))
+
+    @patch.object(vmware, '_configure')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_batch(self, fake_vcenter_session, fake_CATALOG, fake_deploy, fake_configure):
+        """``create_batch`` reports which VMs were created, and which failed"""
+        fake_CATALOG.get.return_value = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['someLAN']}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_deploy.side_effect = lambda vcenter, username, name, *args, **kwargs: name
+        fake_configure.side_effect = lambda vcenter, the_vm, *args: self._configure(the_vm)
+        machines = [{'name': 'superna1', 'ip-config': {}}, {'name': 'superna2', 'ip-config': {}}]
+
+        output = vmware.create_batch('alice', machines, '1.0.0', 'someLAN', MagicMock())
+        expected = {'created': {'superna1': {'worked': True}}, 'failed': {'superna2': 'testing'}}
+
+        self.assertEqual(output, expected)
+
+    def _configure(self, the_vm):
+        """Fails to configure the VM named superna2"""
+        if the_vm == 'superna2':
+            raise RuntimeError('testing')
+        return {'worked': True}
+
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_batch_one_template(self, fake_vcenter_session, fake_CATALOG, fake_deploy):
+        """``create_batch`` clones every VM from a template, so the OVA is only read once"""
+        fake_CATALOG.get.return_value = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['someLAN']}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_deploy.side_effect = RuntimeError('testing')
+
+        vmware.create_batch('alice', [{'name': 'superna1', 'ip-config': {}}], '1.0.0', 'someLAN', MagicMock())
+
+        self.assertEqual(fake_deploy.call_args[1]['mode'], 'template')
+
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_batch_invalid_network(self, fake_vcenter_session, fake_CATALOG):
+        """``create_batch`` raises ValueError if supplied with a non-existing network"""
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {}
+
+        with self.assertRaises(ValueError):
+            vmware.create_batch('alice', [], '1.0.0', 'someLAN', MagicMock())
+
+    @patch.object(vmware.templates, 'is_current')
+    @patch.object(vmware.templates, 'registry')
+    @patch.object(vmware.templates, 'ensure_template')
+    @patch.object(vmware.templates, 'list_templates')
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware, 'vcenter_session')
+    def test_sync_templates(self, fake_vcenter_session, fake_CATALOG, fake_list_templates,
+                            fake_ensure_template, fake_registry, fake_is_current):
+        """``sync_templates`` reports if each template is current"""
+        fake_CATALOG.images.return_value = {'1.0.0': {}}
+        fake_registry.return_value = {'1.0.0': {'meta': {}}, '0.9.0': {'meta': {}}}
+        fake_is_current.return_value = True
+
+        output = vmware.sync_templates(rebuild=False, logger=MagicMock())
+        expected = {'1.0.0': {'meta': {}, 'current': True}, '0.9.0': {'meta': {}, 'current': False}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_ensure_template.called)
+
+    @patch.object(vmware.templates, 'registry')
+    @patch.object(vmware.templates, 'ensure_template')
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware, 'vcenter_session')
+    def test_sync_templates_rebuild(self, fake_vcenter_session, fake_CATALOG, fake_ensure_template, fake_registry):
+        """``sync_templates`` builds a template for every image when ``rebuild`` is True"""
+        fake_CATALOG.images.return_value = {'1.0.0': {}, '1.1.0': {}}
+        fake_registry.return_value = {}
+
+        vmware.sync_templates(rebuild=True, logger=MagicMock())
+
+        self.assertEqual(fake_ensure_template.call_count, 2)
+
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_superna_invalid_image(self, fake_vcenter_session, fake_CATALOG):
+        """``create_superna`` raises ValueError if supplied with a non-existing image"""
+        fake_logger = MagicMock()
+        fake_CATALOG.get.return_value = None
+        ip_config = {
+            'static-ip' : "1.2.3.4",
+            'default-gateway' : '1.2.3.1',
+            'netmask': '255.255.255.0',
+            'dns' : ['1.2.3.2'],
+            'domain' : 'vlab.local'
+        }
+
+        with self.assertRaises(ValueError):
+            vmware.create_superna(username='alice',
+                                  machine_name='SupernaBox',
+                                  image='1.0.0',
+                                  network='someLAN',
+                                  ip_config=ip_config,
+                                  logger=fake_logger)
+
+    @patch.object(vmware.image_catalog, 'CATALOG')
+    def test_list_images(self, fake_CATALOG):
         """``list_images`` - Returns a list of available Superna versions that can be deployed"""
-        fake_listdir.return_value = ['Superna_Eyeglass-2.6.1.ova']
+        fake_CATALOG.versions.return_value = ['2.6.1']
 
         output = vmware.list_images()
         expected = ['2.6.1']
@@ -166,8 +584,8 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware, 'consume_task')
-    def test_add_unique_params(self, fake_consume_task):
+    @patch.object(vmware, 'wait_task')
+    def test_add_unique_params(self, fake_wait_task):
         """``add_unique_params`` Defines the vApp configs for Superna"""
         fake_vm = MagicMock()
         ip_config = {
@@ -0,0 +1,266 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in waiter.py
+"""
+import queue
+import asyncio
+import unittest
+import threading
+from unittest.mock import patch, MagicMock
+
+from vlab_superna_api.lib.worker import waiter
+
+
+def _make_update(version, *changes):
+    """Mimic the UpdateSet returned by WaitForUpdatesEx
+
+    :param changes: Tuples of (object, {property name: value})
+    """
+    update = MagicMock()
+    update.version = version
+    filter_update = MagicMock()
+    filter_update.objectSet = []
+    for obj, props in changes:
+        obj_update = MagicMock()
+        obj_update.obj = obj
+        obj_update.changeSet = []
+        for name, val in props.items():
+            change = MagicMock()
+            change.name = name
+            change.val = val
+            change.op = 'assign'
+            obj_update.changeSet.append(change)
+        filter_update.objectSet.append(obj_update)
+    update.filterSet = [filter_update]
+    return update
+
+
+class FakeCollector(object):
+    """Mimics a PropertyCollector; hands out the updates only once a filter exists"""
+    def __init__(self, *updates):
+        self.updates = queue.Queue()
+        for update in updates:
+            self.updates.put(update)
+        self.filtered = threading.Event()
+        self.filters = []
+        self.versions = []
+
+    def CreateFilter(self, spec, partialUpdates):
+        self.filtered.set()
+        the_filter = MagicMock()
+        self.filters.append(the_filter)
+        return the_filter
+
+    def WaitForUpdatesEx(self, version, options):
+        self.filtered.wait(5)
+        self.versions.append(version)
+        try:
+            update = self.updates.get(timeout=0.05)
+        except queue.Empty:
+            return None
+        if isinstance(update, Exception):
+            raise update
+        return update
+
+
+def _make_waiter(collector):
+    """Create a Waiter that uses the supplied FakeCollector"""
+    vcenter = MagicMock()
+    vcenter.content.propertyCollector.CreatePropertyCollector.return_value = collector
+    return waiter.Waiter(factory=lambda: vcenter, max_wait=1)
+
+
+class TestWaiter(unittest.TestCase):
+    """A set of test cases for the ``Waiter`` object"""
+
+    def test_watch(self):
+        """``Waiter.watch`` returns once the object is in the desired state"""
+        task = waiter.vim.Task('task-1')
+        collector = FakeCollector(_make_update('1', (task, {'info.state': 'running'})),
+                                  _make_update('2', (task, {'info.state': 'success'})))
+        the_waiter = _make_waiter(collector)
+
+        output = the_waiter.watch([task], waiter._task_done, timeout=5)
+
+        self.assertEqual(output[task]['info.state'], 'success')
+        self.assertTrue(collector.filters[0].DestroyPropertyFilter.called)
+        the_waiter.close()
+
+    def test_watch_version(self):
+        """``Waiter`` only asks vCenter for the changes since the last update"""
+        task = waiter.vim.Task('task-1')
+        collector = FakeCollector(_make_update('1', (task, {'info.state': 'running'})),
+                                  _make_update('2', (task, {'info.state': 'success'})))
+        the_waiter = _make_waiter(collector)
+
+        the_waiter.watch([task], waiter._task_done, timeout=5)
+
+        self.assertEqual(collector.versions[:2], ['', '1'])
+        the_waiter.close()
+
+    def test_watch_timeout(self):
+        """``Waiter.watch`` raises RuntimeError if the object never reaches the desired state"""
+        task = waiter.vim.Task('task-1')
+        the_waiter = _make_waiter(FakeCollector(_make_update('1', (task, {'info.state': 'running'}))))
+
+        with self.assertRaises(RuntimeError):
+            the_waiter.watch([task], waiter._task_done, timeout=0.2)
+        self.assertEqual(the_waiter.stats()['timeouts'], 1)
+        the_waiter.close()
+
+    def test_watch_connection_lost(self):
+        """``Waiter.watch`` raises RuntimeError if the connection to vCenter breaks"""
+        task = waiter.vim.Task('task-1')
+        the_waiter = _make_waiter(FakeCollector(OSError('testing')))
+
+        with self.assertRaises(RuntimeError):
+            the_waiter.watch([task], waiter._task_done, timeout=5)
+        self.assertEqual(the_waiter.stats()['errors'], 1)
+
+    def test_watch_async(self):
+        """``Waiter.watch_async`` returns once the object is in the desired state"""
+        task = waiter.vim.Task('task-1')
+        collector = FakeCollector(_make_update('1', (task, {'info.state': 'success'})))
+        the_waiter = _make_waiter(collector)
+
+        output = asyncio.get_event_loop().run_until_complete(the_waiter.watch_async([task], waiter._task_done, 5))
+
+        self.assertEqual(output[task]['info.state'], 'success')
+        the_waiter.close()
+
+    def test_watch_async_timeout(self):
+        """``Waiter.watch_async`` raises RuntimeError if the object never reaches the desired state"""
+        task = waiter.vim.Task('task-1')
+        the_waiter = _make_waiter(FakeCollector())
+
+        with self.assertRaises(RuntimeError):
+            asyncio.get_event_loop().run_until_complete(the_waiter.watch_async([task], waiter._task_done, 0.2))
+        the_waiter.close()
+
+    def test_watch_shared(self):
+        """``Waiter`` uses one filter for concurrent waits on the same object"""
+        the_vm = waiter.vim.VirtualMachine('vm-1')
+        collector = FakeCollector()
+        the_waiter = _make_waiter(collector)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(the_waiter.watch([the_vm], lambda x: x.get('ready'), 5)))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        while the_waiter.stats()['waits'] < 2:
+            pass
+        collector.updates.put(_make_update('1', (the_vm, {'ready': True})))
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(collector.filters), 1)
+        the_waiter.close()
+
+
+class TestHelpers(unittest.TestCase):
+    """A set of test cases for the functions that use the shared Waiter"""
+
+    def test_wait_for_tasks(self):
+        """``wait_for_tasks`` returns the error of every task"""
+        task1 = waiter.vim.Task('task-1')
+        task2 = waiter.vim.Task('task-2')
+        error = MagicMock()
+        error.msg = 'testing'
+        the_waiter = _make_waiter(FakeCollector(_make_update('1', (task1, {'info.state': 'running'}),
+                                                                  (task2, {'info.state': 'success'})),
+                                                _make_update('2', (task1, {'info.state': 'error', 'info.error': error}))))
+
+        with patch.object(waiter, 'WAITER', the_waiter):
+            output = waiter.wait_for_tasks([task1, task2])
+        expected = {task1: 'testing', task2: None}
+
+        self.assertEqual(output, expected)
+        the_waiter.close()
+
+    def test_wait_for_tasks_none(self):
+        """``wait_for_tasks`` does not contact vCenter when there's nothing to wait on"""
+        with patch.object(waiter, 'WAITER') as fake_WAITER:
+            output = waiter.wait_for_tasks([])
+
+        self.assertEqual(output, {})
+        self.assertFalse(fake_WAITER.watch.called)
+
+    @patch.object(waiter, 'WAITER')
+    def test_wait_task(self, fake_WAITER):
+        """``wait_task`` returns the result of the task"""
+        task = waiter.vim.Task('task-1')
+        fake_WAITER.watch.return_value = {task: {'info.state': 'success', 'info.error': None, 'info.result': 'newVM'}}
+
+        output = waiter.wait_task(task)
+
+        self.assertEqual(output, 'newVM')
+
+    @patch.object(waiter, 'WAITER')
+    def test_wait_task_rebind(self, fake_WAITER):
+        """``wait_task`` returns a managed object bound to the session of the task, not the waiter's"""
+        task = waiter.vim.Task('task-1', stub='callerStub')
+        new_vm = waiter.vim.VirtualMachine('vm-1', stub='waiterStub')
+        fake_WAITER.watch.return_value = {task: {'info.state': 'success', 'info.error': None, 'info.result': new_vm}}
+
+        output = waiter.wait_task(task)
+
+        self.assertEqual(output, waiter.vim.VirtualMachine('vm-1'))
+        self.assertEqual(output._stub, 'callerStub')
+
+    @patch.object(waiter, 'WAITER')
+    def test_wait_task_error(self, fake_WAITER):
+        """``wait_task`` raises RuntimeError if the task failed"""
+        task = waiter.vim.Task('task-1')
+        error = MagicMock()
+        error.msg = 'testing'
+        fake_WAITER.watch.return_value = {task: {'info.state': 'error', 'info.error': error}}
+
+        with self.assertRaises(RuntimeError):
+            waiter.wait_task(task)
+
+    @patch.object(waiter, 'wait_task')
+    def test_power(self, fake_wait_task):
+        """``power`` returns False if the power task fails"""
+        the_vm = MagicMock()
+        the_vm.runtime.powerState = 'poweredOff'
+        fake_wait_task.side_effect = RuntimeError('testing')
+
+        self.assertFalse(waiter.power(the_vm, state='on'))
+
+    def test_power_already(self):
+        """``power`` does nothing if the VM is already in the requested state"""
+        the_vm = MagicMock()
+        the_vm.runtime.powerState = 'poweredOn'
+
+        self.assertTrue(waiter.power(the_vm, state='on'))
+        self.assertFalse(the_vm.PowerOn.called)
+
+    def test_power_bad_state(self):
+        """``power`` raises ValueError for unknown power states"""
+        with self.assertRaises(ValueError):
+            waiter.power(MagicMock(), state='sideways')
+
+    def test_has_ip(self):
+        """``_has_ip`` ignores link-local addresses"""
+        nic = MagicMock()
+        nic.ipAddress = ['fe80::1', '169.254.1.1']
+
+        self.assertFalse(waiter._has_ip({'guest.net': [nic]}))
+        nic.ipAddress.append('10.1.1.2')
+        self.assertTrue(waiter._has_ip({'guest.net': [nic]}))
+
+    @patch.object(waiter.time, 'sleep')
+    @patch.object(waiter, 'WAITER')
+    def test_wait_for_boot(self, fake_WAITER, fake_sleep):
+        """``wait_for_boot`` waits for VMware Tools, then for Superna to settle"""
+        waiter.wait_for_boot(MagicMock())
+
+        done = fake_WAITER.watch.call_args[0][1]
+        self.assertTrue(done({'guest.toolsStatus': 'toolsOk'}))
+        self.assertFalse(done({'guest.toolsStatus': 'toolsNotRunning'}))
+        fake_sleep.assert_called_with(waiter.const.VLAB_SUPERNA_BOOT_SETTLE)
+
+
+if __name__ == '__main__':
+    unittest.main()
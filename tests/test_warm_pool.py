@@ -0,0 +1,259 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in warm_pool.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_superna_api.lib.worker import warm_pool
+
+
+def lookup_network(vcenter, name):
+    """Stands in for ``networks.lookup``, using the ``networks`` attribute of the (fake) vCenter"""
+    try:
+        return vcenter.networks[name]
+    except KeyError:
+        raise ValueError('No such network named {}'.format(name))
+
+
+def user_folder(vcenter, username):
+    """Stands in for ``folders.user_folder``, using the ``get_by_name`` method of the (fake) vCenter"""
+    return vcenter.get_by_name(name=username, vimtype=warm_pool.vim.Folder)
+
+
+IMAGE_INFO = {'file': 'Superna_Eyeglass-2.5.6.ova',
+              'networks': ['VM Network'],
+              'properties': ['hostname'],
+              'size': 100,
+              'mtime': 1234}
+READY = '{"component": "SupernaWarm", "version": "2.5.6"}'
+
+
+class TestWarmPool(unittest.TestCase):
+    """A set of test cases for warm_pool.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.logger = MagicMock()
+        for patcher in (patch.object(warm_pool.networks, 'lookup', lookup_network),
+                        patch.object(warm_pool.folders, 'user_folder', user_folder)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch.object(warm_pool, 'const', warm_pool.const._replace(VLAB_SUPERNA_WARM_POOL_SIZE=1,
+                                                               VLAB_SUPERNA_WARM_POOL_SIZES='2.5.6=3,2.6.0=0'))
+    def test_target_size(self):
+        """``target_size`` uses the per-version size, when there is one"""
+        self.assertEqual(warm_pool.target_size('2.5.6'), 3)
+        self.assertEqual(warm_pool.target_size('2.6.0'), 0)
+        self.assertEqual(warm_pool.target_size('1.0.0'), 1)
+
+    def test_enabled(self):
+        """``enabled`` is False by default"""
+        self.assertFalse(warm_pool.enabled())
+
+    def test_staged_name(self):
+        """``staged_name`` makes unique names"""
+        name1 = warm_pool.staged_name('2.5.6')
+        name2 = warm_pool.staged_name('2.5.6')
+
+        self.assertTrue(name1.startswith('SupernaWarm-2.5.6-'))
+        self.assertNotEqual(name1, name2)
+
+    @patch.object(warm_pool.time, 'time')
+    @patch.object(warm_pool, 'staging_folder')
+    @patch.object(warm_pool.inventory, 'folder_vms')
+    def test_occupancy(self, fake_folder_vms, fake_staging_folder, fake_time):
+        """``occupancy`` counts the ready, pending, claimed and failed VMs of each version"""
+        fake_time.return_value = 10000
+        fake_folder_vms.return_value = {
+            'vm1': {'name': 'SupernaWarm-2.5.6-9000-aaaa', 'config.annotation': READY},
+            'vm2': {'name': 'SupernaWarm-2.5.6-9000-bbbb', 'config.annotation': None},
+            'vm3': {'name': 'SupernaWarm-2.5.6-9000-cccc', 'config.annotation': READY.replace('}', ', "claimed": true}')},
+            'vm4': {'name': 'someOtherVM', 'config.annotation': READY},
+            'vm5': {'name': 'SupernaWarm-2.5.6-1000-dddd', 'config.annotation': None},
+        }
+
+        output = warm_pool.occupancy(MagicMock())
+        expected = {'2.5.6': {'ready': 1, 'pending': 1, 'claimed': 1, 'failed': 1, 'target': 0}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(warm_pool.time, 'time')
+    def test_state_stale(self, fake_time):
+        """``_state`` treats a VM that's been pending longer than the stage timeout as failed"""
+        fake_time.return_value = 10000
+        settings = warm_pool.const._replace(VLAB_SUPERNA_WARM_POOL_STAGE_TIMEOUT=600)
+
+        with patch.object(warm_pool, 'const', settings):
+            fresh = warm_pool._state({'name': 'SupernaWarm-2.5.6-9500-aaaa'}, {'component': 'Unknown'})
+            stale = warm_pool._state({'name': 'SupernaWarm-2.5.6-9000-bbbb'}, {'component': 'Unknown'})
+            legacy = warm_pool._state({'name': 'SupernaWarm-2.5.6-cccc'}, {'component': 'Unknown'})
+
+        self.assertEqual(fresh, ('2.5.6', 'pending'))
+        self.assertEqual(stale, ('2.5.6', 'failed'))
+        self.assertEqual(legacy, ('2.5.6', 'failed'))
+
+    @patch.object(warm_pool.templates, 'discard')
+    @patch.object(warm_pool, 'staged_vms')
+    def test_reap(self, fake_staged_vms, fake_discard):
+        """``reap`` destroys the VMs of a version that failed to be deployed"""
+        failed_vm = MagicMock()
+        fake_staged_vms.return_value = [(failed_vm, {'name': 'SupernaWarm-2.5.6-1000-aaaa'}, {'component': 'Unknown'}),
+                                        (MagicMock(), {'name': 'SupernaWarm-2.6.0-1000-bbbb'}, {'component': 'Unknown'}),
+                                        (MagicMock(), {'name': 'SupernaWarm-2.5.6-1000-cccc'},
+                                         {'component': 'SupernaWarm', 'version': '2.5.6'})]
+
+        output = warm_pool.reap(MagicMock(), '2.5.6', self.logger)
+
+        self.assertEqual(output, ['SupernaWarm-2.5.6-1000-aaaa'])
+        self.assertEqual(fake_discard.call_count, 1)
+        self.assertTrue(fake_discard.call_args[0][0] is failed_vm)
+
+    @patch.object(warm_pool, 'occupancy')
+    @patch.object(warm_pool, 'vcenter_session')
+    def test_stats(self, fake_vcenter_session, fake_occupancy):
+        """``stats`` reports the occupancy of the pool"""
+        fake_occupancy.return_value = {'2.5.6': {'ready': 1}}
+        settings = warm_pool.const._replace(VLAB_SUPERNA_WARM_POOL_SIZE=1)
+
+        with patch.object(warm_pool, 'const', settings):
+            output = warm_pool.stats()
+
+        self.assertEqual(output, {'2.5.6': {'ready': 1}})
+
+    @patch.object(warm_pool, 'vcenter_session')
+    def test_stats_disabled(self, fake_vcenter_session):
+        """``stats`` doesn't look at vCenter when the pool isn't used"""
+        output = warm_pool.stats()
+
+        self.assertEqual(output, {})
+        self.assertFalse(fake_vcenter_session.called)
+
+    @patch.object(warm_pool.virtual_machine, 'change_network')
+    @patch.object(warm_pool, 'wait_task')
+    @patch.object(warm_pool, 'staged_vms')
+    def test_claim(self, fake_staged_vms, fake_wait_task, fake_change_network):
+        """``claim`` renames the VM, and moves it to the user's folder"""
+        the_vm = MagicMock()
+        props = {'name': 'SupernaWarm-2.5.6-aaaa', 'config.changeVersion': '1'}
+        fake_staged_vms.return_value = [(the_vm, props, {'component': 'SupernaWarm', 'version': '2.5.6'})]
+        vcenter = MagicMock()
+
+        output = warm_pool.claim(vcenter, 'bob', 'mySuperna', '2.5.6', MagicMock(), self.logger)
+
+        self.assertTrue(output is the_vm)
+        the_vm.Rename_Task.assert_called_with('mySuperna')
+        self.assertTrue(vcenter.get_by_name.return_value.MoveIntoFolder_Task.called)
+        self.assertTrue(fake_change_network.called)
+
+    @patch.object(warm_pool.virtual_machine, 'change_network')
+    @patch.object(warm_pool, 'wait_task')
+    @patch.object(warm_pool, 'staged_vms')
+    def test_claim_race(self, fake_staged_vms, fake_wait_task, fake_change_network):
+        """``claim`` tries the next VM if another worker claimed the VM first"""
+        vm1, vm2 = MagicMock(), MagicMock()
+        meta = {'component': 'SupernaWarm', 'version': '2.5.6'}
+        fake_staged_vms.return_value = [(vm1, {'name': 'SupernaWarm-2.5.6-aaaa', 'config.changeVersion': '1'}, meta),
+                                        (vm2, {'name': 'SupernaWarm-2.5.6-bbbb', 'config.changeVersion': '1'}, meta)]
+        fake_wait_task.side_effect = [RuntimeError('testing'), None, None, None]
+
+        output = warm_pool.claim(MagicMock(), 'bob', 'mySuperna', '2.5.6', MagicMock(), self.logger)
+
+        self.assertTrue(output in (vm1, vm2))
+        self.assertEqual(vm1.Rename_Task.call_count + vm2.Rename_Task.call_count, 1)
+
+    @patch.object(warm_pool, 'staged_vms')
+    def test_claim_empty(self, fake_staged_vms):
+        """``claim`` returns None when the pool is empty"""
+        fake_staged_vms.return_value = []
+
+        output = warm_pool.claim(MagicMock(), 'bob', 'mySuperna', '2.5.6', MagicMock(), self.logger)
+
+        self.assertTrue(output is None)
+
+    @patch.object(warm_pool, '_release')
+    @patch.object(warm_pool, 'wait_task')
+    @patch.object(warm_pool, 'staged_vms')
+    def test_claim_duplicate_name(self, fake_staged_vms, fake_wait_task, fake_release):
+        """``claim`` puts the VM back, and raises ValueError if the VM cannot be renamed"""
+        the_vm = MagicMock()
+        props = {'name': 'SupernaWarm-2.5.6-aaaa', 'config.changeVersion': '1'}
+        fake_staged_vms.return_value = [(the_vm, props, {'component': 'SupernaWarm', 'version': '2.5.6'})]
+        fake_wait_task.side_effect = [None, RuntimeError('testing')]
+
+        with self.assertRaises(ValueError):
+            warm_pool.claim(MagicMock(), 'bob', 'mySuperna', '2.5.6', MagicMock(), self.logger)
+        self.assertTrue(fake_release.called)
+
+    @patch.object(warm_pool.virtual_machine, 'set_meta')
+    @patch.object(warm_pool.templates, 'import_ova')
+    @patch.object(warm_pool, 'staging_folder')
+    @patch.object(warm_pool, 'vcenter_session')
+    def test_stage(self, fake_vcenter_session, fake_staging_folder, fake_import_ova, fake_set_meta):
+        """``stage`` imports the OVA into the staging folder"""
+        vcenter = fake_vcenter_session.return_value.__enter__.return_value
+        vcenter.networks = {'VM Network': warm_pool.vim.Network('net-1')}
+
+        output = warm_pool.stage('2.5.6', IMAGE_INFO, self.logger)
+
+        self.assertTrue(output.startswith('SupernaWarm-2.5.6-'))
+        self.assertTrue(fake_import_ova.call_args[0][1].endswith(IMAGE_INFO['file']))
+        self.assertEqual(fake_set_meta.call_args[0][1]['component'], 'SupernaWarm')
+
+    @patch.object(warm_pool.templates, 'discard')
+    @patch.object(warm_pool.virtual_machine, 'set_meta')
+    @patch.object(warm_pool.templates, 'import_ova')
+    @patch.object(warm_pool, 'staging_folder')
+    @patch.object(warm_pool, 'vcenter_session')
+    def test_stage_cleans_up(self, fake_vcenter_session, fake_staging_folder, fake_import_ova, fake_set_meta,
+                             fake_discard):
+        """``stage`` destroys the new VM if it can't be finished"""
+        vcenter = fake_vcenter_session.return_value.__enter__.return_value
+        vcenter.networks = {'VM Network': warm_pool.vim.Network('net-1')}
+        fake_set_meta.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            warm_pool.stage('2.5.6', IMAGE_INFO, self.logger)
+
+        self.assertTrue(fake_discard.call_args[0][0] is fake_import_ova.return_value)
+
+    @patch.object(warm_pool, 'staging_folder')
+    @patch.object(warm_pool, 'vcenter_session')
+    def test_stage_no_network(self, fake_vcenter_session, fake_staging_folder):
+        """``stage`` raises ValueError if the staging network does not exist"""
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {}
+
+        with self.assertRaises(ValueError):
+            warm_pool.stage('2.5.6', IMAGE_INFO, self.logger)
+
+    @patch.object(warm_pool, 'const', warm_pool.const._replace(VLAB_SUPERNA_WARM_POOL_SIZE=3))
+    @patch.object(warm_pool, 'stage')
+    @patch.object(warm_pool, 'reap')
+    @patch.object(warm_pool, 'occupancy')
+    @patch.object(warm_pool, 'vcenter_session')
+    @patch.object(warm_pool.image_catalog, 'CATALOG')
+    def test_refill(self, fake_CATALOG, fake_vcenter_session, fake_occupancy, fake_reap, fake_stage):
+        """``refill`` removes the failed VMs, and only deploys the VMs the pool is missing"""
+        fake_CATALOG.get.return_value = IMAGE_INFO
+        fake_occupancy.return_value = {'2.5.6': {'ready': 1, 'pending': 1, 'claimed': 4, 'failed': 2}}
+        fake_stage.return_value = 'SupernaWarm-2.5.6-aaaa'
+
+        output = warm_pool.refill('2.5.6', self.logger)
+
+        self.assertEqual(output, ['SupernaWarm-2.5.6-aaaa'])
+        self.assertTrue(fake_reap.called)
+
+    @patch.object(warm_pool, 'stage')
+    @patch.object(warm_pool.image_catalog, 'CATALOG')
+    def test_refill_disabled(self, fake_CATALOG, fake_stage):
+        """``refill`` does nothing when the pool size is zero"""
+        fake_CATALOG.get.return_value = IMAGE_INFO
+
+        output = warm_pool.refill('2.5.6', self.logger)
+
+        self.assertEqual(output, [])
+        self.assertFalse(fake_stage.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,591 @@
+# -*- coding: UTF-8 -*-
+"""
+An in-process fake of vCenter, for measuring the worker without a network.
+
+``VCenterSim`` sits where pyVmomi's SOAP adapter normally does: every method
+call, and every property read, of a managed object bound to the simulator lands
+in ``InvokeMethod`` / ``InvokeAccessor``. Each one is counted as a round trip,
+and costs ``latency`` seconds, so the counts (and the timings) are what the
+code would see against a real vCenter.
+
+It implements just enough of the vSphere API for ``show_superna``,
+``create_superna`` (template mode) and ``delete_superna``:
+
+  - the PropertyCollector (RetrievePropertiesEx w/ paging and traversal specs,
+    CreateFilter and WaitForUpdatesEx)
+  - container views, SearchIndex.FindChild
+  - power on/off, clone, reconfigure and destroy tasks; tasks finish after
+    ``task_duration`` seconds, and a powered on VM gets an IP after ``boot_time``
+
+Anything else raises NotImplementedError, naming the method that's missing.
+"""
+import time
+import datetime
+import itertools
+import threading
+from collections import Counter, defaultdict
+
+import ujson
+import OpenSSL
+from pyVmomi import vim, vmodl
+from pyVmomi.VmomiSupport import ManagedObject, DataObject
+from vlab_inf_common.vmware import vCenter
+
+from vlab_superna_api.lib import const
+
+PropertyCollector = vmodl.query.PropertyCollector
+IMAGE = '1.0.0'
+IMAGE_INFO = {'file': 'Superna_Eyeglass-1.0.0.ova', 'networks': ['VM Network'], 'mtime': 1.0, 'size': 1024}
+VAPP_PROPERTIES = ['eth0.ipv4.ip', 'eth0.ipv4.netmask', 'eth0.ipv4.gateway', 'hostname', 'nameservers']
+
+
+def _copy(value):
+    """Copy a property value, like deserializing a SOAP response would. Without
+    this, the caller could change the state of the simulator by editing a data
+    object it was handed.
+
+    :Returns: Object
+    """
+    if isinstance(value, ManagedObject):
+        return value
+    if isinstance(value, DataObject):
+        answer = value.__class__()
+        for prop in value._GetPropertyList():
+            item = getattr(value, prop.name)
+            if item is not None:
+                setattr(answer, prop.name, _copy(item))
+        return answer
+    if isinstance(value, list):
+        return value.__class__(_copy(x) for x in value)
+    return value
+
+
+def _typed(value):
+    """pyVmomi won't put a plain list into an ``anyType`` field, like the value
+    of a DynamicProperty; it needs to be an array of a vmodl type.
+
+    :Returns: Object
+    """
+    if not isinstance(value, list) or hasattr(type(value), 'Item'):
+        return value
+    types = {type(x) for x in value}
+    if len(types) == 1:
+        return types.pop().Array(value)
+    return vim.ManagedEntity.Array(value)
+
+
+def _certificate():
+    """Make a self-signed cert, to stand in for the one on vCenter
+
+    :Returns: String
+    """
+    key = OpenSSL.crypto.PKey()
+    key.generate_key(OpenSSL.crypto.TYPE_RSA, 1024)
+    cert = OpenSSL.crypto.X509()
+    cert.get_subject().CN = 'vcsim.vlab.local'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, cert).decode()
+
+
+class VCenterSim(object):
+    """A fake vCenter, with an inventory of ``users`` folders, each holding
+    ``vms_per_user`` Superna VMs and ``networks_per_user`` port groups.
+
+    :param users: How many users (i.e. VM folders) to make
+    :type users: Integer
+
+    :param vms_per_user: How many Superna VMs each user owns
+    :type vms_per_user: Integer
+
+    :param networks_per_user: How many port groups each user owns
+    :type networks_per_user: Integer
+
+    :param latency: How many seconds every round trip takes
+    :type latency: Float
+
+    :param task_duration: How many seconds every task takes to finish
+    :type task_duration: Float
+
+    :param boot_time: How many seconds after power on until a VM has an IP
+    :type boot_time: Float
+    """
+    def __init__(self, users=10, vms_per_user=5, networks_per_user=2, latency=0.0, task_duration=0.0, boot_time=0.0):
+        self.latency = latency
+        self.task_duration = task_duration
+        self.boot_time = boot_time
+        self.calls = Counter()
+        self.certificate = _certificate()
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._ids = itertools.count(1)
+        self._props = {}
+        self._tokens = {}
+        self._filters = {}
+        self._dirty = defaultdict(set)
+        self._version = 0
+        self._props['SessionManager'] = {'currentSession': vim.UserSession(key='vcsim-session', userName='tester')}
+        self._props['VpxSettings'] = {'setting': vim.option.OptionValue.Array()}
+        self._build(users, vms_per_user, networks_per_user)
+
+    # --- Inventory -----------------------------------------------------------
+
+    def _new(self, cls, prefix, **props):
+        """Make a managed object, bound to the simulator
+
+        :Returns: pyVmomi.VmomiSupport.ManagedObject
+        """
+        mo = cls('{}-{}'.format(prefix, next(self._ids)), stub=self)
+        self._props[mo._moId] = props
+        return mo
+
+    def _add_child(self, folder, child):
+        """Put a managed entity into a folder"""
+        self._props[folder._moId]['childEntity'].append(child)
+        self._props[child._moId]['parent'] = folder
+
+    def _folder(self, parent, name):
+        """Make a folder"""
+        folder = self._new(vim.Folder, 'group-v', name=name, childEntity=vim.ManagedEntity.Array())
+        if parent is not None:
+            self._add_child(parent, folder)
+        return folder
+
+    def _folder_path(self, root, path):
+        """Make every folder in a path, like ``vCenter.create_vm_folder``"""
+        folder = root
+        for name in path.strip('/').split('/'):
+            for child in self._props[folder._moId]['childEntity']:
+                if isinstance(child, vim.Folder) and self._props[child._moId]['name'] == name:
+                    folder = child
+                    break
+            else:
+                folder = self._folder(folder, name)
+        return folder
+
+    def _build(self, users, vms_per_user, networks_per_user):
+        """Make the inventory"""
+        self.root = self._folder(None, 'Datacenters')
+        self.vm_folder = self._folder(None, 'vm')
+        self.network_folder = self._folder(None, 'network')
+        datacenter = self._new(vim.Datacenter, 'datacenter', name='Datacenter', vmFolder=self.vm_folder,
+                               networkFolder=self.network_folder, hostFolder=self._folder(None, 'host'),
+                               datastoreFolder=self._folder(None, 'datastore'))
+        self._add_child(self.root, datacenter)
+        # compute & storage
+        pool = self._new(vim.ResourcePool, 'resgroup', name=const.INF_VCENTER_RESORUCE_POOL)
+        host = self._new(vim.HostSystem, 'host', name='esxi01.vlab.local',
+                         runtime=vim.host.RuntimeInfo(inMaintenanceMode=False))
+        cluster = self._new(vim.ClusterComputeResource, 'domain-c', name='cluster', resourcePool=pool,
+                            host=vim.HostSystem.Array([host]))
+        self._add_child(self._props[datacenter._moId]['hostFolder'], cluster)
+        datastore = self._new(vim.Datastore, 'datastore', name='datastore1')
+        pod = self._new(vim.StoragePod, 'group-p', name=const.INF_VCENTER_DATASTORE.split(',')[0],
+                        childEntity=vim.ManagedEntity.Array([datastore]))
+        self._add_child(self._props[datacenter._moId]['datastoreFolder'], pod)
+        # networking
+        self.dvs = self._new(vim.dvs.VmwareDistributedVirtualSwitch, 'dvs', name='vlab-dvs', uuid='dvs-uuid-1')
+        self._add_child(self.network_folder, self.dvs)
+        self._add_child(self.network_folder, self._portgroup(const.VLAB_SUPERNA_TEMPLATE_NETWORK))
+        # the template that creates clone
+        template_folder = self._folder_path(self.vm_folder, const.VLAB_SUPERNA_TEMPLATE_DIR)
+        meta = {'component': 'SupernaTemplate', 'created': 0, 'version': IMAGE, 'configured': False,
+                'generation': 1, 'ova_mtime': IMAGE_INFO['mtime'], 'ova_size': IMAGE_INFO['size']}
+        self.template = self._vm(template_folder, 'SupernaTemplate-{}'.format(IMAGE), ujson.dumps(meta), None)
+        self._props[self.template._moId]['config'].template = True
+        # the users, and their VMs
+        top = self._folder_path(self.vm_folder, const.INF_VCENTER_TOP_LVL_DIR)
+        self.users = []
+        for user in range(users):
+            username = 'user{}'.format(user)
+            self.users.append(username)
+            folder = self._folder(top, username)
+            portgroups = []
+            for network in range(networks_per_user):
+                portgroups.append(self._portgroup('{}_network{}'.format(username, network)))
+                self._add_child(self.network_folder, portgroups[-1])
+            for vm in range(vms_per_user):
+                meta = {'component': 'Superna', 'created': 0, 'version': IMAGE, 'configured': False, 'generation': 1}
+                the_vm = self._vm(folder, 'superna{}'.format(vm), ujson.dumps(meta), portgroups[0] if portgroups else None)
+                self._power(the_vm, vim.VirtualMachinePowerState.poweredOn)
+                self._boot(the_vm)
+
+    def _portgroup(self, name):
+        """Make a distributed port group"""
+        key = 'dvportgroup-key-{}'.format(next(self._ids))
+        config = vim.dvs.DistributedVirtualPortgroup.ConfigInfo(key=key, name=name, distributedVirtualSwitch=self.dvs)
+        return self._new(vim.dvs.DistributedVirtualPortgroup, 'dvportgroup', name=name, key=key, config=config,
+                         vm=vim.VirtualMachine.Array())
+
+    def _vm(self, folder, name, annotation, portgroup):
+        """Make a powered off VM"""
+        vapp = vim.vApp.VmConfigInfo(property=[vim.vApp.PropertyInfo(key=x, id=y) for x, y in enumerate(VAPP_PROPERTIES)])
+        hardware = vim.vm.VirtualHardware(device=[vim.vm.device.VirtualVmxnet3(key=4000)])
+        config = vim.vm.ConfigInfo(name=name, annotation=annotation, template=False, vAppConfig=vapp, hardware=hardware)
+        the_vm = self._new(vim.VirtualMachine, 'vm', name=name, config=config,
+                           runtime=vim.vm.RuntimeInfo(powerState=vim.VirtualMachinePowerState.poweredOff),
+                           guest=vim.vm.GuestInfo(toolsStatus=vim.vm.GuestInfo.ToolsStatus.toolsNotRunning, net=[]),
+                           network=vim.Network.Array())
+        self._add_child(folder, the_vm)
+        if portgroup is not None:
+            self._connect(the_vm, portgroup)
+        return the_vm
+
+    def _connect(self, the_vm, portgroup):
+        """Connect a VM to a port group"""
+        self._props[the_vm._moId]['network'] = vim.Network.Array([portgroup])
+        self._props[portgroup._moId]['vm'].append(the_vm)
+
+    def _power(self, the_vm, state):
+        """Change the power state of a VM"""
+        props = self._props[the_vm._moId]
+        props['runtime'].powerState = state
+        if state == vim.VirtualMachinePowerState.poweredOff:
+            props['guest'].toolsStatus = vim.vm.GuestInfo.ToolsStatus.toolsNotRunning
+            props['guest'].net = []
+        self._changed(the_vm)
+
+    def _boot(self, the_vm):
+        """VMware Tools is up, and the VM has an IP"""
+        with self._lock:
+            props = self._props.get(the_vm._moId)
+            if props is None or props['runtime'].powerState != vim.VirtualMachinePowerState.poweredOn:
+                return
+            props['guest'].toolsStatus = vim.vm.GuestInfo.ToolsStatus.toolsOk
+            props['guest'].net = [vim.vm.GuestInfo.NicInfo(ipAddress=['10.0.0.{}'.format(next(self._ids) % 250 + 2)])]
+            self._changed(the_vm)
+
+    def _get(self, mo, path):
+        """Read a (possibly nested, i.e. "runtime.powerState") property
+
+        :Returns: Object
+
+        :Raises: vmodl.fault.ManagedObjectNotFound if the object was destroyed
+        """
+        props = self._props.get(mo._moId)
+        if props is None:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        name, _, rest = path.partition('.')
+        value = props.get(name)
+        for part in rest.split('.') if rest else []:
+            if value is None:
+                break
+            value = getattr(value, part)
+        return value
+
+    def _children(self, entity):
+        """The things directly inside an entity, for FindChild & container views"""
+        props = self._props.get(entity._moId, {})
+        if isinstance(entity, vim.Datacenter):
+            return [props['vmFolder'], props['hostFolder'], props['networkFolder'], props['datastoreFolder']]
+        if isinstance(entity, vim.ComputeResource):
+            return [props['resourcePool']] + list(props['host'])
+        return list(props.get('childEntity', []))
+
+    def _changed(self, mo):
+        """Tell the property filters watching an object that it changed. Must hold the lock."""
+        with self._cond:
+            for filter_id, (collector_id, objs, _) in self._filters.items():
+                if mo._moId in objs:
+                    self._dirty[collector_id].add(filter_id)
+            self._cond.notify_all()
+
+    # --- The stub interface pyVmomi calls ------------------------------------
+
+    def InvokeAccessor(self, mo, info):
+        """Read a property of a managed object; one round trip"""
+        self._round_trip('get:{}'.format(info.name))
+        with self._lock:
+            return _copy(self._get(mo, info.name))
+
+    def InvokeMethod(self, mo, info, args):
+        """Call a method of a managed object; one round trip"""
+        name = info.wsdlName
+        if name == 'WaitForUpdatesEx':
+            # A long poll; it costs its own time, not a round trip's worth
+            self.calls[name] += 1
+            return self._wait_for_updates(mo, *args)
+        self._round_trip(name)
+        handler = getattr(self, '_do_{}'.format(name), None)
+        if handler is None:
+            raise NotImplementedError('The vCenter simulator does not implement {}'.format(name))
+        with self._lock:
+            return handler(mo, *args)
+
+    def _round_trip(self, name):
+        """Count, and pay for, a round trip"""
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def round_trips(self):
+        """How many round trips have been made; long polls are not included
+
+        :Returns: Integer
+        """
+        with self._lock:
+            return sum(y for x, y in self.calls.items() if x != 'WaitForUpdatesEx')
+
+    def login(self):
+        """Stands in for ``session_pool._login``
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        self._round_trip('Login')
+        vcenter = vCenter.__new__(vCenter)
+        vcenter._conn = vim.ServiceInstance('ServiceInstance', stub=self)
+        vcenter._base_dir = const.INF_VCENTER_TOP_LVL_DIR
+        vcenter._net_cache = None
+        return vcenter
+
+    # --- Methods -------------------------------------------------------------
+
+    def _do_RetrieveServiceContent(self, mo):
+        return vim.ServiceInstanceContent(rootFolder=self.root,
+                                          propertyCollector=PropertyCollector('propertyCollector', stub=self),
+                                          viewManager=vim.view.ViewManager('ViewManager', stub=self),
+                                          searchIndex=vim.SearchIndex('SearchIndex', stub=self),
+                                          sessionManager=vim.SessionManager('SessionManager', stub=self),
+                                          ovfManager=vim.OvfManager('OvfManager', stub=self),
+                                          setting=vim.option.OptionManager('VpxSettings', stub=self),
+                                          about=vim.AboutInfo(instanceUuid='vcsim-uuid'))
+
+    def _do_Logout(self, mo):
+        return None
+
+    def _do_AcquireCloneTicket(self, mo):
+        return 'cst-{}'.format(next(self._ids))
+
+    def _do_CreateContainerView(self, mo, container, types, recursive):
+        found = []
+        pending = self._children(container)
+        while pending:
+            obj = pending.pop(0)
+            if any(isinstance(obj, x) for x in types):
+                found.append(obj)
+            if recursive:
+                pending.extend(self._children(obj))
+        return self._new(vim.view.ContainerView, 'session', view=vim.ManagedEntity.Array(found))
+
+    def _do_DestroyView(self, mo):
+        self._props.pop(mo._moId, None)
+
+    def _do_FindChild(self, mo, entity, name):
+        for child in self._children(entity):
+            if self._props[child._moId].get('name') == name:
+                return child
+        return None
+
+    def _do_RetrievePropertiesEx(self, mo, specs, options):
+        contents = []
+        for spec in specs:
+            contents.extend(self._retrieve(spec))
+        return self._page(contents, options.maxObjects if options else None)
+
+    def _do_ContinueRetrievePropertiesEx(self, mo, token):
+        contents, page_size = self._tokens.pop(token)
+        return self._page(contents, page_size)
+
+    def _page(self, contents, page_size):
+        """Return a page of results, and keep the rest for ContinueRetrievePropertiesEx"""
+        if not contents:
+            return None
+        result = PropertyCollector.RetrieveResult(objects=contents[:page_size] if page_size else contents)
+        if page_size and len(contents) > page_size:
+            result.token = 'token-{}'.format(next(self._ids))
+            self._tokens[result.token] = (contents[page_size:], page_size)
+        return result
+
+    def _retrieve(self, spec):
+        """Run the object & traversal specs of a filter, then read the properties
+
+        :Returns: List of vmodl.query.PropertyCollector.ObjectContent
+        """
+        named = {}
+
+        def gather(selections):
+            for selection in selections or []:
+                if isinstance(selection, PropertyCollector.TraversalSpec):
+                    named.setdefault(selection.name, selection)
+                    gather(selection.selectSet)
+
+        for obj_spec in spec.objectSet:
+            gather(obj_spec.selectSet)
+        found = []
+        seen = set()
+        visited = set()
+
+        def add(obj):
+            if obj._moId in self._props and obj._moId not in seen:
+                seen.add(obj._moId)
+                found.append(obj)
+
+        def follow(obj, selection):
+            if not isinstance(selection, PropertyCollector.TraversalSpec):
+                selection = named.get(selection.name)
+            if selection is None or not isinstance(obj, selection.type) or obj._moId not in self._props:
+                return
+            key = (obj._moId, selection.name or id(selection))
+            if key in visited:
+                return
+            visited.add(key)
+            value = self._get(obj, selection.path)
+            for child in value if isinstance(value, list) else [value] if value is not None else []:
+                if not selection.skip:
+                    add(child)
+                for next_selection in selection.selectSet or []:
+                    follow(child, next_selection)
+
+        for obj_spec in spec.objectSet:
+            if not obj_spec.skip:
+                add(obj_spec.obj)
+            for selection in obj_spec.selectSet or []:
+                follow(obj_spec.obj, selection)
+        contents = []
+        for obj in found:
+            paths = [y for x in spec.propSet if isinstance(obj, x.type) for y in x.pathSet]
+            if not paths:
+                continue
+            props = []
+            for path in paths:
+                value = self._get(obj, path)
+                if value is not None and not (isinstance(value, list) and not value):
+                    props.append(vmodl.DynamicProperty(name=path, val=_typed(_copy(value))))
+            contents.append(PropertyCollector.ObjectContent(obj=obj, propSet=props))
+        return contents
+
+    def _do_CreatePropertyCollector(self, mo):
+        return self._new(PropertyCollector, 'session')
+
+    def _do_DestroyPropertyCollector(self, mo):
+        self._props.pop(mo._moId, None)
+
+    def _do_CreateFilter(self, mo, spec, partial_updates):
+        the_filter = self._new(PropertyCollector.Filter, 'filter')
+        objs = {x.obj._moId for x in spec.objectSet}
+        self._filters[the_filter._moId] = (mo._moId, objs, spec)
+        # The first update has the current values
+        self._dirty[mo._moId].add(the_filter._moId)
+        self._cond.notify_all()
+        return the_filter
+
+    def _do_DestroyPropertyFilter(self, mo):
+        self._filters.pop(mo._moId, None)
+        self._props.pop(mo._moId, None)
+
+    def _wait_for_updates(self, collector, version, options):
+        """Block until a watched object changes, or ``maxWaitSeconds`` pass
+
+        :Returns: vmodl.query.PropertyCollector.UpdateSet or None
+        """
+        timeout = options.maxWaitSeconds if options and options.maxWaitSeconds is not None else 600
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._dirty[collector._moId], timeout):
+                return None
+            dirty, self._dirty[collector._moId] = self._dirty[collector._moId], set()
+            filter_updates = []
+            for filter_id in dirty:
+                if filter_id not in self._filters:
+                    continue
+                _, _, spec = self._filters[filter_id]
+                obj_updates = []
+                for obj_spec in spec.objectSet:
+                    obj = obj_spec.obj
+                    if obj._moId not in self._props:
+                        obj_updates.append(PropertyCollector.ObjectUpdate(kind='leave', obj=obj))
+                        continue
+                    changes = []
+                    for path in [y for x in spec.propSet if isinstance(obj, x.type) for y in x.pathSet]:
+                        value = self._get(obj, path)
+                        if isinstance(value, list) and not value:
+                            value = None
+                        changes.append(PropertyCollector.Change(name=path, op='assign', val=_typed(_copy(value))))
+                    obj_updates.append(PropertyCollector.ObjectUpdate(kind='modify', obj=obj, changeSet=changes))
+                filter_updates.append(PropertyCollector.FilterUpdate(filter=PropertyCollector.Filter(filter_id, stub=self),
+                                                                     objectSet=obj_updates))
+            self._version += 1
+            return PropertyCollector.UpdateSet(version=str(self._version), filterSet=filter_updates)
+
+    # --- Tasks ---------------------------------------------------------------
+
+    def _task(self, obj, work):
+        """Start a task that runs ``work`` after ``task_duration`` seconds. Must hold the lock.
+
+        :Returns: vim.Task
+        """
+        info = vim.TaskInfo(key='task-key', state=vim.TaskInfo.State.running, entity=obj,
+                            queueTime=datetime.datetime.now())
+        task = self._new(vim.Task, 'task', info=info)
+        info.task = task
+
+        def finish():
+            with self._lock:
+                try:
+                    info.result = work()
+                    info.state = vim.TaskInfo.State.success
+                except vmodl.MethodFault as doh:
+                    info.error = doh
+                    info.state = vim.TaskInfo.State.error
+                info.completeTime = datetime.datetime.now()
+                self._changed(task)
+
+        if self.task_duration > 0:
+            timer = threading.Timer(self.task_duration, finish)
+            timer.daemon = True
+            timer.start()
+        else:
+            finish()
+        return task
+
+    def _do_PowerOnVM_Task(self, mo, host):
+        def work():
+            self._power(mo, vim.VirtualMachinePowerState.poweredOn)
+            if self.boot_time > 0:
+                timer = threading.Timer(self.boot_time, self._boot, args=(mo,))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._boot(mo)
+        return self._task(mo, work)
+
+    def _do_PowerOffVM_Task(self, mo):
+        return self._task(mo, lambda: self._power(mo, vim.VirtualMachinePowerState.poweredOff))
+
+    def _do_ReconfigVM_Task(self, mo, spec):
+        def work():
+            config = self._props[mo._moId]['config']
+            if spec.annotation is not None:
+                config.annotation = spec.annotation
+            if spec.vAppConfig is not None:
+                values = {x.info.id: x.info.value for x in spec.vAppConfig.property}
+                for prop in config.vAppConfig.property:
+                    prop.value = values.get(prop.id, prop.value)
+            self._changed(mo)
+        return self._task(mo, work)
+
+    def _do_CloneVM_Task(self, mo, folder, name, spec):
+        def work():
+            if self._do_FindChild(None, folder, name) is not None:
+                raise vim.fault.DuplicateName(name=name, object=folder)
+            annotation = spec.config.annotation if spec.config else self._props[mo._moId]['config'].annotation
+            portgroup = None
+            for device_spec in spec.config.deviceChange if spec.config else []:
+                key = device_spec.device.backing.port.portgroupKey
+                portgroup = [x for x in self._props[self.network_folder._moId]['childEntity']
+                             if self._props[x._moId].get('key') == key][0]
+            return self._vm(folder, name, annotation, portgroup)
+        return self._task(mo, work)
+
+    def _do_Destroy_Task(self, mo):
+        def work():
+            props = self._props.pop(mo._moId)
+            self._props[props['parent']._moId]['childEntity'].remove(mo)
+            for portgroup in props.get('network', []):
+                self._props[portgroup._moId]['vm'].remove(mo)
+            self._changed(mo)
+        return self._task(mo, work)
@@ -1,17 +1,59 @@
 # -*- coding: UTF-8 -*-
-from flask import Flask
+import time
+
+from flask import Flask, g, request
 from celery import Celery
 
-from vlab_superna_api.lib import const
-from vlab_superna_api.lib.views import HealthView, SupernaView
+from vlab_superna_api.lib import const, metrics, results, routing, tracing
+from vlab_superna_api.lib.views import HealthView, MetricsView, SupernaView
 
 app = Flask(__name__)
-app.celery_app = Celery('superna', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+app.celery_app = Celery('superna', backend=const.VLAB_SUPERNA_RESULT_BACKEND, broker=const.VLAB_MESSAGE_BROKER)
+results.configure(app.celery_app)
+routing.configure(app.celery_app)
 app.celery_app.conf.broker_heartbeat = 0 #https://github.com/celery/celery/issues/4895
+tracing.EXPORTER.service = 'vlab-superna-api'
 
 HealthView.register(app)
+MetricsView.register(app)
 SupernaView.register(app)
 
 
+def _endpoint():
+    """The route, not the path, so every task id doesn't become its own series"""
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@app.before_request
+def start_timer():
+    """Note when the API started on a request, and trace it (validation included)"""
+    g.started = time.time()
+    g.span = tracing.start('{} {}'.format(request.method, _endpoint()),
+                           txn_id=request.headers.get('X-REQUEST-ID', 'noId'))
+    if g.span is not None:
+        g.span_token = tracing.activate(g.span)
+
+
+@app.after_request
+def record_request(response):
+    """Record how long the API took to respond"""
+    metrics.HTTP_SECONDS.observe(time.time() - g.get('started', time.time()),
+                                 method=request.method, endpoint=_endpoint(), status=response.status_code)
+    if g.get('span') is not None:
+        g.span.set('status', response.status_code)
+    return response
+
+
+@app.teardown_request
+def finish_trace(error):
+    """End the span of a request, even one that raised"""
+    the_span = g.get('span')
+    if the_span is not None:
+        if error is not None:
+            the_span.error = '{}'.format(error)
+        tracing.deactivate(g.span_token)
+        the_span.finish()
+
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", debug=True)
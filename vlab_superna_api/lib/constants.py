@@ -24,6 +24,63 @@ DEFINED = OrderedDict([
             ('VLAB_URL', environ.get('VLAB_URL', 'https://localhost')),
             ('VLAB_SUPERNA_IMAGES_DIR', environ.get('VLAB_SUPERNA_IMAGES_DIR', '/images')),
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
+            ('VLAB_SUPERNA_VCENTER_POOL_SIZE', int(environ.get('VLAB_SUPERNA_VCENTER_POOL_SIZE', 4))),
+            ('VLAB_SUPERNA_VCENTER_KEEPALIVE', int(environ.get('VLAB_SUPERNA_VCENTER_KEEPALIVE', 300))),
+            ('VLAB_SUPERNA_VCENTER_MAX_IDLE', int(environ.get('VLAB_SUPERNA_VCENTER_MAX_IDLE', 3600))),
+            ('VLAB_SUPERNA_IMAGE_RECHECK', int(environ.get('VLAB_SUPERNA_IMAGE_RECHECK', 5))),
+            ('VLAB_SUPERNA_IMAGE_SETTLE', int(environ.get('VLAB_SUPERNA_IMAGE_SETTLE', 60))),
+            ('VLAB_SUPERNA_IMAGE_SYNC', environ.get('VLAB_SUPERNA_IMAGE_SYNC', False)),
+            ('VLAB_SUPERNA_IMAGE_MAX_AGE', int(environ.get('VLAB_SUPERNA_IMAGE_MAX_AGE', 300))),
+            ('VLAB_SUPERNA_SHOW_CACHE_TTL', int(environ.get('VLAB_SUPERNA_SHOW_CACHE_TTL', 10))),
+            ('VLAB_SUPERNA_SHOW_CACHE_SIZE', int(environ.get('VLAB_SUPERNA_SHOW_CACHE_SIZE', 500))),
+            ('VLAB_SUPERNA_FOLDER_MISS_TTL', int(environ.get('VLAB_SUPERNA_FOLDER_MISS_TTL', 10))),
+            ('VLAB_SUPERNA_DEPLOY_MODE', environ.get('VLAB_SUPERNA_DEPLOY_MODE', 'ova')),
+            ('VLAB_SUPERNA_TEMPLATE_DIR', environ.get('VLAB_SUPERNA_TEMPLATE_DIR', 'vlab/templates/superna')),
+            ('VLAB_SUPERNA_TEMPLATE_NETWORK', environ.get('VLAB_SUPERNA_TEMPLATE_NETWORK', 'VM Network')),
+            ('VLAB_SUPERNA_LINKED_CLONE', environ.get('VLAB_SUPERNA_LINKED_CLONE', False)),
+            ('VLAB_SUPERNA_WARM_POOL_SIZE', int(environ.get('VLAB_SUPERNA_WARM_POOL_SIZE', 0))),
+            ('VLAB_SUPERNA_WARM_POOL_SIZES', environ.get('VLAB_SUPERNA_WARM_POOL_SIZES', '')),
+            ('VLAB_SUPERNA_WARM_POOL_DIR', environ.get('VLAB_SUPERNA_WARM_POOL_DIR', 'vlab/staging/superna')),
+            ('VLAB_SUPERNA_WARM_POOL_CONCURRENCY', int(environ.get('VLAB_SUPERNA_WARM_POOL_CONCURRENCY', 2))),
+            ('VLAB_SUPERNA_WARM_POOL_INTERVAL', int(environ.get('VLAB_SUPERNA_WARM_POOL_INTERVAL', 600))),
+            ('VLAB_SUPERNA_WARM_POOL_STAGE_TIMEOUT', int(environ.get('VLAB_SUPERNA_WARM_POOL_STAGE_TIMEOUT', 7200))),
+            ('VLAB_SUPERNA_BATCH_CONCURRENCY', int(environ.get('VLAB_SUPERNA_BATCH_CONCURRENCY', 4))),
+            ('VLAB_SUPERNA_BATCH_MAX', int(environ.get('VLAB_SUPERNA_BATCH_MAX', 50))),
+            ('VLAB_SUPERNA_BOOT_SETTLE', int(environ.get('VLAB_SUPERNA_BOOT_SETTLE', 300))),
+            ('VLAB_SUPERNA_EXECUTION_MODE', environ.get('VLAB_SUPERNA_EXECUTION_MODE', 'sync')),
+            ('VLAB_SUPERNA_ASYNC_CONCURRENCY', int(environ.get('VLAB_SUPERNA_ASYNC_CONCURRENCY', 10))),
+            ('VLAB_SUPERNA_ASYNC_THREADS', int(environ.get('VLAB_SUPERNA_ASYNC_THREADS', 50))),
+            ('VLAB_SUPERNA_NFC_CONCURRENCY', int(environ.get('VLAB_SUPERNA_NFC_CONCURRENCY', 4))),
+            ('VLAB_SUPERNA_NFC_RETRIES', int(environ.get('VLAB_SUPERNA_NFC_RETRIES', 3))),
+            ('VLAB_SUPERNA_NFC_TIMEOUT', int(environ.get('VLAB_SUPERNA_NFC_TIMEOUT', 300))),
+            ('VLAB_SUPERNA_NETWORK_TTL', int(environ.get('VLAB_SUPERNA_NETWORK_TTL', 300))),
+            ('VLAB_SUPERNA_MANIFEST_INDEX', environ.get('VLAB_SUPERNA_MANIFEST_INDEX', '/tmp/vlab_superna_manifests.json')),
+            ('VLAB_SUPERNA_EVENTS_POLL', float(environ.get('VLAB_SUPERNA_EVENTS_POLL', 1))),
+            ('VLAB_SUPERNA_EVENTS_KEEPALIVE', int(environ.get('VLAB_SUPERNA_EVENTS_KEEPALIVE', 15))),
+            ('VLAB_SUPERNA_EVENTS_TIMEOUT', int(environ.get('VLAB_SUPERNA_EVENTS_TIMEOUT', 25))),
+            ('VLAB_SUPERNA_RESULT_BACKEND', environ.get('VLAB_SUPERNA_RESULT_BACKEND', 'rpc://')),
+            ('VLAB_SUPERNA_RESULT_TTL', int(environ.get('VLAB_SUPERNA_RESULT_TTL', 86400))),
+            ('VLAB_SUPERNA_RESULT_COMPRESSION', environ.get('VLAB_SUPERNA_RESULT_COMPRESSION', '')),
+            ('VLAB_SUPERNA_TASKS_MAX', int(environ.get('VLAB_SUPERNA_TASKS_MAX', 100))),
+            # A long-poll holds one of the API's threads; see app.ini
+            ('VLAB_SUPERNA_TASKS_WAIT_MAX', min(int(environ.get('VLAB_SUPERNA_TASKS_WAIT_MAX', 25)), 25)),
+            ('VLAB_SUPERNA_DEDUP_TTL', int(environ.get('VLAB_SUPERNA_DEDUP_TTL', 900))),
+            ('VLAB_SUPERNA_DEDUP_SIZE', int(environ.get('VLAB_SUPERNA_DEDUP_SIZE', 10000))),
+            ('VLAB_SUPERNA_METRICS_PORT', int(environ.get('VLAB_SUPERNA_METRICS_PORT', 9180))),
+            ('VLAB_SUPERNA_METRICS_DIR', environ.get('VLAB_SUPERNA_METRICS_DIR', '/tmp/vlab_superna_metrics')),
+            ('VLAB_SUPERNA_TRACE_EXPORTER', environ.get('VLAB_SUPERNA_TRACE_EXPORTER', '')),
+            ('VLAB_SUPERNA_TRACE_FILE', environ.get('VLAB_SUPERNA_TRACE_FILE', '/tmp/vlab_superna_traces.jsonl')),
+            ('VLAB_SUPERNA_TRACE_OTLP_URL', environ.get('VLAB_SUPERNA_TRACE_OTLP_URL', 'http://localhost:4318/v1/traces')),
+            ('VLAB_SUPERNA_WORKER_MODE', environ.get('VLAB_SUPERNA_WORKER_MODE', 'all')),
+            ('VLAB_SUPERNA_FAST_CONCURRENCY', int(environ.get('VLAB_SUPERNA_FAST_CONCURRENCY', 8))),
+            ('VLAB_SUPERNA_FAST_PREFETCH', int(environ.get('VLAB_SUPERNA_FAST_PREFETCH', 4))),
+            ('VLAB_SUPERNA_SLOW_CONCURRENCY', int(environ.get('VLAB_SUPERNA_SLOW_CONCURRENCY', 4))),
+            ('VLAB_SUPERNA_SLOW_PREFETCH', int(environ.get('VLAB_SUPERNA_SLOW_PREFETCH', 1))),
+            ('VLAB_SUPERNA_ADMISSION_STORE', environ.get('VLAB_SUPERNA_ADMISSION_STORE', 'file:///tmp/vlab_superna_admission')),
+            ('VLAB_SUPERNA_IMPORTS_PER_DATASTORE', int(environ.get('VLAB_SUPERNA_IMPORTS_PER_DATASTORE', 3))),
+            ('VLAB_SUPERNA_IMPORTS_PER_HOST', int(environ.get('VLAB_SUPERNA_IMPORTS_PER_HOST', 2))),
+            ('VLAB_SUPERNA_ADMISSION_TTL', int(environ.get('VLAB_SUPERNA_ADMISSION_TTL', 60))),
+            ('VLAB_SUPERNA_ADMISSION_TIMEOUT', int(environ.get('VLAB_SUPERNA_ADMISSION_TIMEOUT', 3600))),
           ])
 
 Constants = namedtuple('Constants', list(DEFINED.keys()))
@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+"""
+Stops a retried request from sending the same task twice.
+
+Clients retry on gateway timeouts; without this, every retry of a create starts
+another multi-GB OVA import. A task is remembered two ways:
+
+  - By (username, task, X-REQUEST-ID), for VLAB_SUPERNA_DEDUP_TTL seconds. A
+    retry with the same X-REQUEST-ID gets the same task id, even if the task is
+    already done.
+  - By (username, machine name), but only while the task is running. A
+    create/delete of a machine that's already being created/deleted gets the
+    task id of the one in flight. Once it's done, or once another kind of task
+    is sent for the machine, a new task is sent as normal.
+
+Whether a task is still running is read from a key/value result backend (i.e.
+Redis). The ``rpc://`` backend only delivers the state of a task to the
+process that's waiting on it, so there a finished (or failed) task would look
+like it's still running; with ``rpc://`` only the X-REQUEST-ID is used.
+
+The store is in-memory, so it only catches retries that land on the same API
+process. Two copies of a request that arrive at the exact same moment can both
+be sent; retries come seconds apart, so that's not worth a lock around the
+broker I/O.
+"""
+from celery import states
+from celery.backends.base import BaseKeyValueStoreBackend
+
+from vlab_superna_api.lib import const, metrics, results, tracing
+from vlab_superna_api.lib.ttl_cache import TTLCache
+
+NO_TXN_ID = 'noId'
+
+
+class Deduplicator(object):
+    """Sends Celery tasks, unless an identical one was sent recently
+
+    :param max_size: The most requests to remember, per key type
+    :type max_size: Integer
+
+    :param ttl: How many seconds to remember a request for
+    :type ttl: Integer
+    """
+    def __init__(self, max_size=const.VLAB_SUPERNA_DEDUP_SIZE, ttl=const.VLAB_SUPERNA_DEDUP_TTL):
+        self._txns = TTLCache(max_size=max_size, ttl=ttl)
+        self._machines = TTLCache(max_size=max_size, ttl=ttl)
+        self.counters = {'sent': 0, 'duplicates': 0}
+
+    def send_task(self, celery_app, name, args, username, txn_id, machine_name=None):
+        """Send a Celery task, or find the task already sent for the same request
+
+        :Returns: String (the task id)
+
+        :param celery_app: The Celery app to send the task with
+        :type celery_app: celery.Celery
+
+        :param name: The name of the task, i.e. ``superna.create``
+        :type name: String
+
+        :param args: The arguments of the task
+        :type args: List
+
+        :param username: The name of the user who sent the request
+        :type username: String
+
+        :param txn_id: The X-REQUEST-ID of the request
+        :type txn_id: String
+
+        :param machine_name: The name of the machine the task works on, if any
+        :type machine_name: String
+        """
+        with tracing.span('send_task', task=name) as the_span:
+            task_id = self._send_task(celery_app, name, args, username, txn_id, machine_name)
+            if the_span is not None:
+                the_span.set('task_id', task_id)
+        return task_id
+
+    def _send_task(self, celery_app, name, args, username, txn_id, machine_name):
+        """The body of ``send_task``, within its trace span
+
+        :Returns: String
+        """
+        txn_key = (username, name, txn_id) if txn_id != NO_TXN_ID else None
+        if machine_name is not None and isinstance(celery_app.backend, BaseKeyValueStoreBackend):
+            machine_key = (username, machine_name)
+        else:
+            machine_key = None
+        task_id = self._find(celery_app, name, txn_key, machine_key)
+        if task_id is not None:
+            self.counters['duplicates'] += 1
+            metrics.TASKS_DEDUPLICATED.inc(task=name)
+            return task_id
+        # The headers carry the trace, and the time sent, to the worker
+        task_id = celery_app.send_task(name, args, headers=tracing.headers()).id
+        self.counters['sent'] += 1
+        metrics.TASKS_SENT.inc(task=name)
+        if txn_key is not None:
+            self._txns.set(txn_key, task_id)
+        if machine_key is not None:
+            self._machines.set(machine_key, (name, task_id))
+        return task_id
+
+    def _find(self, celery_app, name, txn_key, machine_key):
+        """Look for the task of an identical request
+
+        :Returns: String or None
+        """
+        if txn_key is not None:
+            task_id = self._txns.get(txn_key)
+            if task_id is not None:
+                return task_id
+        if machine_key is not None:
+            found = self._machines.get(machine_key)
+            if found is not None and found[0] == name:
+                if self._in_flight(celery_app, found[1]):
+                    return found[1]
+                self._machines.pop(machine_key)
+        return None
+
+    def _in_flight(self, celery_app, task_id):
+        """Check if a task is still running. Needs a key/value result backend.
+
+        :Returns: Boolean
+        """
+        status = results.get_many(celery_app, [task_id])[task_id]['status']
+        return status not in states.READY_STATES
+
+    def stats(self):
+        """Obtain counters about how many retries were caught
+
+        :Returns: Dictionary
+        """
+        answer = dict(self.counters)
+        answer['remembered'] = len(self._txns) + len(self._machines)
+        return answer
+
+
+DEDUP = Deduplicator()
@@ -0,0 +1,360 @@
+# -*- coding: UTF-8 -*-
+"""
+An in-process catalog of the Superna OVAs that can be deployed.
+
+The images directory is normally a network mount, so listing it (and opening
+multi-GB OVAs to learn what's inside) is slow. The catalog reads the directory
+once, and only reads it again after the directory's mtime changes. The details
+about each OVA are kept, and only looked up again if the file itself changes.
+
+What's learned from each OVA (the OVF descriptor, networks, vApp properties,
+and where every disk lives within the tarball) is also saved to an on-disk
+index, so a restarted API/worker doesn't have to re-read the OVAs, and a deploy
+can seek straight to the disk data.
+"""
+import os
+import time
+import tarfile
+import threading
+from xml.etree import ElementTree
+
+import ujson
+
+from vlab_superna_api.lib import const
+
+
+def convert_name(name, to_version=False):
+    """This function centralizes converting between the name of the OVA, and the
+    version of software it contains.
+
+    :param name: The thing to covert
+    :type name: String
+
+    :param to_version: Set to True to covert the name of an OVA to the version
+    :type to_version: Boolean
+    """
+    if to_version:
+        return name.split('-')[-1].replace('.ova', '')
+    else:
+        return 'Superna_Eyeglass-{}.ova'.format(name)
+
+
+def scan_ova(ova_file):
+    """Read the tar headers of an OVA (but not the disks) to find the OVF
+    descriptor, and where each disk is.
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if the OVA has no OVF descriptor
+
+    :param ova_file: The path to the OVA
+    :type ova_file: String
+    """
+    ovf = None
+    disks = {}
+    with tarfile.open(ova_file) as tar:
+        for member in tar:
+            if member.name.endswith('.ovf'):
+                ovf = tar.extractfile(member).read().decode()
+            elif member.name.endswith('.vmdk'):
+                disks[member.name] = [member.offset_data, member.size]
+    if ovf is None:
+        raise ValueError('No OVF descriptor found in {}'.format(ova_file))
+    answer = parse_ovf(ovf)
+    answer['ovf'] = ovf
+    answer['disks'] = disks
+    return answer
+
+
+def parse_ovf(ovf):
+    """Find the network names and vApp property ids defined in an OVF descriptor
+
+    :Returns: Dictionary
+
+    :param ovf: The OVF descriptor XML
+    :type ovf: String
+    """
+    networks = []
+    properties = []
+    for element in ElementTree.fromstring(ovf).iter():
+        tag = element.tag.split('}')[-1]
+        if tag == 'Network':
+            networks.append(_get_attr(element, 'name'))
+        elif tag == 'Property':
+            properties.append(_get_attr(element, 'key'))
+    return {'networks': [x for x in networks if x], 'properties': [x for x in properties if x]}
+
+
+def _get_attr(element, name):
+    """Obtain an XML attribute, ignoring whatever namespace it's in
+
+    :Returns: String or None
+
+    :param element: The XML element with the attribute
+    :type element: xml.etree.ElementTree.Element
+
+    :param name: The attribute name, without the namespace
+    :type name: String
+    """
+    for key, value in element.attrib.items():
+        if key.split('}')[-1] == name:
+            return value
+    return None
+
+
+class ManifestIndex(object):
+    """An on-disk index of what's inside each OVA, keyed by the path of the OVA.
+    An entry is only used if the size and mtime of the OVA still match.
+
+    :param location: The file to keep the index in; an empty string keeps it in memory only
+    :type location: String
+    """
+    def __init__(self, location=const.VLAB_SUPERNA_MANIFEST_INDEX):
+        self._location = location
+        self._lock = threading.Lock()
+        self._entries = None
+        self.counters = {'hits': 0, 'scans': 0}
+
+    def _read(self):
+        """Load the index file
+
+        :Returns: Dictionary
+        """
+        if not self._location:
+            return {}
+        try:
+            with open(self._location) as the_file:
+                return ujson.load(the_file)
+        except (OSError, ValueError):
+            # Missing or corrupt; it'll get rebuilt
+            return {}
+
+    def _write(self):
+        """Save the index file. Other processes might share the file, so merge
+        with what's there, then atomically replace it. Must hold the lock.
+
+        :Returns: None
+        """
+        if not self._location:
+            return
+        entries = self._read()
+        entries.update(self._entries)
+        # Forget about OVAs that have been deleted
+        entries = {k: v for k, v in entries.items() if os.path.exists(k)}
+        tmp_file = '{}.{}'.format(self._location, os.getpid())
+        try:
+            with open(tmp_file, 'w') as the_file:
+                ujson.dump(entries, the_file)
+            os.replace(tmp_file, self._location)
+        except OSError:
+            # A read-only index just means we parse OVAs more often
+            pass
+        self._entries = entries
+
+    def get(self, ova_file):
+        """Obtain the manifest of an OVA, scanning the OVA only if it's not in the index
+
+        :Returns: Dictionary
+
+        :Raises: ValueError if the OVA has no OVF descriptor
+
+        :param ova_file: The path to the OVA
+        :type ova_file: String
+        """
+        info = os.stat(ova_file)
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._read()
+            entry = self._entries.get(ova_file, None)
+            if entry and entry['mtime'] == info.st_mtime and entry['size'] == info.st_size:
+                self.counters['hits'] += 1
+                return entry
+        entry = scan_ova(ova_file)
+        entry['size'] = info.st_size
+        entry['mtime'] = info.st_mtime
+        with self._lock:
+            self.counters['scans'] += 1
+            self._entries[ova_file] = entry
+            self._write()
+        return entry
+
+
+INDEX = ManifestIndex()
+
+
+def manifest(ova_file):
+    """Obtain the OVF descriptor, networks, vApp properties and disk locations of an OVA
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if the OVA has no OVF descriptor
+
+    :param ova_file: The path to the OVA
+    :type ova_file: String
+    """
+    return INDEX.get(ova_file)
+
+
+class ImageCatalog(object):
+    """Tracks the Superna OVAs in a directory, along with details about each OVA.
+
+    :param images_dir: The directory that contains the OVAs
+    :type images_dir: String
+
+    :param recheck: Don't even stat the directory if it was checked this many seconds ago
+    :type recheck: Integer
+
+    :param settle: Ignore OVAs modified in the last N seconds; they're still being uploaded
+    :type settle: Integer
+
+    :param index: Where to look up the contents of each OVA. Default is the shared index.
+    :type index: ManifestIndex
+    """
+    def __init__(self, images_dir=const.VLAB_SUPERNA_IMAGES_DIR,
+                 recheck=const.VLAB_SUPERNA_IMAGE_RECHECK,
+                 settle=const.VLAB_SUPERNA_IMAGE_SETTLE,
+                 index=None):
+        self._images_dir = images_dir
+        self._index = index or INDEX
+        self._recheck = recheck
+        self._settle = settle
+        self._lock = threading.Lock()
+        self._images = {}
+        self._dir_mtime = None
+        self._checked = 0
+        self._pending = False
+        self._warming = False
+        self.counters = {'refreshes': 0, 'parsed': 0, 'skipped': 0}
+
+    @property
+    def loaded(self):
+        """True once the catalog has read the images directory
+
+        :Returns: Boolean
+        """
+        return self._dir_mtime is not None
+
+    def warm(self):
+        """Build the catalog in a background thread, so the caller doesn't block
+        on reading the images directory. Errors are ignored; the catalog just
+        stays unloaded.
+
+        :Returns: None
+        """
+        with self._lock:
+            if self._warming:
+                return
+            self._warming = True
+        threading.Thread(target=self._warm, daemon=True).start()
+
+    def _warm(self):
+        try:
+            self.refresh()
+        except OSError:
+            pass
+        finally:
+            self._warming = False
+
+    def images(self):
+        """Obtain the details about every available image, keyed by version
+
+        :Returns: Dictionary
+        """
+        self.refresh()
+        return dict(self._images)
+
+    def versions(self):
+        """Obtain the available versions of Superna
+
+        :Returns: List
+        """
+        return sorted(self.images().keys())
+
+    def get(self, version):
+        """Obtain the details about a specific version of Superna
+
+        :Returns: Dictionary or None
+
+        :param version: The version of Superna
+        :type version: String
+        """
+        return self.images().get(version, None)
+
+    def refresh(self, force=False):
+        """Re-read the images directory if it has changed
+
+        :Returns: None
+
+        :param force: Set to True to read the directory even if it hasn't changed
+        :type force: Boolean
+        """
+        with self._lock:
+            now = time.time()
+            if not force and self.loaded and now - self._checked < self._recheck:
+                return
+            self._checked = now
+            dir_mtime = os.stat(self._images_dir).st_mtime
+            if not force and dir_mtime == self._dir_mtime and not self._pending:
+                return
+            self._load(now)
+            self._dir_mtime = dir_mtime
+
+    def _load(self, now):
+        """Build the catalog; must be called while holding the lock
+
+        :Returns: None
+
+        :param now: The current time, as a UNIX timestamp
+        :type now: Float
+        """
+        self.counters['refreshes'] += 1
+        self._pending = False
+        images = {}
+        known = {x['file']: x for x in self._images.values()}
+        for file_name in os.listdir(self._images_dir):
+            if file_name.startswith('.') or not file_name.endswith('.ova'):
+                # rsync & friends upload to hidden temp files, then rename them
+                continue
+            ova_file = os.path.join(self._images_dir, file_name)
+            try:
+                info = os.stat(ova_file)
+            except FileNotFoundError:
+                continue
+            if now - info.st_mtime < self._settle:
+                # Writing to a file doesn't change the directory mtime, so we
+                # have to check again even if the directory looks unchanged.
+                self._pending = True
+                self.counters['skipped'] += 1
+                continue
+            previous = known.get(file_name, None)
+            if previous and previous['mtime'] == info.st_mtime and previous['size'] == info.st_size:
+                image = previous
+            else:
+                try:
+                    entry = self._index.get(ova_file)
+                except (tarfile.TarError, EOFError, ValueError, ElementTree.ParseError, OSError):
+                    # Truncated or bogus OVA; maybe it'll be fixed by the next refresh
+                    self._pending = True
+                    self.counters['skipped'] += 1
+                    continue
+                self.counters['parsed'] += 1
+                image = {'networks': entry['networks'],
+                         'properties': entry['properties'],
+                         'file': file_name,
+                         'size': entry['size'],
+                         'mtime': entry['mtime']}
+            images[convert_name(file_name, to_version=True)] = image
+        self._images = images
+
+    def stats(self):
+        """Obtain counters about how often the catalog is rebuilt
+
+        :Returns: Dictionary
+        """
+        answer = dict(self.counters)
+        answer['images'] = len(self._images)
+        answer['index'] = dict(self._index.counters)
+        return answer
+
+
+CATALOG = ImageCatalog()
@@ -0,0 +1,461 @@
+# -*- coding: UTF-8 -*-
+"""
+Counters and latency histograms, exported in the Prometheus text format.
+
+The worker times every step of a task that talks to vCenter (a "phase"), and
+labels it with the name of the task and the image version it's working on:
+
+  - ``vlab_superna_queue_seconds{task}``
+  - ``vlab_superna_task_seconds{task, image}``
+  - ``vlab_superna_vcenter_seconds{phase, task, image}``
+  - ``vlab_superna_vcenter_errors_total{phase, task, image}``
+
+The API counts the requests it handles, and the tasks it sends:
+
+  - ``vlab_superna_http_request_seconds{method, endpoint, status}``
+  - ``vlab_superna_tasks_sent_total{task}``
+  - ``vlab_superna_tasks_deduplicated_total{task}``
+
+The metrics live in the memory of each process. The API serves its own on
+``/api/1/inf/superna/metrics``. A prefork Celery worker runs tasks in child
+processes, so each child writes a snapshot of its metrics to
+VLAB_SUPERNA_METRICS_DIR after every task, and the parent merges them on
+``http://<worker>:VLAB_SUPERNA_METRICS_PORT/metrics``. Celery replaces child
+processes (i.e. ``--max-tasks-per-child``), so when the parent finds the
+snapshot of a child that's gone, it folds it into ``retained.json``. That way
+the files don't pile up, and the counters never go backwards.
+"""
+import os
+import time
+import glob
+import threading
+import contextvars
+from contextlib import contextmanager
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+import ujson
+
+from vlab_superna_api.lib import tracing
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# The metrics of worker processes that are gone
+RETAINED = 'retained.json'
+# vCenter calls take anywhere from milliseconds (a property read) to half an
+# hour (an OVA import)
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# The task, and image version, the current thread (or coroutine) is working on
+_LABELS = contextvars.ContextVar('vlab_superna_metric_labels', default={'task': '', 'image': ''})
+
+
+class _Metric(object):
+    """The parts shared by every type of metric
+
+    :param name: The name of the metric
+    :type name: String
+
+    :param help: What the metric measures
+    :type help: String
+
+    :param labels: The names of the labels of the metric
+    :type labels: List
+    """
+    kind = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = list(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        """Order the label values the same way every time
+
+        :Returns: Tuple
+        """
+        return tuple('{}'.format(labels.get(x, '')) for x in self.labels)
+
+    def snapshot(self):
+        """Copy the current values, in a form that survives a trip through JSON
+
+        :Returns: Dictionary
+        """
+        with self._lock:
+            values = [[list(x), y if isinstance(y, (int, float)) else list(y)] for x, y in self._values.items()]
+        return {'name': self.name, 'type': self.kind, 'help': self.help, 'labels': self.labels, 'values': values}
+
+
+class Counter(_Metric):
+    """A value that only goes up"""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Add to the counter
+
+        :Returns: None
+
+        :param amount: How much to add
+        :type amount: Float
+
+        :param labels: The value of each label
+        :type labels: Dictionary
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    """Counts observations (i.e. how long something took) by bucket
+
+    :param buckets: The upper bound of each bucket; +Inf is added for you
+    :type buckets: Tuple
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Record an observation
+
+        :Returns: None
+
+        :param value: The observed value
+        :type value: Float
+
+        :param labels: The value of each label
+        :type labels: Dictionary
+        """
+        key = self._key(labels)
+        with self._lock:
+            # the count of each bucket, then the sum, then the total count
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def snapshot(self):
+        """Copy the current values, in a form that survives a trip through JSON
+
+        :Returns: Dictionary
+        """
+        answer = super(Histogram, self).snapshot()
+        answer['buckets'] = list(self.buckets)
+        return answer
+
+
+class Registry(object):
+    """Every metric a process records"""
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        """Define a new counter
+
+        :Returns: Counter
+        """
+        self._metrics.append(Counter(name, help, labels))
+        return self._metrics[-1]
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        """Define a new histogram
+
+        :Returns: Histogram
+        """
+        self._metrics.append(Histogram(name, help, labels, buckets))
+        return self._metrics[-1]
+
+    def snapshot(self):
+        """Copy the current value of every metric
+
+        :Returns: List
+        """
+        return [x.snapshot() for x in self._metrics]
+
+
+REGISTRY = Registry()
+QUEUE_SECONDS = REGISTRY.histogram('vlab_superna_queue_seconds',
+                                   'How long tasks wait in the broker before a worker starts them',
+                                   ['task'])
+TASK_SECONDS = REGISTRY.histogram('vlab_superna_task_seconds',
+                                  'How long worker tasks take',
+                                  ['task', 'image'])
+PHASE_SECONDS = REGISTRY.histogram('vlab_superna_vcenter_seconds',
+                                   'How long each step of a worker task that talks to vCenter takes',
+                                   ['phase', 'task', 'image'])
+PHASE_ERRORS = REGISTRY.counter('vlab_superna_vcenter_errors_total',
+                                'How many steps of a worker task failed',
+                                ['phase', 'task', 'image'])
+HTTP_SECONDS = REGISTRY.histogram('vlab_superna_http_request_seconds',
+                                  'How long the API takes to respond',
+                                  ['method', 'endpoint', 'status'])
+TASKS_SENT = REGISTRY.counter('vlab_superna_tasks_sent_total',
+                              'How many tasks the API sent to the workers',
+                              ['task'])
+TASKS_DEDUPLICATED = REGISTRY.counter('vlab_superna_tasks_deduplicated_total',
+                                      'How many retried requests got the task of the original request',
+                                      ['task'])
+
+
+@contextmanager
+def task(name, image=''):
+    """Time a worker task, and label the phases within it
+
+    :Returns: None
+
+    :param name: The name of the task, i.e. ``superna.create``
+    :type name: String
+
+    :param image: The image/version of Superna the task is working on, if any
+    :type image: String
+    """
+    labels = {'task': name, 'image': image or ''}
+    token = _LABELS.set(labels)
+    started = time.time()
+    try:
+        yield
+    finally:
+        TASK_SECONDS.observe(time.time() - started, **labels)
+        _LABELS.reset(token)
+
+
+@contextmanager
+def phase(name):
+    """Time one step of a task. A step that raises is counted as an error. The
+    step is also traced, as a child span of the task.
+
+    :Returns: None
+
+    :param name: What the step does, i.e. ``power_on``
+    :type name: String
+    """
+    labels = dict(_LABELS.get(), phase=name)
+    started = time.time()
+    try:
+        with tracing.span(name):
+            yield
+    except BaseException:
+        PHASE_ERRORS.inc(**labels)
+        raise
+    finally:
+        PHASE_SECONDS.observe(time.time() - started, **labels)
+
+
+def _escape(value):
+    """Escape a label value for the text format
+
+    :Returns: String
+    """
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=None):
+    """Format the labels of a sample
+
+    :Returns: String
+    """
+    pairs = ['{}="{}"'.format(x, _escape(y)) for x, y in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+
+def _number(value):
+    """Format the value of a sample
+
+    :Returns: String
+    """
+    return repr(float(value)) if isinstance(value, float) else '{}'.format(value)
+
+
+def merge(snapshots):
+    """Add up the snapshots of many processes
+
+    :Returns: List
+
+    :param snapshots: The output of ``Registry.snapshot``, from each process
+    :type snapshots: List
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for metric in snapshot:
+            found = merged.setdefault(metric['name'], dict(metric, values={}))
+            for key, value in metric['values']:
+                key = tuple(key)
+                if isinstance(value, list):
+                    total = found['values'].setdefault(key, [0] * len(value))
+                    found['values'][key] = [x + y for x, y in zip(total, value)]
+                else:
+                    found['values'][key] = found['values'].get(key, 0) + value
+    answer = []
+    for metric in merged.values():
+        metric['values'] = [[list(x), y] for x, y in metric['values'].items()]
+        answer.append(metric)
+    return answer
+
+
+def render(snapshot=None):
+    """Format metrics in the Prometheus text format
+
+    :Returns: String
+
+    :param snapshot: The metrics to format. Default is the metrics of this process.
+    :type snapshot: List
+    """
+    if snapshot is None:
+        snapshot = REGISTRY.snapshot()
+    lines = []
+    for metric in snapshot:
+        name = metric['name']
+        lines.append('# HELP {} {}'.format(name, metric['help']))
+        lines.append('# TYPE {} {}'.format(name, metric['type']))
+        for key, value in sorted(metric['values']):
+            if metric['type'] != 'histogram':
+                lines.append('{}{} {}'.format(name, _labels(metric['labels'], key), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric['buckets'], value):
+                cumulative += count
+                le = ('le', _number(float(bound)))
+                lines.append('{}_bucket{} {}'.format(name, _labels(metric['labels'], key, le), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, _labels(metric['labels'], key, ('le', '+Inf')), value[-1]))
+            lines.append('{}_sum{} {}'.format(name, _labels(metric['labels'], key), _number(value[-2])))
+            lines.append('{}_count{} {}'.format(name, _labels(metric['labels'], key), value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def dump(directory):
+    """Save the metrics of this process, for ``collect`` to find
+
+    :Returns: None
+
+    :param directory: Where every worker process saves its metrics
+    :type directory: String
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}.json'.format(os.getpid()))
+    # Write then rename, so ``collect`` never reads half a file
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as the_file:
+        ujson.dump(REGISTRY.snapshot(), the_file)
+    os.replace(tmp, path)
+
+
+def _alive(pid):
+    """Check if a process is still running
+
+    :Returns: Boolean
+
+    :param pid: The id of the process
+    :type pid: Integer
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, it's just not ours
+        return True
+    return True
+
+
+def collect(directory):
+    """Merge the metrics every worker process saved, and fold the metrics of
+    processes that are gone into RETAINED
+
+    :Returns: String
+
+    :param directory: Where every worker process saves its metrics
+    :type directory: String
+    """
+    snapshots = []
+    retained = []
+    dead = []
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as the_file:
+                snapshot = ujson.load(the_file)
+        except (OSError, ValueError):
+            # Removed, or not written yet
+            continue
+        snapshots.append(snapshot)
+        name = os.path.basename(path)[:-len('.json')]
+        if name.isdigit() and not _alive(int(name)):
+            dead.append(path)
+            retained.append(snapshot)
+        elif name == RETAINED[:-len('.json')]:
+            retained.append(snapshot)
+    if dead:
+        _retain(directory, merge(retained), dead)
+    return render(merge(snapshots))
+
+
+def _retain(directory, retained, dead):
+    """Save the metrics of processes that are gone, then remove their snapshots
+
+    :Returns: None
+    """
+    path = os.path.join(directory, RETAINED)
+    tmp = '{}.tmp'.format(path)
+    try:
+        with open(tmp, 'w') as the_file:
+            ujson.dump(retained, the_file)
+        os.replace(tmp, path)
+        for dead_path in dead:
+            os.remove(dead_path)
+    except OSError:
+        # Try again on the next scrape
+        pass
+
+
+def reset(directory):
+    """Remove the metrics saved by processes of an older worker
+
+    :Returns: None
+
+    :param directory: Where every worker process saves its metrics
+    :type directory: String
+    """
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _QuietHandler(WSGIRequestHandler):
+    """Keeps every scrape from being logged to stderr"""
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, directory):
+    """Serve the metrics of every worker process on ``/metrics``, from a
+    background thread
+
+    :Returns: wsgiref.simple_server.WSGIServer
+
+    :param port: The TCP port to listen on
+    :type port: Integer
+
+    :param directory: Where every worker process saves its metrics
+    :type directory: String
+    """
+    def app(environ, start_response):
+        if environ.get('PATH_INFO') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found\n']
+        body = collect(directory).encode()
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE), ('Content-Length', '{}'.format(len(body)))])
+        return [body]
+
+    server = make_server('', port, app, handler_class=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
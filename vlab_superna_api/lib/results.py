@@ -0,0 +1,102 @@
+# -*- coding: UTF-8 -*-
+"""
+Where the API and the workers keep the results of tasks.
+
+The default ``rpc://`` backend sends a result, as a message, to the process that
+sent the task; it can be read once, and only by that process. That breaks as
+soon as uWSGI recycles a worker, or the next poll lands on another worker. Set
+VLAB_SUPERNA_RESULT_BACKEND to a shared store instead, i.e.:
+
+  - ``redis://superna-results:6379/0`` (needs the ``redis`` package)
+  - ``file:///var/lib/vlab/superna-results`` (a directory both can write to)
+
+Results are kept for VLAB_SUPERNA_RESULT_TTL seconds. The file backend has no
+native expiry; a worker started with ``--beat`` removes old results once a day.
+"""
+import time
+
+from celery import states
+from celery.backends.base import BaseKeyValueStoreBackend
+
+from vlab_superna_api.lib import const
+
+
+def configure(celery_app):
+    """Apply the result backend settings to a Celery app
+
+    :Returns: None
+
+    :param celery_app: The Celery app of the API, or of the workers
+    :type celery_app: celery.Celery
+    """
+    celery_app.conf.update(result_backend=const.VLAB_SUPERNA_RESULT_BACKEND,
+                           result_expires=const.VLAB_SUPERNA_RESULT_TTL,
+                           result_serializer='json',
+                           result_accept_content=['json'],
+                           # don't store the args of every task next to its result
+                           result_extended=False)
+    if const.VLAB_SUPERNA_RESULT_COMPRESSION:
+        # Only the rpc/amqp backends compress; the key/value stores ignore it
+        celery_app.conf.result_compression = const.VLAB_SUPERNA_RESULT_COMPRESSION
+
+
+def get_many(celery_app, task_ids):
+    """Obtain the state of many tasks at once. Unlike ``backend.get_many``, this
+    does not wait for the tasks to finish.
+
+    With a key/value store this is a single round trip (i.e. one Redis MGET),
+    instead of one per task.
+
+    :Returns: Dictionary
+
+    :param celery_app: The Celery app that sent the tasks
+    :type celery_app: celery.Celery
+
+    :param task_ids: The ids of the tasks to look up
+    :type task_ids: List
+    """
+    task_ids = list(dict.fromkeys(task_ids))
+    backend = celery_app.backend
+    found = {}
+    if isinstance(backend, BaseKeyValueStoreBackend):
+        values = backend.mget([backend.get_key_for_task(x) for x in task_ids])
+        for task_id, value in zip(task_ids, values):
+            if value is None:
+                found[task_id] = {'status': 'PENDING', 'result': None}
+            else:
+                meta = backend.decode_result(value)
+                found[task_id] = {'status': meta['status'], 'result': meta['result']}
+    else:
+        for task_id in task_ids:
+            result = celery_app.AsyncResult(task_id)
+            found[task_id] = {'status': result.state, 'result': result.info}
+    return found
+
+
+def wait_many(celery_app, task_ids, timeout, interval=1):
+    """Like ``get_many``, but waits up to ``timeout`` seconds for every task to
+    finish. Only the tasks that are not done yet are looked up again.
+
+    :Returns: Dictionary
+
+    :param celery_app: The Celery app that sent the tasks
+    :type celery_app: celery.Celery
+
+    :param task_ids: The ids of the tasks to look up
+    :type task_ids: List
+
+    :param timeout: The most seconds to wait. Zero returns right away.
+    :type timeout: Integer
+
+    :param interval: How many seconds to wait between lookups
+    :type interval: Float
+    """
+    deadline = time.time() + timeout
+    found = {}
+    pending = task_ids
+    while True:
+        found.update(get_many(celery_app, pending))
+        pending = [x for x, y in found.items() if y['status'] not in states.READY_STATES]
+        if not pending or time.time() >= deadline:
+            return found
+        time.sleep(interval)
@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+"""
+Which broker queue each task goes to, and which queues a worker consumes.
+
+A ``show`` answers in a second or two, but a ``create`` that imports an OVA
+can take many minutes. On a single queue, a class that deploys 30 Superna VMs
+at once leaves every ``show`` poll waiting behind those imports. So the tasks
+are split between two queues:
+
+  - ``superna.fast``: read-only tasks; show, image, stats and listing the
+    templates
+  - ``superna.slow``: tasks that change the inventory; create, delete (and
+    their batch versions), refill_pool and rebuilding the templates (which
+    imports an OVA per image)
+
+Set VLAB_SUPERNA_WORKER_MODE to pick the queues a worker consumes:
+
+  - ``fast`` runs VLAB_SUPERNA_FAST_CONCURRENCY processes, each reserving up
+    to VLAB_SUPERNA_FAST_PREFETCH tasks
+  - ``slow`` runs VLAB_SUPERNA_SLOW_CONCURRENCY processes, each reserving up
+    to VLAB_SUPERNA_SLOW_PREFETCH tasks
+  - ``all`` (the default) consumes both, with the processes of both, and
+    reserves one task at a time
+
+Only separate ``fast`` and ``slow`` workers fully isolate interactive latency
+from bulk deploys; an ``all`` worker whose processes are all busy importing
+OVAs still can't run a ``show``.
+
+With VLAB_SUPERNA_EXECUTION_MODE=async a task just waits on the event loop of
+its process (see aio.py), so the worker runs a pool of
+VLAB_SUPERNA_ASYNC_THREADS threads instead of processes.
+
+The ``-Q``, ``-P``, ``--concurrency`` and ``--prefetch-multiplier`` options of
+``celery worker`` override these settings.
+"""
+from kombu import Queue
+
+from vlab_superna_api.lib import const
+
+FAST = 'superna.fast'
+SLOW = 'superna.slow'
+ROUTES = {'superna.show': FAST,
+          'superna.image': FAST,
+          'superna.stats': FAST,
+          'superna.templates': FAST,
+          'superna.create': SLOW,
+          'superna.create_batch': SLOW,
+          'superna.delete': SLOW,
+          'superna.delete_batch': SLOW,
+          'superna.refill_pool': SLOW}
+MODES = {'all': (FAST, SLOW), 'fast': (FAST,), 'slow': (SLOW,)}
+
+
+def route(name, args, kwargs, options, task=None, **kw):
+    """Pick the queue of a task. A Celery router; see ``task_routes``.
+
+    :Returns: Dictionary, or None for the default queue
+
+    :param name: The name of the task, i.e. ``superna.show``
+    :type name: String
+
+    :param args: The positional arguments of the task
+    :type args: List
+
+    :param kwargs: The keyword arguments of the task
+    :type kwargs: Dictionary
+    """
+    if name == 'superna.templates':
+        # template_registry(txn_id, rebuild=False)
+        args = args or ()
+        rebuild = args[1] if len(args) > 1 else (kwargs or {}).get('rebuild', False)
+        return {'queue': SLOW if rebuild else FAST}
+    if name in ROUTES:
+        return {'queue': ROUTES[name]}
+    return None
+
+
+def configure(celery_app):
+    """Route every task to its queue. The API and the workers both need this.
+
+    :Returns: None
+
+    :param celery_app: The Celery app of the API, or of the workers
+    :type celery_app: celery.Celery
+    """
+    celery_app.conf.update(task_queues=[Queue(x) for x in (FAST, SLOW)],
+                           task_routes=(route,),
+                           # anything not in ROUTES is assumed to be slow
+                           task_default_queue=SLOW)
+
+
+def configure_worker(celery_app, mode):
+    """Consume only the queues of a worker mode, with the concurrency and
+    prefetch of those queues
+
+    :Returns: None
+
+    :Raises: ValueError, if the mode is not one of MODES
+
+    :param celery_app: The Celery app of the workers
+    :type celery_app: celery.Celery
+
+    :param mode: Which queues to consume; one of MODES
+    :type mode: String
+    """
+    if mode not in MODES:
+        error = 'Unknown worker mode {}; supply one of {}'.format(mode, ', '.join(sorted(MODES)))
+        raise ValueError(error)
+    if mode == 'fast':
+        concurrency = const.VLAB_SUPERNA_FAST_CONCURRENCY
+        prefetch = const.VLAB_SUPERNA_FAST_PREFETCH
+    elif mode == 'slow':
+        concurrency = const.VLAB_SUPERNA_SLOW_CONCURRENCY
+        prefetch = const.VLAB_SUPERNA_SLOW_PREFETCH
+    else:
+        concurrency = const.VLAB_SUPERNA_FAST_CONCURRENCY + const.VLAB_SUPERNA_SLOW_CONCURRENCY
+        # A reserved show must not sit behind a create on the same process
+        prefetch = 1
+    celery_app.conf.update(task_queues=[Queue(x) for x in MODES[mode]],
+                           worker_concurrency=concurrency,
+                           worker_prefetch_multiplier=prefetch)
+    if const.VLAB_SUPERNA_EXECUTION_MODE == 'async':
+        # With processes, each one blocks on its own event loop; no gain over sync
+        celery_app.conf.update(worker_pool='threads',
+                               worker_concurrency=const.VLAB_SUPERNA_ASYNC_THREADS)
@@ -0,0 +1,350 @@
+# -*- coding: UTF-8 -*-
+"""
+Traces a request from the API, through the broker, to each step of the worker task.
+
+The API opens a span per HTTP request, and a child span when it sends a task.
+The W3C ``traceparent`` of that child, and the time the task was sent, ride
+along in the Celery message headers. The worker then records:
+
+  - a ``queue`` span, from when the API sent the task until a worker started
+    it (the broker queue latency)
+  - a span for the task itself
+  - a child span for each step that talks to vCenter (see ``metrics.phase``),
+    the parsing of the OVA, and the NFC upload of each disk
+
+Set VLAB_SUPERNA_TRACE_EXPORTER to export the finished spans:
+
+  - ``file`` appends one JSON object per span to VLAB_SUPERNA_TRACE_FILE
+  - ``otlp`` posts them (OTLP/HTTP, JSON encoded) to VLAB_SUPERNA_TRACE_OTLP_URL,
+    i.e. an OpenTelemetry collector
+
+Tracing is off by default; a span is then just a check of a constant. The
+queue span uses the clocks of two hosts, so it's only as good as NTP.
+"""
+import os
+import time
+import queue
+import random
+import threading
+import contextvars
+import urllib.request
+from contextlib import contextmanager
+
+import ujson
+
+from vlab_superna_api.lib import const
+
+TRACEPARENT = 'traceparent'
+SENT_AT = 'vlab_sent_at'
+BATCH_SIZE = 100
+# The span the current thread (or coroutine) is within
+_CURRENT = contextvars.ContextVar('vlab_superna_span', default=None)
+
+
+def enabled():
+    """Check if spans should be recorded
+
+    :Returns: Boolean
+    """
+    return const.VLAB_SUPERNA_TRACE_EXPORTER in ('file', 'otlp')
+
+
+class Span(object):
+    """One timed operation within a trace
+
+    :param name: What the operation is
+    :type name: String
+
+    :param trace_id: The 32 hex digit id of the trace the span belongs to
+    :type trace_id: String
+
+    :param parent_id: The 16 hex digit id of the parent span, if any
+    :type parent_id: String
+
+    :param start: When the operation started, in seconds since the epoch. Default is now.
+    :type start: Float
+
+    :param attributes: Anything else worth knowing about the operation
+    :type attributes: Dictionary
+    """
+    def __init__(self, name, trace_id, parent_id=None, start=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '{:016x}'.format(random.getrandbits(64))
+        self.parent_id = parent_id
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set(self, key, value):
+        """Add an attribute to the span
+
+        :Returns: None
+        """
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self):
+        """The W3C trace context header for children of this span, in other processes
+
+        :Returns: String
+        """
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    def finish(self, end=None):
+        """Mark the span as done, and export it
+
+        :Returns: None
+
+        :param end: When the operation ended, in seconds since the epoch. Default is now.
+        :type end: Float
+        """
+        self.end = time.time() if end is None else end
+        EXPORTER.export(self)
+
+    def to_dict(self):
+        """Describe the span
+
+        :Returns: Dictionary
+        """
+        return {'name': self.name,
+                'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'start': self.start,
+                'end': self.end,
+                'duration': self.end - self.start,
+                'attributes': self.attributes,
+                'error': self.error}
+
+
+def parse(traceparent):
+    """Read the trace and span ids out of a W3C ``traceparent`` header
+
+    :Returns: Tuple of (trace_id, span_id), or None if the header is invalid
+
+    :param traceparent: The value of the header
+    :type traceparent: String
+    """
+    try:
+        _, trace_id, span_id, _ = traceparent.split('-')
+        int(trace_id, 16), int(span_id, 16)
+    except (AttributeError, ValueError):
+        return None
+    if len(trace_id) != 32 or len(span_id) != 16:
+        return None
+    return trace_id, span_id
+
+
+def start(name, traceparent=None, start_time=None, **attributes):
+    """Begin a span. The parent is the ``traceparent`` from another process if
+    supplied, otherwise the current span (if any).
+
+    :Returns: Span, or None if tracing is disabled
+
+    :param name: What the operation is
+    :type name: String
+
+    :param traceparent: The W3C trace context of the parent span, from another process
+    :type traceparent: String
+
+    :param start_time: When the operation started, in seconds since the epoch. Default is now.
+    :type start_time: Float
+
+    :param attributes: Anything else worth knowing about the operation
+    :type attributes: Dictionary
+    """
+    if not enabled():
+        return None
+    parent = parse(traceparent) if traceparent else None
+    if parent is None and _CURRENT.get() is not None:
+        parent = (_CURRENT.get().trace_id, _CURRENT.get().span_id)
+    if parent is None:
+        parent = ('{:032x}'.format(random.getrandbits(128)), None)
+    return Span(name, parent[0], parent_id=parent[1], start=start_time, attributes=attributes)
+
+
+def activate(the_span):
+    """Make a span the parent of the spans that follow, in this thread or coroutine
+
+    :Returns: contextvars.Token, for ``deactivate``
+    """
+    return _CURRENT.set(the_span)
+
+
+def deactivate(token):
+    """Undo ``activate``
+
+    :Returns: None
+    """
+    _CURRENT.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Trace an operation for the life of a ``with`` statement. The span is the
+    parent of any spans made within the ``with`` statement.
+
+    :Returns: Span, or None if tracing is disabled
+
+    :param name: What the operation is
+    :type name: String
+
+    :param attributes: Anything else worth knowing about the operation
+    :type attributes: Dictionary
+    """
+    the_span = start(name, **attributes)
+    if the_span is None:
+        yield None
+        return
+    token = activate(the_span)
+    try:
+        yield the_span
+    except BaseException as doh:
+        the_span.error = '{}'.format(doh) or doh.__class__.__name__
+        raise
+    finally:
+        deactivate(token)
+        the_span.finish()
+
+
+def headers():
+    """The Celery message headers that carry the trace to the worker
+
+    :Returns: Dictionary
+    """
+    answer = {SENT_AT: time.time()}
+    current = _CURRENT.get()
+    if current is not None:
+        answer[TRACEPARENT] = current.traceparent
+    return answer
+
+
+class Exporter(object):
+    """Exports finished spans from a background thread, so tracing never slows
+    down (or breaks) a request or task.
+
+    :param service: The name of the service that made the spans, i.e. ``vlab-superna-api``
+    :type service: String
+
+    :param max_queued: The most spans to hold before dropping new ones
+    :type max_queued: Integer
+    """
+    def __init__(self, service='vlab-superna', max_queued=10000):
+        self.service = service
+        self._max_queued = max_queued
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self.counters = {'exported': 0, 'dropped': 0, 'errors': 0}
+
+    def export(self, the_span):
+        """Queue a finished span for export
+
+        :Returns: None
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked (or never started); threads don't survive a fork
+                self._pid = os.getpid()
+                self._queue = queue.Queue(maxsize=self._max_queued)
+                thread = threading.Thread(target=self._run, args=(self._queue,))
+                thread.daemon = True
+                thread.start()
+            the_queue = self._queue
+        try:
+            the_queue.put_nowait(the_span.to_dict())
+        except queue.Full:
+            self.counters['dropped'] += 1
+
+    def _run(self, the_queue):
+        """The body of the export thread; sends spans in batches"""
+        while True:
+            batch = [the_queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(the_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._send(batch)
+            except Exception:
+                self.counters['errors'] += 1
+                self.counters['dropped'] += len(batch)
+            else:
+                self.counters['exported'] += len(batch)
+
+    def _send(self, batch):
+        """Write a batch of spans to the configured destination
+
+        :Returns: None
+        """
+        if const.VLAB_SUPERNA_TRACE_EXPORTER == 'otlp':
+            req = urllib.request.Request(const.VLAB_SUPERNA_TRACE_OTLP_URL,
+                                         data=ujson.dumps(to_otlp(batch, self.service)).encode(),
+                                         headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(req, timeout=10) as resp:
+                resp.read()
+        else:
+            with open(const.VLAB_SUPERNA_TRACE_FILE, 'a') as the_file:
+                for item in batch:
+                    item['service'] = self.service
+                    the_file.write(ujson.dumps(item) + '\n')
+
+    def stats(self):
+        """Obtain counters about the spans this process exported
+
+        :Returns: Dictionary
+        """
+        answer = dict(self.counters)
+        answer['queued'] = self._queue.qsize() if self._queue is not None else 0
+        return answer
+
+
+def _otlp_value(value):
+    """Convert an attribute value into an OTLP AnyValue
+
+    :Returns: Dictionary
+    """
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': '{}'.format(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': '{}'.format(value)}
+
+
+def to_otlp(batch, service):
+    """Convert spans into an OTLP/JSON ``ExportTraceServiceRequest``
+
+    :Returns: Dictionary
+
+    :param batch: The output of ``Span.to_dict``, for each span
+    :type batch: List
+
+    :param service: The name of the service that made the spans
+    :type service: String
+    """
+    spans = []
+    for item in batch:
+        the_span = {'traceId': item['trace_id'],
+                    'spanId': item['span_id'],
+                    'name': item['name'],
+                    'kind': 1,
+                    'startTimeUnixNano': '{}'.format(int(item['start'] * 1e9)),
+                    'endTimeUnixNano': '{}'.format(int(item['end'] * 1e9)),
+                    'attributes': [{'key': x, 'value': _otlp_value(y)} for x, y in item['attributes'].items()],
+                    'status': {'code': 1}}
+        if item['parent_id']:
+            the_span['parentSpanId'] = item['parent_id']
+        if item['error']:
+            the_span['status'] = {'code': 2, 'message': item['error']}
+        spans.append(the_span)
+    resource = {'attributes': [{'key': 'service.name', 'value': {'stringValue': service}}]}
+    return {'resourceSpans': [{'resource': resource,
+                               'scopeSpans': [{'scope': {'name': 'vlab_superna_api'}, 'spans': spans}]}]}
+
+
+EXPORTER = Exporter()
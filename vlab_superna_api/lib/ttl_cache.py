@@ -0,0 +1,245 @@
+# -*- coding: UTF-8 -*-
+"""
+A small, thread safe, in-memory cache where entries expire after a fixed TTL,
+and the least recently used entry is evicted when the cache is full.
+"""
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Maps keys to values for up to ``ttl`` seconds.
+
+    :param max_size: The most entries to keep. Least recently used entries are evicted first.
+    :type max_size: Integer
+
+    :param ttl: How many seconds an entry is valid for. Zero disables the cache.
+    :type ttl: Integer
+    """
+    def __init__(self, max_size, ttl):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidations': 0}
+
+    def get(self, key, default=None):
+        """Obtain the value for a key, if it's cached and hasn't expired
+
+        :Returns: Object
+
+        :param key: The thing the value was cached under
+        :type key: Object
+
+        :param default: What to return if the key isn't cached
+        :type default: Object
+        """
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.counters['misses'] += 1
+                return default
+            if expires < time.time():
+                del self._data[key]
+                self.counters['expired'] += 1
+                self.counters['misses'] += 1
+                return default
+            self._data.move_to_end(key)
+            self.counters['hits'] += 1
+            return value
+
+    def set(self, key, value):
+        """Cache a value
+
+        :Returns: None
+
+        :param key: The thing to cache the value under
+        :type key: Object
+
+        :param value: The thing to cache
+        :type value: Object
+        """
+        if self._ttl <= 0 or self._max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.time() + self._ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def pop(self, key):
+        """Remove a key from the cache, if it's there
+
+        :Returns: None
+
+        :param key: The thing to stop caching
+        :type key: Object
+        """
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.counters['invalidations'] += 1
+
+    def clear(self):
+        """Remove everything from the cache
+
+        :Returns: None
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Obtain the hit rate and eviction counters, to help tune the TTL and size
+
+        :Returns: Dictionary
+        """
+        with self._lock:
+            answer = dict(self.counters)
+            answer['size'] = len(self._data)
+        lookups = answer['hits'] + answer['misses']
+        answer['hit_rate'] = answer['hits'] / lookups if lookups else 0.0
+        return answer
+
+
+class SharedTTLCache(TTLCache):
+    """A TTLCache whose ``pop`` reaches every process that shares a key/value
+    Celery result backend (i.e. Redis, or a shared directory).
+
+    Each key has a generation in the backend, and ``pop`` gives it a new one. An
+    entry remembers the generation it was made in, and ``get`` drops it once the
+    generation changes. So a create in a slow worker invalidates the ``show``
+    cache of every fast worker. With the ``rpc://`` backend there's nowhere to
+    share the generation, and a ``pop`` only reaches this process.
+
+    :param max_size: The most entries to keep. Least recently used entries are evicted first.
+    :type max_size: Integer
+
+    :param ttl: How many seconds an entry is valid for. Zero disables the cache.
+    :type ttl: Integer
+
+    :param prefix: Where, in the backend, the generation of each key is kept
+    :type prefix: String
+    """
+    def __init__(self, max_size, ttl, prefix):
+        super(SharedTTLCache, self).__init__(max_size, ttl)
+        self._prefix = prefix
+        self._get_backend = None
+
+    def share(self, get_backend):
+        """Share invalidations through a Celery result backend
+
+        :Returns: None
+
+        :param get_backend: Returns the result backend of this process, i.e. ``lambda: app.backend``
+        :type get_backend: Function
+        """
+        self._get_backend = get_backend
+
+    def _backend(self):
+        """The result backend, if it can keep the generations
+
+        :Returns: celery.backends.base.BaseKeyValueStoreBackend, or None
+        """
+        # Imported here, so the API (which doesn't share) doesn't need Celery for this
+        from celery.backends.base import BaseKeyValueStoreBackend
+        if self._get_backend is None:
+            return None
+        backend = self._get_backend()
+        if isinstance(backend, BaseKeyValueStoreBackend):
+            return backend
+        return None
+
+    def _key(self, key):
+        """Where, in the backend, the generation of a key is kept
+
+        :Returns: Bytes
+        """
+        # Like ``get_key_for_task``; the file backend only takes bytes
+        return '{}{}'.format(self._prefix, key).encode()
+
+    def generation(self, key):
+        """Obtain the current generation of a key. Look it up *before* making the
+        value to cache, so an invalidation that happens meanwhile isn't lost.
+
+        :Returns: String, or None if invalidations aren't shared
+
+        :param key: The thing a value is cached under
+        :type key: String
+        """
+        backend = self._backend()
+        if backend is None:
+            return None
+        try:
+            found = backend.get(self._key(key))
+        except Exception:
+            # Treat it as a new generation; the entry is simply not reused
+            return uuid.uuid4().hex
+        if isinstance(found, bytes):
+            found = found.decode()
+        return found or ''
+
+    def get(self, key, default=None):
+        """Obtain the value for a key, if it's cached, hasn't expired, and wasn't
+        invalidated by any process
+
+        :Returns: Object
+
+        :param key: The thing the value was cached under
+        :type key: String
+
+        :param default: What to return if the key isn't cached
+        :type default: Object
+        """
+        found = super(SharedTTLCache, self).get(key)
+        if found is None:
+            return default
+        generation, value = found
+        if generation is not None and generation != self.generation(key):
+            with self._lock:
+                self._data.pop(key, None)
+                self.counters['hits'] -= 1
+                self.counters['misses'] += 1
+                self.counters['invalidations'] += 1
+            return default
+        return value
+
+    def set(self, key, value, generation=None):
+        """Cache a value
+
+        :Returns: None
+
+        :param key: The thing to cache the value under
+        :type key: String
+
+        :param value: The thing to cache
+        :type value: Object
+
+        :param generation: The generation the value was made in. Default is the current one.
+        :type generation: String
+        """
+        if generation is None:
+            generation = self.generation(key)
+        super(SharedTTLCache, self).set(key, (generation, value))
+
+    def pop(self, key):
+        """Remove a key from the cache of every process
+
+        :Returns: None
+
+        :param key: The thing to stop caching
+        :type key: String
+        """
+        super(SharedTTLCache, self).pop(key)
+        backend = self._backend()
+        if backend is not None:
+            try:
+                backend.set(self._key(key), uuid.uuid4().hex)
+            except Exception:
+                # Other processes are stale for up to the TTL, instead of failing the change
+                pass
@@ -0,0 +1,22 @@
+# -*- coding: UTF-8 -*-
+"""
+Exports the metrics of the API, for Prometheus to scrape
+"""
+from flask_classy import FlaskView, Response
+
+from vlab_superna_api.lib import metrics
+
+
+class MetricsView(FlaskView):
+    """
+    The counters and latency histograms of this API process
+    """
+    route_base = '/api/1/inf/superna/metrics'
+    trailing_slash = False
+
+    def get(self):
+        """End point for Prometheus"""
+        response = Response(metrics.render())
+        response.status_code = 200
+        response.headers['Content-Type'] = metrics.CONTENT_TYPE
+        return response
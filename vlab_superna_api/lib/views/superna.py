@@ -2,15 +2,18 @@
 """
 TODO
 """
+import time
+import hashlib
+
 import ujson
-from flask import current_app
+from flask import current_app, stream_with_context
 from flask_classy import request, route, Response
 from vlab_inf_common.views import MachineView
 from vlab_inf_common.vmware import vCenter, vim
 from vlab_api_common import describe, get_logger, requires, validate_input
 
 
-from vlab_superna_api.lib import const
+from vlab_superna_api.lib import const, dedup, image_catalog, results
 
 
 logger = get_logger(__name__, loglevel=const.VLAB_SUPERNA_LOG_LEVEL)
@@ -70,6 +73,29 @@ class SupernaView(MachineView):
                     },
                     "required": ["name", "image", "network", "ip-config"]
                   }
+    BATCH_SCHEMA = { "$schema": "http://json-schema.org/draft-04/schema#",
+                     "type": "object",
+                     "description": "Create many Superna servers that share an image and network",
+                     "properties": {
+                        "image": POST_SCHEMA['properties']['image'],
+                        "network": POST_SCHEMA['properties']['network'],
+                        "machines": {
+                            "description": "The name and IP config of each Superna instance",
+                            "type": "array",
+                            "minItems": 1,
+                            "maxItems": const.VLAB_SUPERNA_BATCH_MAX,
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "name": POST_SCHEMA['properties']['name'],
+                                    "ip-config": POST_SCHEMA['properties']['ip-config'],
+                                },
+                                "required": ["name", "ip-config"]
+                            }
+                        }
+                     },
+                     "required": ["image", "network", "machines"]
+                   }
     DELETE_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                      "description": "Destroy a Superna",
                      "type": "object",
@@ -81,12 +107,49 @@ class SupernaView(MachineView):
                      },
                      "required": ["name"]
                     }
+    BATCH_DELETE_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                           "description": "Destroy many Superna instances",
+                           "type": "object",
+                           "properties": {
+                              "names": {
+                                  "description": "The names of the Superna instances to destroy",
+                                  "type": "array",
+                                  "minItems": 1,
+                                  "items": {"type": "string"}
+                              },
+                              "all": {
+                                  "description": "Set to true to destroy every Superna instance you own",
+                                  "type": "boolean"
+                              }
+                           }
+                          }
     GET_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                   "description": "Display the Superna instances you own"
                  }
     IMAGES_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                      "description": "View available versions of Superna that can be created"
                     }
+    TASKS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                    "description": "Check the status of many tasks at once",
+                    "type": "object",
+                    "properties": {
+                        "task-ids": {
+                            "description": "The ids of the tasks to check",
+                            "type": "array",
+                            "minItems": 1,
+                            "maxItems": const.VLAB_SUPERNA_TASKS_MAX,
+                            "items": {"type": "string"}
+                        },
+                        "timeout": {
+                            "description": "Wait up to this many seconds for every task to finish",
+                            "type": "integer",
+                            "minimum": 0,
+                            "maximum": const.VLAB_SUPERNA_TASKS_WAIT_MAX,
+                            "default": 0
+                        }
+                    },
+                    "required": ["task-ids"]
+                   }
 
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
@@ -96,11 +159,11 @@ class SupernaView(MachineView):
         username = kwargs['token']['username']
         resp_data = {'user' : username}
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
-        task = current_app.celery_app.send_task('superna.show', [username, txn_id])
-        resp_data['content'] = {'task-id': task.id}
+        task_id = dedup.DEDUP.send_task(current_app.celery_app, 'superna.show', [username, txn_id], username, txn_id)
+        resp_data['content'] = {'task-id': task_id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
-        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
         return resp
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
@@ -113,17 +176,18 @@ class SupernaView(MachineView):
         body = kwargs['body']
         machine_name = body['name']
         image = body['image']
-        ip_config = {'default-gateway': '192.168.1.1',
-                     'netmask': '255.255.255.0',
-                     'dns': ['192.168.1.1.'],
-                     'domain': "vlab.local"}
-        ip_config.update(body['ip-config'])
+        ip_config = _ip_config(body['ip-config'])
         network = '{}_{}'.format(username, body['network'])
-        task = current_app.celery_app.send_task('superna.create', [username, machine_name, image, network, ip_config, txn_id])
-        resp_data['content'] = {'task-id': task.id}
+        task_id = dedup.DEDUP.send_task(current_app.celery_app,
+                                        'superna.create',
+                                        [username, machine_name, image, network, ip_config, txn_id],
+                                        username,
+                                        txn_id,
+                                        machine_name=machine_name)
+        resp_data['content'] = {'task-id': task_id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
-        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
         return resp
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
@@ -134,11 +198,74 @@ class SupernaView(MachineView):
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
         machine_name = kwargs['body']['name']
-        task = current_app.celery_app.send_task('superna.delete', [username, machine_name, txn_id])
-        resp_data['content'] = {'task-id': task.id}
+        task_id = dedup.DEDUP.send_task(current_app.celery_app,
+                                        'superna.delete',
+                                        [username, machine_name, txn_id],
+                                        username,
+                                        txn_id,
+                                        machine_name=machine_name)
+        resp_data['content'] = {'task-id': task_id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
+        return resp
+
+    @route('/batch', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(post=BATCH_SCHEMA, delete=BATCH_DELETE_SCHEMA)
+    @validate_input(schema=BATCH_SCHEMA)
+    def batch(self, *args, **kwargs):
+        """Create many Superna instances with one task"""
+        username = kwargs['token']['username']
+        resp_data = {'user' : username}
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        body = kwargs['body']
+        names = [x['name'] for x in body['machines']]
+        if len(set(names)) != len(names):
+            resp_data['error'] = 'Every machine in a batch must have a unique name'
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 400
+            return resp
+        machines = [{'name': x['name'], 'ip-config': _ip_config(x['ip-config'])} for x in body['machines']]
+        network = '{}_{}'.format(username, body['network'])
+        task_id = dedup.DEDUP.send_task(current_app.celery_app,
+                                        'superna.create_batch',
+                                        [username, machines, body['image'], network, txn_id],
+                                        username,
+                                        txn_id)
+        resp_data['content'] = {'task-id': task_id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
+        return resp
+
+    @route('/batch', methods=["DELETE"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=BATCH_DELETE_SCHEMA)
+    def batch_delete(self, *args, **kwargs):
+        """Destroy many Superna instances with one task"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        body = kwargs['body']
+        if body.get('all', False):
+            machine_names = None
+        elif body.get('names'):
+            machine_names = body['names']
+        else:
+            resp_data['error'] = 'Must supply "names", or set "all" to true'
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 400
+            return resp
+        task_id = dedup.DEDUP.send_task(current_app.celery_app,
+                                        'superna.delete_batch',
+                                        [username, machine_names, txn_id],
+                                        username,
+                                        txn_id)
+        resp_data['content'] = {'task-id': task_id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
-        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
         return resp
 
     @route('/image', methods=["GET"])
@@ -149,9 +276,178 @@ class SupernaView(MachineView):
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
-        task = current_app.celery_app.send_task('superna.image', [txn_id])
-        resp_data['content'] = {'task-id': task.id}
+        if const.VLAB_SUPERNA_IMAGE_SYNC:
+            if image_catalog.CATALOG.loaded:
+                try:
+                    return _image_response(resp_data)
+                except OSError as doh:
+                    # i.e. the images mount went away; the workers can still answer
+                    logger.error('Unable to read image catalog: {}'.format(doh))
+            else:
+                image_catalog.CATALOG.warm()
+        task_id = dedup.DEDUP.send_task(current_app.celery_app, 'superna.image', [txn_id], username, txn_id)
+        resp_data['content'] = {'task-id': task_id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
-        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
+        return resp
+
+    @route('/task', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(post=TASKS_SCHEMA)
+    @validate_input(schema=TASKS_SCHEMA)
+    def tasks(self, *args, **kwargs):
+        """Check the status of many tasks with one request, optionally waiting for them to finish.
+        A wait holds one of the API's threads, so it's capped at VLAB_SUPERNA_TASKS_WAIT_MAX (25) seconds.
+        """
+        username = kwargs['token']['username']
+        resp_data = {'user' : username, 'error': None, 'params': {}}
+        body = kwargs['body']
+        found = results.wait_many(current_app.celery_app,
+                                  body['task-ids'],
+                                  timeout=body.get('timeout', 0),
+                                  interval=const.VLAB_SUPERNA_EVENTS_POLL)
+        resp_data['content'] = {x: _task_status(y) for x, y in found.items()}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 200
+        resp.headers['Content-Type'] = 'application/json'
         return resp
+
+    @route('/task/<tid>/events', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    def events(self, *args, **kwargs):
+        """Stream the progress of a task as Server-Sent Events, instead of polling the task link"""
+        task = current_app.celery_app.AsyncResult(kwargs['tid'])
+        # Sent by an EventSource when it reconnects
+        last_event_id = request.headers.get('Last-Event-ID')
+        resp = Response(stream_with_context(_task_events(task, last_event_id)), mimetype='text/event-stream')
+        resp.headers['Cache-Control'] = 'no-cache'
+        resp.headers['X-Accel-Buffering'] = 'no'
+        return resp
+
+
+def _task_events(task, last_event_id=None):
+    """Yield a Server-Sent Event every time the state of a task changes, until
+    the task is done.
+
+    A stream holds an API thread the whole time, so it ends after
+    VLAB_SUPERNA_EVENTS_TIMEOUT seconds with a ``reconnect`` event. An
+    EventSource reconnects on its own, and sends the id of the last event it
+    got as Last-Event-ID; that event isn't sent again.
+
+    :Returns: Generator
+
+    :param task: The task to follow
+    :type task: celery.result.AsyncResult
+
+    :param last_event_id: The id of the last event the client got, if it's reconnecting
+    :type last_event_id: String
+    """
+    last = None
+    started = time.time()
+    quiet_since = started
+    while True:
+        state = task.state
+        if state in ('SUCCESS', 'FAILURE', 'REVOKED'):
+            if state == 'SUCCESS':
+                data = task.result
+            else:
+                data = {'error': str(task.result)}
+            yield _sse(state.lower(), data)
+            return
+        info = task.info if state == 'PROGRESS' else None
+        now = time.time()
+        if (state, info) != last:
+            last = (state, info)
+            quiet_since = now
+            event_id = hashlib.md5(ujson.dumps([state, info]).encode()).hexdigest()[:16]
+            if event_id != last_event_id:
+                yield _sse(state.lower(), info or {}, event_id=event_id)
+        elif now - quiet_since > const.VLAB_SUPERNA_EVENTS_KEEPALIVE:
+            # Comments keep proxies from closing an idle connection
+            quiet_since = now
+            yield ': keepalive\n\n'
+        if now - started > const.VLAB_SUPERNA_EVENTS_TIMEOUT:
+            yield _sse('reconnect', {}, retry=int(const.VLAB_SUPERNA_EVENTS_POLL * 1000))
+            return
+        time.sleep(const.VLAB_SUPERNA_EVENTS_POLL)
+
+
+def _task_status(meta):
+    """Format the state of one task the same way as the task link does
+
+    :Returns: Dictionary
+
+    :param meta: The status and result of the task
+    :type meta: Dictionary
+    """
+    status = {'status': meta['status']}
+    if meta['status'] == 'SUCCESS':
+        status.update(meta['result'])
+    elif meta['status'] == 'PROGRESS':
+        status['progress'] = meta['result']
+    elif meta['status'] == 'FAILURE':
+        status['error'] = '{}'.format(meta['result'])
+    return status
+
+
+def _sse(event, data, event_id=None, retry=None):
+    """Format a Server-Sent Event
+
+    :Returns: String
+
+    :param event: The name of the event
+    :type event: String
+
+    :param data: The payload of the event
+    :type data: Object
+
+    :param event_id: Identifies the event, for the Last-Event-ID of a reconnect
+    :type event_id: String
+
+    :param retry: How long, in milliseconds, the client should wait before reconnecting
+    :type retry: Integer
+    """
+    message = 'event: {}\ndata: {}\n'.format(event, ujson.dumps(data))
+    if event_id is not None:
+        message += 'id: {}\n'.format(event_id)
+    if retry is not None:
+        message += 'retry: {}\n'.format(retry)
+    return message + '\n'
+
+
+def _ip_config(supplied):
+    """Fill in the defaults for the optional parts of the IP config
+
+    :Returns: Dictionary
+
+    :param supplied: The "ip-config" section of a request body
+    :type supplied: Dictionary
+    """
+    ip_config = {'default-gateway': '192.168.1.1',
+                 'netmask': '255.255.255.0',
+                 'dns': ['192.168.1.1.'],
+                 'domain': "vlab.local"}
+    ip_config.update(supplied)
+    return ip_config
+
+
+def _image_response(resp_data):
+    """Answer a request for the available images from the local image catalog,
+    instead of sending a task to the backend workers.
+
+    :Returns: flask.Response
+
+    :param resp_data: The response body, with the user already set
+    :type resp_data: Dictionary
+    """
+    resp_data['content'] = {'image': image_catalog.CATALOG.versions()}
+    resp_data['error'] = None
+    resp_data['params'] = {}
+    body = ujson.dumps(resp_data)
+    resp = Response(body)
+    resp.status_code = 200
+    resp.headers['Content-Type'] = 'application/json'
+    resp.headers['Cache-Control'] = 'private, max-age={}'.format(const.VLAB_SUPERNA_IMAGE_MAX_AGE)
+    resp.set_etag(hashlib.md5(body.encode()).hexdigest())
+    return resp.make_conditional(request)
@@ -0,0 +1,385 @@
+# -*- coding: UTF-8 -*-
+"""
+Limits how many OVA imports run at once, per datastore and per ESXi host.
+
+Every import streams gigabytes over HTTP NFC. A few at once use the datastore
+and the NFC service well, but 30 at once make every import slower, and
+the slowest ones run out their NFC lease. So an import first takes a slot on
+its datastore (VLAB_SUPERNA_IMPORTS_PER_DATASTORE) and then on its host
+(VLAB_SUPERNA_IMPORTS_PER_HOST). The slots are first come, first served, and
+an import that's waiting reports its place in line as the ``queued for import``
+step. Set a limit to 0 to turn it off.
+
+The slots are shared by every worker process that uses the same
+VLAB_SUPERNA_ADMISSION_STORE:
+
+  - ``file:///some/dir`` keeps them in files, so it covers the processes of
+    one worker host (or a shared volume that supports ``flock``)
+  - ``redis://superna-redis:6379/0`` covers every worker (needs the ``redis``
+    package)
+
+A slot belongs to a ticket, and the process holding the ticket refreshes it
+every few seconds. A worker that dies doesn't refresh its tickets, so they
+expire after VLAB_SUPERNA_ADMISSION_TTL seconds and its slots are freed.
+"""
+import os
+import time
+import uuid
+import fcntl
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse, unquote
+
+import ujson
+
+from vlab_superna_api.lib import const, metrics
+from vlab_superna_api.lib.worker import progress
+
+
+class FileStore(object):
+    """Keeps the line for each resource in a JSON file, with ``flock`` to keep
+    processes from stepping on each other
+
+    :param directory: Where to keep the files
+    :type directory: String
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    @contextmanager
+    def _line(self, key):
+        """Lock, load and (on the way out) save the line for a resource
+
+        :Returns: List of [ticket, last refreshed]
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}.json'.format(key.replace('/', '_')))
+        with open('{}.lock'.format(path), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(path) as the_file:
+                        line = ujson.load(the_file)
+                except (OSError, ValueError):
+                    line = []
+                yield line
+                tmp = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp, 'w') as the_file:
+                    ujson.dump(line, the_file)
+                os.replace(tmp, path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def join(self, key, ticket, now):
+        """Get in line for a resource
+
+        :Returns: None
+        """
+        with self._line(key) as line:
+            line.append([ticket, now])
+
+    def poll(self, key, ticket, now, ttl):
+        """Refresh a ticket, and forget tickets nobody refreshed for ``ttl`` seconds
+
+        :Returns: Integer, the ticket's place in line (0 is first), or None if the ticket expired
+        """
+        with self._line(key) as line:
+            line[:] = [x for x in line if x[0] == ticket or x[1] > now - ttl]
+            for index, item in enumerate(line):
+                if item[0] == ticket:
+                    item[1] = now
+                    return index
+        return None
+
+    def leave(self, key, ticket):
+        """Get out of line, or give back a slot
+
+        :Returns: None
+        """
+        with self._line(key) as line:
+            line[:] = [x for x in line if x[0] != ticket]
+
+    def length(self, key, now, ttl):
+        """How many tickets, holding a slot or waiting for one, a resource has
+
+        :Returns: Integer
+        """
+        with self._line(key) as line:
+            return len([x for x in line if x[1] > now - ttl])
+
+
+class RedisStore(object):
+    """Keeps the line for each resource in two sorted sets; one orders the
+    tickets, and the other says when each was last refreshed
+
+    :param url: Where Redis is, i.e. ``redis://superna-redis:6379/0``
+    :type url: String
+    """
+    def __init__(self, url):
+        self.url = url
+        self._pid = None
+        self._client = None
+
+    @property
+    def client(self):
+        """The connection to Redis; a forked process makes its own
+
+        :Returns: redis.Redis
+        """
+        if self._pid != os.getpid():
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+            self._pid = os.getpid()
+        return self._client
+
+    def join(self, key, ticket, now):
+        """Get in line for a resource
+
+        :Returns: None
+        """
+        place = self.client.incr('{}:next'.format(key))
+        pipe = self.client.pipeline()
+        pipe.zadd('{}:order'.format(key), {ticket: place})
+        pipe.zadd('{}:seen'.format(key), {ticket: now})
+        pipe.execute()
+
+    def _expire(self, key, now, ttl):
+        """Forget tickets nobody refreshed for ``ttl`` seconds
+
+        :Returns: None
+        """
+        stale = self.client.zrangebyscore('{}:seen'.format(key), '-inf', now - ttl)
+        if stale:
+            pipe = self.client.pipeline()
+            pipe.zrem('{}:order'.format(key), *stale)
+            pipe.zrem('{}:seen'.format(key), *stale)
+            pipe.execute()
+
+    def poll(self, key, ticket, now, ttl):
+        """Refresh a ticket, and forget tickets nobody refreshed for ``ttl`` seconds
+
+        :Returns: Integer, the ticket's place in line (0 is first), or None if the ticket expired
+        """
+        self._expire(key, now, ttl)
+        pipe = self.client.pipeline()
+        pipe.zadd('{}:seen'.format(key), {ticket: now}, xx=True)
+        pipe.zrank('{}:order'.format(key), ticket)
+        return pipe.execute()[1]
+
+    def leave(self, key, ticket):
+        """Get out of line, or give back a slot
+
+        :Returns: None
+        """
+        pipe = self.client.pipeline()
+        pipe.zrem('{}:order'.format(key), ticket)
+        pipe.zrem('{}:seen'.format(key), ticket)
+        pipe.execute()
+
+    def length(self, key, now, ttl):
+        """How many tickets, holding a slot or waiting for one, a resource has
+
+        :Returns: Integer
+        """
+        self._expire(key, now, ttl)
+        return self.client.zcard('{}:order'.format(key))
+
+
+def make_store(url):
+    """Make the store named by a VLAB_SUPERNA_ADMISSION_STORE URL
+
+    :Returns: FileStore or RedisStore
+
+    :Raises: ValueError, if the URL has an unsupported scheme
+
+    :param url: Where to keep the slots
+    :type url: String
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        return FileStore(unquote(parsed.path))
+    elif parsed.scheme in ('redis', 'rediss'):
+        return RedisStore(url)
+    error = 'Unsupported admission store {}; use a file:// or redis:// URL'.format(url)
+    raise ValueError(error)
+
+
+class _Heartbeat(object):
+    """Refreshes the tickets of slots being held, so they don't expire during
+    a long import
+
+    :param store: Where the slots are kept
+    :type store: FileStore or RedisStore
+
+    :param held: The (key, ticket) of each slot held
+    :type held: List
+
+    :param ttl: How long a ticket lives without being refreshed
+    :type ttl: Integer
+    """
+    def __init__(self, store, held, ttl):
+        self._store = store
+        self._held = held
+        self._ttl = ttl
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        """Begin refreshing"""
+        self._thread.start()
+
+    def stop(self):
+        """Stop refreshing"""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        """The body of the heartbeat thread"""
+        while not self._stop.wait(max(self._ttl / 3.0, 0.1)):
+            for key, ticket in list(self._held):
+                try:
+                    self._store.poll(key, ticket, time.time(), self._ttl)
+                except Exception:
+                    # Try again next time; the ticket outlives a few misses
+                    pass
+
+
+class Admission(object):
+    """Hands out the import slots of each datastore and host
+
+    :param url: Where to keep the slots. Default is VLAB_SUPERNA_ADMISSION_STORE.
+    :type url: String
+
+    :param interval: How often, in seconds, a waiting import checks its place in line
+    :type interval: Float
+    """
+    def __init__(self, url=None, interval=1):
+        self._url = url
+        self._store = None
+        self._interval = interval
+        self._lock = threading.Lock()
+        self.counters = {'admitted': 0, 'waited': 0, 'timeouts': 0, 'wait_seconds': 0.0}
+
+    @property
+    def store(self):
+        """Where the slots are kept
+
+        :Returns: FileStore or RedisStore
+        """
+        if self._store is None:
+            self._store = make_store(self._url or const.VLAB_SUPERNA_ADMISSION_STORE)
+        return self._store
+
+    def least_busy(self, kind, names):
+        """Pick the resource with the fewest imports running, or waiting to run
+
+        :Returns: String
+
+        :param kind: What sort of resource, i.e. ``host``
+        :type kind: String
+
+        :param names: The names of the resources to pick from
+        :type names: List
+        """
+        now = time.time()
+        return min(names, key=lambda x: self.store.length('{}/{}'.format(kind, x), now,
+                                                          const.VLAB_SUPERNA_ADMISSION_TTL))
+
+    @contextmanager
+    def slots(self, resources, logger, report_progress=progress.no_progress):
+        """Hold a slot on every resource for the life of a ``with`` statement,
+        waiting in line for each as needed
+
+        :Returns: None
+
+        :Raises: ValueError, if the slots aren't free within VLAB_SUPERNA_ADMISSION_TIMEOUT seconds
+
+        :param resources: The (kind, name, limit) of each resource, in the order to take them
+        :type resources: List
+
+        :param logger: An object for logging messages
+        :type logger: logging.LoggerAdapter
+
+        :param report_progress: Called with the place in line, while waiting
+        :type report_progress: Function
+        """
+        held = []
+        heartbeat = _Heartbeat(self.store, held, const.VLAB_SUPERNA_ADMISSION_TTL)
+        started = time.time()
+        try:
+            with metrics.phase('admission'):
+                # Always in the same order (datastore, then host), so two
+                # imports can't each hold the slot the other is waiting for
+                for kind, name, limit in resources:
+                    if limit > 0:
+                        held.append(self._take('{}/{}'.format(kind, name), limit, started, held, logger,
+                                               report_progress))
+            heartbeat.start()
+            with self._lock:
+                self.counters['admitted'] += 1
+            yield
+        finally:
+            heartbeat.stop()
+            for key, ticket in held:
+                try:
+                    self.store.leave(key, ticket)
+                except Exception as doh:
+                    # The ticket expires on its own
+                    logger.error('Unable to free import slot {}: {}'.format(key, doh))
+
+    def _take(self, key, limit, started, held, logger, report_progress):
+        """Wait in line for a slot on one resource
+
+        :Returns: Tuple of (key, ticket)
+        """
+        ticket = uuid.uuid4().hex
+        ttl = const.VLAB_SUPERNA_ADMISSION_TTL
+        self.store.join(key, ticket, time.time())
+        reported = None
+        waited = False
+        try:
+            while True:
+                now = time.time()
+                for other_key, other_ticket in held:
+                    # Keep the slots already held while waiting for this one
+                    self.store.poll(other_key, other_ticket, now, ttl)
+                place = self.store.poll(key, ticket, now, ttl)
+                if place is None:
+                    # Expired (i.e. the store was wiped); get back in line
+                    self.store.join(key, ticket, now)
+                    continue
+                if place < limit:
+                    break
+                position = place - limit + 1
+                if position != reported:
+                    logger.info('Waiting for an import slot on {}; {} in line'.format(key, position))
+                    report_progress(progress.QUEUED, resource=key, position=position)
+                    reported = position
+                waited = True
+                if now - started > const.VLAB_SUPERNA_ADMISSION_TIMEOUT:
+                    with self._lock:
+                        self.counters['timeouts'] += 1
+                    error = 'Timed out waiting for an import slot on {}; {} imports are ahead'.format(key, position)
+                    raise ValueError(error)
+                time.sleep(self._interval)
+        except BaseException:
+            self.store.leave(key, ticket)
+            raise
+        if waited:
+            with self._lock:
+                self.counters['waited'] += 1
+                self.counters['wait_seconds'] += time.time() - started
+        return key, ticket
+
+    def stats(self):
+        """Obtain counters about the imports admitted by this process
+
+        :Returns: Dictionary
+        """
+        with self._lock:
+            return dict(self.counters)
+
+
+ADMISSION = Admission()
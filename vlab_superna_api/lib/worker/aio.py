@@ -0,0 +1,291 @@
+# -*- coding: UTF-8 -*-
+"""
+An asyncio execution mode for the VMware operations.
+
+With ``VLAB_SUPERNA_EXECUTION_MODE=async`` the Celery tasks hand their work to
+one event loop per worker process, and just block on the result. That setting
+also makes the worker run a pool of VLAB_SUPERNA_ASYNC_THREADS threads (see
+routing.py), so a single process can drive dozens of creates at once. On a
+prefork pool (i.e. ``-P prefork`` on the command line) every process still
+runs one task at a time, so async only adds a hop to the event loop; the
+worker logs a warning.
+
+Only ``create`` gains from this; ``show`` and ``delete`` just run their sync
+versions in the thread pool, so they get no more concurrency than the sync
+mode on the same thread pool.
+
+pyVmomi has no async SOAP client, so the individual vCenter calls (and the NFC
+upload of an OVA import) run in a thread pool. What the event loop buys us is
+that the *waiting* - on tasks, on VMware Tools, on an IP, and the long settle
+after boot - doesn't hold a thread or a vCenter session. The number of vCenter
+calls in flight at once is capped by a semaphore per vCenter server.
+"""
+import os
+import time
+import asyncio
+import functools
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from vlab_inf_common.vmware import virtual_machine
+
+from vlab_superna_api.lib import const, image_catalog, metrics
+from vlab_superna_api.lib.worker import networks, progress, vmware, waiter
+from vlab_superna_api.lib.worker.session_pool import vcenter_session
+
+
+class _EventLoop(object):
+    """Runs an asyncio event loop in a background thread, so (synchronous)
+    Celery tasks can submit coroutines to it.
+
+    :param max_calls: The most vCenter calls, per vCenter server, that can be in flight at once
+    :type max_calls: Integer
+    """
+    def __init__(self, max_calls):
+        self._max_calls = max_calls
+        self._lock = threading.Lock()
+        self._pid = None
+        self._loop = None
+        self._executor = None
+        self._semaphores = {}
+
+    def _start(self):
+        """Create the event loop & its thread, if needed. Must hold the lock."""
+        if self._pid != os.getpid():
+            # Forked (or never started); threads don't survive a fork
+            self._pid = os.getpid()
+            self._loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(max_workers=max(self._max_calls, 1) * 2)
+            self._loop.set_default_executor(self._executor)
+            self._semaphores = {}
+            thread = threading.Thread(target=self._loop.run_forever)
+            thread.daemon = True
+            thread.start()
+
+    def run(self, coro):
+        """Run a coroutine on the event loop, and block until it's done
+
+        :Returns: Whatever the coroutine returns
+
+        :param coro: The work to do
+        :type coro: Coroutine
+        """
+        with self._lock:
+            self._start()
+            loop = self._loop
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def semaphore(self, server):
+        """Obtain the semaphore that caps the calls to a vCenter server. Must be
+        called from the event loop.
+
+        :Returns: asyncio.Semaphore
+
+        :param server: The vCenter server
+        :type server: String
+        """
+        if server not in self._semaphores:
+            self._semaphores[server] = asyncio.Semaphore(self._max_calls)
+        return self._semaphores[server]
+
+
+LOOP = _EventLoop(max_calls=const.VLAB_SUPERNA_ASYNC_CONCURRENCY)
+
+
+def enabled():
+    """Check if the Celery tasks should use the asyncio execution mode
+
+    :Returns: Boolean
+    """
+    return const.VLAB_SUPERNA_EXECUTION_MODE == 'async'
+
+
+def run(coro):
+    """Run a coroutine on this process' event loop, and block until it's done
+
+    :Returns: Whatever the coroutine returns
+
+    :param coro: The work to do
+    :type coro: Coroutine
+    """
+    return LOOP.run(_in_context(coro, contextvars.copy_context()))
+
+
+async def _in_context(coro, context):
+    """Run a coroutine with the context variables (i.e. the metric labels) of
+    the thread that submitted it. The coroutine runs in its own asyncio Task,
+    so this doesn't leak into other coroutines.
+
+    :Returns: Whatever the coroutine returns
+    """
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+
+async def call(func, *args, **kwargs):
+    """Make a blocking vCenter call without blocking the event loop
+
+    :Returns: Whatever ``func`` returns
+
+    :param func: The blocking function to call
+    :type func: Function
+    """
+    loop = asyncio.get_event_loop()
+    # run_in_executor doesn't carry over context variables (asyncio.to_thread does, in 3.9+)
+    context = contextvars.copy_context()
+    async with LOOP.semaphore(const.INF_VCENTER_SERVER):
+        return await loop.run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+
+
+async def call_with_session(func, *args, **kwargs):
+    """Like ``call``, but checks out a pooled vCenter session for just the
+    duration of the call, and passes it as the first argument to ``func``.
+
+    :Returns: Whatever ``func`` returns
+
+    :param func: The blocking function to call
+    :type func: Function
+    """
+    def _with_session():
+        with vcenter_session() as vcenter:
+            return func(vcenter, *args, **kwargs)
+    return await call(_with_session)
+
+
+async def wait_task(the_task, timeout=600):
+    """The async version of ``waiter.wait_task``
+
+    :Returns: vim.TaskInfo.result
+
+    :Raises: RuntimeError if the task fails, or takes too long
+
+    :param the_task: The task to wait on
+    :type the_task: vim.Task
+
+    :param timeout: How many seconds to wait for the task
+    :type timeout: Integer
+    """
+    props = (await waiter.WAITER.watch_async([the_task], waiter._task_done, timeout))[the_task]
+    return waiter._task_result(the_task, props)
+
+
+async def report(report_progress, step, **details):
+    """Publish the progress of a task without blocking the event loop
+
+    :Returns: None
+
+    :param report_progress: Publishes the progress of the task
+    :type report_progress: Function
+
+    :param step: What the task is doing
+    :type step: String
+    """
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, functools.partial(report_progress, step, **details))
+
+
+async def show_superna(username):
+    """The async version of ``vmware.show_superna``
+
+    :Returns: Dictionary
+
+    :param username: The user requesting info about their Superna
+    :type username: String
+    """
+    return await call(vmware.show_superna, username)
+
+
+async def delete_superna(username, machine_name, logger):
+    """The async version of ``vmware.delete_superna``
+
+    :Returns: None
+
+    :param username: The user who wants to delete their Superna
+    :type username: String
+
+    :param machine_name: The name of the VM to delete
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    return await call(vmware.delete_superna, username, machine_name, logger)
+
+
+async def create_superna(username, machine_name, image, network, ip_config, logger,
+                         report_progress=progress.no_progress):
+    """The async version of ``vmware.create_superna``. Each step that talks to
+    vCenter runs in the thread pool with its own pooled session; the waits on
+    power on, boot and the IP only occupy the event loop.
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to create a new Superna
+    :type username: String
+
+    :param machine_name: The name of the new instance of Superna
+    :type machine_name: String
+
+    :param image: The image/version of Superna to create
+    :type image: String
+
+    :param network: The name of the network to connect the new Superna instance up to
+    :type network: String
+
+    :param ip_config: The IPv4 network configuration for the Superna instance.
+    :type ip_config: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param report_progress: Called with each step of the create, for the client to see
+    :type report_progress: Function
+    """
+    image_info = image_catalog.CATALOG.get(image)
+    if image_info is None:
+        raise ValueError('No such image/version of Superna: {}'.format(image))
+    logger.info(image_info['file'])
+    the_vm = await call_with_session(_deploy, username, machine_name, image, image_info, network, logger,
+                                     report_progress)
+    logger.info("Setting vApp parameters")
+    await report(report_progress, progress.CONFIGURING)
+    with metrics.phase('reconfigure'):
+        await call(vmware.add_unique_params, the_vm, ip_config)
+    await report(report_progress, progress.POWERING_ON)
+    with metrics.phase('power_on'):
+        task = await call(the_vm.PowerOn)
+        await wait_task(task)
+    await report(report_progress, progress.WAITING_FOR_BOOT)
+    with metrics.phase('boot_wait'):
+        await waiter.WAITER.watch_async([the_vm], waiter._tools_ok, 1800)
+        # See waiter.wait_for_boot for why
+        await asyncio.sleep(const.VLAB_SUPERNA_BOOT_SETTLE)
+    meta_data = {'component' : "Superna",
+                 'created' : time.time(),
+                 'version' : image,
+                 'configured' : False,
+                 'generation' : 1}
+    with metrics.phase('set_meta'):
+        await call(virtual_machine.set_meta, the_vm, meta_data)
+    await report(report_progress, progress.WAITING_FOR_IP)
+    with metrics.phase('ip_wait'):
+        await waiter.WAITER.watch_async([the_vm], waiter._has_ip, 600)
+    with metrics.phase('get_info'):
+        info = await call_with_session(virtual_machine.get_info, the_vm, username)
+    vmware.SHOW_CACHE.pop(username)
+    return {machine_name: info}
+
+
+def _deploy(vcenter, username, machine_name, image, image_info, network, logger, report_progress=progress.no_progress):
+    """Look up the network, then deploy the new VM (powered off)
+
+    :Returns: vim.VirtualMachine
+    """
+    with metrics.phase('find_network'):
+        the_network = networks.lookup(vcenter, network)
+    with metrics.phase('deploy'):
+        return vmware._deploy(vcenter, username, machine_name, image, image_info, the_network, logger,
+                              report_progress=report_progress)
+
@@ -0,0 +1,130 @@
+# -*- coding: UTF-8 -*-
+"""
+A per-process cache of the VM folder of every user.
+
+``vCenter.get_by_name`` makes a container view of the whole inventory, then
+reads the name of every folder until it finds the user's; that's O(inventory)
+round trips on every show, create and delete. The cache gets the name of every
+folder under INF_VCENTER_TOP_LVL_DIR in a single PropertyCollector query. Before
+a cached folder is used, its name is read back (one round trip), so a folder
+that was deleted or renamed causes the cache to be rebuilt, instead of an error.
+
+A username with no folder is remembered for VLAB_SUPERNA_FOLDER_MISS_TTL
+seconds, so a client polling with a bad username doesn't rebuild the cache on
+every request.
+"""
+import threading
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+from vlab_superna_api.lib import const
+from vlab_superna_api.lib.ttl_cache import TTLCache
+from vlab_superna_api.lib.worker import inventory
+
+PropertyCollector = vmodl.query.PropertyCollector
+
+
+class UserFolders(object):
+    """Maps a username to their VM folder
+
+    :param miss_ttl: How many seconds to remember that a user has no folder
+    :type miss_ttl: Integer
+    """
+    def __init__(self, miss_ttl=const.VLAB_SUPERNA_FOLDER_MISS_TTL):
+        self._lock = threading.Lock()
+        self._folders = {}
+        self._missing = TTLCache(max_size=1000, ttl=miss_ttl)
+        self.counters = {'hits': 0, 'stale': 0, 'rebuilds': 0, 'missing': 0}
+
+    def get(self, vcenter, username):
+        """Find the VM folder of a user
+
+        :Returns: vim.Folder
+
+        :Raises: ValueError if the user has no folder
+
+        :param vcenter: An established connection to vCenter
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param username: The name of the user
+        :type username: String
+        """
+        with self._lock:
+            folder = self._folders.get(username, None)
+        if folder is not None:
+            folder = vim.Folder(folder._moId, stub=vcenter._conn._stub)
+            if self._valid(folder, username):
+                with self._lock:
+                    self.counters['hits'] += 1
+                return folder
+            with self._lock:
+                self.counters['stale'] += 1
+        elif self._missing.get(username):
+            with self._lock:
+                self.counters['missing'] += 1
+            raise ValueError('Unable to locate object named {}'.format(username))
+        with self._lock:
+            self._build(vcenter)
+            folder = self._folders.get(username, None)
+        if folder is None:
+            self._missing.set(username, True)
+            raise ValueError('Unable to locate object named {}'.format(username))
+        return folder
+
+    def _valid(self, folder, username):
+        """Check that a cached folder still exists, and still belongs to the user
+
+        :Returns: Boolean
+        """
+        try:
+            return folder.name == username
+        except vmodl.fault.ManagedObjectNotFound:
+            return False
+
+    def _build(self, vcenter):
+        """Find every folder under INF_VCENTER_TOP_LVL_DIR. Must hold the lock.
+
+        :Returns: None
+        """
+        self.counters['rebuilds'] += 1
+        root = vcenter.get_vm_folder(const.INF_VCENTER_TOP_LVL_DIR)
+        to_folders = PropertyCollector.TraversalSpec(name='folderTraversal',
+                                                     type=vim.Folder,
+                                                     path='childEntity',
+                                                     skip=False,
+                                                     selectSet=[PropertyCollector.SelectionSpec(name='folderTraversal')])
+        filter_spec = PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [PropertyCollector.ObjectSpec(obj=root, skip=True, selectSet=[to_folders])]
+        filter_spec.propSet = [PropertyCollector.PropertySpec(type=vim.Folder, pathSet=['name'])]
+        found = inventory.retrieve(vcenter, filter_spec)
+        self._folders = {y['name']: x for x, y in found.items()}
+
+    def stats(self):
+        """Obtain counters about how well the cache is working
+
+        :Returns: Dictionary
+        """
+        with self._lock:
+            answer = dict(self.counters)
+            answer['folders'] = len(self._folders)
+        return answer
+
+
+USER_FOLDERS = UserFolders()
+
+
+def user_folder(vcenter, username):
+    """Find the VM folder of a user, using the shared cache
+
+    :Returns: vim.Folder
+
+    :Raises: ValueError if the user has no folder
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param username: The name of the user
+    :type username: String
+    """
+    return USER_FOLDERS.get(vcenter, username)
@@ -0,0 +1,235 @@
+# -*- coding: UTF-8 -*-
+"""
+Bulk lookups of vCenter inventory via the PropertyCollector.
+
+Reading an attribute of a pyVmomi object is a round trip to vCenter, so walking
+a folder and inspecting each VM costs several round trips *per VM*. These
+functions ask the PropertyCollector for everything up front instead.
+"""
+import ssl
+import textwrap
+
+import ujson
+import OpenSSL
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+from vlab_superna_api.lib import const
+
+PropertyCollector = vmodl.query.PropertyCollector
+VM_PROPERTIES = ['name', 'runtime.powerState', 'config.annotation', 'guest.net', 'network']
+UNKNOWN_META = {'component': 'Unknown',
+                'created': 0,
+                'version': "Unknown",
+                'generation': 0,
+                'configured': False
+               }
+
+
+def retrieve(vcenter, filter_spec, page_size=500):
+    """Run a PropertyCollector query, following the paging tokens until every
+    object has been returned.
+
+    :Returns: Dictionary
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param filter_spec: Defines the objects and properties to obtain
+    :type filter_spec: vmodl.query.PropertyCollector.FilterSpec
+
+    :param page_size: The max number of objects vCenter returns per round trip
+    :type page_size: Integer
+    """
+    collector = vcenter.content.propertyCollector
+    options = PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    result = collector.RetrievePropertiesEx(specSet=[filter_spec], options=options)
+    found = {}
+    while result:
+        for obj in result.objects:
+            found[obj.obj] = {prop.name: prop.val for prop in obj.propSet}
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(token=result.token)
+    return found
+
+
+def folder_vms(vcenter, folder, properties=None):
+    """Obtain properties for every VM in a folder, along with the names of the
+    networks those VMs are connected to, in a single query.
+
+    :Returns: Dictionary, mapping vim.VirtualMachine to a dictionary of properties
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The folder that contains the VMs
+    :type folder: vim.Folder
+
+    :param properties: The VM properties to obtain. Must include "network".
+    :type properties: List
+    """
+    if properties is None:
+        properties = VM_PROPERTIES
+    to_vms = PropertyCollector.TraversalSpec(name='folderToVms',
+                                             type=vim.Folder,
+                                             path='childEntity',
+                                             skip=False,
+                                             selectSet=[PropertyCollector.SelectionSpec(name='vmToNetworks')])
+    to_networks = PropertyCollector.TraversalSpec(name='vmToNetworks',
+                                                  type=vim.VirtualMachine,
+                                                  path='network',
+                                                  skip=False)
+    filter_spec = PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [PropertyCollector.ObjectSpec(obj=folder, skip=True, selectSet=[to_vms, to_networks])]
+    filter_spec.propSet = [PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=properties),
+                           PropertyCollector.PropertySpec(type=vim.Network, pathSet=['name'])]
+    found = retrieve(vcenter, filter_spec)
+    network_names = {x: y['name'] for x, y in found.items() if isinstance(x, vim.Network)}
+    vms = {}
+    for obj, props in found.items():
+        if isinstance(obj, vim.VirtualMachine):
+            props['network'] = [network_names.get(x, '') for x in props.get('network', [])]
+            vms[obj] = props
+    return vms
+
+
+def find_vm(vcenter, folder, machine_name, properties):
+    """Find a VM by name within a folder, and obtain some of its properties. Costs
+    two round trips, no matter how many VMs are in the folder.
+
+    :Returns: Tuple of (vim.VirtualMachine, Dictionary), or None if there's no such VM
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The folder that contains the VM
+    :type folder: vim.Folder
+
+    :param machine_name: The name of the VM
+    :type machine_name: String
+
+    :param properties: The VM properties to obtain
+    :type properties: List
+    """
+    the_vm = vcenter.content.searchIndex.FindChild(entity=folder, name=machine_name)
+    if not isinstance(the_vm, vim.VirtualMachine):
+        # Not found, or it's a folder/vApp with the same name
+        return None
+    filter_spec = PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [PropertyCollector.ObjectSpec(obj=the_vm, skip=False)]
+    filter_spec.propSet = [PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=properties)]
+    return the_vm, retrieve(vcenter, filter_spec).get(the_vm, {})
+
+
+def vm_folder(vcenter, path):
+    """Obtain a VM folder by path, creating it if needed
+
+    :Returns: vim.Folder
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param path: The absolute path to the folder, from the root of the data center
+    :type path: String
+    """
+    try:
+        return vcenter.get_vm_folder(path)
+    except FileNotFoundError:
+        vcenter.create_vm_folder(path)
+        return vcenter.get_vm_folder(path)
+
+
+def parse_meta(annotation):
+    """Convert the notes on a VM into the vLab meta data
+
+    :Returns: Dictionary
+
+    :param annotation: The VM notes, as a JSON string
+    :type annotation: String
+    """
+    try:
+        return ujson.loads(annotation)
+    except (ValueError, TypeError):
+        # ValueError -> VM created, but notes not updated
+        # TypeError  -> VM failed to be created; notes are None
+        return dict(UNKNOWN_META)
+
+
+def vm_info(the_vm, props, username, console):
+    """Build the same output as ``virtual_machine.get_info`` from already-obtained
+    VM properties.
+
+    :Returns: Dictionary
+
+    :param the_vm: The VM the properties belong to
+    :type the_vm: vim.VirtualMachine
+
+    :param props: The output from ``folder_vms`` for this VM
+    :type props: Dictionary
+
+    :param username: The name of the user who owns the VM
+    :type username: String
+
+    :param console: Makes the URL for the HTML console of a VM
+    :type console: ConsoleUrls
+    """
+    ips = []
+    for nic in props.get('guest.net', []):
+        ips += nic.ipAddress
+    prefix = '{}_'.format(username)
+    details = {}
+    details['state'] = props.get('runtime.powerState')
+    details['console'] = console(the_vm, props['name'])
+    details['ips'] = [x for x in ips if not (x.startswith('fe80::') and x != '127.0.0.1')]
+    details['networks'] = [x.replace(prefix, '') for x in props.get('network', []) if x.startswith(username)]
+    details['moid'] = the_vm._moId
+    details['meta'] = parse_meta(props.get('config.annotation'))
+    return details
+
+
+class ConsoleUrls(object):
+    """Makes HTML5 console URLs for VMs, only looking up the parts that are the
+    same for every VM (cert thumbprint, server GUID, FQDN) once.
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    def __init__(self, vcenter):
+        self._vcenter = vcenter
+        self._content = None
+        self._server_guid = None
+        self._thumbprint = None
+
+    def _lookup(self):
+        """Obtain the details shared by every console URL"""
+        vcenter_cert = ssl.get_server_certificate((const.INF_VCENTER_SERVER, const.INF_VCENTER_PORT))
+        self._thumbprint = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, vcenter_cert).digest('sha1').decode()
+        self._content = self._vcenter.content
+        self._server_guid = self._content.about.instanceUuid
+
+    def __call__(self, the_vm, vm_name):
+        """Make the console URL for one VM
+
+        :Returns: (Really long) String
+
+        :param the_vm: The VM to make a console URL for
+        :type the_vm: vim.VirtualMachine
+
+        :param vm_name: The name of the VM
+        :type vm_name: String
+        """
+        if self._content is None:
+            self._lookup()
+        # Clone tickets are single use, so every VM needs its own
+        session = self._content.sessionManager.AcquireCloneTicket()
+        url = """\
+        https://{0}/ui/webconsole.html?vmId={1}&vmName={2}&serverGuid={3}&
+        locale=en_US&host={0}&sessionTicket={4}&thumbprint={5}
+        """.format(const.INF_VCENTER_SERVER,
+                   the_vm._moId,
+                   vm_name,
+                   self._server_guid,
+                   session,
+                   self._thumbprint)
+        return textwrap.dedent(url).replace('\n', '')
@@ -0,0 +1,167 @@
+# -*- coding: UTF-8 -*-
+"""
+A per-process index of the networks in vCenter, by name.
+
+``vCenter.networks`` lists every network, then reads the name of each one; with
+thousands of user port groups that's thousands of round trips per create. The
+index gets every name in a single PropertyCollector query, and rebuilds itself
+every VLAB_SUPERNA_NETWORK_TTL seconds. A name that's not in the index (i.e. a
+port group made since the last rebuild) is looked up directly in the network
+folder of each datacenter before giving up. Before a network from the index is
+used, its name is read back (one round trip), so a port group that was deleted
+and made again is looked up again, instead of failing the create later on.
+"""
+import time
+import threading
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+from vlab_superna_api.lib import const
+from vlab_superna_api.lib.worker import inventory
+
+PropertyCollector = vmodl.query.PropertyCollector
+
+
+def _rebind(obj, vcenter):
+    """Make a managed object use the caller's session, instead of whatever
+    session was used to build the index.
+
+    :Returns: pyVmomi.VmomiSupport.ManagedObject
+
+    :param obj: The object to rebind
+    :type obj: pyVmomi.VmomiSupport.ManagedObject
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    return obj.__class__(obj._moId, stub=vcenter._conn._stub)
+
+
+class NetworkIndex(object):
+    """Maps the name of every network to its managed object
+
+    :param ttl: How many seconds before the index is rebuilt
+    :type ttl: Integer
+    """
+    def __init__(self, ttl=const.VLAB_SUPERNA_NETWORK_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._names = {}
+        self._network_folders = []
+        self._built = 0
+        self.counters = {'hits': 0, 'misses': 0, 'stale': 0, 'refreshes': 0}
+
+    def lookup(self, vcenter, name):
+        """Find a network by name
+
+        :Returns: vim.Network
+
+        :Raises: ValueError if there's no such network
+
+        :param vcenter: An established connection to vCenter
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param name: The name of the network
+        :type name: String
+        """
+        with self._lock:
+            if time.time() - self._built > self._ttl:
+                self._build(vcenter)
+            the_network = self._names.get(name, None)
+            folders = list(self._network_folders)
+        if the_network is not None:
+            the_network = _rebind(the_network, vcenter)
+            if self._valid(the_network, name):
+                with self._lock:
+                    self.counters['hits'] += 1
+                return the_network
+            with self._lock:
+                self.counters['stale'] += 1
+                self._names.pop(name, None)
+        with self._lock:
+            self.counters['misses'] += 1
+        the_network = self._find(vcenter, name, folders)
+        if the_network is None:
+            raise ValueError('No such network named {}'.format(name))
+        with self._lock:
+            self._names[name] = the_network
+        return the_network
+
+    def _valid(self, the_network, name):
+        """Check that a network from the index still exists, and still has its name
+
+        :Returns: Boolean
+        """
+        try:
+            return the_network.name == name
+        except vmodl.fault.ManagedObjectNotFound:
+            return False
+
+    def _build(self, vcenter):
+        """Get the name of every network (and the network folder of every
+        datacenter) in one query. Must hold the lock.
+
+        :Returns: None
+        """
+        self.counters['refreshes'] += 1
+        view = vcenter.content.viewManager.CreateContainerView(container=vcenter.content.rootFolder,
+                                                               type=[vim.Network, vim.Datacenter],
+                                                               recursive=True)
+        try:
+            filter_spec = PropertyCollector.FilterSpec()
+            to_view = PropertyCollector.TraversalSpec(name='traverseView',
+                                                      type=vim.view.ContainerView,
+                                                      path='view',
+                                                      skip=False)
+            filter_spec.objectSet = [PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[to_view])]
+            filter_spec.propSet = [PropertyCollector.PropertySpec(type=vim.Network, pathSet=['name']),
+                                   PropertyCollector.PropertySpec(type=vim.Datacenter, pathSet=['networkFolder'])]
+            found = inventory.retrieve(vcenter, filter_spec)
+        finally:
+            view.DestroyView()
+        self._names = {y['name']: x for x, y in found.items() if isinstance(x, vim.Network)}
+        self._network_folders = [y['networkFolder'] for x, y in found.items() if isinstance(x, vim.Datacenter)]
+        self._built = time.time()
+
+    def _find(self, vcenter, name, folders):
+        """Look for a network that's not in the index
+
+        :Returns: vim.Network or None
+        """
+        search_index = vcenter.content.searchIndex
+        for folder in folders:
+            the_network = search_index.FindChild(entity=_rebind(folder, vcenter), name=name)
+            if the_network is not None:
+                return the_network
+        return None
+
+    def stats(self):
+        """Obtain counters about how well the index is working
+
+        :Returns: Dictionary
+        """
+        with self._lock:
+            answer = dict(self.counters)
+            answer['networks'] = len(self._names)
+            answer['age'] = time.time() - self._built if self._built else None
+        return answer
+
+
+INDEX = NetworkIndex()
+
+
+def lookup(vcenter, name):
+    """Find a network by name, using the shared index
+
+    :Returns: vim.Network
+
+    :Raises: ValueError if there's no such network
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param name: The name of the network
+    :type name: String
+    """
+    return INDEX.lookup(vcenter, name)
@@ -0,0 +1,307 @@
+# -*- coding: UTF-8 -*-
+"""
+Upload the disks of an OVA to vCenter over HTTP NFC.
+
+``Ova.deploy`` uploads one disk at a time, over one stream read out of the
+tarball. This uploads the disks concurrently, over a pool of (kept alive)
+HTTPS connections, sending straight out of an mmap of the OVA instead of
+copying each chunk through the tarfile module. Progress is reported to the
+lease by bytes sent, and a disk that fails part way is re-sent, without
+touching the disks that already finished. Once a disk runs out of retries, the
+other disks stop at their next chunk, and the lease is aborted right away.
+"""
+import mmap
+import threading
+import contextvars
+import http.client
+from collections import defaultdict
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pyVmomi import vmodl
+from vlab_inf_common.ssl_context import get_context
+
+from vlab_superna_api.lib import const, tracing
+from vlab_superna_api.lib.worker import progress
+
+CHUNK_SIZE = 8 * 1024 * 1024
+# Errors that are worth re-sending a disk for
+TRANSIENT_ERRORS = (OSError, http.client.HTTPException)
+
+
+class _Stopped(Exception):
+    """Raised by an upload that was told to stop, because another disk failed"""
+
+
+class _Progress(object):
+    """Counts the bytes sent, and reports them to the lease. Reporting also keeps
+    the lease from timing out during long uploads.
+
+    :param lease: The lease of the import
+    :type lease: vim.HttpNfcLease
+
+    :param total: The total number of bytes to upload
+    :type total: Integer
+
+    :param report_progress: Called with the bytes sent, every time the lease is updated
+    :type report_progress: Function
+
+    :param interval: How often, in seconds, to update the lease
+    :type interval: Integer
+    """
+    def __init__(self, lease, total, report_progress=progress.no_progress, interval=5):
+        self._lease = lease
+        self._report_progress = report_progress
+        self._total = max(total, 1)
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.sent = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        """Begin reporting progress
+
+        :Returns: None
+        """
+        self._thread.start()
+
+    def add(self, amount):
+        """Record that more bytes were sent (or, when negative, will be re-sent)
+
+        :Returns: None
+
+        :param amount: The number of bytes
+        :type amount: Integer
+        """
+        with self._lock:
+            self.sent += amount
+
+    def percent(self):
+        """The percent of bytes sent. Never 100 until the lease is completed.
+
+        :Returns: Integer
+        """
+        with self._lock:
+            return min(int(100 * self.sent / self._total), 99)
+
+    def stop(self):
+        """Stop reporting progress
+
+        :Returns: None
+        """
+        self._stop.set()
+
+    def _run(self):
+        """The body of the reporting thread"""
+        while not self._stop.wait(self._interval):
+            try:
+                self._lease.HttpNfcLeaseProgress(self.percent())
+            except Exception:
+                # i.e. the lease was aborted; the upload will fail on its own
+                return
+            self._report_progress(progress.IMPORTING, bytes=self.sent, total=self._total)
+
+
+class _ConnectionPool(object):
+    """Reuses HTTP(S) connections to the ESXi hosts between disks
+
+    :param context: The SSL context for HTTPS connections
+    :type context: ssl.SSLContext
+    """
+    def __init__(self, context):
+        self._context = context
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)
+
+    def get(self, scheme, netloc):
+        """Obtain a connection
+
+        :Returns: http.client.HTTPConnection
+        """
+        with self._lock:
+            if self._idle[(scheme, netloc)]:
+                return self._idle[(scheme, netloc)].pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, context=self._context, timeout=const.VLAB_SUPERNA_NFC_TIMEOUT)
+        return http.client.HTTPConnection(netloc, timeout=const.VLAB_SUPERNA_NFC_TIMEOUT)
+
+    def put(self, scheme, netloc, conn):
+        """Return a healthy connection to the pool
+
+        :Returns: None
+        """
+        with self._lock:
+            self._idle[(scheme, netloc)].append(conn)
+
+    def close(self):
+        """Close every idle connection
+
+        :Returns: None
+        """
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+def device_url(lease, file_item, host):
+    """Obtain the URL to upload a disk to
+
+    :Returns: String
+
+    :Raises: RuntimeError if the lease has no URL for the disk
+
+    :param lease: The lease of the import
+    :type lease: vim.HttpNfcLease
+
+    :param file_item: The disk to upload
+    :type file_item: vim.OvfManager.FileItem
+
+    :param host: The ESXi host the lease is for
+    :type host: String
+    """
+    for device in lease.info.deviceUrl:
+        if device.importKey == file_item.deviceId:
+            # ESXi sometimes doesn't know its own name
+            return device.url.replace('*', host)
+    raise RuntimeError("Failed to find deviceUrl for file {}".format(file_item.path))
+
+
+def _send(conn, url, ova_fh, ova_map, offset, size, report, stop):
+    """POST one disk to the NFC URL
+
+    :Returns: None
+
+    :param report: Called with the number of bytes, as they are sent
+    :type report: Function
+
+    :param stop: Set when the upload should give up, checked between chunks
+    :type stop: threading.Event
+
+    :Raises: RuntimeError if ESXi rejects the disk, _Stopped if told to stop
+    """
+    parsed = urlparse(url)
+    conn.putrequest('POST', parsed.path + ('?' + parsed.query if parsed.query else ''))
+    conn.putheader('Content-Length', str(size))
+    conn.putheader('Content-Type', 'application/x-vnd.vmware-streamVmdk')
+    conn.putheader('Connection', 'Keep-Alive')
+    conn.endheaders()
+    if parsed.scheme == 'http':
+        # No TLS, so the kernel can copy the file straight to the socket
+        report(conn.sock.sendfile(ova_fh, offset, size))
+    else:
+        view = memoryview(ova_map)
+        try:
+            for start in range(offset, offset + size, CHUNK_SIZE):
+                if stop.is_set():
+                    raise _Stopped()
+                chunk = view[start:min(start + CHUNK_SIZE, offset + size)]
+                conn.sock.sendall(chunk)
+                report(len(chunk))
+        finally:
+            view.release()
+    resp = conn.getresponse()
+    resp.read()
+    if resp.status >= 300:
+        raise RuntimeError('Upload of disk rejected: HTTP {} {}'.format(resp.status, resp.reason))
+
+
+def upload(lease, file_items, ova_file, disks, host, logger, report_progress=progress.no_progress):
+    """Upload every disk of an OVA, then complete the lease. Aborts the lease on failure.
+
+    :Returns: None
+
+    :Raises: RuntimeError if a disk cannot be uploaded
+
+    :param lease: The ready-to-use lease of the import
+    :type lease: vim.HttpNfcLease
+
+    :param file_items: The files of the import spec
+    :type file_items: List of vim.OvfManager.FileItem
+
+    :param ova_file: The path to the OVA
+    :type ova_file: String
+
+    :param disks: Maps the name of each disk to its (byte offset, size) within the OVA
+    :type disks: Dictionary
+
+    :param host: The ESXi host the lease is for
+    :type host: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param report_progress: Called with the bytes uploaded, every few seconds
+    :type report_progress: Function
+    """
+    # Files in the spec, but not the OVA (i.e. empty disks) are made by ESXi
+    to_upload = [x for x in file_items if x.path in disks]
+    total = sum(disks[x.path][1] for x in to_upload)
+    tracker = _Progress(lease, total, report_progress)
+    pool = _ConnectionPool(get_context())
+    stop = threading.Event()
+
+    def upload_disk(file_item):
+        with tracing.span('nfc_upload_disk', disk=file_item.path, bytes=disks[file_item.path][1]) as the_span:
+            _upload_disk(file_item, the_span)
+
+    def _upload_disk(file_item, the_span):
+        url = device_url(lease, file_item, host)
+        parsed = urlparse(url)
+        offset, size = disks[file_item.path]
+        for attempt in range(const.VLAB_SUPERNA_NFC_RETRIES + 1):
+            if stop.is_set():
+                raise _Stopped()
+            if the_span is not None:
+                the_span.set('attempts', attempt + 1)
+            attempt_sent = []
+            conn = pool.get(parsed.scheme, parsed.netloc)
+            try:
+                _send(conn, url, ova_fh, ova_map, offset, size,
+                      lambda amount: attempt_sent.append(amount) or tracker.add(amount), stop)
+            except TRANSIENT_ERRORS as doh:
+                conn.close()
+                # Resend just this disk; the others are untouched
+                tracker.add(-sum(attempt_sent))
+                if attempt == const.VLAB_SUPERNA_NFC_RETRIES:
+                    raise RuntimeError('Failed to upload {}: {}'.format(file_item.path, doh))
+                logger.info('Retrying upload of {}: {}'.format(file_item.path, doh))
+            else:
+                pool.put(parsed.scheme, parsed.netloc, conn)
+                logger.debug('Uploaded {}'.format(file_item.path))
+                return
+
+    with open(ova_file, 'rb') as ova_fh, tracing.span('nfc_upload', bytes=total, disks=len(to_upload)):
+        ova_map = mmap.mmap(ova_fh.fileno(), 0, access=mmap.ACCESS_READ)
+        tracker.start()
+        executor = ThreadPoolExecutor(max_workers=max(const.VLAB_SUPERNA_NFC_CONCURRENCY, 1))
+        futures = []
+        try:
+            try:
+                # Each disk runs in the context of the upload, so its span is a child of it
+                futures = [executor.submit(contextvars.copy_context().run, upload_disk, x) for x in to_upload]
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # Don't wait on the other disks; aborting the lease also breaks
+                # any upload that is in the middle of a sendfile
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+            lease.HttpNfcLeaseProgress(100)
+            lease.HttpNfcLeaseComplete()
+        except vmodl.MethodFault as doh:
+            lease.HttpNfcLeaseAbort(doh)
+            raise
+        except Exception as doh:
+            lease.HttpNfcLeaseAbort(vmodl.fault.SystemError(reason=str(doh)))
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            tracker.stop()
+            pool.close()
+            ova_map.close()
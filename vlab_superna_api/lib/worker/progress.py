@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+"""
+Publish what a long running task is doing, so clients don't have to guess.
+
+The steps are published as the custom Celery state ``PROGRESS``; the meta data
+says which step the task is on (and for imports, how many bytes have been
+uploaded). The API streams these to clients; see ``SupernaView.events``.
+"""
+import time
+
+STATE = 'PROGRESS'
+QUEUED = 'queued for import'
+DEPLOYING = 'deploying'
+IMPORTING = 'importing'
+CONFIGURING = 'configuring vApp'
+POWERING_ON = 'powering on'
+WAITING_FOR_BOOT = 'waiting for boot'
+WAITING_FOR_IP = 'waiting for IP'
+
+
+def no_progress(step, **details):
+    """The default progress reporter; it does nothing
+
+    :Returns: None
+
+    :param step: What the task is doing
+    :type step: String
+    """
+    pass
+
+
+class TaskProgress(object):
+    """Publishes the steps of a Celery task via ``update_state``
+
+    :param task: The bound Celery task
+    :type task: celery.Task
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    def __init__(self, task, logger):
+        self._task = task
+        self._logger = logger
+        # ``task.request`` is thread-local, and progress is also reported from
+        # other threads (i.e. the NFC upload), so remember the id now
+        self._task_id = task.request.id
+
+    def __call__(self, step, **details):
+        """Publish the step the task is on
+
+        :Returns: None
+
+        :param step: What the task is doing
+        :type step: String
+
+        :param details: Anything else to tell the client, like the bytes uploaded
+        :type details: Dictionary
+        """
+        self._logger.debug('Progress: {} {}'.format(step, details))
+        if self._task_id is None:
+            # Called directly, not via Celery; there's nobody to tell
+            return
+        meta = {'step': step, 'time': time.time()}
+        meta.update(details)
+        try:
+            self._task.update_state(task_id=self._task_id, state=STATE, meta=meta)
+        except Exception as doh:
+            # Progress is nice to have; never fail the task over it
+            self._logger.error('Unable to publish progress: {}'.format(doh))
@@ -0,0 +1,277 @@
+# -*- coding: UTF-8 -*-
+"""
+A per-process pool of authenticated vCenter sessions.
+
+Opening a ``vCenter`` object is a SOAP login, plus a fetch of the service content,
+plus a logout when the ``with`` statement exits. For quick tasks like ``superna.show``
+that handshake is most of the work, and every task burns one of vCenter's
+(limited) sessions. The pool keeps sessions around between tasks instead.
+"""
+import os
+import time
+import functools
+import threading
+from contextlib import contextmanager
+
+from vlab_inf_common.vmware import vCenter, vim
+
+from vlab_superna_api.lib import const, metrics
+
+
+def _login():
+    """The default factory for new vCenter sessions
+
+    :Returns: vlab_inf_common.vmware.vCenter
+    """
+    return vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                   password=const.INF_VCENTER_PASSWORD)
+
+
+class _PooledSession(object):
+    """Book keeping for a single session in the pool.
+
+    :param vcenter: The authenticated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    def __init__(self, vcenter):
+        self.vcenter = vcenter
+        self.last_used = time.time()
+        # Cached so a health check is one round trip, not two
+        self._session_manager = None
+
+    def is_alive(self):
+        """Check if vCenter still considers this session to be logged in.
+
+        :Returns: Boolean
+        """
+        try:
+            if self._session_manager is None:
+                self._session_manager = self.vcenter.content.sessionManager
+            return self._session_manager.currentSession is not None
+        except Exception:
+            # Broken socket, expired session, vCenter restarted; they all mean
+            # the same thing to us: toss it and make a new one.
+            return False
+
+    def close(self):
+        """Logout of vCenter, ignoring errors since the session might already be dead"""
+        try:
+            self.vcenter.close()
+        except Exception:
+            pass
+
+
+class SessionPool(object):
+    """Hands out authenticated vCenter sessions, and keeps them alive between uses.
+
+    Sessions are created lazily, up to ``max_size`` per process. When every
+    session is in use, callers block until one is checked back in. A background
+    thread pings idle sessions so vCenter doesn't expire them, and logs out of
+    sessions that have been idle longer than ``max_idle`` seconds.
+
+    :param max_size: The most sessions this process will have open at once
+    :type max_size: Integer
+
+    :param keepalive: How often, in seconds, to ping idle sessions
+    :type keepalive: Integer
+
+    :param max_idle: Logout of sessions that haven't been used in this many seconds
+    :type max_idle: Integer
+
+    :param factory: Creates a new, authenticated vCenter object
+    :type factory: Function
+    """
+    def __init__(self, max_size=const.VLAB_SUPERNA_VCENTER_POOL_SIZE,
+                 keepalive=const.VLAB_SUPERNA_VCENTER_KEEPALIVE,
+                 max_idle=const.VLAB_SUPERNA_VCENTER_MAX_IDLE, factory=_login):
+        self._max_size = max_size
+        self._keepalive = keepalive
+        self._max_idle = max_idle
+        self._factory = factory
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        """Forget every session. Also used after a fork, because a Celery prefork
+        child inherits the parent's sockets, and sharing those would be bad."""
+        self._pid = os.getpid()
+        self._idle = []
+        self._in_use = 0
+        # Taken out of ``_idle`` by the keeper to ping; still open, so they count toward ``max_size``
+        self._pinging = 0
+        self._keeper = None
+        self.counters = {'hits': 0, 'misses': 0, 'discarded': 0, 'relogins': 0, 'waits': 0}
+
+    @contextmanager
+    def session(self):
+        """Checkout a session for the life of a ``with`` statement.
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        pooled = self._checkout()
+        try:
+            yield pooled.vcenter
+        except vim.fault.NotAuthenticated:
+            self._discard(pooled)
+            # If one session expired, odds are the rest did too (i.e. vCenter restarted)
+            self.flush()
+            raise
+        except BaseException:
+            self._checkin(pooled)
+            raise
+        else:
+            self._checkin(pooled)
+
+    def _checkout(self):
+        """Obtain an idle session, or make a new one
+
+        :Returns: _PooledSession
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                self._reset()
+            self._start_keeper()
+            while not self._idle and self._in_use + self._pinging >= self._max_size:
+                self.counters['waits'] += 1
+                self._cond.wait()
+            self._in_use += 1
+            pooled = self._idle.pop() if self._idle else None
+        while pooled is not None:
+            # Only bother vCenter with a health check if the keeper might not
+            # have pinged this session recently.
+            if time.time() - pooled.last_used < self._keepalive or pooled.is_alive():
+                self._count('hits')
+                return pooled
+            self._count('discarded')
+            pooled.close()
+            with self._cond:
+                pooled = self._idle.pop() if self._idle else None
+        self._count('misses')
+        try:
+            with metrics.phase('login'):
+                return _PooledSession(self._factory())
+        except BaseException:
+            self._release()
+            raise
+
+    def _checkin(self, pooled):
+        """Return a session to the pool
+
+        :Returns: None
+        """
+        pooled.last_used = time.time()
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._idle.append(pooled)
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _discard(self, pooled):
+        """Drop a session that's no longer usable
+
+        :Returns: None
+        """
+        pooled.close()
+        self._count('discarded')
+        self._release()
+
+    def _release(self):
+        """Free up a slot for a session that was never returned"""
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _count(self, counter):
+        with self._cond:
+            self.counters[counter] += 1
+
+    def flush(self):
+        """Logout of every idle session
+
+        :Returns: None
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self._count('discarded')
+            pooled.close()
+
+    def stats(self):
+        """Obtain the hit/miss counters, and how many sessions are open
+
+        :Returns: Dictionary
+        """
+        with self._cond:
+            answer = dict(self.counters)
+            answer['idle'] = len(self._idle)
+            answer['in_use'] = self._in_use
+            answer['pinging'] = self._pinging
+            answer['max_size'] = self._max_size
+        return answer
+
+    def _start_keeper(self):
+        """Lazily start the keepalive thread; must be called while holding the lock"""
+        if self._keeper is None and self._keepalive > 0:
+            self._keeper = threading.Thread(target=self._keep_alive, daemon=True)
+            self._keeper.start()
+
+    def _keep_alive(self):
+        """Ping idle sessions so vCenter doesn't log them out; runs forever"""
+        pid = os.getpid()
+        while pid == self._pid:
+            time.sleep(self._keepalive)
+            self._ping_idle()
+
+    def _ping_idle(self):
+        """Ping every idle session once, and logout of the dead and long idle ones
+
+        :Returns: None
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._pinging += len(idle)
+        keep = []
+        now = time.time()
+        for pooled in idle:
+            if now - pooled.last_used < self._max_idle and pooled.is_alive():
+                keep.append(pooled)
+            else:
+                self._count('discarded')
+                pooled.close()
+        with self._cond:
+            self._pinging -= len(idle)
+            self._idle.extend(keep)
+            # A kept session, or the slot of a discarded one, for each waiter
+            self._cond.notify(len(idle))
+
+
+def reauthenticate(func):
+    """Decorator that re-runs a function once if vCenter reports the session is
+    no longer authenticated. Only use it on functions that are safe to repeat.
+
+    :Returns: Function
+
+    :param func: The function to wrap
+    :type func: Function
+    """
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except vim.fault.NotAuthenticated:
+            SESSIONS._count('relogins')
+            return func(*args, **kwargs)
+    return inner
+
+
+SESSIONS = SessionPool()
+
+
+def vcenter_session():
+    """Obtain a pooled connection to vCenter. Use it in a ``with`` statement,
+    just like the ``vCenter`` object.
+
+    :Returns: contextlib.GeneratorContextManager
+    """
+    return SESSIONS.session()
@@ -2,13 +2,90 @@
 """
 Entry point logic for available backend worker tasks
 """
-from celery import Celery
+import time
+import logging
+
+from celery import Celery, concurrency, signals
 from vlab_api_common import get_task_logger
 
-from vlab_superna_api.lib import const
-from vlab_superna_api.lib.worker import vmware
+from vlab_superna_api.lib import const, image_catalog, metrics, results, routing, tracing
+from vlab_superna_api.lib.worker import vmware, session_pool, warm_pool, waiter, aio, networks, folders, admission
+from vlab_superna_api.lib.worker.progress import TaskProgress
+
+app = Celery('superna', backend=const.VLAB_SUPERNA_RESULT_BACKEND, broker=const.VLAB_MESSAGE_BROKER)
+results.configure(app)
+routing.configure(app)
+vmware.SHOW_CACHE.share(lambda: app.backend)
+routing.configure_worker(app, const.VLAB_SUPERNA_WORKER_MODE)
+tracing.EXPORTER.service = 'vlab-superna-worker'
+# task id -> (the span of the running task, the token to deactivate it with)
+_SPANS = {}
+if warm_pool.enabled():
+    # Only a worker started with ``--beat`` (or a separate ``celery beat``)
+    # runs this; it replaces the pre-deployed VMs that are claimed, and
+    # destroys (and replaces) the ones that failed to be made. The slow
+    # worker in docker-compose.yml runs it; run it in exactly one place, or
+    # every refill is sent more than once.
+    app.conf.beat_schedule = {'superna-refill-pool': {'task': 'superna.refill_pool',
+                                                      'schedule': const.VLAB_SUPERNA_WARM_POOL_INTERVAL,
+                                                      'args': ('beat',)}}
+
+
+@signals.worker_init.connect
+def serve_metrics(**kwargs):
+    """Export the metrics of every worker process, from the parent process"""
+    if const.VLAB_SUPERNA_METRICS_PORT:
+        metrics.reset(const.VLAB_SUPERNA_METRICS_DIR)
+        metrics.serve(const.VLAB_SUPERNA_METRICS_PORT, const.VLAB_SUPERNA_METRICS_DIR)
+
+
+@signals.worker_init.connect
+def check_pool(sender=None, **kwargs):
+    """Warn if the async execution mode runs on a pool that can't make use of it"""
+    if aio.enabled() and sender is not None and sender.pool_cls is not concurrency.get_implementation('threads'):
+        logging.getLogger(__name__).warning('VLAB_SUPERNA_EXECUTION_MODE=async needs a thread pool (-P threads); '
+                                            'with {} each process still runs one task at a time'.format(
+                                                sender.pool_cls.__module__))
+
 
-app = Celery('superna', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+@signals.task_prerun.connect
+def start_trace(task_id=None, task=None, **kwargs):
+    """Record how long a task waited in the broker, and trace the task as a child
+    of the API request that sent it"""
+    now = time.time()
+    traceparent = task.request.get(tracing.TRACEPARENT)
+    sent_at = task.request.get(tracing.SENT_AT)
+    if sent_at:
+        metrics.QUEUE_SECONDS.observe(max(now - sent_at, 0), task=task.name)
+        queued = tracing.start('queue', traceparent, start_time=sent_at, task=task.name)
+        if queued is not None:
+            queued.finish(end=now)
+    the_span = tracing.start(task.name, traceparent, start_time=now, task_id=task_id)
+    if the_span is not None:
+        _SPANS[task_id] = (the_span, tracing.activate(the_span))
+
+
+@signals.task_postrun.connect
+def finish_trace(task_id=None, state=None, retval=None, **kwargs):
+    """End the span of a task"""
+    the_span, token = _SPANS.pop(task_id, (None, None))
+    if the_span is not None:
+        tracing.deactivate(token)
+        the_span.set('state', state)
+        if isinstance(retval, dict) and retval.get('error'):
+            the_span.error = retval['error']
+        the_span.finish()
+
+
+@signals.task_postrun.connect
+def save_metrics(**kwargs):
+    """Make the metrics of the task that just ran visible to ``serve_metrics``"""
+    if const.VLAB_SUPERNA_METRICS_PORT:
+        try:
+            metrics.dump(const.VLAB_SUPERNA_METRICS_DIR)
+        except OSError:
+            # Metrics are nice to have; never fail a task over them
+            pass
 
 
 @app.task(name='superna.show', bind=True)
@@ -27,7 +104,11 @@ def show(self, username, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        info = vmware.show_superna(username)
+        with metrics.task('superna.show'):
+            if aio.enabled():
+                info = aio.run(aio.show_superna(username))
+            else:
+                info = vmware.show_superna(username)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
@@ -64,11 +145,59 @@ def create(self, username, machine_name, image, network, ip_config, txn_id):
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SUPERNA_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
+    report_progress = TaskProgress(self, logger)
     try:
-        resp['content'] = vmware.create_superna(username, machine_name, image, network, ip_config, logger)
+        with metrics.task('superna.create', image):
+            if aio.enabled():
+                resp['content'] = aio.run(aio.create_superna(username, machine_name, image, network, ip_config, logger,
+                                                             report_progress=report_progress))
+            else:
+                resp['content'] = vmware.create_superna(username, machine_name, image, network, ip_config, logger,
+                                                        report_progress=report_progress)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+    if warm_pool.target_size(image) > 0:
+        refill_pool.apply_async(args=(txn_id,), kwargs={'version': image})
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='superna.create_batch', bind=True)
+def create_batch(self, username, machines, image, network, txn_id):
+    """Deploy many instances of Superna, that share an image and network
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to create the new Superna instances
+    :type username: String
+
+    :param machines: The name and IPv4 network config of each new instance
+    :type machines: List of Dictionaries
+
+    :param image: The image/version of Superna to create
+    :type image: String
+
+    :param network: The name of the network to connect the new Superna instances up to
+    :type network: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SUPERNA_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        with metrics.task('superna.create_batch', image):
+            resp['content'] = vmware.create_batch(username, machines, image, network, logger)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        if resp['content']['failed']:
+            resp['error'] = 'Failed to create {} of {} instances'.format(len(resp['content']['failed']), len(machines))
+    if warm_pool.target_size(image) > 0:
+        refill_pool.apply_async(args=(txn_id,), kwargs={'version': image})
     logger.info('Task complete')
     return resp
 
@@ -92,11 +221,46 @@ def delete(self, username, machine_name, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        vmware.delete_superna(username, machine_name, logger)
+        with metrics.task('superna.delete'):
+            if aio.enabled():
+                aio.run(aio.delete_superna(username, machine_name, logger))
+            else:
+                vmware.delete_superna(username, machine_name, logger)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        logger.info('Task complete')
+    return resp
+
+
+@app.task(name='superna.delete_batch', bind=True)
+def delete_batch(self, username, machine_names, txn_id):
+    """Destroy many instances of Superna
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to delete their Superna instances
+    :type username: String
+
+    :param machine_names: The names of the instances to delete. None means all of them.
+    :type machine_names: List
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SUPERNA_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        with metrics.task('superna.delete_batch'):
+            resp['content'] = vmware.delete_many(username, machine_names, logger)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
     else:
+        if resp['content']['failed']:
+            resp['error'] = 'Failed to delete {} instances'.format(len(resp['content']['failed']))
         logger.info('Task complete')
     return resp
 
@@ -116,3 +280,83 @@ def image(self, txn_id):
     resp['content'] = {'image': vmware.list_images()}
     logger.info('Task complete')
     return resp
+
+
+@app.task(name='superna.stats', bind=True)
+def stats(self, txn_id):
+    """Obtain performance counters for the worker process that runs this task
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SUPERNA_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    resp['content'] = {'sessions': session_pool.SESSIONS.stats(),
+                       'images': image_catalog.CATALOG.stats(),
+                       'show_cache': vmware.SHOW_CACHE.stats(),
+                       'waiter': waiter.WAITER.stats(),
+                       'networks': networks.INDEX.stats(),
+                       'folders': folders.USER_FOLDERS.stats(),
+                       'tracing': tracing.EXPORTER.stats(),
+                       'admission': admission.ADMISSION.stats(),
+                       'warm_pool': warm_pool.stats()}
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='superna.templates', bind=True)
+def template_registry(self, txn_id, rebuild=False):
+    """Discover the Superna templates used by the "template" deploy mode, and
+    optionally (re)build any that are missing or out of date.
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+
+    :param rebuild: Set to True to build templates for every available image
+    :type rebuild: Boolean
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SUPERNA_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        resp['content'] = {'templates': vmware.sync_templates(rebuild, logger)}
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        logger.info('Task complete')
+    return resp
+
+
+@app.task(name='superna.refill_pool', bind=True)
+def refill_pool(self, txn_id, version=None):
+    """Pre-deploy enough VMs to bring the warm pool back up to its target size
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+
+    :param version: Only refill the pool for this version of Superna. Default is every version.
+    :type version: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_SUPERNA_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    if version is None:
+        versions = image_catalog.CATALOG.versions()
+    else:
+        versions = [version]
+    try:
+        resp['content'] = {'staged': {x: warm_pool.refill(x, logger) for x in versions}}
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        logger.info('Task complete')
+    return resp
@@ -0,0 +1,433 @@
+# -*- coding: UTF-8 -*-
+"""
+Deploy Superna by cloning a template, instead of importing the OVA every time.
+
+Each version of Superna is imported once into ``VLAB_SUPERNA_TEMPLATE_DIR`` as a
+template. New VMs are cloned from that template, which is a copy within the
+datastore (or, for linked clones, just a new delta disk) instead of streaming
+the whole OVA over HTTP NFC.
+
+When the OVA of a version changes, the old template is renamed (retired), not
+destroyed, because linked clones still use its snapshot. Remove retired
+templates by hand once no VMs use them.
+"""
+import os
+import re
+import time
+import random
+import threading
+from collections import defaultdict
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim, virtual_machine
+
+from vlab_superna_api.lib import const, image_catalog, tracing
+from vlab_superna_api.lib.worker import admission, folders, inventory, networks, nfc, progress
+from vlab_superna_api.lib.worker.waiter import wait_task
+
+HOSTNAME_REGEX = r'^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$'
+TEMPLATE_COMPONENT = 'SupernaTemplate'
+RETIRED_MARKER = '-retired-'
+SNAPSHOT_NAME = 'base'
+
+# version -> {'moref': String, 'meta': Dictionary}; only the id of the VM is
+# kept, because the session that found it may be closed by the next lookup
+_REGISTRY = {}
+_LOCKS = defaultdict(threading.Lock)
+
+
+def template_name(version):
+    """Centralizes the naming of templates
+
+    :Returns: String
+
+    :param version: The version of Superna
+    :type version: String
+    """
+    return 'SupernaTemplate-{}'.format(version)
+
+
+def _bind(moref, vcenter):
+    """Make the template VM with a managed object id, using the caller's session
+
+    :Returns: vim.VirtualMachine
+
+    :param moref: The managed object id of the VM, i.e. ``vm-123``
+    :type moref: String
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    return vim.VirtualMachine(moref, stub=vcenter._conn._stub)
+
+
+def template_folder(vcenter):
+    """Obtain the folder that holds the templates, creating it if needed
+
+    :Returns: vim.Folder
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    return inventory.vm_folder(vcenter, const.VLAB_SUPERNA_TEMPLATE_DIR)
+
+
+def list_templates(vcenter):
+    """Discover the Superna templates that exist in vCenter. Refreshes the
+    in-process registry as a side effect.
+
+    :Returns: Dictionary, mapping version to the template VM & its meta data
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    folder = template_folder(vcenter)
+    found = {}
+    vms = inventory.folder_vms(vcenter, folder, properties=['name', 'config.annotation', 'network'])
+    for vm, props in vms.items():
+        meta = inventory.parse_meta(props.get('config.annotation'))
+        # Retired templates keep their meta data, but not their name
+        if meta['component'] == TEMPLATE_COMPONENT and props.get('name') == template_name(meta['version']):
+            found[meta['version']] = {'vm': vm, 'meta': meta}
+    _REGISTRY.clear()
+    _REGISTRY.update({x: {'moref': y['vm']._moId, 'meta': y['meta']} for x, y in found.items()})
+    return found
+
+
+def is_current(meta, image_info):
+    """Check if a template was built from the OVA that's currently in the images dir
+
+    :Returns: Boolean
+
+    :param meta: The meta data of the template
+    :type meta: Dictionary
+
+    :param image_info: The details about the OVA, from the image catalog
+    :type image_info: Dictionary
+    """
+    return meta.get('ova_mtime') == image_info['mtime'] and meta.get('ova_size') == image_info['size']
+
+
+def ensure_template(vcenter, version, image_info, logger):
+    """Obtain the template for a version of Superna, building (or rebuilding if
+    the OVA changed) it as needed.
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param version: The version of Superna
+    :type version: String
+
+    :param image_info: The details about the OVA, from the image catalog
+    :type image_info: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    with _LOCKS[version]:
+        known = _REGISTRY.get(version, None)
+        if known is not None and is_current(known['meta'], image_info):
+            return _bind(known['moref'], vcenter)
+        # _LOCKS only covers this process; the slot keeps every other worker
+        # from building the same template at the same time
+        with admission.ADMISSION.slots([('template', version, 1)], logger):
+            # Another worker might have already built it
+            list_templates(vcenter)
+            known = _REGISTRY.get(version, None)
+            if known is not None and is_current(known['meta'], image_info):
+                return _bind(known['moref'], vcenter)
+            if known is not None:
+                logger.info('OVA for version {} changed; rebuilding template'.format(version))
+                retire_template(vcenter, version, known)
+            return build_template(vcenter, version, image_info, logger)
+
+
+def retire_template(vcenter, version, known):
+    """Rename an outdated template, so a new one can take its name. It's not
+    destroyed, because linked clones still use its snapshot.
+
+    :Returns: None
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param version: The version of Superna
+    :type version: String
+
+    :param known: The registry entry of the template
+    :type known: Dictionary
+    """
+    new_name = '{}{}{}'.format(template_name(version), RETIRED_MARKER, int(time.time()))
+    wait_task(_bind(known['moref'], vcenter).Rename_Task(newName=new_name))
+    _REGISTRY.pop(version, None)
+
+
+def discard(the_vm, machine_name, logger):
+    """Destroy a VM that failed to be made, so it doesn't block the next try.
+    Never raises; the original error is the one worth reporting.
+
+    :Returns: None
+
+    :param the_vm: The half-made VM
+    :type the_vm: vim.VirtualMachine
+
+    :param machine_name: The name of the VM, for logging
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    try:
+        wait_task(the_vm.Destroy_Task())
+    except vmodl.fault.ManagedObjectNotFound:
+        # Aborting the NFC lease already removed it
+        pass
+    except Exception as doh:
+        logger.error('Unable to destroy half-made VM {}: {}'.format(machine_name, doh))
+
+
+def build_template(vcenter, version, image_info, logger):
+    """Import an OVA, and convert it into a template
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param version: The version of Superna
+    :type version: String
+
+    :param image_info: The details about the OVA, from the image catalog
+    :type image_info: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    logger.info('Building template for Superna version {}'.format(version))
+    folder = template_folder(vcenter)
+    network = networks.lookup(vcenter, const.VLAB_SUPERNA_TEMPLATE_NETWORK)
+    network_map = vim.OvfManager.NetworkMapping()
+    network_map.name = image_info['networks'][0]
+    network_map.network = network
+    ova_file = os.path.join(const.VLAB_SUPERNA_IMAGES_DIR, image_info['file'])
+    the_vm = import_ova(vcenter, ova_file, [network_map], folder, template_name(version), logger)
+    meta_data = {'component' : TEMPLATE_COMPONENT,
+                 'created' : time.time(),
+                 'version' : version,
+                 'configured' : False,
+                 'generation' : 1,
+                 'ova_mtime' : image_info['mtime'],
+                 'ova_size' : image_info['size']}
+    try:
+        virtual_machine.set_meta(the_vm, meta_data)
+        # Linked clones need a snapshot to hang their delta disks off of
+        wait_task(the_vm.CreateSnapshot_Task(name=SNAPSHOT_NAME,
+                                             description='Base for linked clones',
+                                             memory=False,
+                                             quiesce=False))
+        the_vm.MarkAsTemplate()
+    except Exception:
+        discard(the_vm, template_name(version), logger)
+        raise
+    _REGISTRY[version] = {'moref': the_vm._moId, 'meta': meta_data}
+    return the_vm
+
+
+def import_ova(vcenter, ova_file, network_map, folder, machine_name, logger, report_progress=progress.no_progress):
+    """Like ``virtual_machine.deploy_from_ova``, but into any folder, not just the
+    folder of a user, and the disks are uploaded in parallel (see nfc.py).
+
+    :Returns: vim.VirtualMachine
+
+    :Raises: ValueError if the machine name is invalid
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param ova_file: The path to the OVA to import
+    :type ova_file: String
+
+    :param network_map: The mapping of networks defined in the OVA with what's
+                        available in vCenter.
+    :type network_map: List of vim.OvfManager.NetworkMapping
+
+    :param folder: The folder to create the VM in
+    :type folder: vim.Folder
+
+    :param machine_name: The unique name to give the new VM
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param report_progress: Called with the bytes uploaded, for the client to see
+    :type report_progress: Function
+    """
+    if not re.match(HOSTNAME_REGEX, machine_name):
+        error = 'Invalid machine name. Names can only contain characters a-z, A-Z, 0-9, periods (".") and dashes ("-"). Supplied: {}'.format(machine_name)
+        raise ValueError(error)
+    resource_pool = vcenter.resource_pools[const.INF_VCENTER_RESORUCE_POOL]
+    datastore = pick_datastore(vcenter)
+    all_hosts = {x: y for x, y in vcenter.host_systems.items() if not y.runtime.inMaintenanceMode}
+    # The host with the fewest imports running (or waiting) gets the next one
+    host_name = admission.ADMISSION.least_busy('host', sorted(all_hosts.keys()))
+    host = all_hosts[host_name]
+    spec_params = vim.OvfManager.CreateImportSpecParams(entityName=machine_name,
+                                                        diskProvisioning='thin',
+                                                        networkMapping=network_map)
+    with tracing.span('ova_parse', ova=ova_file):
+        manifest = image_catalog.manifest(ova_file)
+    resources = [('datastore', datastore.name, const.VLAB_SUPERNA_IMPORTS_PER_DATASTORE),
+                 ('host', host_name, const.VLAB_SUPERNA_IMPORTS_PER_HOST)]
+    # The NFC lease times out if the upload doesn't start soon, so wait for
+    # the slots before asking for it
+    with admission.ADMISSION.slots(resources, logger, report_progress=report_progress):
+        spec = vcenter.ovf_manager.CreateImportSpec(ovfDescriptor=manifest['ovf'],
+                                                    resourcePool=resource_pool,
+                                                    datastore=datastore,
+                                                    cisp=spec_params)
+        lease = virtual_machine._get_lease(resource_pool, spec.importSpec, folder, host)
+        # Once the lease is complete it's gone, so grab the new VM while we can
+        the_vm = lease.info.entity
+        logger.debug('Uploading OVA')
+        try:
+            nfc.upload(lease, spec.fileItem, ova_file, manifest['disks'], host.name, logger,
+                       report_progress=report_progress)
+        except Exception:
+            discard(the_vm, machine_name, logger)
+            raise
+    logger.debug('OVA deployed successfully')
+    return the_vm
+
+
+def pick_datastore(vcenter):
+    """Choose where a new VM's disks should live, the same way ``deploy_from_ova`` does
+
+    :Returns: vim.Datastore
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    datastore = vcenter.datastores[random.choice(const.INF_VCENTER_DATASTORE.split(','))]
+    if isinstance(datastore, vim.StoragePod):
+        datastore = random.choice(datastore.childEntity)
+    return datastore
+
+
+def clone(vcenter, the_template, folder, machine_name, network, linked=False):
+    """Create a new, powered off, VM from a template
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_template: The template to clone
+    :type the_template: vim.VirtualMachine
+
+    :param folder: The folder to create the new VM in
+    :type folder: vim.Folder
+
+    :param machine_name: The unique name to give the new VM
+    :type machine_name: String
+
+    :param network: The network to connect the new VM to
+    :type network: vim.Network
+
+    :param linked: Set to True to make a linked clone off the template's snapshot
+    :type linked: Boolean
+    """
+    if not re.match(HOSTNAME_REGEX, machine_name):
+        error = 'Invalid machine name. Names can only contain characters a-z, A-Z, 0-9, periods (".") and dashes ("-"). Supplied: {}'.format(machine_name)
+        raise ValueError(error)
+    relocate = vim.vm.RelocateSpec()
+    relocate.pool = vcenter.resource_pools[const.INF_VCENTER_RESORUCE_POOL]
+    spec = vim.vm.CloneSpec(location=relocate, powerOn=False, template=False)
+    snapshot = the_template.snapshot
+    if linked and snapshot:
+        relocate.diskMoveType = 'createNewChildDiskBacking'
+        spec.snapshot = snapshot.currentSnapshot
+    else:
+        relocate.datastore = pick_datastore(vcenter)
+    # The template's notes are its own meta data; don't let the clone inherit them
+    spec.config = vim.vm.ConfigSpec(annotation='', deviceChange=[_nic_spec(the_template, network)])
+    return wait_task(the_template.CloneVM_Task(folder=folder, name=machine_name, spec=spec))
+
+
+def _nic_spec(the_vm, network):
+    """Make the spec that connects the first NIC of a VM to a network. Putting this
+    in the clone spec avoids a separate reconfigure task after the clone.
+
+    :Returns: vim.vm.device.VirtualDeviceSpec
+
+    :param the_vm: The VM with the NIC
+    :type the_vm: vim.VirtualMachine
+
+    :param network: The network to connect to
+    :type network: vim.dvs.DistributedVirtualPortgroup
+    """
+    nics = [x for x in the_vm.config.hardware.device if isinstance(x, vim.vm.device.VirtualEthernetCard)]
+    if not nics:
+        raise RuntimeError('Template {} has no network adapter'.format(the_vm.name))
+    nicspec = vim.vm.device.VirtualDeviceSpec()
+    nicspec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+    nicspec.device = nics[0]
+    dvs_port_connection = vim.dvs.PortConnection()
+    dvs_port_connection.portgroupKey = network.key
+    dvs_port_connection.switchUuid = network.config.distributedVirtualSwitch.uuid
+    nicspec.device.backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
+    nicspec.device.backing.port = dvs_port_connection
+    nicspec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+    nicspec.device.connectable.startConnected = True
+    nicspec.device.connectable.allowGuestControl = True
+    nicspec.device.connectable.connected = True
+    return nicspec
+
+
+def deploy(vcenter, username, machine_name, version, image_info, network, logger):
+    """Create a new, powered off, instance of Superna from a template
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param username: The name of the user who wants to create a new Superna
+    :type username: String
+
+    :param machine_name: The name of the new instance of Superna
+    :type machine_name: String
+
+    :param version: The version of Superna
+    :type version: String
+
+    :param image_info: The details about the OVA, from the image catalog
+    :type image_info: Dictionary
+
+    :param network: The network to connect the new VM to
+    :type network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    folder = folders.user_folder(vcenter, username)
+    linked = bool(const.VLAB_SUPERNA_LINKED_CLONE)
+    the_template = ensure_template(vcenter, version, image_info, logger)
+    logger.info('Cloning template {}'.format(template_name(version)))
+    try:
+        return clone(vcenter, the_template, folder, machine_name, network, linked=linked)
+    except vmodl.fault.ManagedObjectNotFound:
+        # Somebody deleted the template out from under our registry
+        _REGISTRY.pop(version, None)
+        the_template = ensure_template(vcenter, version, image_info, logger)
+        return clone(vcenter, the_template, folder, machine_name, network, linked=linked)
+
+
+def registry():
+    """Describe the templates this process knows about
+
+    :Returns: Dictionary
+    """
+    return {version: {'name': template_name(version), 'meta': info['meta']} for version, info in _REGISTRY.items()}
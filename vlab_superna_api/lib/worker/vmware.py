@@ -3,11 +3,28 @@
 import time
 import random
 import os.path
-from vlab_inf_common.vmware import vCenter, Ova, vim, virtual_machine, consume_task
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
-from vlab_superna_api.lib import const
+from vlab_inf_common.vmware import vim, virtual_machine
 
+from vlab_superna_api.lib import const, image_catalog, metrics
+from vlab_superna_api.lib.image_catalog import convert_name
+from vlab_superna_api.lib.ttl_cache import SharedTTLCache
+from vlab_superna_api.lib.worker import folders, inventory, networks, progress, templates, warm_pool, waiter
+from vlab_superna_api.lib.worker.session_pool import vcenter_session, reauthenticate
+from vlab_superna_api.lib.worker.waiter import wait_task
 
+# The UI polls superna.show every few seconds; this keeps each poll from being
+# a walk of the user's folder. Creates and deletes run in the slow worker, but
+# shows in the fast one, so tasks.py shares the invalidations through the
+# result backend. With ``rpc://`` it can't, and a show may be stale for up to
+# VLAB_SUPERNA_SHOW_CACHE_TTL seconds after a change.
+SHOW_CACHE = SharedTTLCache(max_size=const.VLAB_SUPERNA_SHOW_CACHE_SIZE, ttl=const.VLAB_SUPERNA_SHOW_CACHE_TTL,
+                            prefix='superna-show-')
+
+
+@reauthenticate
 def show_superna(username):
     """Obtain basic information about Superna
 
@@ -16,18 +33,26 @@ def show_superna(username):
     :param username: The user requesting info about their Superna
     :type username: String
     """
-    info = {}
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+    superna_vms = SHOW_CACHE.get(username)
+    if superna_vms is not None:
+        return superna_vms
+    generation = SHOW_CACHE.generation(username)
+    with vcenter_session() as vcenter:
+        with metrics.phase('find_folder'):
+            folder = folders.user_folder(vcenter, username)
+        console = inventory.ConsoleUrls(vcenter)
         superna_vms = {}
-        for vm in folder.childEntity:
-            info = virtual_machine.get_info(vcenter, vm, username)
-            if info['meta']['component'] == 'Superna':
-                superna_vms[vm.name] = info
+        with metrics.phase('list_vms'):
+            for vm, props in inventory.folder_vms(vcenter, folder).items():
+                # Check the meta data first, so we only build the (costly) console
+                # URL for the VMs we actually return
+                if inventory.parse_meta(props.get('config.annotation'))['component'] == 'Superna':
+                    superna_vms[props['name']] = inventory.vm_info(vm, props, username, console)
+    SHOW_CACHE.set(username, superna_vms, generation=generation)
     return superna_vms
 
 
+@reauthenticate
 def delete_superna(username, machine_name, logger):
     """Unregister and destroy a user's Superna
 
@@ -42,24 +67,84 @@ def delete_superna(username, machine_name, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                info = virtual_machine.get_info(vcenter, entity, username)
-                if info['meta']['component'] == 'Superna':
-                    logger.debug('powering off VM')
-                    virtual_machine.power(entity, state='off')
-                    delete_task = entity.Destroy_Task()
-                    logger.debug('blocking while VM is being destroyed')
-                    consume_task(delete_task)
-                    break
-        else:
+    with vcenter_session() as vcenter:
+        with metrics.phase('find_folder'):
+            folder = folders.user_folder(vcenter, username)
+        with metrics.phase('find_vm'):
+            found = inventory.find_vm(vcenter, folder, machine_name, properties=['config.annotation', 'runtime.powerState'])
+        if found is None or inventory.parse_meta(found[1].get('config.annotation'))['component'] != 'Superna':
             raise ValueError('No {} named {} found'.format('superna', machine_name))
+        the_vm, props = found
+        if props.get('runtime.powerState') != vim.VirtualMachinePowerState.poweredOff:
+            logger.debug('powering off VM')
+            with metrics.phase('power_off'):
+                waiter.power(the_vm, state='off')
+        with metrics.phase('destroy'):
+            delete_task = the_vm.Destroy_Task()
+            logger.debug('blocking while VM is being destroyed')
+            wait_task(delete_task)
+        SHOW_CACHE.pop(username)
+
+
+@reauthenticate
+def delete_many(username, machine_names, logger):
+    """Destroy many of a user's Superna instances at once. The VMs are powered
+    off in parallel, then destroyed in parallel.
+
+    :Returns: Dictionary
 
+    :param username: The user who wants to delete their Superna instances
+    :type username: String
+
+    :param machine_names: The names of the VMs to delete. Set to None to delete every Superna the user owns.
+    :type machine_names: List
 
-def create_superna(username, machine_name, image, network, ip_config, logger):
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    answer = {'deleted': [], 'failed': {}}
+    with vcenter_session() as vcenter:
+        with metrics.phase('find_folder'):
+            folder = folders.user_folder(vcenter, username)
+        with metrics.phase('list_vms'):
+            vms = inventory.folder_vms(vcenter, folder, properties=['name', 'runtime.powerState', 'config.annotation', 'network'])
+        targets = {}
+        for vm, props in vms.items():
+            if inventory.parse_meta(props.get('config.annotation'))['component'] != 'Superna':
+                continue
+            if machine_names is None or props['name'] in machine_names:
+                targets[props['name']] = (vm, props)
+        for name in machine_names or []:
+            if name not in targets:
+                answer['failed'][name] = 'No {} named {} found'.format('superna', name)
+
+        power_tasks = {}
+        with metrics.phase('power_off'):
+            for name, (vm, props) in targets.items():
+                if props.get('runtime.powerState') != vim.VirtualMachinePowerState.poweredOff:
+                    power_tasks[vm.PowerOffVM_Task()] = name
+            logger.debug('powering off {} VMs'.format(len(power_tasks)))
+            power_results = waiter.wait_for_tasks(list(power_tasks.keys()))
+        for task, error in power_results.items():
+            if error is not None:
+                answer['failed'][power_tasks[task]] = error
+                targets.pop(power_tasks[task])
+
+        with metrics.phase('destroy'):
+            destroy_tasks = {vm.Destroy_Task(): name for name, (vm, _) in targets.items()}
+            logger.debug('blocking while {} VMs are being destroyed'.format(len(destroy_tasks)))
+            destroy_results = waiter.wait_for_tasks(list(destroy_tasks.keys()))
+        for task, error in destroy_results.items():
+            if error is None:
+                answer['deleted'].append(destroy_tasks[task])
+            else:
+                answer['failed'][destroy_tasks[task]] = error
+    answer['deleted'].sort()
+    SHOW_CACHE.pop(username)
+    return answer
+
+
+def create_superna(username, machine_name, image, network, ip_config, logger, report_progress=progress.no_progress):
     """Deploy a new instance of Superna
 
     :Returns: Dictionary
@@ -81,67 +166,213 @@ def create_superna(username, machine_name, image, network, ip_config, logger):
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
+
+    :param report_progress: Called with each step of the create, for the client to see
+    :type report_progress: Function
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        image_name = convert_name(image)
+    with vcenter_session() as vcenter:
+        image_info = image_catalog.CATALOG.get(image)
+        if image_info is None:
+            raise ValueError('No such image/version of Superna: {}'.format(image))
+        image_name = image_info['file']
         logger.info(image_name)
-        ova = Ova(os.path.join(const.VLAB_SUPERNA_IMAGES_DIR, image_name))
-        try:
-            network_map = vim.OvfManager.NetworkMapping()
-            network_map.name = ova.networks[0]
-            try:
-                network_map.network = vcenter.networks[network]
-            except KeyError:
-                raise ValueError('No such network named {}'.format(network))
-            the_vm = virtual_machine.deploy_from_ova(vcenter=vcenter,
-                                                     ova=ova,
-                                                     network_map=[network_map],
-                                                     username=username,
-                                                     machine_name=machine_name,
-                                                     logger=logger,
-                                                     power_on=False)
-        finally:
-            ova.close()
-
-        logger.info("Setting vApp parameters")
+        with metrics.phase('find_network'):
+            the_network = networks.lookup(vcenter, network)
+        with metrics.phase('deploy'):
+            the_vm = _deploy(vcenter, username, machine_name, image, image_info, the_network, logger,
+                             report_progress=report_progress)
+        info = _configure(vcenter, the_vm, username, image, ip_config, logger, report_progress=report_progress)
+        SHOW_CACHE.pop(username)
+        return  {the_vm.name: info}
+
+
+def create_batch(username, machines, image, network, logger):
+    """Deploy many instances of Superna that share an image and network.
+
+    The whole batch uses one vCenter session, and the OVA is only read once: it's
+    imported as a template (if needed) and every VM is cloned from it, regardless
+    of VLAB_SUPERNA_DEPLOY_MODE. At most VLAB_SUPERNA_BATCH_CONCURRENCY VMs are
+    deployed at the same time.
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if the image or network does not exist
+
+    :param username: The name of the user who wants to create the new Superna instances
+    :type username: String
+
+    :param machines: The name and IPv4 network config of each new instance
+    :type machines: List of Dictionaries, like {'name': 'superna1', 'ip-config': {...}}
+
+    :param image: The image/version of Superna to create
+    :type image: String
+
+    :param network: The name of the network to connect the new Superna instances up to
+    :type network: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    image_info = image_catalog.CATALOG.get(image)
+    if image_info is None:
+        raise ValueError('No such image/version of Superna: {}'.format(image))
+    answer = {'created': {}, 'failed': {}}
+    with vcenter_session() as vcenter:
+        with metrics.phase('find_network'):
+            the_network = networks.lookup(vcenter, network)
+
+        def create_one(machine):
+            with metrics.phase('deploy'):
+                the_vm = _deploy(vcenter, username, machine['name'], image, image_info, the_network, logger, mode='template')
+            return _configure(vcenter, the_vm, username, image, machine['ip-config'], logger)
+
+        with ThreadPoolExecutor(max_workers=max(const.VLAB_SUPERNA_BATCH_CONCURRENCY, 1)) as executor:
+            # Each VM runs in the context of the task, so its phases get the task's labels
+            futures = {x['name']: executor.submit(contextvars.copy_context().run, create_one, x) for x in machines}
+            for machine_name, future in futures.items():
+                try:
+                    answer['created'][machine_name] = future.result()
+                except Exception as doh:
+                    # One bad VM shouldn't lose the results of the rest of the batch
+                    logger.error('Failed to create {}: {}'.format(machine_name, doh))
+                    answer['failed'][machine_name] = '{}'.format(doh)
+    SHOW_CACHE.pop(username)
+    return answer
+
+
+def _configure(vcenter, the_vm, username, image, ip_config, logger, report_progress=progress.no_progress):
+    """Set the vApp parameters of a newly deployed Superna, and boot it
+
+    :Returns: Dictionary
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The new, powered off, Superna
+    :type the_vm: vim.VirtualMachine
+
+    :param username: The name of the user who owns the new Superna
+    :type username: String
+
+    :param image: The image/version of Superna that was deployed
+    :type image: String
+
+    :param ip_config: The IPv4 network configuration for the Superna instance.
+    :type ip_config: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param report_progress: Called with each step of the create, for the client to see
+    :type report_progress: Function
+    """
+    logger.info("Setting vApp parameters")
+    report_progress(progress.CONFIGURING)
+    with metrics.phase('reconfigure'):
         add_unique_params(the_vm, ip_config)
-        virtual_machine.power(the_vm, state='on')
-        virtual_machine.block_on_boot(the_vm)
-        meta_data = {'component' : "Superna",
-                     'created' : time.time(),
-                     'version' : image,
-                     'configured' : False,
-                     'generation' : 1}
+    report_progress(progress.POWERING_ON)
+    with metrics.phase('power_on'):
+        waiter.power(the_vm, state='on')
+    report_progress(progress.WAITING_FOR_BOOT)
+    with metrics.phase('boot_wait'):
+        waiter.wait_for_boot(the_vm)
+    meta_data = {'component' : "Superna",
+                 'created' : time.time(),
+                 'version' : image,
+                 'configured' : False,
+                 'generation' : 1}
+    with metrics.phase('set_meta'):
         virtual_machine.set_meta(the_vm, meta_data)
-        info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
-        return  {the_vm.name: info}
+    report_progress(progress.WAITING_FOR_IP)
+    with metrics.phase('ip_wait'):
+        waiter.wait_for_ip(the_vm)
+    with metrics.phase('get_info'):
+        return virtual_machine.get_info(vcenter, the_vm, username)
 
 
-def list_images():
-    """Obtain a list of available versions of Superna that can be created
+def _deploy(vcenter, username, machine_name, image, image_info, the_network, logger, mode=None,
+            report_progress=progress.no_progress):
+    """Obtain a new, powered off VM for the user; from the warm pool if one is
+    available, otherwise from a template or the OVA (per VLAB_SUPERNA_DEPLOY_MODE).
 
-    :Returns: List
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param username: The name of the user who wants to create a new Superna
+    :type username: String
+
+    :param machine_name: The name of the new instance of Superna
+    :type machine_name: String
+
+    :param image: The image/version of Superna to create
+    :type image: String
+
+    :param image_info: The details about the OVA, from the image catalog
+    :type image_info: Dictionary
+
+    :param the_network: The network to connect the new Superna instance up to
+    :type the_network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param mode: Overrides VLAB_SUPERNA_DEPLOY_MODE
+    :type mode: String
+
+    :param report_progress: Called with each step of the create, for the client to see
+    :type report_progress: Function
     """
-    images = os.listdir(const.VLAB_SUPERNA_IMAGES_DIR)
-    images = [convert_name(x, to_version=True) for x in images]
-    return images
+    report_progress(progress.DEPLOYING)
+    if mode is None:
+        mode = const.VLAB_SUPERNA_DEPLOY_MODE
+    if warm_pool.target_size(image) > 0:
+        the_vm = warm_pool.claim(vcenter, username, machine_name, image, the_network, logger)
+        if the_vm is not None:
+            return the_vm
+        logger.info('Warm pool for {} is empty'.format(image))
+    if mode == 'template':
+        return templates.deploy(vcenter, username, machine_name, image, image_info, the_network, logger)
+    network_map = vim.OvfManager.NetworkMapping()
+    network_map.name = image_info['networks'][0]
+    network_map.network = the_network
+    folder = folders.user_folder(vcenter, username)
+    ova_file = os.path.join(const.VLAB_SUPERNA_IMAGES_DIR, image_info['file'])
+    return templates.import_ova(vcenter, ova_file, [network_map], folder, machine_name, logger,
+                                report_progress=report_progress)
+
+
+def sync_templates(rebuild, logger):
+    """Discover the templates used by the "template" deploy mode
 
+    :Returns: Dictionary
 
-def convert_name(name, to_version=False):
-    """This function centralizes converting between the name of the OVA, and the
-    version of software it contains.
+    :param rebuild: Set to True to build templates that are missing or out of date
+    :type rebuild: Boolean
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    images = image_catalog.CATALOG.images()
+    with vcenter_session() as vcenter:
+        if rebuild:
+            for version, image_info in images.items():
+                templates.ensure_template(vcenter, version, image_info, logger)
+        else:
+            templates.list_templates(vcenter)
+    answer = templates.registry()
+    for version, info in answer.items():
+        info['current'] = version in images and templates.is_current(info['meta'], images[version])
+    return answer
 
-    :param name: The thing to covert
-    :type name: String
 
-    :param to_version: Set to True to covert the name of an OVA to the version
-    :type to_version: Boolean
+def list_images():
+    """Obtain a list of available versions of Superna that can be created
+
+    :Returns: List
     """
-    if to_version:
-        return name.split('-')[-1].replace('.ova', '')
-    else:
-        return 'Superna_Eyeglass-{}.ova'.format(name)
+    return image_catalog.CATALOG.versions()
 
 
 def add_unique_params(the_vm, ip_config):
@@ -172,4 +403,4 @@ def add_unique_params(the_vm, ip_config):
     spec = vim.vm.ConfigSpec()
     spec.vAppConfig = vapp_spec
     task = the_vm.ReconfigVM_Task(spec)
-    consume_task(task)
+    wait_task(task)
@@ -0,0 +1,518 @@
+# -*- coding: UTF-8 -*-
+"""
+Wait on vCenter tasks and VM state changes without polling.
+
+``consume_task`` and ``block_on_boot`` poll once a second, which is a round
+trip per second per wait, and up to a second of extra latency every time. The
+``Waiter`` instead keeps one PropertyCollector per process, with a filter for
+every object somebody is waiting on, and a single thread blocked in
+``WaitForUpdatesEx``. vCenter pushes the changes, and the waiting threads are
+woken up as soon as the state they want shows up.
+"""
+import os
+import time
+import asyncio
+import threading
+from collections import defaultdict
+
+from pyVmomi import vmodl
+from pyVmomi.VmomiSupport import ManagedObject
+from vlab_inf_common.vmware import vim
+
+from vlab_superna_api.lib import const
+from vlab_superna_api.lib.worker.session_pool import _login
+
+PropertyCollector = vmodl.query.PropertyCollector
+DONE_STATES = (vim.TaskInfo.State.success, vim.TaskInfo.State.error)
+TASK_PROPERTIES = ['info.state', 'info.error', 'info.result']
+VM_PROPERTIES = ['runtime.powerState', 'guest.toolsStatus', 'guest.net']
+MAX_WAIT = 60
+
+
+class _Watch(object):
+    """One caller, waiting for a set of objects to reach the state they want.
+
+    :param objs: The managed objects to wait on
+    :type objs: List
+
+    :param done: Returns True when the properties of an object are in the desired state
+    :type done: Function
+
+    :param on_done: Optional - Called (from the update thread) when the wait is over
+    :type on_done: Function
+    """
+    def __init__(self, objs, done, on_done=None):
+        self.pending = set(objs)
+        self.done = done
+        self.props = {}
+        self.error = None
+        self.event = threading.Event()
+        self._on_done = on_done
+
+    def _finish(self):
+        """Wake up the caller"""
+        self.event.set()
+        if self._on_done is not None:
+            self._on_done()
+
+    def update(self, obj, props):
+        """Check if an object reached the desired state
+
+        :Returns: None
+
+        :param obj: The object that changed
+        :type obj: vmodl.ManagedObject
+
+        :param props: The latest values of the object's properties
+        :type props: Dictionary
+        """
+        if obj in self.pending and self.done(props):
+            self.props[obj] = dict(props)
+            self.pending.discard(obj)
+            if not self.pending:
+                self._finish()
+
+    def fail(self, error):
+        """Wake up the caller, because the wait can never finish
+
+        :Returns: None
+
+        :param error: Why the wait failed
+        :type error: String
+        """
+        self.error = error
+        self._finish()
+
+
+class Waiter(object):
+    """Shares one PropertyCollector, and one thread blocked in ``WaitForUpdatesEx``,
+    between every wait in the process.
+
+    The Waiter uses its own vCenter session (not one from the session pool),
+    since the thread holds it forever. If that session breaks, every pending
+    wait raises RuntimeError and the next wait logs in again.
+
+    :param factory: Creates a new, authenticated, vCenter connection
+    :type factory: Function
+
+    :param max_wait: How long, in seconds, each ``WaitForUpdatesEx`` call blocks for
+    :type max_wait: Integer
+    """
+    def __init__(self, factory=_login, max_wait=MAX_WAIT):
+        self._factory = factory
+        self._max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._vcenter = None
+        self._collector = None
+        self._filters = {}
+        self._known = {}
+        self._watches = defaultdict(list)
+        self._stats = {'waits': 0, 'updates': 0, 'timeouts': 0, 'errors': 0}
+
+    def watch(self, objs, done, timeout):
+        """Block until every object reaches the desired state
+
+        :Returns: Dictionary, mapping each object to its properties
+
+        :Raises: RuntimeError on timeout, or if the connection to vCenter breaks
+
+        :param objs: The tasks and/or VMs to wait on
+        :type objs: List
+
+        :param done: Returns True when the properties of an object are in the desired state
+        :type done: Function
+
+        :param timeout: How many seconds to wait
+        :type timeout: Integer
+        """
+        watch = _Watch(objs, done)
+        try:
+            self._register(watch, objs)
+            if not watch.event.wait(timeout):
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise RuntimeError('Timeout of {} seconds exceeded waiting on {}'.format(timeout, list(watch.pending)))
+            if watch.error:
+                raise RuntimeError(watch.error)
+            return watch.props
+        finally:
+            self._unregister(watch, objs)
+
+    async def watch_async(self, objs, done, timeout):
+        """The same as ``watch``, except the caller's event loop is free while waiting.
+
+        :Returns: Dictionary, mapping each object to its properties
+
+        :Raises: RuntimeError on timeout, or if the connection to vCenter breaks
+
+        :param objs: The tasks and/or VMs to wait on
+        :type objs: List
+
+        :param done: Returns True when the properties of an object are in the desired state
+        :type done: Function
+
+        :param timeout: How many seconds to wait
+        :type timeout: Integer
+        """
+        loop = asyncio.get_event_loop()
+        finished = asyncio.Event()
+        watch = _Watch(objs, done, on_done=lambda: loop.call_soon_threadsafe(finished.set))
+        try:
+            # Creating the filters are SOAP calls, so keep them off the event loop
+            await loop.run_in_executor(None, self._register, watch, objs)
+            try:
+                await asyncio.wait_for(finished.wait(), timeout)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise RuntimeError('Timeout of {} seconds exceeded waiting on {}'.format(timeout, list(watch.pending)))
+            if watch.error:
+                raise RuntimeError(watch.error)
+            return watch.props
+        finally:
+            await loop.run_in_executor(None, self._unregister, watch, objs)
+
+    def _register(self, watch, objs):
+        """Start tracking the objects of a wait
+
+        :Returns: None
+
+        :param watch: The new wait
+        :type watch: _Watch
+
+        :param objs: The tasks and/or VMs to wait on
+        :type objs: List
+        """
+        with self._lock:
+            self._start()
+            self._stats['waits'] += 1
+            for obj in objs:
+                self._watches[obj].append(watch)
+                if obj not in self._filters:
+                    # vCenter sends the current values as the first update
+                    self._filters[obj] = self._collector.CreateFilter(_filter_spec(obj), True)
+                elif obj in self._known:
+                    watch.update(obj, self._known[obj])
+
+    def _unregister(self, watch, objs):
+        """Stop tracking the objects of a wait that's over
+
+        :Returns: None
+
+        :param watch: The wait that's over
+        :type watch: _Watch
+
+        :param objs: The tasks and/or VMs that were waited on
+        :type objs: List
+        """
+        with self._lock:
+            for obj in objs:
+                self._unwatch(obj, watch)
+
+    def stats(self):
+        """Obtain counters about the waits in this process
+
+        :Returns: Dictionary
+        """
+        with self._lock:
+            answer = dict(self._stats)
+            answer['watched'] = len(self._watches)
+        return answer
+
+    def close(self):
+        """Wake up every pending wait, and logout of vCenter
+
+        :Returns: None
+        """
+        with self._lock:
+            self._fail('Waiter closed')
+
+    def _start(self):
+        """Connect to vCenter, and start the update thread, if needed. Must hold the lock."""
+        if self._pid != os.getpid():
+            # Forked; the parent owns the socket and thread, so just forget them
+            self._pid = os.getpid()
+            self._vcenter = None
+            self._collector = None
+            self._filters.clear()
+            self._known.clear()
+            self._watches.clear()
+        if self._collector is None:
+            self._vcenter = self._factory()
+            self._collector = self._vcenter.content.propertyCollector.CreatePropertyCollector()
+            thread = threading.Thread(target=self._run, args=(self._collector,))
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, collector):
+        """The body of the update thread
+
+        :Returns: None
+
+        :param collector: The PropertyCollector this thread services
+        :type collector: vmodl.query.PropertyCollector
+        """
+        version = ''
+        options = PropertyCollector.WaitOptions(maxWaitSeconds=self._max_wait)
+        while True:
+            try:
+                update = collector.WaitForUpdatesEx(version, options)
+            except Exception as doh:
+                with self._lock:
+                    if collector is self._collector:
+                        self._fail('Lost connection to vCenter: {}'.format(doh))
+                return
+            with self._lock:
+                if collector is not self._collector:
+                    # closed, or replaced after a failure
+                    return
+                if update is None:
+                    # maxWaitSeconds elapsed without any change
+                    continue
+                version = update.version
+                self._dispatch(update)
+
+    def _dispatch(self, update):
+        """Record the changed properties, and wake any waits that are done. Must hold the lock.
+
+        :Returns: None
+
+        :param update: The output of ``WaitForUpdatesEx``
+        :type update: vmodl.query.PropertyCollector.UpdateSet
+        """
+        for filter_update in update.filterSet:
+            for obj_update in filter_update.objectSet:
+                self._stats['updates'] += 1
+                # Only the properties that changed are sent
+                props = self._known.setdefault(obj_update.obj, {})
+                for change in obj_update.changeSet:
+                    if change.op in ('remove', 'indirectRemove'):
+                        props.pop(change.name, None)
+                    else:
+                        props[change.name] = change.val
+                for watch in list(self._watches.get(obj_update.obj, [])):
+                    watch.update(obj_update.obj, props)
+
+    def _unwatch(self, obj, watch):
+        """Stop tracking an object once nobody is waiting on it. Must hold the lock.
+
+        :Returns: None
+
+        :param obj: The object that was waited on
+        :type obj: vmodl.ManagedObject
+
+        :param watch: The wait that's done
+        :type watch: _Watch
+        """
+        watches = self._watches.get(obj, [])
+        if watch in watches:
+            watches.remove(watch)
+        if watches:
+            return
+        self._watches.pop(obj, None)
+        self._known.pop(obj, None)
+        the_filter = self._filters.pop(obj, None)
+        if the_filter is not None:
+            try:
+                the_filter.DestroyPropertyFilter()
+            except Exception:
+                # The object (i.e. a destroyed VM) or session might already be gone
+                pass
+
+    def _fail(self, error):
+        """Fail every pending wait, and throw away the connection. Must hold the lock.
+
+        :Returns: None
+
+        :param error: Why the waits failed
+        :type error: String
+        """
+        for watches in self._watches.values():
+            for watch in watches:
+                watch.fail(error)
+        self._watches.clear()
+        self._filters.clear()
+        self._known.clear()
+        if self._vcenter is not None:
+            self._stats['errors'] += 1
+            try:
+                self._vcenter.close()
+            except Exception:
+                pass
+        self._vcenter = None
+        self._collector = None
+
+
+def _filter_spec(obj):
+    """Define the properties to watch on a task or VM
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+
+    :param obj: The object to watch
+    :type obj: vim.Task or vim.VirtualMachine
+    """
+    if isinstance(obj, vim.Task):
+        prop_spec = PropertyCollector.PropertySpec(type=vim.Task, pathSet=TASK_PROPERTIES)
+    else:
+        prop_spec = PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=VM_PROPERTIES)
+    filter_spec = PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [PropertyCollector.ObjectSpec(obj=obj)]
+    filter_spec.propSet = [prop_spec]
+    return filter_spec
+
+
+def _task_done(props):
+    """Check if a task is finished"""
+    return props.get('info.state') in DONE_STATES
+
+
+WAITER = Waiter()
+
+
+def wait_for_tasks(tasks, timeout=600):
+    """Block until every task is done
+
+    :Returns: Dictionary, mapping each task to None if it worked, or the error message if it failed
+
+    :Raises: RuntimeError if the tasks do not finish before the timeout
+
+    :param tasks: The tasks to wait on
+    :type tasks: List of vim.Task
+
+    :param timeout: How many seconds to wait for all the tasks
+    :type timeout: Integer
+    """
+    if not tasks:
+        return {}
+    results = {}
+    for task, props in WAITER.watch(tasks, _task_done, timeout).items():
+        error = props.get('info.error')
+        results[task] = None if error is None else error.msg
+    return results
+
+
+def wait_task(the_task, timeout=600):
+    """A drop in replacement for ``consume_task``
+
+    :Returns: vim.TaskInfo.result
+
+    :Raises: RuntimeError if the task fails, or takes too long
+
+    :param the_task: The task to wait on
+    :type the_task: vim.Task
+
+    :param timeout: How many seconds to wait for the task
+    :type timeout: Integer
+    """
+    props = WAITER.watch([the_task], _task_done, timeout)[the_task]
+    return _task_result(the_task, props)
+
+
+def _task_result(the_task, props):
+    """Obtain the result of a finished task. A managed object (i.e. the VM a
+    clone made) is rebound to the session of the task, so later calls on it
+    don't go over the waiter's own session.
+
+    :Returns: vim.TaskInfo.result
+
+    :Raises: RuntimeError if the task failed
+
+    :param the_task: The task, bound to the caller's session
+    :type the_task: vim.Task
+
+    :param props: The properties the waiter read for the task
+    :type props: Dictionary
+    """
+    if props.get('info.error') is not None:
+        raise RuntimeError(props['info.error'].msg)
+    result = props.get('info.result')
+    if isinstance(result, ManagedObject):
+        return result.__class__(result._moId, stub=the_task._stub)
+    elif isinstance(result, list) and result and isinstance(result[0], ManagedObject):
+        return [x.__class__(x._moId, stub=the_task._stub) for x in result]
+    return result
+
+
+def power(the_vm, state, timeout=600):
+    """A drop in replacement for ``virtual_machine.power``
+
+    :Returns: Boolean
+
+    :param the_vm: The VM to power on/off/restart
+    :type the_vm: vim.VirtualMachine
+
+    :param state: The power state to put the VM into. Valid values are "on" "off" and "restart"
+    :type state: String
+
+    :param timeout: How many seconds to wait for the power state to change
+    :type timeout: Integer
+    """
+    valid_states = {'on', 'off', 'restart'}
+    if state not in valid_states:
+        error = 'state must be one of {}, supplied {}'.format(valid_states, state)
+        raise ValueError(error)
+    vm_power_state = the_vm.runtime.powerState.lower().replace('powered', '')
+    if vm_power_state == state:
+        return True
+    elif (state == 'on') or (vm_power_state == 'off' and state == 'restart'):
+        task = the_vm.PowerOn()
+    elif state == 'off':
+        task = the_vm.PowerOff()
+    else:
+        task = the_vm.ResetVM_Task()
+    try:
+        wait_task(task, timeout=timeout)
+    except RuntimeError:
+        return False
+    return True
+
+
+def wait_for_boot(the_vm, timeout=1800):
+    """A replacement for ``virtual_machine.block_on_boot``; wait until VMware
+    Tools is ready, then for VLAB_SUPERNA_BOOT_SETTLE seconds.
+
+    :Returns: None
+
+    :Raises: RuntimeError if VMware Tools is not ready before the timeout
+
+    :param the_vm: The VM that's booting
+    :type the_vm: vim.VirtualMachine
+
+    :param timeout: How many seconds to wait for VMware Tools
+    :type timeout: Integer
+    """
+    WAITER.watch([the_vm], _tools_ok, timeout)
+    # Superna is still booting after Tools is up, and drops network changes
+    # made before it's done. There's no property that says when it's done.
+    time.sleep(const.VLAB_SUPERNA_BOOT_SETTLE)
+
+
+def _tools_ok(props):
+    """Check if VMware Tools is ready"""
+    return props.get('guest.toolsStatus') == vim.vm.GuestInfo.ToolsStatus.toolsOk
+
+
+def _has_ip(props):
+    """Check if a VM has an IP that's not link-local"""
+    for nic in props.get('guest.net') or []:
+        for ip in nic.ipAddress:
+            if not ip.startswith('fe80::') and not ip.startswith('169.254.'):
+                return True
+    return False
+
+
+def wait_for_ip(the_vm, timeout=600):
+    """Block until a VM has an IP
+
+    :Returns: None
+
+    :Raises: RuntimeError if the VM does not get an IP before the timeout
+
+    :param the_vm: The VM to wait on
+    :type the_vm: vim.VirtualMachine
+
+    :param timeout: How many seconds to wait for the IP
+    :type timeout: Integer
+    """
+    WAITER.watch([the_vm], _has_ip, timeout)
@@ -0,0 +1,321 @@
+# -*- coding: UTF-8 -*-
+"""
+A pool of pre-deployed, powered off, unconfigured Superna VMs.
+
+The VMs wait in ``VLAB_SUPERNA_WARM_POOL_DIR``. When a user creates a Superna,
+one is claimed, renamed, moved into the user's folder and connected to the
+user's network. That skips the import/clone entirely; the pool is refilled
+afterwards by the ``superna.refill_pool`` task, and every
+VLAB_SUPERNA_WARM_POOL_INTERVAL seconds by Celery beat. Beat has to run
+somewhere (i.e. ``celery worker --beat`` on one worker, like the slow worker in
+docker-compose.yml), or the pool is only refilled after a create.
+
+A VM's name says when it started to be deployed. One that still isn't finished
+after VLAB_SUPERNA_WARM_POOL_STAGE_TIMEOUT seconds (i.e. the worker died during
+the import) is destroyed by the next refill, and not counted in the meantime.
+"""
+import os
+import uuid
+import time
+import random
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import ujson
+from vlab_inf_common.vmware import vim, virtual_machine
+
+from vlab_superna_api.lib import const, image_catalog
+from vlab_superna_api.lib.worker import folders, inventory, networks, templates
+from vlab_superna_api.lib.worker.session_pool import vcenter_session, reauthenticate
+from vlab_superna_api.lib.worker.waiter import wait_task
+
+WARM_COMPONENT = 'SupernaWarm'
+NAME_PREFIX = 'SupernaWarm-'
+STAGED_PROPERTIES = ['name', 'config.annotation', 'config.changeVersion', 'network']
+
+_LOCKS = defaultdict(threading.Lock)
+
+
+def target_size(version):
+    """How many pre-deployed VMs to keep for a version of Superna.
+    ``VLAB_SUPERNA_WARM_POOL_SIZES`` (i.e. "2.5.6=3,2.6.0=1") overrides
+    ``VLAB_SUPERNA_WARM_POOL_SIZE`` for specific versions.
+
+    :Returns: Integer
+
+    :param version: The version of Superna
+    :type version: String
+    """
+    for item in const.VLAB_SUPERNA_WARM_POOL_SIZES.split(','):
+        if '=' in item:
+            name, size = item.split('=', 1)
+            if name.strip() == version:
+                return int(size)
+    return const.VLAB_SUPERNA_WARM_POOL_SIZE
+
+
+def enabled():
+    """Check if the warm pool is used for any version of Superna
+
+    :Returns: Boolean
+    """
+    return bool(const.VLAB_SUPERNA_WARM_POOL_SIZE or const.VLAB_SUPERNA_WARM_POOL_SIZES)
+
+
+def staged_name(version):
+    """Make a unique name for a pre-deployed VM, i.e. ``SupernaWarm-2.5.6-1700000000-1a2b3c4d``
+
+    :Returns: String
+
+    :param version: The version of Superna
+    :type version: String
+    """
+    return '{}{}-{}-{}'.format(NAME_PREFIX, version, int(time.time()), uuid.uuid4().hex[:8])
+
+
+def staging_folder(vcenter):
+    """Obtain the folder that holds the pre-deployed VMs
+
+    :Returns: vim.Folder
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    return inventory.vm_folder(vcenter, const.VLAB_SUPERNA_WARM_POOL_DIR)
+
+
+def staged_vms(vcenter):
+    """Find every VM in the staging folder
+
+    :Returns: List of (vim.VirtualMachine, properties, meta data)
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    found = []
+    vms = inventory.folder_vms(vcenter, staging_folder(vcenter), properties=STAGED_PROPERTIES)
+    for vm, props in vms.items():
+        if props.get('name', '').startswith(NAME_PREFIX):
+            found.append((vm, props, inventory.parse_meta(props.get('config.annotation'))))
+    return found
+
+
+def _state(props, meta):
+    """Determine the version and state of a staged VM
+
+    :Returns: Tuple of (version, state)
+
+    :param props: The properties of the staged VM
+    :type props: Dictionary
+
+    :param meta: The meta data of the staged VM
+    :type meta: Dictionary
+    """
+    if meta['component'] != WARM_COMPONENT:
+        # Still being deployed (so the notes aren't set yet), or never will be
+        parts = props['name'][len(NAME_PREFIX):].rsplit('-', 2)
+        if len(parts) == 3 and parts[1].isdigit():
+            if time.time() - int(parts[1]) > const.VLAB_SUPERNA_WARM_POOL_STAGE_TIMEOUT:
+                return parts[0], 'failed'
+            return parts[0], 'pending'
+        # Named before the start time was part of the name; it's long dead
+        return props['name'][len(NAME_PREFIX):].rsplit('-', 1)[0], 'failed'
+    elif meta.get('claimed'):
+        return meta['version'], 'claimed'
+    return meta['version'], 'ready'
+
+
+def occupancy(vcenter):
+    """Report how full the pool is for each version of Superna
+
+    :Returns: Dictionary
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    answer = {}
+    for _, props, meta in staged_vms(vcenter):
+        version, state = _state(props, meta)
+        answer.setdefault(version, {'ready': 0, 'pending': 0, 'claimed': 0, 'failed': 0,
+                                    'target': target_size(version)})
+        answer[version][state] += 1
+    return answer
+
+
+@reauthenticate
+def stats():
+    """Report how full the pool is, for the ``superna.stats`` task. Unlike the
+    other stats, this looks at vCenter, so it's the same from every worker.
+
+    :Returns: Dictionary
+    """
+    if not enabled():
+        return {}
+    with vcenter_session() as vcenter:
+        return occupancy(vcenter)
+
+
+def claim(vcenter, username, machine_name, version, network, logger):
+    """Take a pre-deployed VM out of the pool, and give it to a user.
+
+    :Returns: vim.VirtualMachine, or None if the pool is empty
+
+    :Raises: ValueError if the VM cannot be given to the user (i.e. duplicate name)
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param username: The name of the user who wants to create a new Superna
+    :type username: String
+
+    :param machine_name: The name of the new instance of Superna
+    :type machine_name: String
+
+    :param version: The version of Superna
+    :type version: String
+
+    :param network: The network to connect the new VM to
+    :type network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    candidates = [x for x in staged_vms(vcenter) if _state(x[1], x[2]) == (version, 'ready')]
+    random.shuffle(candidates)
+    for the_vm, props, meta in candidates:
+        claimed = dict(meta)
+        claimed['claimed'] = True
+        # Setting changeVersion makes vCenter reject the reconfig if another
+        # worker changed the VM first, so only one worker can win a claim.
+        spec = vim.vm.ConfigSpec(changeVersion=props['config.changeVersion'],
+                                 annotation=ujson.dumps(claimed))
+        try:
+            wait_task(the_vm.ReconfigVM_Task(spec))
+        except RuntimeError:
+            logger.debug('Lost race to claim {}'.format(props['name']))
+            continue
+        logger.info('Claimed pre-deployed VM {}'.format(props['name']))
+        try:
+            wait_task(the_vm.Rename_Task(machine_name))
+            folder = folders.user_folder(vcenter, username)
+            wait_task(folder.MoveIntoFolder_Task([the_vm]))
+        except RuntimeError as doh:
+            _release(the_vm, props['name'], meta)
+            raise ValueError('Unable to create {}: {}'.format(machine_name, doh))
+        virtual_machine.change_network(the_vm, network)
+        return the_vm
+    return None
+
+
+def _release(the_vm, name, meta):
+    """Put a claimed VM back into the pool
+
+    :Returns: None
+
+    :param the_vm: The claimed VM
+    :type the_vm: vim.VirtualMachine
+
+    :param name: The name the VM had in the staging folder
+    :type name: String
+
+    :param meta: The meta data the VM had in the staging folder
+    :type meta: Dictionary
+    """
+    wait_task(the_vm.Rename_Task(name))
+    wait_task(the_vm.ReconfigVM_Task(vim.vm.ConfigSpec(annotation=ujson.dumps(meta))))
+
+
+def reap(vcenter, version, logger):
+    """Destroy the VMs of a version that failed to be deployed
+
+    :Returns: List of the names of the destroyed VMs
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param version: The version of Superna
+    :type version: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    reaped = []
+    for the_vm, props, meta in staged_vms(vcenter):
+        if _state(props, meta) == (version, 'failed'):
+            logger.info('Destroying pre-deployed VM {}; it was never finished'.format(props['name']))
+            templates.discard(the_vm, props['name'], logger)
+            reaped.append(props['name'])
+    return reaped
+
+
+def stage(version, image_info, logger):
+    """Deploy one unconfigured VM into the staging folder
+
+    :Returns: String, the name of the new VM
+
+    :param version: The version of Superna
+    :type version: String
+
+    :param image_info: The details about the OVA, from the image catalog
+    :type image_info: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    name = staged_name(version)
+    with vcenter_session() as vcenter:
+        folder = staging_folder(vcenter)
+        network = networks.lookup(vcenter, const.VLAB_SUPERNA_TEMPLATE_NETWORK)
+        if const.VLAB_SUPERNA_DEPLOY_MODE == 'template':
+            the_template = templates.ensure_template(vcenter, version, image_info, logger)
+            the_vm = templates.clone(vcenter, the_template, folder, name, network,
+                                     linked=bool(const.VLAB_SUPERNA_LINKED_CLONE))
+        else:
+            network_map = vim.OvfManager.NetworkMapping()
+            network_map.name = image_info['networks'][0]
+            network_map.network = network
+            ova_file = os.path.join(const.VLAB_SUPERNA_IMAGES_DIR, image_info['file'])
+            the_vm = templates.import_ova(vcenter, ova_file, [network_map], folder, name, logger)
+        meta_data = {'component' : WARM_COMPONENT,
+                     'created' : time.time(),
+                     'version' : version,
+                     'configured' : False,
+                     'generation' : 1}
+        try:
+            virtual_machine.set_meta(the_vm, meta_data)
+        except Exception:
+            # Otherwise it counts as pending until the stage timeout
+            templates.discard(the_vm, name, logger)
+            raise
+    logger.info('Pre-deployed {}'.format(name))
+    return name
+
+
+def refill(version, logger):
+    """Deploy enough VMs to bring the pool for a version back up to its target size
+
+    :Returns: List of the names of the new VMs
+
+    :param version: The version of Superna
+    :type version: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    target = target_size(version)
+    image_info = image_catalog.CATALOG.get(version)
+    if target <= 0 or image_info is None:
+        return []
+    # Keeps concurrent refills in this process from over filling the pool
+    with _LOCKS[version]:
+        with vcenter_session() as vcenter:
+            reap(vcenter, version, logger)
+            have = occupancy(vcenter).get(version, {})
+        needed = target - have.get('ready', 0) - have.get('pending', 0)
+        if needed <= 0:
+            return []
+        logger.info('Pre-deploying {} VMs of version {}'.format(needed, version))
+        with ThreadPoolExecutor(max_workers=max(const.VLAB_SUPERNA_WARM_POOL_CONCURRENCY, 1)) as executor:
+            futures = [executor.submit(stage, version, image_info, logger) for _ in range(needed)]
+            return [x.result() for x in futures]